@@ -29,6 +29,8 @@ class config:
     frozen_student_mask_decoder = False
     decoder_point_iters = 5
     get_point_num_per_iter = 1
+    # image encoder only run once per batch for all decoder point iters
+    encode_image_once = True
 
     teacher_trained_model_path = '/root/autodl-tmp/pretrained_models/sam_official_pytorch_weights/sam_vit_h_4b8939.pth'
     student_trained_model_path = ''
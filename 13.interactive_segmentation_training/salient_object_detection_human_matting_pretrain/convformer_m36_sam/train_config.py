@@ -30,6 +30,8 @@ class config:
     mask_threshold = 0.0
     decoder_point_iters = 5
     get_point_num_per_iter = 1
+    # image encoder only run once per batch for all decoder point iters
+    encode_image_once = True
 
     model = light_sam.__dict__[network](**{
         'image_size': input_image_size,
@@ -77,6 +77,12 @@ class config:
 
     save_image_dir = ''
 
+    # generate images and compute fid/is in memory,reference statistics are cached in fid_stats_cache_dir
+    use_streaming_metric = True
+    # save test/generated images in streaming metric mode
+    save_images = False
+    fid_stats_cache_dir = ''
+
     fid_model_batch_size = 512
     fid_model_num_workers = 16
 
@@ -13,7 +13,7 @@ from simpleAICV.text_recognition.char_sets.final_char_table import final_char_ta
 from simpleAICV.text_recognition.char_sets.num_and_alpha_char_table import num_char_table, alpha_char_table
 from simpleAICV.text_recognition.char_sets.common_standard_chinese_char_table import common_standard_chinese_char_first_table, common_standard_chinese_char_second_table, common_standard_chinese_char_third_table
 from simpleAICV.text_recognition.datasets.text_recognition_dataset import CNENTextRecognition
-from simpleAICV.text_recognition.common import RandomScale, RandomGaussianBlur, RandomBrightness, RandomRotate, Distort, Stretch, Perspective, Normalize, KeepRatioResizeTextRecognitionCollater, CTCTextLabelConverter, load_state_dict
+from simpleAICV.text_recognition.common import RandomScale, RandomGaussianBlur, RandomBrightness, RandomRotate, Distort, Stretch, Perspective, Normalize, KeepRatioResize, KeepRatioResizeTextRecognitionCollater, CTCTextLabelConverter, load_state_dict
 
 import torch
 import torchvision.transforms as transforms
@@ -104,6 +104,7 @@ class config:
         ],
         set_type='train',
         str_max_length=str_max_length,
+        converter=converter,
         transform=transforms.Compose([
             RandomScale(scale=[0.8, 1.0], prob=0.5),
             RandomGaussianBlur(sigma=[0.5, 1.5], prob=0.5),
@@ -113,6 +114,7 @@ class config:
             Stretch(prob=0.2),
             Perspective(prob=0.2),
             Normalize(),
+            KeepRatioResize(resize_h=resize_h),
         ]))
 
     # 完整数据集必须在list中第0个位置
@@ -135,13 +137,21 @@ class config:
             set_name=per_sub_val_dataset_name,
             set_type='test',
             str_max_length=str_max_length,
+            converter=converter,
             transform=transforms.Compose([
                 Normalize(),
+                KeepRatioResize(resize_h=resize_h),
             ]))
         val_dataset_list.append(per_sub_val_dataset)
 
-    train_collater = KeepRatioResizeTextRecognitionCollater(resize_h=resize_h)
-    test_collater = KeepRatioResizeTextRecognitionCollater(resize_h=resize_h)
+    train_collater = KeepRatioResizeTextRecognitionCollater(
+        resize_h=resize_h, converter=converter)
+    test_collater = KeepRatioResizeTextRecognitionCollater(
+        resize_h=resize_h, converter=converter)
+
+    # group train images by resized width to reduce padding
+    use_width_bucket_sampler = True
+    width_boundaries = [64, 128, 192, 256, 320, 384, 512, 640]
 
     seed = 0
     # batch_size is total size
@@ -18,12 +18,15 @@ import torch
 
 from simpleAICV.interactive_segmentation.models import segment_anything
 from simpleAICV.interactive_segmentation.common import load_state_dict
+from simpleAICV.interactive_segmentation.interactive_engine import SAMInteractiveEngine
 
 seed = 0
 model_name = 'sam_h'
 trained_model_path = '/root/autodl-tmp/pretrained_models/sam_official_pytorch_weights/sam_vit_h_4b8939.pth'
 input_image_size = 1024
 clip_threshold = 0.5
+# max bytes of cached image embeddings
+cache_max_bytes = 2 * 1024 * 1024 * 1024
 
 os.environ['PYTHONHASHSEED'] = str(seed)
 random.seed(seed)
@@ -46,83 +49,37 @@ else:
     print('No pretrained model load!')
 model.eval()
 
-
-def preprocess_image(image, resize):
-    # PIL image(RGB) to opencv image(RGB)
-    image = np.asarray(image).astype(np.float32)
-
-    origin_image = image.copy()
-    h, w, _ = origin_image.shape
-
-    origin_size = [h, w]
-
-    factor = resize / max(h, w)
-
-    resize_h, resize_w = int(round(h * factor)), int(round(w * factor))
-    image = cv2.resize(image, (resize_w, resize_h))
-
-    # normalize
-    mean = [123.675, 116.28, 103.53]
-    std = [58.395, 57.12, 57.375]
-    image = (image - mean) / std
-
-    padded_img = np.zeros(
-        (max(resize_h, resize_w), max(resize_h, resize_w), 3),
-        dtype=np.float32)
-    padded_img[:resize_h, :resize_w, :] = image
-
-    scale = factor
-    scaled_size = [resize_h, resize_w]
-
-    return origin_image, padded_img, scale, scaled_size, origin_size
+# image embedding is cached by image content,each click only run prompt encoder and mask decoder
+engine = SAMInteractiveEngine(model,
+                              input_image_size=input_image_size,
+                              cache_max_bytes=cache_max_bytes,
+                              cache_on_host=False,
+                              pad_points=False)
 
 
 def predict(image, select_points, mask_out_idx):
 
     assert len(select_points) >= 1, 'no prompt point!'
 
-    origin_image, resized_img, scale, scaled_size, origin_size = preprocess_image(
-        image, input_image_size)
-    resized_img = torch.tensor(resized_img).permute(2, 0, 1).unsqueeze(0)
+    origin_image = np.asarray(image).astype(np.float32)
 
-    resized_input_points = []
-    resized_input_labels = []
+    prompt_points = []
     for per_select_points in select_points:
-        resized_input_points.append([
+        prompt_points.append([
             per_select_points[0][0],
             per_select_points[0][1],
+            per_select_points[1],
         ])
-        resized_input_labels.append([per_select_points[1]])
-    resized_input_points = np.array(resized_input_points) * scale
-    resized_input_labels = np.array(resized_input_labels)
-
-    prompt_points = np.concatenate(
-        [resized_input_points, resized_input_labels], axis=1)
-
-    input_prompt_point = torch.tensor(np.expand_dims(prompt_points,
-                                                     axis=0)).float().cuda()
-
-    batch_prompts = {
-        'prompt_point': input_prompt_point,
-        'prompt_box': None,
-        'prompt_mask': None
-    }
-
-    mask_out_idx = [mask_out_idx]
-
-    with torch.no_grad():
-        batch_mask_outputs, batch_iou_outputs = model(
-            resized_img, batch_prompts, mask_out_idxs=mask_out_idx)
-        masks, iou_preds = batch_mask_outputs, batch_iou_outputs
+    prompt_points = np.array(prompt_points)
 
-    masks = masks.squeeze(dim=0).squeeze(dim=0)
-    masks = masks.numpy().astype(np.float32)
-    masks = masks[:scaled_size[0], :scaled_size[1]]
+    masks, iou_preds = engine.predict(image, [{
+        'prompt_point': prompt_points
+    }],
+                                      mask_out_idxs=[mask_out_idx])
 
-    iou_preds = iou_preds.squeeze(dim=0).squeeze(dim=0)
-    iou_preds = iou_preds.numpy()
+    masks = masks[0, 0]
+    iou_preds = iou_preds[0, 0]
 
-    masks = cv2.resize(masks, (origin_size[1], origin_size[0]))
     masks[masks < clip_threshold] = 0
     masks[masks >= clip_threshold] = 1
 
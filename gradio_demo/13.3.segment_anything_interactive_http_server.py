@@ -0,0 +1,138 @@
+import os
+import sys
+import warnings
+
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(FILE_DIR)
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+warnings.filterwarnings('ignore')
+
+import base64
+import cv2
+import json
+import random
+import numpy as np
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from simpleAICV.interactive_segmentation.models import segment_anything
+from simpleAICV.interactive_segmentation.common import load_state_dict
+from simpleAICV.interactive_segmentation.interactive_engine import SAMInteractiveEngine
+
+seed = 0
+model_name = 'sam_h'
+trained_model_path = '/root/autodl-tmp/pretrained_models/sam_official_pytorch_weights/sam_vit_h_4b8939.pth'
+input_image_size = 1024
+clip_threshold = 0.5
+# max bytes of cached image embeddings
+cache_max_bytes = 2 * 1024 * 1024 * 1024
+
+os.environ['PYTHONHASHSEED'] = str(seed)
+random.seed(seed)
+np.random.seed(seed)
+torch.manual_seed(seed)
+
+model = segment_anything.__dict__[model_name](**{
+    'image_size': input_image_size,
+    'use_gradient_checkpoint': False,
+    'frozen_image_encoder': False,
+    'frozen_prompt_encoder': False,
+    'frozen_mask_decoder': False,
+    'sigmoid_out': False,
+    'binary_mask_out': False,
+    'mask_threshold': 0.0,
+})
+if trained_model_path:
+    load_state_dict(trained_model_path, model)
+else:
+    print('No pretrained model load!')
+if torch.cuda.is_available():
+    model = model.cuda()
+model.eval()
+
+engine = SAMInteractiveEngine(model,
+                              input_image_size=input_image_size,
+                              cache_max_bytes=cache_max_bytes,
+                              cache_on_host=False,
+                              pad_points=False)
+
+
+def decode_image(image_base64):
+    image = np.frombuffer(base64.b64decode(image_base64), dtype=np.uint8)
+    image = cv2.imdecode(image, cv2.IMREAD_COLOR)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    return image
+
+
+def encode_mask(mask):
+    mask = (mask > clip_threshold).astype(np.uint8) * 255
+    _, mask = cv2.imencode('.png', mask)
+    mask = base64.b64encode(mask.tobytes()).decode('utf-8')
+
+    return mask
+
+
+class SAMRequestHandler(BaseHTTPRequestHandler):
+    '''
+    POST /set_image {"image":base64 image file} -> {"image_key":str}
+    POST /predict {"image_key":str,"prompts":[{"prompt_point":[[x,y,label],...],"prompt_box":[x1,y1,x2,y2]},...],"mask_out_idxs":[0]}
+                  -> {"masks":[[base64 png mask,...],...],"iou_preds":[[float,...],...]}
+    GET /cache_info -> engine cache info
+    '''
+
+    def send_json(self, result, status=200):
+        result = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def do_GET(self):
+        if self.path == '/cache_info':
+            self.send_json(engine.cache_info())
+        else:
+            self.send_json({'error': f'unknown path {self.path}'}, status=404)
+
+    def do_POST(self):
+        inputs = self.rfile.read(int(self.headers['Content-Length']))
+        inputs = json.loads(inputs)
+
+        try:
+            if self.path == '/set_image':
+                image = decode_image(inputs['image'])
+                image_key = engine.set_image(image)
+                self.send_json({'image_key': image_key})
+            elif self.path == '/predict':
+                if 'image_key' in inputs.keys():
+                    image_or_key = inputs['image_key']
+                else:
+                    image_or_key = decode_image(inputs['image'])
+                mask_out_idxs = inputs[
+                    'mask_out_idxs'] if 'mask_out_idxs' in inputs.keys(
+                    ) else [0]
+
+                masks, iou_preds = engine.predict(image_or_key,
+                                                  inputs['prompts'],
+                                                  mask_out_idxs=mask_out_idxs)
+
+                masks = [[encode_mask(per_mask) for per_mask in per_masks]
+                         for per_masks in masks]
+                self.send_json({
+                    'masks': masks,
+                    'iou_preds': iou_preds.tolist(),
+                })
+            else:
+                self.send_json({'error': f'unknown path {self.path}'},
+                               status=404)
+        except (AssertionError, KeyError, ValueError) as e:
+            self.send_json({'error': str(e)}, status=400)
+
+
+# local server: http://127.0.0.1:6006/
+server = ThreadingHTTPServer(('0.0.0.0', 6006), SAMRequestHandler)
+server.serve_forever()
@@ -0,0 +1,951 @@
+'''
+batched augmentations which run on the device where the image batch is.
+every op samples random parameters per sample with the same distribution as the cpu ops in common.py/auto_rand_augment.py:
+BatchRandomResizedCrop     <-> TorchRandomResizedCrop
+BatchRandomHorizontalFlip  <-> TorchRandomHorizontalFlip
+BatchColorJitter           <-> TorchColorJitter
+BatchAutoAugment           <-> AutoAugment
+BatchRandAugment           <-> RandAugment
+BatchMeanStdNormalize      <-> TorchMeanStdNormalize
+BatchRandomErasing         <-> RandomErasing
+BatchMixupCutmix           <-> MixupCutmixClassificationCollater
+all ops take and return a batch dict,so they can be combined by transforms.Compose like the cpu ops.
+use DeviceAugmentClassificationCollater to collate uint8 images loaded by datasets with keep_uint8=True and transform=None.
+differences from the cpu ops:
+1.images are rounded to uint8 grid after every op but kept in float32;
+2.geometric ops of AutoAugment/RandAugment always use bilinear interpolation(cpu ops choose bilinear or bicubic randomly).
+'''
+import os
+import sys
+
+BASE_DIR = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(BASE_DIR)
+
+import math
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+from simpleAICV.classification.auto_rand_augment import _LEVEL_DENOM, _RAND_TRANSFORMS, _RAND_INCREASING_TRANSFORMS, _select_rand_weights, auto_augment_policy
+from simpleAICV.classification.common import TorchDeviceMeanStdNormalize
+from simpleAICV.classification.mixupcutmixclassificationcollator import MixupCutmixClassificationCollater, mixup_label
+
+
+class DeviceAugmentClassificationCollater:
+    '''
+    pack uint8 H W 3 images with different sizes into one flat uint8 tensor,
+    image_size:[B,2] (h,w),image_offset:[B] start index of every image in flat tensor.
+    '''
+
+    def __init__(self):
+        pass
+
+    def __call__(self, data):
+        images = [
+            np.ascontiguousarray(s['image'], dtype=np.uint8) for s in data
+        ]
+        labels = [s['label'] for s in data]
+
+        image_sizes = np.array(
+            [[per_image.shape[0], per_image.shape[1]] for per_image in images],
+            dtype=np.int64)
+        image_offsets = np.cumsum([0] +
+                                  [per_image.size for per_image in images])
+
+        batch_images = torch.empty(int(image_offsets[-1]), dtype=torch.uint8)
+        for i, per_image in enumerate(images):
+            batch_images[image_offsets[i]:image_offsets[i + 1]].copy_(
+                torch.from_numpy(per_image.reshape(-1)))
+
+        labels = np.array(labels).astype(np.float32)
+        labels = torch.from_numpy(labels).long()
+
+        return {
+            'image': batch_images,
+            'image_size': torch.from_numpy(image_sizes),
+            'image_offset': torch.from_numpy(image_offsets[:-1]),
+            'label': labels,
+        }
+
+
+def blend(degenerate, images, factor):
+    # same as PIL Image.blend(degenerate, image, factor)
+    images = degenerate + factor * (images - degenerate)
+    images = images.clamp(0, 255)
+
+    return images
+
+
+def rgb_to_grayscale(images):
+    # same as PIL convert('L'):L = R * 299/1000 + G * 587/1000 + B * 114/1000
+    gray_images = 0.299 * images[:, 0:1] + 0.587 * images[:, 1:2] + 0.114 * images[:, 2:3]
+    gray_images = gray_images.round()
+
+    return gray_images
+
+
+def adjust_brightness(images, factor):
+    return blend(torch.zeros_like(images), images, factor).round()
+
+
+def adjust_contrast(images, factor):
+    mean = rgb_to_grayscale(images).mean(dim=(1, 2, 3), keepdim=True)
+    mean = torch.floor(mean + 0.5)
+
+    return blend(mean, images, factor).round()
+
+
+def adjust_saturation(images, factor):
+    return blend(rgb_to_grayscale(images), images, factor).round()
+
+
+def adjust_sharpness(images, factor):
+    # PIL ImageFilter.SMOOTH kernel,border pixels are kept
+    kernel = torch.tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]],
+                          dtype=images.dtype,
+                          device=images.device) / 13.
+    kernel = kernel.view(1, 1, 3, 3).repeat(3, 1, 1, 1)
+    degenerate = F.conv2d(images, kernel, groups=3).round()
+    degenerate = F.pad(degenerate, (1, 1, 1, 1))
+    border_mask = torch.ones_like(degenerate[:, 0:1])
+    border_mask[:, :, 1:-1, 1:-1] = 0
+    degenerate = torch.where(border_mask > 0, images, degenerate)
+
+    return blend(degenerate, images, factor).round()
+
+
+def rgb_to_hsv(images):
+    # images:[B,3,H,W],value range [0,1]
+    r, g, b = images.unbind(dim=1)
+    maxc = torch.max(images, dim=1).values
+    minc = torch.min(images, dim=1).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r).float() * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)).float() * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)).float() * (4.0 + gc - rc)
+    h = (hr + hg + hb) / 6.0 + 1.0
+    h = torch.fmod(h, 1.0)
+
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def hsv_to_rgb(images):
+    h, s, v = images.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(torch.int32) % 6
+    p = torch.clamp(v * (1.0 - s), 0.0, 1.0)
+    q = torch.clamp(v * (1.0 - s * f), 0.0, 1.0)
+    t = torch.clamp(v * (1.0 - s * (1.0 - f)), 0.0, 1.0)
+
+    mask = i.unsqueeze(dim=1) == torch.arange(6, device=i.device).view(
+        -1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    a4 = torch.stack((a1, a2, a3), dim=1)
+
+    return torch.einsum('...ijk,...xijk->...xjk', mask.to(images.dtype), a4)
+
+
+def adjust_hue(images, factor):
+    hsv_images = rgb_to_hsv(images / 255.)
+    h = torch.remainder(hsv_images[:, 0:1] + factor, 1.0)
+    hsv_images = torch.cat([h, hsv_images[:, 1:]], dim=1)
+    images = hsv_to_rgb(hsv_images) * 255.
+
+    return images.round().clamp(0, 255)
+
+
+def auto_contrast(images):
+    # same as PIL ImageOps.autocontrast with cutoff=0
+    min_value = images.amin(dim=(2, 3), keepdim=True)
+    max_value = images.amax(dim=(2, 3), keepdim=True)
+    valid = max_value > min_value
+    scale = 255. / torch.where(valid, max_value - min_value,
+                               torch.ones_like(max_value))
+    outputs = ((images - min_value) * scale).round().clamp(0, 255)
+
+    return torch.where(valid, outputs, images)
+
+
+def equalize(images):
+    # same as PIL ImageOps.equalize,per channel histogram lut
+    b, c, h, w = images.shape
+    flat_images = images.reshape(b * c, h * w).long().clamp(0, 255)
+    hist = torch.zeros((b * c, 256),
+                       dtype=images.dtype,
+                       device=images.device)
+    hist.scatter_add_(1, flat_images, torch.ones_like(flat_images,
+                                                      dtype=images.dtype))
+
+    nonzero = hist > 0
+    last_nonzero_idx = 255 - torch.argmax(nonzero.flip(dims=[1]).int(),
+                                          dim=1,
+                                          keepdim=True)
+    last_nonzero_num = torch.gather(hist, 1, last_nonzero_idx)
+    step = torch.div(hist.sum(dim=1, keepdim=True) - last_nonzero_num,
+                     256,
+                     rounding_mode='floor')
+    valid = (step > 0) & (nonzero.sum(dim=1, keepdim=True) > 1)
+    step = torch.where(valid, step, torch.ones_like(step))
+
+    exclusive_cumsum = torch.cumsum(hist, dim=1) - hist
+    lut = torch.div(torch.div(step, 2, rounding_mode='floor') +
+                    exclusive_cumsum,
+                    step,
+                    rounding_mode='floor').clamp(0, 255)
+    identity_lut = torch.arange(256, dtype=images.dtype,
+                                device=images.device).unsqueeze(0)
+    lut = torch.where(valid, lut, identity_lut)
+
+    outputs = torch.gather(lut, 1, flat_images)
+
+    return outputs.reshape(b, c, h, w)
+
+
+def invert(images):
+    return 255. - images
+
+
+def posterize(images, bits):
+    # bits:[B,1,1,1],keep bits MSB of image
+    factor = torch.pow(2., (8 - bits).clamp(min=0))
+
+    return torch.floor(images / factor) * factor
+
+
+def solarize(images, thresh):
+    return torch.where(images >= thresh, 255. - images, images)
+
+
+def solarize_add(images, add, thresh=128):
+    return torch.where(images < thresh, (images + add).clamp(max=255),
+                       images)
+
+
+def affine(images, matrix, fill):
+    '''
+    matrix:[B,6],PIL Image.transform AFFINE data (a,b,c,d,e,f),
+    output pixel (x,y) comes from input pixel (a*x+b*y+c,d*x+e*y+f)
+    fill:[3] fill color for area outside input image
+    '''
+    _, _, h, w = images.shape
+    a, b, c, d, e, f = matrix.unbind(dim=1)
+    # convert pixel coordinates to grid_sample normalized coordinates(align_corners=False)
+    theta = torch.stack([
+        torch.stack([a, b * h / w, a + b * h / w + 2. * c / w - 1.], dim=1),
+        torch.stack([d * w / h, e, d * w / h + e + 2. * f / h - 1.], dim=1),
+    ],
+                        dim=1)
+    grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+
+    # sample an extra ones channel to know the weight of inside area
+    inputs = torch.cat([images, torch.ones_like(images[:, 0:1])], dim=1)
+    outputs = F.grid_sample(inputs,
+                            grid,
+                            mode='bilinear',
+                            padding_mode='zeros',
+                            align_corners=False)
+    outputs, inside_weight = outputs[:, 0:3], outputs[:, 3:4]
+    fill = torch.tensor(fill, dtype=images.dtype,
+                        device=images.device).view(1, 3, 1, 1)
+    outputs = outputs + (1. - inside_weight) * fill
+
+    return outputs.round().clamp(0, 255)
+
+
+def randomly_negate(value):
+    # with 50% prob,negate the value
+    sign = torch.where(
+        torch.rand(value.shape, device=value.device) > 0.5, -1., 1.)
+
+    return value * sign
+
+
+# level to arg functions of auto_rand_augment.py,magnitude is a [B] tensor
+LEVEL_TO_ARG = {
+    'AutoContrast':
+    None,
+    'Equalize':
+    None,
+    'Invert':
+    None,
+    'Rotate':
+    lambda m, h: randomly_negate((m / _LEVEL_DENOM) * 30.),
+    'Posterize':
+    lambda m, h: torch.floor((m / _LEVEL_DENOM) * 4),
+    'PosterizeIncreasing':
+    lambda m, h: 4 - torch.floor((m / _LEVEL_DENOM) * 4),
+    'PosterizeOriginal':
+    lambda m, h: torch.floor((m / _LEVEL_DENOM) * 4) + 4,
+    'Solarize':
+    lambda m, h: torch.floor((m / _LEVEL_DENOM) * 256),
+    'SolarizeIncreasing':
+    lambda m, h: 256 - torch.floor((m / _LEVEL_DENOM) * 256),
+    'SolarizeAdd':
+    lambda m, h: torch.floor((m / _LEVEL_DENOM) * 110),
+    'Color':
+    lambda m, h: (m / _LEVEL_DENOM) * 1.8 + 0.1,
+    'ColorIncreasing':
+    lambda m, h:
+    (1.0 + randomly_negate((m / _LEVEL_DENOM) * .9)).clamp(min=0.1),
+    'Contrast':
+    lambda m, h: (m / _LEVEL_DENOM) * 1.8 + 0.1,
+    'ContrastIncreasing':
+    lambda m, h:
+    (1.0 + randomly_negate((m / _LEVEL_DENOM) * .9)).clamp(min=0.1),
+    'Brightness':
+    lambda m, h: (m / _LEVEL_DENOM) * 1.8 + 0.1,
+    'BrightnessIncreasing':
+    lambda m, h:
+    (1.0 + randomly_negate((m / _LEVEL_DENOM) * .9)).clamp(min=0.1),
+    'Sharpness':
+    lambda m, h: (m / _LEVEL_DENOM) * 1.8 + 0.1,
+    'SharpnessIncreasing':
+    lambda m, h:
+    (1.0 + randomly_negate((m / _LEVEL_DENOM) * .9)).clamp(min=0.1),
+    'ShearX':
+    lambda m, h: randomly_negate((m / _LEVEL_DENOM) * 0.3),
+    'ShearY':
+    lambda m, h: randomly_negate((m / _LEVEL_DENOM) * 0.3),
+    'TranslateX':
+    lambda m, h: randomly_negate(
+        (m / _LEVEL_DENOM) * float(h['translate_const'])),
+    'TranslateY':
+    lambda m, h: randomly_negate(
+        (m / _LEVEL_DENOM) * float(h['translate_const'])),
+    'TranslateXRel':
+    lambda m, h: randomly_negate(
+        (m / _LEVEL_DENOM) * h.get('translate_pct', 0.45)),
+    'TranslateYRel':
+    lambda m, h: randomly_negate(
+        (m / _LEVEL_DENOM) * h.get('translate_pct', 0.45)),
+}
+
+GEOMETRIC_OP_NAMES = [
+    'Rotate',
+    'ShearX',
+    'ShearY',
+    'TranslateX',
+    'TranslateY',
+    'TranslateXRel',
+    'TranslateYRel',
+]
+
+
+def get_geometric_op_matrix(name, arg, h, w):
+    # return [B,6] PIL affine data,same as ops in auto_rand_augment.py
+    ones, zeros = torch.ones_like(arg), torch.zeros_like(arg)
+    if name == 'Rotate':
+        angle = -arg * math.pi / 180.
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        center_x, center_y = w / 2.0, h / 2.0
+        c = cos * (-center_x) + sin * (-center_y) + center_x
+        f = -sin * (-center_x) + cos * (-center_y) + center_y
+        return torch.stack([cos, sin, c, -sin, cos, f], dim=1)
+    elif name == 'ShearX':
+        return torch.stack([ones, arg, zeros, zeros, ones, zeros], dim=1)
+    elif name == 'ShearY':
+        return torch.stack([ones, zeros, zeros, arg, ones, zeros], dim=1)
+    elif name == 'TranslateX':
+        return torch.stack([ones, zeros, arg, zeros, ones, zeros], dim=1)
+    elif name == 'TranslateY':
+        return torch.stack([ones, zeros, zeros, zeros, ones, arg], dim=1)
+    elif name == 'TranslateXRel':
+        return torch.stack([ones, zeros, arg * w, zeros, ones, zeros], dim=1)
+    elif name == 'TranslateYRel':
+        return torch.stack([ones, zeros, zeros, zeros, ones, arg * h], dim=1)
+
+
+def apply_color_op(images, name, arg):
+    if arg is not None:
+        arg = arg.view(-1, 1, 1, 1)
+
+    if name == 'AutoContrast':
+        return auto_contrast(images)
+    elif name == 'Equalize':
+        return equalize(images)
+    elif name == 'Invert':
+        return invert(images)
+    elif name in ['Posterize', 'PosterizeIncreasing', 'PosterizeOriginal']:
+        return posterize(images, arg)
+    elif name in ['Solarize', 'SolarizeIncreasing']:
+        return solarize(images, arg)
+    elif name == 'SolarizeAdd':
+        return solarize_add(images, arg)
+    elif name in ['Color', 'ColorIncreasing']:
+        return adjust_saturation(images, arg)
+    elif name in ['Contrast', 'ContrastIncreasing']:
+        return adjust_contrast(images, arg)
+    elif name in ['Brightness', 'BrightnessIncreasing']:
+        return adjust_brightness(images, arg)
+    elif name in ['Sharpness', 'SharpnessIncreasing']:
+        return adjust_sharpness(images, arg)
+
+
+def apply_batch_augment_ops(images, op_ids, apply_mask, magnitudes,
+                            op_name_list, hparams):
+    '''
+    apply one augment op for every sample
+    images:[B,3,H,W] float,value range [0,255]
+    op_ids:[B] index of op_name_list
+    apply_mask:[B] bool,whether apply the op
+    magnitudes:[B] float magnitude
+    '''
+    _, _, h, w = images.shape
+    outputs = images.clone()
+
+    # every op only runs on samples selecting it,ops without selected sample are skipped
+    op_sample_nums = torch.bincount(op_ids[apply_mask].long(),
+                                    minlength=len(op_name_list)).tolist()
+
+    # all geometric ops are merged into one affine transform
+    identity = torch.tensor([1., 0., 0., 0., 1., 0.],
+                            dtype=images.dtype,
+                            device=images.device)
+    matrix = identity.unsqueeze(0).repeat(images.shape[0], 1)
+    geometric_mask = torch.zeros_like(apply_mask)
+    for op_id, name in enumerate(op_name_list):
+        if name not in GEOMETRIC_OP_NAMES or op_sample_nums[op_id] == 0:
+            continue
+        selected = apply_mask & (op_ids == op_id)
+        arg = LEVEL_TO_ARG[name](magnitudes[selected], hparams)
+        matrix[selected] = get_geometric_op_matrix(name, arg, h, w)
+        geometric_mask = geometric_mask | selected
+    if any(op_sample_nums[op_id] > 0 for op_id, name in enumerate(op_name_list)
+           if name in GEOMETRIC_OP_NAMES):
+        outputs[geometric_mask] = affine(images[geometric_mask],
+                                         matrix[geometric_mask],
+                                         hparams['img_mean'])
+
+    for op_id, name in enumerate(op_name_list):
+        if name in GEOMETRIC_OP_NAMES or op_sample_nums[op_id] == 0:
+            continue
+        selected = apply_mask & (op_ids == op_id)
+        arg = LEVEL_TO_ARG[name](
+            magnitudes[selected],
+            hparams) if LEVEL_TO_ARG[name] is not None else None
+        outputs[selected] = apply_color_op(images[selected], name, arg)
+
+    return outputs
+
+
+def sample_magnitudes(magnitudes, hparams):
+    # same as AugmentOp magnitude randomization
+    magnitude_std = hparams.get('magnitude_std', 0)
+    if magnitude_std > 0:
+        if magnitude_std == float('inf'):
+            magnitudes = torch.rand_like(magnitudes) * magnitudes
+        else:
+            magnitudes = magnitudes + torch.randn_like(
+                magnitudes) * magnitude_std
+    upper_bound = hparams.get('magnitude_max', None) or _LEVEL_DENOM
+    magnitudes = magnitudes.clamp(0., upper_bound)
+
+    return magnitudes
+
+
+class BatchRandomResizedCrop:
+    '''
+    input data from DeviceAugmentClassificationCollater,
+    output image:[B,3,resize,resize] float,value range [0,255]
+    crop params are sampled same as torchvision RandomResizedCrop,resize uses antialias bilinear like PIL.
+    '''
+
+    def __init__(self, resize=224, scale=(0.08, 1.0), ratio=(3. / 4.,
+                                                            4. / 3.)):
+        self.resize = int(resize)
+        self.scale = scale
+        self.ratio = ratio
+
+    def get_params(self, image_sizes):
+        batch_size = image_sizes.shape[0]
+        origin_h = image_sizes[:, 0:1].astype(np.float64)
+        origin_w = image_sizes[:, 1:2].astype(np.float64)
+        area = origin_h * origin_w
+
+        log_ratio = np.log(np.array(self.ratio))
+        target_area = area * np.random.uniform(
+            self.scale[0], self.scale[1], size=(batch_size, 10))
+        aspect_ratio = np.exp(
+            np.random.uniform(log_ratio[0], log_ratio[1],
+                              size=(batch_size, 10)))
+        w = np.round(np.sqrt(target_area * aspect_ratio))
+        h = np.round(np.sqrt(target_area / aspect_ratio))
+        valid = (w > 0) & (w <= origin_w) & (h > 0) & (h <= origin_h)
+
+        # take the first valid attempt for every sample
+        first_valid_idx = np.argmax(valid, axis=1)
+        has_valid = np.any(valid, axis=1)
+        batch_idx = np.arange(batch_size)
+        w, h = w[batch_idx, first_valid_idx], h[batch_idx, first_valid_idx]
+        origin_h, origin_w = origin_h[:, 0], origin_w[:, 0]
+        top = np.floor(np.random.uniform(size=batch_size) *
+                       (origin_h - h + 1))
+        left = np.floor(
+            np.random.uniform(size=batch_size) * (origin_w - w + 1))
+
+        # fallback to central crop
+        in_ratio = origin_w / origin_h
+        fallback_w, fallback_h = origin_w.copy(), origin_h.copy()
+        small_ratio = in_ratio < min(self.ratio)
+        fallback_h[small_ratio] = np.round(origin_w[small_ratio] /
+                                           min(self.ratio))
+        large_ratio = in_ratio > max(self.ratio)
+        fallback_w[large_ratio] = np.round(origin_h[large_ratio] *
+                                           max(self.ratio))
+        fallback_top = (origin_h - fallback_h) // 2
+        fallback_left = (origin_w - fallback_w) // 2
+
+        top = np.where(has_valid, top, fallback_top).astype(np.int64)
+        left = np.where(has_valid, left, fallback_left).astype(np.int64)
+        h = np.where(has_valid, h, fallback_h).astype(np.int64)
+        w = np.where(has_valid, w, fallback_w).astype(np.int64)
+
+        return top, left, h, w
+
+    def __call__(self, data):
+        images, image_sizes, image_offsets = data['image'], data[
+            'image_size'], data['image_offset']
+        image_sizes = image_sizes.cpu().numpy()
+        image_offsets = image_offsets.cpu().numpy()
+
+        top, left, h, w = self.get_params(image_sizes)
+
+        outputs = torch.empty(
+            (image_sizes.shape[0], 3, self.resize, self.resize),
+            dtype=torch.float32,
+            device=images.device)
+        for i, (origin_h, origin_w) in enumerate(image_sizes):
+            per_image = images[image_offsets[i]:image_offsets[i] +
+                               origin_h * origin_w * 3].view(
+                                   origin_h, origin_w, 3)
+            per_image = per_image[top[i]:top[i] + h[i],
+                                  left[i]:left[i] + w[i], :]
+            per_image = per_image.permute(2, 0, 1).unsqueeze(0).float()
+            outputs[i] = F.interpolate(per_image,
+                                       size=(self.resize, self.resize),
+                                       mode='bilinear',
+                                       align_corners=False,
+                                       antialias=True)[0]
+        outputs = outputs.round_().clamp_(0, 255)
+
+        data['image'] = outputs
+
+        return data
+
+
+class BatchRandomHorizontalFlip:
+
+    def __init__(self, prob=0.5):
+        self.prob = prob
+
+    def __call__(self, data):
+        images = data['image']
+
+        flip_mask = torch.rand(images.shape[0],
+                               device=images.device) < self.prob
+        images = torch.where(flip_mask.view(-1, 1, 1, 1), images.flip(-1),
+                             images)
+
+        data['image'] = images
+
+        return data
+
+
+class BatchColorJitter:
+    '''
+    same as torchvision ColorJitter on PIL image:
+    brightness/contrast/saturation/hue ops are applied in a random order for every sample.
+    '''
+
+    def __init__(self, brightness=0.4, contrast=0.4, saturation=0.4, hue=0):
+        assert brightness >= 0 and contrast >= 0 and saturation >= 0 and hue >= 0, 'brightness/contrast/saturation/hue value must be non negative!'
+        assert 0.0 <= hue <= 0.5, 'hue value should >=0.0 and <=0.5!'
+        self.factor_ranges = [
+            [max(0.0, 1 - float(brightness)), 1 + float(brightness)]
+            if brightness > 0 else None,
+            [max(0.0, 1 - float(contrast)), 1 + float(contrast)]
+            if contrast > 0 else None,
+            [max(0.0, 1 - float(saturation)), 1 + float(saturation)]
+            if saturation > 0 else None,
+            [-float(hue), float(hue)] if hue > 0 else None,
+        ]
+        self.adjust_fns = [
+            adjust_brightness,
+            adjust_contrast,
+            adjust_saturation,
+            adjust_hue,
+        ]
+
+    def __call__(self, data):
+        images = data['image']
+        batch_size, device = images.shape[0], images.device
+
+        # per sample random op order
+        fn_orders = torch.argsort(torch.rand((batch_size, 4), device=device),
+                                  dim=1)
+        factors = []
+        for per_range in self.factor_ranges:
+            if per_range is None:
+                factors.append(None)
+                continue
+            factors.append((torch.rand(batch_size, device=device) *
+                            (per_range[1] - per_range[0]) +
+                            per_range[0]).view(-1, 1, 1, 1))
+
+        for step in range(4):
+            step_inputs = images
+            for fn_idx, adjust_fn in enumerate(self.adjust_fns):
+                if factors[fn_idx] is None:
+                    continue
+                selected = (fn_orders[:, step] == fn_idx).view(-1, 1, 1, 1)
+                images = torch.where(selected,
+                                     adjust_fn(step_inputs, factors[fn_idx]),
+                                     images)
+
+        data['image'] = images
+
+        return data
+
+
+class BatchAutoAugment:
+
+    def __init__(self,
+                 policy_name,
+                 resize=224,
+                 mean=[0.485, 0.456, 0.406],
+                 magnitude_std=None):
+        assert policy_name in ['original', 'originalr', 'v0', 'v0r']
+        self.hparams = dict(
+            translate_const=int(resize * 0.45),
+            img_mean=tuple([min(255, round(255 * x)) for x in mean]),
+        )
+        if magnitude_std:
+            self.hparams.setdefault('magnitude_std', float(magnitude_std))
+        policy = auto_augment_policy(policy_name, hparams=self.hparams)
+
+        self.op_name_list = sorted(
+            list(set([op.name for sub_policy in policy
+                      for op in sub_policy])))
+        self.policy_op_ids = torch.tensor(
+            [[self.op_name_list.index(op.name) for op in sub_policy]
+             for sub_policy in policy],
+            dtype=torch.long)
+        self.policy_probs = torch.tensor(
+            [[op.prob for op in sub_policy] for sub_policy in policy],
+            dtype=torch.float32)
+        self.policy_magnitudes = torch.tensor(
+            [[op.magnitude for op in sub_policy] for sub_policy in policy],
+            dtype=torch.float32)
+
+    def __call__(self, data):
+        images = data['image']
+        batch_size, device = images.shape[0], images.device
+
+        if self.policy_op_ids.device != device:
+            self.policy_op_ids = self.policy_op_ids.to(device)
+            self.policy_probs = self.policy_probs.to(device)
+            self.policy_magnitudes = self.policy_magnitudes.to(device)
+
+        sub_policy_ids = torch.randint(0,
+                                       self.policy_op_ids.shape[0],
+                                       (batch_size, ),
+                                       device=device)
+        for op_position in range(self.policy_op_ids.shape[1]):
+            op_ids = self.policy_op_ids[sub_policy_ids, op_position]
+            probs = self.policy_probs[sub_policy_ids, op_position]
+            apply_mask = torch.rand(batch_size, device=device) <= probs
+            magnitudes = sample_magnitudes(
+                self.policy_magnitudes[sub_policy_ids, op_position],
+                self.hparams)
+            images = apply_batch_augment_ops(images, op_ids, apply_mask,
+                                             magnitudes, self.op_name_list,
+                                             self.hparams)
+
+        data['image'] = images
+
+        return data
+
+
+class BatchRandAugment:
+
+    def __init__(self,
+                 magnitude=9,
+                 num_layers=2,
+                 resize=224,
+                 mean=[0.485, 0.456, 0.406],
+                 integer=True,
+                 weight_idx=None,
+                 magnitude_std=0.5,
+                 magnitude_max=None):
+        self.op_name_list = _RAND_INCREASING_TRANSFORMS if integer else _RAND_TRANSFORMS
+        self.hparams = dict(
+            translate_const=int(resize * 0.45),
+            img_mean=tuple([min(255, round(255 * x)) for x in mean]),
+        )
+        if magnitude_std:
+            self.hparams.setdefault('magnitude_std', float(magnitude_std))
+        if magnitude_max:
+            self.hparams.setdefault('magnitude_max', int(magnitude_max))
+
+        self.magnitude = magnitude
+        self.num_layers = num_layers
+        # no replacement when using weighted choice
+        self.replacement = weight_idx is None
+        self.choice_weights = torch.ones(
+            len(self.op_name_list)) if weight_idx is None else torch.tensor(
+                _select_rand_weights(weight_idx), dtype=torch.float32)
+
+    def __call__(self, data):
+        images = data['image']
+        batch_size, device = images.shape[0], images.device
+
+        if self.choice_weights.device != device:
+            self.choice_weights = self.choice_weights.to(device)
+
+        layer_op_ids = torch.multinomial(self.choice_weights.unsqueeze(0).expand(
+            batch_size, -1),
+                                         self.num_layers,
+                                         replacement=self.replacement)
+        for layer_idx in range(self.num_layers):
+            # every op has 0.5 prob to be applied
+            apply_mask = torch.rand(batch_size, device=device) <= 0.5
+            magnitudes = sample_magnitudes(
+                torch.full((batch_size, ),
+                           float(self.magnitude),
+                           device=device), self.hparams)
+            images = apply_batch_augment_ops(images,
+                                             layer_op_ids[:, layer_idx],
+                                             apply_mask, magnitudes,
+                                             self.op_name_list, self.hparams)
+
+        data['image'] = images
+
+        return data
+
+
+class BatchMeanStdNormalize:
+
+    def __init__(self, mean, std):
+        self.normalize = TorchDeviceMeanStdNormalize(mean=mean, std=std)
+
+    def __call__(self, data):
+        data['image'] = self.normalize(data['image'])
+
+        return data
+
+
+class BatchRandomErasing:
+    '''
+    same as RandomErasing,use after BatchMeanStdNormalize
+    '''
+
+    def __init__(self,
+                 prob=0.25,
+                 min_area=0.02,
+                 max_area=1 / 3,
+                 min_aspect=0.3,
+                 max_aspect=None,
+                 mode='pixel',
+                 min_count=1,
+                 max_count=None):
+        self.prob = prob
+        self.min_area = min_area
+        self.max_area = max_area
+        max_aspect = max_aspect if max_aspect else 1 / min_aspect
+        self.log_aspect_ratio = (math.log(min_aspect), math.log(max_aspect))
+
+        assert mode in ['const', 'rand', 'pixel']
+        self.mode = mode
+        self.min_count = min_count
+        self.max_count = max_count if max_count else min_count
+
+    def __call__(self, data):
+        images = data['image']
+        batch_size, image_c, image_h, image_w = images.shape
+        device = images.device
+        area = image_h * image_w
+
+        erase_mask = torch.rand(batch_size, device=device) < self.prob
+        if self.min_count == self.max_count:
+            counts = torch.full((batch_size, ),
+                                self.min_count,
+                                dtype=torch.float32,
+                                device=device)
+        else:
+            counts = torch.randint(self.min_count,
+                                   self.max_count, (batch_size, ),
+                                   device=device).float()
+
+        ys = torch.arange(image_h, device=device).view(1, image_h, 1)
+        xs = torch.arange(image_w, device=device).view(1, 1, image_w)
+        for count_idx in range(self.max_count):
+            # 10 attempts for every sample,take the first valid one
+            target_area = (torch.rand((batch_size, 10), device=device) *
+                           (self.max_area - self.min_area) +
+                           self.min_area) * area / counts.unsqueeze(1)
+            aspect_ratio = torch.exp(
+                torch.rand((batch_size, 10), device=device) *
+                (self.log_aspect_ratio[1] - self.log_aspect_ratio[0]) +
+                self.log_aspect_ratio[0])
+            h = torch.round(torch.sqrt(target_area * aspect_ratio))
+            w = torch.round(torch.sqrt(target_area / aspect_ratio))
+            valid = (w < image_w) & (h < image_h)
+            first_valid_idx = torch.argmax(valid.int(), dim=1, keepdim=True)
+            has_valid = torch.any(valid, dim=1)
+            h = torch.gather(h, 1, first_valid_idx)[:, 0]
+            w = torch.gather(w, 1, first_valid_idx)[:, 0]
+            top = torch.floor(
+                torch.rand(batch_size, device=device) * (image_h - h))
+            left = torch.floor(
+                torch.rand(batch_size, device=device) * (image_w - w))
+
+            active = erase_mask & has_valid & (count_idx < counts)
+            box_mask = (ys >= top.view(-1, 1, 1)) & (
+                ys < (top + h).view(-1, 1, 1)) & (xs >= left.view(
+                    -1, 1, 1)) & (xs < (left + w).view(-1, 1, 1))
+            box_mask = (box_mask & active.view(-1, 1, 1)).unsqueeze(1)
+
+            if self.mode == 'pixel':
+                fill_area = torch.randn_like(images)
+            elif self.mode == 'rand':
+                fill_area = torch.randn((batch_size, image_c, 1, 1),
+                                        dtype=images.dtype,
+                                        device=device)
+            else:
+                fill_area = torch.zeros((batch_size, image_c, 1, 1),
+                                        dtype=images.dtype,
+                                        device=device)
+
+            images = torch.where(box_mask, fill_area, images)
+
+        data['image'] = images
+
+        return data
+
+
+class BatchMixupCutmix(MixupCutmixClassificationCollater):
+    '''
+    same args as MixupCutmixClassificationCollater,mix images and labels of the batch on device
+    '''
+
+    def __call__(self, data):
+        images, labels = data['image'], data['label']
+
+        if self.use_mixup:
+            b, _, _, _ = images.shape
+            assert b % 2 == 0, 'Batch size should be even when using this'
+            if self.mode == 'elem':
+                lam = self._mix_elem(images)
+            elif self.mode == 'pair':
+                lam = self._mix_pair(images)
+            else:
+                lam = self._mix_batch(images)
+            labels = mixup_label(labels, self.num_classes, lam,
+                                 self.label_smoothing)
+
+        data['image'], data['label'] = images, labels
+
+        return data
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    import numpy as np
+    import torch
+    seed = 0
+    # for hash
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    # for python and numpy
+    random.seed(seed)
+    np.random.seed(seed)
+    # for cpu gpu
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+    import os
+    import sys
+
+    BASE_DIR = os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.append(BASE_DIR)
+
+    from tools.path import ILSVRC2012_path
+
+    import time
+    import torchvision.transforms as transforms
+    from tqdm import tqdm
+
+    from torch.utils.data import DataLoader
+    from simpleAICV.classification.datasets.ilsvrc2012dataset import ILSVRC2012Dataset
+    from simpleAICV.classification.common import Opencv2PIL, TorchRandomResizedCrop, TorchRandomHorizontalFlip, TorchMeanStdNormalize, RandomErasing, RandAugment, ClassificationCollater
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    cpu_augment_dataset = ILSVRC2012Dataset(
+        root_dir=ILSVRC2012_path,
+        set_name='train',
+        transform=transforms.Compose([
+            Opencv2PIL(),
+            TorchRandomResizedCrop(resize=224),
+            TorchRandomHorizontalFlip(prob=0.5),
+            RandAugment(magnitude=9, num_layers=2, resize=224),
+            TorchMeanStdNormalize(mean=[0.485, 0.456, 0.406],
+                                  std=[0.229, 0.224, 0.225]),
+            RandomErasing(prob=0.25, mode='pixel', max_count=1),
+        ]))
+    device_augment_dataset = ILSVRC2012Dataset(root_dir=ILSVRC2012_path,
+                                               set_name='train',
+                                               transform=None,
+                                               keep_uint8=True)
+    device_transform = transforms.Compose([
+        BatchRandomResizedCrop(resize=224),
+        BatchRandomHorizontalFlip(prob=0.5),
+        BatchRandAugment(magnitude=9, num_layers=2, resize=224),
+        BatchMeanStdNormalize(mean=[0.485, 0.456, 0.406],
+                              std=[0.229, 0.224, 0.225]),
+        BatchRandomErasing(prob=0.25, mode='pixel', max_count=1),
+    ])
+
+    cpu_loader = DataLoader(cpu_augment_dataset,
+                            batch_size=128,
+                            shuffle=True,
+                            num_workers=4,
+                            collate_fn=ClassificationCollater())
+    device_loader = DataLoader(device_augment_dataset,
+                               batch_size=128,
+                               shuffle=True,
+                               num_workers=4,
+                               collate_fn=DeviceAugmentClassificationCollater())
+
+    # compare per channel mean/std of augmented batches and throughput
+    for name, loader in [['cpu', cpu_loader], ['device', device_loader]]:
+        start_time, image_num = time.time(), 0
+        channel_means, channel_stds = [], []
+        for i, data in enumerate(tqdm(loader)):
+            data['image'], data['label'] = data['image'].to(
+                device), data['label'].to(device)
+            if name == 'device':
+                data = device_transform(data)
+            images = data['image']
+            channel_means.append(images.mean(dim=(0, 2, 3)).cpu().numpy())
+            channel_stds.append(images.std(dim=(0, 2, 3)).cpu().numpy())
+            image_num += images.shape[0]
+            if i == 20:
+                break
+        print(
+            f'{name} augment: {image_num / (time.time() - start_time):.1f} images/sec, channel mean: {np.mean(channel_means, axis=0)}, channel std: {np.mean(channel_stds, axis=0)}'
+        )
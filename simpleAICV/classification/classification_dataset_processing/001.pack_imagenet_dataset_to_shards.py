@@ -0,0 +1,42 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))))
+sys.path.append(BASE_DIR)
+
+from tools.path import ILSVRC2012_path, ImageNet21K_path, ILSVRC2012_packed_shards_path, ImageNet21K_packed_shards_path
+
+from simpleAICV.classification.datasets.packedshardsdataset import pack_image_folder_dataset_to_shards
+
+if __name__ == '__main__':
+    # ILSVRC2012
+    pack_image_folder_dataset_to_shards(root_dir=ILSVRC2012_path,
+                                        save_dir=ILSVRC2012_packed_shards_path,
+                                        set_name='train',
+                                        shard_max_bytes=1024 * 1024 * 1024,
+                                        shuffle_before_pack=True,
+                                        seed=0)
+    pack_image_folder_dataset_to_shards(root_dir=ILSVRC2012_path,
+                                        save_dir=ILSVRC2012_packed_shards_path,
+                                        set_name='val',
+                                        shard_max_bytes=1024 * 1024 * 1024,
+                                        shuffle_before_pack=False,
+                                        seed=0)
+
+    # ImageNet21K
+    pack_image_folder_dataset_to_shards(
+        root_dir=ImageNet21K_path,
+        save_dir=ImageNet21K_packed_shards_path,
+        set_name='train',
+        shard_max_bytes=1024 * 1024 * 1024,
+        shuffle_before_pack=True,
+        seed=0)
+    pack_image_folder_dataset_to_shards(
+        root_dir=ImageNet21K_path,
+        save_dir=ImageNet21K_packed_shards_path,
+        set_name='val',
+        shard_max_bytes=1024 * 1024 * 1024,
+        shuffle_before_pack=False,
+        seed=0)
@@ -39,8 +39,9 @@ class Opencv2PIL:
 
 class PIL2Opencv:
 
-    def __init__(self):
-        pass
+    def __init__(self, keep_uint8=False):
+        # keep_uint8=True:keep uint8 image for uint8 data path,normalize image on gpu by TorchDeviceMeanStdNormalize
+        self.keep_uint8 = keep_uint8
 
     def __call__(self, sample):
         '''
@@ -48,7 +49,10 @@ class PIL2Opencv:
         '''
         image, label = sample['image'], sample['label']
 
-        image = np.asarray(image).astype(np.float32)
+        if self.keep_uint8:
+            image = np.asarray(image, dtype=np.uint8)
+        else:
+            image = np.asarray(image).astype(np.float32)
 
         sample['image'], sample['label'] = image, label
 
@@ -248,6 +252,30 @@ class TorchMeanStdNormalize:
         return sample
 
 
+class TorchDeviceMeanStdNormalize:
+    '''
+    normalize a uint8 [B,3,H,W] image batch on the device where images are,
+    same result as TorchMeanStdNormalize:(image / 255. - mean) / std.
+    use with keep_uint8 datasets/PIL2Opencv(keep_uint8=True)/Uint8ClassificationCollater.
+    '''
+
+    def __init__(self, mean, std):
+        mean = np.array(mean, dtype=np.float32).reshape(1, 3, 1, 1)
+        std = np.array(std, dtype=np.float32).reshape(1, 3, 1, 1)
+        # (image / 255. - mean) / std = image * scale + bias
+        self.scale = torch.from_numpy(1. / (255. * std))
+        self.bias = torch.from_numpy(-mean / std)
+
+    def __call__(self, images):
+        if self.scale.device != images.device:
+            self.scale = self.scale.to(images.device)
+            self.bias = self.bias.to(images.device)
+
+        images = torch.addcmul(self.bias, images.float(), self.scale)
+
+        return images
+
+
 class ReflectPad:
 
     def __init__(self, pad=4):
@@ -665,6 +693,37 @@ class ClassificationCollater:
         }
 
 
+class Uint8ClassificationCollater:
+    '''
+    collate uint8 H W 3 images into one preallocated contiguous uint8 B 3 H W tensor,
+    pinned memory host to device copy is 4x smaller than float32 batch.
+    '''
+
+    def __init__(self):
+        pass
+
+    def __call__(self, data):
+        images = [s['image'] for s in data]
+        labels = [s['label'] for s in data]
+
+        h, w, c = images[0].shape
+        batch_images = torch.empty((len(images), c, h, w), dtype=torch.uint8)
+        for i, per_image in enumerate(images):
+            # H W 3 ->3 H W
+            batch_images[i].copy_(
+                torch.from_numpy(np.ascontiguousarray(per_image,
+                                                      dtype=np.uint8)).permute(
+                                                          2, 0, 1))
+
+        labels = np.array(labels).astype(np.float32)
+        labels = torch.from_numpy(labels).long()
+
+        return {
+            'image': batch_images,
+            'label': labels,
+        }
+
+
 class AverageMeter:
     '''Computes and stores the average and current value'''
 
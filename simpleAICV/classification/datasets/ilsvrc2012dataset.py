@@ -4,42 +4,68 @@ import numpy as np
 
 from torch.utils.data import Dataset
 
+from simpleAICV.classification.datasets.imagefolderindex import load_or_build_image_folder_index
+
 
 class ILSVRC2012Dataset(Dataset):
     '''
     ILSVRC2012 Dataset:https://image-net.org/ 
     '''
 
-    def __init__(self, root_dir, set_name='train', transform=None):
+    def __init__(self,
+                 root_dir,
+                 set_name='train',
+                 transform=None,
+                 use_index_cache=False,
+                 index_dir=None,
+                 keep_uint8=False):
         assert set_name in ['train', 'val'], 'Wrong set name!'
         # make sure all directories in set_dir directory are sub-categories directory and no other files
         set_dir = os.path.join(root_dir, set_name)
 
-        sub_class_name_list = []
-        for per_sub_class_name in os.listdir(set_dir):
-            sub_class_name_list.append(per_sub_class_name)
-        sub_class_name_list = sorted(sub_class_name_list)
-
-        self.image_path_list = []
-        for per_sub_class_name in sub_class_name_list:
-            per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
-            for per_image_name in os.listdir(per_sub_class_dir):
-                per_image_path = os.path.join(per_sub_class_dir,
-                                              per_image_name)
-                self.image_path_list.append(per_image_path)
-        self.image_path_list = sorted(self.image_path_list)
+        if use_index_cache:
+            # image path list and labels are saved once and memory-mapped on later runs
+            # index is written to index_dir(default root_dir/image_index/set_name),use a writable index_dir for read-only dataset dir
+            index_dir = os.path.join(
+                root_dir, 'image_index',
+                set_name) if index_dir is None else index_dir
+            sub_class_name_list, self.image_path_list, self.image_label_array = load_or_build_image_folder_index(
+                set_dir, index_dir)
+        else:
+            sub_class_name_list = []
+            for per_sub_class_name in os.listdir(set_dir):
+                sub_class_name_list.append(per_sub_class_name)
+            sub_class_name_list = sorted(sub_class_name_list)
+
+            self.image_path_list = []
+            for per_sub_class_name in sub_class_name_list:
+                per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
+                for per_image_name in os.listdir(per_sub_class_dir):
+                    per_image_path = os.path.join(per_sub_class_dir,
+                                                  per_image_name)
+                    self.image_path_list.append(per_image_path)
+            self.image_path_list = sorted(self.image_path_list)
 
         self.class_name_to_label = {
             sub_class_name: i
             for i, sub_class_name in enumerate(sub_class_name_list)
         }
 
+        if not use_index_cache:
+            self.image_label_array = np.array([
+                self.class_name_to_label[per_image_path.split('/')[-2]]
+                for per_image_path in self.image_path_list
+            ],
+                                              dtype=np.int32)
+
         self.label_to_class_name = {
             i: sub_class_name
             for i, sub_class_name in enumerate(sub_class_name_list)
         }
 
         self.transform = transform
+        # keep_uint8=True:load uint8 image for uint8 data path
+        self.keep_uint8 = keep_uint8
 
         print(f'Dataset Size:{len(self.image_path_list)}')
         print(f'Dataset Class Num:{len(self.class_name_to_label)}')
@@ -69,12 +95,13 @@ class ILSVRC2012Dataset(Dataset):
             cv2.IMREAD_COLOR)
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
+        if self.keep_uint8:
+            return image
+
         return image.astype(np.float32)
 
     def load_label(self, idx):
-        label = self.class_name_to_label[self.image_path_list[idx].split('/')
-                                         [-2]]
-        label = np.array(label)
+        label = np.array(self.image_label_array[idx])
 
         return label.astype(np.float32)
 
@@ -342,3 +369,69 @@ if __name__ == '__main__':
             i += 1
         else:
             break
+
+    ###################################################################################
+    # loader throughput benchmark:float32 data path vs uint8 data path
+    import time
+    from simpleAICV.classification.common import TorchMeanStdNormalize, Uint8ClassificationCollater, TorchDeviceMeanStdNormalize
+
+    benchmark_batch_size, benchmark_num_workers, benchmark_iters = 128, 8, 50
+
+    float32_dataset = ILSVRC2012Dataset(
+        root_dir=ILSVRC2012_path,
+        set_name='train',
+        transform=transforms.Compose([
+            Opencv2PIL(),
+            TorchRandomResizedCrop(resize=224),
+            TorchRandomHorizontalFlip(prob=0.5),
+            TorchMeanStdNormalize(mean=[0.485, 0.456, 0.406],
+                                  std=[0.229, 0.224, 0.225]),
+        ]))
+    uint8_dataset = ILSVRC2012Dataset(
+        root_dir=ILSVRC2012_path,
+        set_name='train',
+        transform=transforms.Compose([
+            Opencv2PIL(),
+            TorchRandomResizedCrop(resize=224),
+            TorchRandomHorizontalFlip(prob=0.5),
+            PIL2Opencv(keep_uint8=True),
+        ]),
+        keep_uint8=True)
+    device_normalize = TorchDeviceMeanStdNormalize(
+        mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
+    for benchmark_name, benchmark_dataset, benchmark_collater in [
+        ['float32', float32_dataset,
+         ClassificationCollater()],
+        ['uint8', uint8_dataset,
+         Uint8ClassificationCollater()],
+    ]:
+        benchmark_loader = DataLoader(benchmark_dataset,
+                                      batch_size=benchmark_batch_size,
+                                      shuffle=True,
+                                      pin_memory=True,
+                                      num_workers=benchmark_num_workers,
+                                      collate_fn=benchmark_collater)
+
+        image_num = 0
+        for i, data in enumerate(benchmark_loader):
+            images = data['image']
+            if torch.cuda.is_available():
+                images = images.cuda(non_blocking=True)
+            if benchmark_name == 'uint8':
+                images = device_normalize(images)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+
+            # skip first batches for worker warm up
+            if i == benchmark_num_workers:
+                start_time = time.time()
+            elif i > benchmark_num_workers:
+                image_num += images.shape[0]
+
+            if i == benchmark_num_workers + benchmark_iters:
+                break
+
+        print(
+            f'{benchmark_name} data path: {image_num / (time.time() - start_time):.1f} images/sec, batch bytes: {data["image"].element_size() * data["image"].nelement()}'
+        )
@@ -0,0 +1,130 @@
+import os
+import hashlib
+import json
+import numpy as np
+
+from tqdm import tqdm
+
+index_meta_file_name = 'meta.json'
+index_path_file_name = 'image_relative_paths.npy'
+index_class_id_file_name = 'image_class_ids.npy'
+
+
+class ImageFolderPathList:
+    '''
+    list-like wrapper of a memory-mapped relative image path array,
+    index it like a python list of full image paths.
+    '''
+
+    def __init__(self, set_dir, relative_path_array):
+        self.set_dir = set_dir
+        self.relative_path_array = relative_path_array
+
+    def __len__(self):
+        return len(self.relative_path_array)
+
+    def __getitem__(self, idx):
+        return os.path.join(self.set_dir,
+                            self.relative_path_array[idx].decode('utf-8'))
+
+
+def compute_image_folder_fingerprint(set_dir, sub_class_name_list):
+    '''
+    directory mtime changes when files are added/removed/renamed in it,
+    so mtimes of set_dir and all class dirs identify the dataset file list without listing files.
+    '''
+    fingerprint = hashlib.md5()
+    fingerprint.update(f'{os.stat(set_dir).st_mtime_ns}'.encode('utf-8'))
+    for per_sub_class_name in sub_class_name_list:
+        per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
+        fingerprint.update(
+            f'{per_sub_class_name}:{os.stat(per_sub_class_dir).st_mtime_ns}'.
+            encode('utf-8'))
+
+    return fingerprint.hexdigest()
+
+
+def build_image_folder_index(set_dir, sub_class_name_list,
+                             filter_image_name_list):
+    image_relative_path_list, image_class_id_list = [], []
+    for class_id, per_sub_class_name in enumerate(tqdm(sub_class_name_list)):
+        per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
+        for per_image_name in os.listdir(per_sub_class_dir):
+            if per_image_name in filter_image_name_list:
+                continue
+            image_relative_path_list.append(
+                [f'{per_sub_class_name}/{per_image_name}', class_id])
+    image_relative_path_list = sorted(image_relative_path_list)
+
+    image_class_id_list = np.array(
+        [per_item[1] for per_item in image_relative_path_list],
+        dtype=np.int32)
+    image_relative_path_list = np.array([
+        per_item[0].encode('utf-8') for per_item in image_relative_path_list
+    ])
+
+    return image_relative_path_list, image_class_id_list
+
+
+def save_array_atomically(array, save_path):
+    # every rank may build the index at the same time,write to a temp file then rename
+    temp_save_path = f'{save_path}.{os.getpid()}.tmp.npy'
+    np.save(temp_save_path, array)
+    os.replace(temp_save_path, save_path)
+
+
+def load_or_build_image_folder_index(set_dir,
+                                     index_dir,
+                                     filter_image_name_list=()):
+    '''
+    set_dir: image folder dir,make sure all directories in set_dir are sub-categories directory and no other files
+    index_dir: dir to save index files
+    return:
+    sub_class_name_list: sorted sub-categories directory name list
+    image_path_list: ImageFolderPathList,sorted full image path list
+    image_class_id_array: [N] int32 array,per image index of sub_class_name_list
+    '''
+    sub_class_name_list = sorted(os.listdir(set_dir))
+    fingerprint = compute_image_folder_fingerprint(set_dir,
+                                                   sub_class_name_list)
+    filter_image_name_list = sorted(filter_image_name_list)
+
+    meta_path = os.path.join(index_dir, index_meta_file_name)
+    path_file_path = os.path.join(index_dir, index_path_file_name)
+    class_id_file_path = os.path.join(index_dir, index_class_id_file_name)
+
+    index_is_valid = False
+    if os.path.exists(meta_path) and os.path.exists(
+            path_file_path) and os.path.exists(class_id_file_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        index_is_valid = meta['fingerprint'] == fingerprint and meta[
+            'sub_class_name_list'] == sub_class_name_list and meta[
+                'filter_image_name_list'] == filter_image_name_list
+
+    if not index_is_valid:
+        print(f'Building image index for {set_dir}')
+        os.makedirs(index_dir) if not os.path.exists(index_dir) else None
+        image_relative_path_array, image_class_id_array = build_image_folder_index(
+            set_dir, sub_class_name_list, filter_image_name_list)
+        save_array_atomically(image_relative_path_array, path_file_path)
+        save_array_atomically(image_class_id_array, class_id_file_path)
+
+        temp_meta_path = f'{meta_path}.{os.getpid()}.tmp'
+        with open(temp_meta_path, 'w', encoding='utf-8') as f:
+            json.dump(
+                {
+                    'fingerprint': fingerprint,
+                    'sub_class_name_list': sub_class_name_list,
+                    'filter_image_name_list': filter_image_name_list,
+                    'image_num': len(image_class_id_array),
+                },
+                f,
+                ensure_ascii=False)
+        os.replace(temp_meta_path, meta_path)
+
+    image_relative_path_array = np.load(path_file_path, mmap_mode='r')
+    image_class_id_array = np.load(class_id_file_path, mmap_mode='r')
+    image_path_list = ImageFolderPathList(set_dir, image_relative_path_array)
+
+    return sub_class_name_list, image_path_list, image_class_id_array
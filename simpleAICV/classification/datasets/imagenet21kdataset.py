@@ -7,6 +7,8 @@ from tqdm import tqdm
 import torch
 from torch.utils.data import Dataset
 
+from simpleAICV.classification.datasets.imagefolderindex import load_or_build_image_folder_index
+
 filter_image_name_list = [
     'n02088094_294.JPEG',
 ]
@@ -17,38 +19,62 @@ class ImageNet21KSingleLabelDataset(Dataset):
     ImageNet21K Dataset:https://image-net.org/ 
     '''
 
-    def __init__(self, root_dir, set_name='train', transform=None):
+    def __init__(self,
+                 root_dir,
+                 set_name='train',
+                 transform=None,
+                 use_index_cache=False,
+                 index_dir=None,
+                 keep_uint8=False):
         assert set_name in ['train', 'val'], 'Wrong set name!'
         # make sure all directories in set_dir directory are sub-categories directory and no other files
         set_dir = os.path.join(root_dir, set_name)
 
-        sub_class_name_list = []
-        for per_sub_class_name in os.listdir(set_dir):
-            sub_class_name_list.append(per_sub_class_name)
-        sub_class_name_list = sorted(sub_class_name_list)
-
-        self.image_path_list = []
-        for per_sub_class_name in tqdm(sub_class_name_list):
-            per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
-            for per_image_name in os.listdir(per_sub_class_dir):
-                if per_image_name in filter_image_name_list:
-                    continue
-                per_image_path = os.path.join(per_sub_class_dir,
-                                              per_image_name)
-                self.image_path_list.append(per_image_path)
-        self.image_path_list = sorted(self.image_path_list)
+        if use_index_cache:
+            # image path list and labels are saved once and memory-mapped on later runs
+            # index is written to index_dir(default root_dir/image_index/set_name),use a writable index_dir for read-only dataset dir
+            index_dir = os.path.join(
+                root_dir, 'image_index',
+                set_name) if index_dir is None else index_dir
+            sub_class_name_list, self.image_path_list, self.image_label_array = load_or_build_image_folder_index(
+                set_dir, index_dir, filter_image_name_list)
+        else:
+            sub_class_name_list = []
+            for per_sub_class_name in os.listdir(set_dir):
+                sub_class_name_list.append(per_sub_class_name)
+            sub_class_name_list = sorted(sub_class_name_list)
+
+            self.image_path_list = []
+            for per_sub_class_name in tqdm(sub_class_name_list):
+                per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
+                for per_image_name in os.listdir(per_sub_class_dir):
+                    if per_image_name in filter_image_name_list:
+                        continue
+                    per_image_path = os.path.join(per_sub_class_dir,
+                                                  per_image_name)
+                    self.image_path_list.append(per_image_path)
+            self.image_path_list = sorted(self.image_path_list)
 
         self.class_name_to_label = {
             sub_class_name: i
             for i, sub_class_name in enumerate(sub_class_name_list)
         }
 
+        if not use_index_cache:
+            self.image_label_array = np.array([
+                self.class_name_to_label[per_image_path.split('/')[-2]]
+                for per_image_path in self.image_path_list
+            ],
+                                              dtype=np.int32)
+
         self.label_to_class_name = {
             i: sub_class_name
             for i, sub_class_name in enumerate(sub_class_name_list)
         }
 
         self.transform = transform
+        # keep_uint8=True:load uint8 image for uint8 data path
+        self.keep_uint8 = keep_uint8
 
         print(f'Dataset Size:{len(self.image_path_list)}')
         print(f'Dataset Class Num:{len(self.class_name_to_label)}')
@@ -78,12 +104,13 @@ class ImageNet21KSingleLabelDataset(Dataset):
             cv2.IMREAD_COLOR)
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
+        if self.keep_uint8:
+            return image
+
         return image.astype(np.float32)
 
     def load_label(self, idx):
-        label = self.class_name_to_label[self.image_path_list[idx].split('/')
-                                         [-2]]
-        label = np.array(label)
+        label = np.array(self.image_label_array[idx])
 
         return label.astype(np.float32)
 
@@ -93,7 +120,13 @@ class ImageNet21KSemanticTreeLabelDataset(Dataset):
     ImageNet21K Dataset:https://image-net.org/ 
     '''
 
-    def __init__(self, root_dir, set_name='train', transform=None):
+    def __init__(self,
+                 root_dir,
+                 set_name='train',
+                 transform=None,
+                 use_index_cache=False,
+                 index_dir=None,
+                 keep_uint8=False):
         assert set_name in ['train', 'val'], 'Wrong set name!'
         # make sure all directories in set_dir directory are sub-categories directory and no other files
         semantic_tree_path = os.path.join(root_dir,
@@ -158,22 +191,47 @@ class ImageNet21KSemanticTreeLabelDataset(Dataset):
 
         set_dir = os.path.join(root_dir, set_name)
 
-        sub_class_name_list = []
-        for per_sub_class_name in os.listdir(set_dir):
-            sub_class_name_list.append(per_sub_class_name)
-        sub_class_name_list = sorted(sub_class_name_list)
-
-        self.image_path_list = []
-        for per_sub_class_name in tqdm(sub_class_name_list):
-            per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
-            for per_image_name in os.listdir(per_sub_class_dir):
-                if per_image_name in filter_image_name_list:
-                    continue
-                per_image_path = os.path.join(per_sub_class_dir,
-                                              per_image_name)
-                self.image_path_list.append(per_image_path)
+        if use_index_cache:
+            # image path list is saved once and memory-mapped on later runs
+            # index is written to index_dir(default root_dir/image_index/set_name),use a writable index_dir for read-only dataset dir
+            index_dir = os.path.join(
+                root_dir, 'image_index',
+                set_name) if index_dir is None else index_dir
+            sub_class_name_list, self.image_path_list, image_class_id_array = load_or_build_image_folder_index(
+                set_dir, index_dir, filter_image_name_list)
+            # map sub-categories directory index to semantic tree single label
+            sub_class_id_to_single_label = np.array([
+                self.class_file_name_to_single_label[per_sub_class_name]
+                for per_sub_class_name in sub_class_name_list
+            ],
+                                                    dtype=np.int32)
+            self.image_label_array = sub_class_id_to_single_label[
+                image_class_id_array]
+        else:
+            sub_class_name_list = []
+            for per_sub_class_name in os.listdir(set_dir):
+                sub_class_name_list.append(per_sub_class_name)
+            sub_class_name_list = sorted(sub_class_name_list)
+
+            self.image_path_list = []
+            for per_sub_class_name in tqdm(sub_class_name_list):
+                per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
+                for per_image_name in os.listdir(per_sub_class_dir):
+                    if per_image_name in filter_image_name_list:
+                        continue
+                    per_image_path = os.path.join(per_sub_class_dir,
+                                                  per_image_name)
+                    self.image_path_list.append(per_image_path)
+
+            self.image_label_array = np.array([
+                self.class_file_name_to_single_label[per_image_path.split(
+                    '/')[-2]] for per_image_path in self.image_path_list
+            ],
+                                              dtype=np.int32)
 
         self.transform = transform
+        # keep_uint8=True:load uint8 image for uint8 data path
+        self.keep_uint8 = keep_uint8
 
         print(f'Dataset Size:{len(self.image_path_list)}')
         print(f'Dataset Class Num:{len(self.class_file_name_to_single_label)}')
@@ -203,12 +261,13 @@ class ImageNet21KSemanticTreeLabelDataset(Dataset):
             cv2.IMREAD_COLOR)
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
+        if self.keep_uint8:
+            return image
+
         return image.astype(np.float32)
 
     def load_label(self, idx):
-        label = self.class_file_name_to_single_label[
-            self.image_path_list[idx].split('/')[-2]]
-        label = np.array(label)
+        label = np.array(self.image_label_array[idx])
 
         return label.astype(np.float32)
 
@@ -0,0 +1,509 @@
+import os
+import cv2
+import json
+import math
+import numpy as np
+
+from tqdm import tqdm
+
+import torch
+from torch.utils.data import Dataset, IterableDataset
+
+from simpleAICV.classification.datasets.imagenet21kdataset import filter_image_name_list
+
+# every shard is a plain binary file with encoded image bytes written back to back,
+# shard index(offset,length,label) of all shards is saved in one index.npz file
+shard_name_format = 'shard_{:06d}.bin'
+shard_meta_file_name = 'meta.json'
+shard_index_file_name = 'index.npz'
+
+
+def pack_image_folder_dataset_to_shards(root_dir,
+                                        save_dir,
+                                        set_name='train',
+                                        shard_max_bytes=1024 * 1024 * 1024,
+                                        shuffle_before_pack=True,
+                                        seed=0):
+    '''
+    pack a ILSVRC2012/ImageNet21K style image folder dataset(root_dir/set_name/class_name/image_name) into large shards.
+    root_dir: image folder dataset root dir
+    save_dir: packed dataset save dir,shards are saved in save_dir/set_name
+    shard_max_bytes: max bytes of per shard file
+    shuffle_before_pack: shuffle image order before packing,so every shard contains mixed classes
+    '''
+    assert set_name in ['train', 'val'], 'Wrong set name!'
+    set_dir = os.path.join(root_dir, set_name)
+    save_set_dir = os.path.join(save_dir, set_name)
+    os.makedirs(save_set_dir) if not os.path.exists(save_set_dir) else None
+
+    sub_class_name_list = sorted(os.listdir(set_dir))
+    class_name_to_label = {
+        sub_class_name: i
+        for i, sub_class_name in enumerate(sub_class_name_list)
+    }
+
+    image_path_label_list = []
+    for per_sub_class_name in tqdm(sub_class_name_list):
+        per_sub_class_dir = os.path.join(set_dir, per_sub_class_name)
+        for per_image_name in os.listdir(per_sub_class_dir):
+            if per_image_name in filter_image_name_list:
+                continue
+            per_image_path = os.path.join(per_sub_class_dir, per_image_name)
+            image_path_label_list.append(
+                [per_image_path, class_name_to_label[per_sub_class_name]])
+    image_path_label_list = sorted(image_path_label_list)
+
+    if shuffle_before_pack:
+        np.random.RandomState(seed).shuffle(image_path_label_list)
+
+    shard_name_list = []
+    all_shard_ids, all_offsets, all_lengths, all_labels = [], [], [], []
+
+    shard_id, shard_offset, shard_file = -1, 0, None
+    for per_image_path, per_label in tqdm(image_path_label_list):
+        per_image_bytes = np.fromfile(per_image_path, dtype=np.uint8)
+
+        if shard_file is None or shard_offset + len(
+                per_image_bytes) > shard_max_bytes:
+            shard_file.close() if shard_file is not None else None
+            shard_id += 1
+            shard_offset = 0
+            shard_name_list.append(shard_name_format.format(shard_id))
+            shard_file = open(
+                os.path.join(save_set_dir, shard_name_list[-1]), 'wb')
+
+        shard_file.write(per_image_bytes.tobytes())
+
+        all_shard_ids.append(shard_id)
+        all_offsets.append(shard_offset)
+        all_lengths.append(len(per_image_bytes))
+        all_labels.append(per_label)
+
+        shard_offset += len(per_image_bytes)
+
+    shard_file.close() if shard_file is not None else None
+
+    np.savez(os.path.join(save_set_dir, shard_index_file_name),
+             shard_ids=np.array(all_shard_ids, dtype=np.int32),
+             offsets=np.array(all_offsets, dtype=np.int64),
+             lengths=np.array(all_lengths, dtype=np.int64),
+             labels=np.array(all_labels, dtype=np.int64))
+
+    with open(os.path.join(save_set_dir, shard_meta_file_name),
+              'w',
+              encoding='utf-8') as f:
+        json.dump(
+            {
+                'class_name_list': sub_class_name_list,
+                'shard_name_list': shard_name_list,
+                'sample_num': len(all_labels),
+            },
+            f,
+            ensure_ascii=False)
+
+    print(f'Packed Sample Num:{len(all_labels)}')
+    print(f'Packed Shard Num:{len(shard_name_list)}')
+
+    return
+
+
+def load_packed_shards_meta_and_index(root_dir, set_name):
+    set_dir = os.path.join(root_dir, set_name)
+
+    with open(os.path.join(set_dir, shard_meta_file_name),
+              'r',
+              encoding='utf-8') as f:
+        meta = json.load(f)
+
+    index = np.load(os.path.join(set_dir, shard_index_file_name))
+    index = {key: index[key] for key in index.files}
+
+    shard_path_list = [
+        os.path.join(set_dir, per_shard_name)
+        for per_shard_name in meta['shard_name_list']
+    ]
+
+    return meta, index, shard_path_list
+
+
+def decode_image_bytes(image_bytes, keep_uint8=False):
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8),
+                         cv2.IMREAD_COLOR)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    if keep_uint8:
+        return image
+
+    return image.astype(np.float32)
+
+
+class PackedShardsDataset(Dataset):
+    '''
+    random access dataset for shards packed by pack_image_folder_dataset_to_shards,
+    can replace ILSVRC2012Dataset/ImageNet21KSingleLabelDataset in train_config.py directly.
+    '''
+
+    def __init__(self,
+                 root_dir,
+                 set_name='train',
+                 transform=None,
+                 keep_uint8=False):
+        assert set_name in ['train', 'val'], 'Wrong set name!'
+        meta, index, self.shard_path_list = load_packed_shards_meta_and_index(
+            root_dir, set_name)
+
+        self.shard_ids = index['shard_ids']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.labels = index['labels']
+
+        sub_class_name_list = meta['class_name_list']
+        self.class_name_to_label = {
+            sub_class_name: i
+            for i, sub_class_name in enumerate(sub_class_name_list)
+        }
+        self.label_to_class_name = {
+            i: sub_class_name
+            for i, sub_class_name in enumerate(sub_class_name_list)
+        }
+
+        # shard file descriptors are opened lazily,reads use os.pread with explicit offset,
+        # so descriptors inherited by forked dataloader workers don't share a file offset
+        self.shard_fd_dict = {}
+
+        self.transform = transform
+        # keep_uint8=True:load uint8 image for uint8 data path
+        self.keep_uint8 = keep_uint8
+
+        print(f'Dataset Size:{len(self.labels)}')
+        print(f'Dataset Class Num:{len(self.class_name_to_label)}')
+        print(f'Dataset Shard Num:{len(self.shard_path_list)}')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        shard_id = self.shard_ids[idx]
+        path = f'{self.shard_path_list[shard_id]}:{self.offsets[idx]}'
+        image = self.load_image(idx)
+        label = self.load_label(idx)
+
+        sample = {
+            'path': path,
+            'image': image,
+            'label': label,
+        }
+
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
+
+    def __getstate__(self):
+        # file descriptors can't be pickled to dataloader workers
+        state = self.__dict__.copy()
+        state['shard_fd_dict'] = {}
+
+        return state
+
+    def load_image(self, idx):
+        shard_id = int(self.shard_ids[idx])
+        if shard_id not in self.shard_fd_dict:
+            self.shard_fd_dict[shard_id] = os.open(
+                self.shard_path_list[shard_id], os.O_RDONLY)
+        image_bytes = os.pread(self.shard_fd_dict[shard_id],
+                               int(self.lengths[idx]), int(self.offsets[idx]))
+
+        return decode_image_bytes(image_bytes, self.keep_uint8)
+
+    def load_label(self, idx):
+        label = np.array(self.labels[idx])
+
+        return label.astype(np.float32)
+
+
+class PackedShardsIterableDataset(IterableDataset):
+    '''
+    streaming dataset for shards packed by pack_image_folder_dataset_to_shards.
+    every epoch:
+    1.shuffle shard order with the same seed on all ranks;
+    2.split the concatenated sample stream into equal contiguous parts for each rank and then for each dataloader worker,
+      so every rank gets the same sample num and reads its shards sequentially;
+    3.shuffle samples inside each worker with a shuffle buffer.
+    don't use DistributedSampler with this dataset,call set_epoch(epoch) before each epoch instead.
+    '''
+
+    def __init__(self,
+                 root_dir,
+                 set_name='train',
+                 transform=None,
+                 shuffle=True,
+                 shuffle_buffer_size=2048,
+                 seed=0,
+                 keep_uint8=False):
+        assert set_name in ['train', 'val'], 'Wrong set name!'
+        meta, index, self.shard_path_list = load_packed_shards_meta_and_index(
+            root_dir, set_name)
+
+        self.shard_ids = index['shard_ids']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.labels = index['labels']
+
+        # sample index range [start,end) of every shard
+        self.shard_sample_ranges = []
+        shard_sample_nums = np.bincount(self.shard_ids,
+                                        minlength=len(self.shard_path_list))
+        start = 0
+        for per_shard_sample_num in shard_sample_nums:
+            self.shard_sample_ranges.append(
+                [start, start + int(per_shard_sample_num)])
+            start += int(per_shard_sample_num)
+
+        sub_class_name_list = meta['class_name_list']
+        self.class_name_to_label = {
+            sub_class_name: i
+            for i, sub_class_name in enumerate(sub_class_name_list)
+        }
+        self.label_to_class_name = {
+            i: sub_class_name
+            for i, sub_class_name in enumerate(sub_class_name_list)
+        }
+
+        self.transform = transform
+        # keep_uint8=True:load uint8 image for uint8 data path
+        self.keep_uint8 = keep_uint8
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+        print(f'Dataset Size:{len(self.labels)}')
+        print(f'Dataset Class Num:{len(self.class_name_to_label)}')
+        print(f'Dataset Shard Num:{len(self.shard_path_list)}')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_rank_and_world_size(self):
+        if torch.distributed.is_available(
+        ) and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(
+            ), torch.distributed.get_world_size()
+
+        return 0, 1
+
+    def get_worker_sample_indexes(self):
+        rank, world_size = self.get_rank_and_world_size()
+
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers
+                                  ) if worker_info is not None else (0, 1)
+
+        shard_order = np.arange(len(self.shard_path_list))
+        if self.shuffle:
+            np.random.RandomState(self.seed +
+                                  self.epoch).shuffle(shard_order)
+
+        # samples are stored shard by shard,so concatenating shard ranges keeps reads sequential
+        sample_indexes = np.concatenate([
+            np.arange(self.shard_sample_ranges[i][0],
+                      self.shard_sample_ranges[i][1]) for i in shard_order
+        ])
+
+        # drop tail samples so every rank gets the same sample num
+        per_rank_sample_num = len(sample_indexes) // world_size
+        sample_indexes = sample_indexes[rank *
+                                        per_rank_sample_num:(rank + 1) *
+                                        per_rank_sample_num]
+
+        per_worker_sample_num = int(
+            math.ceil(per_rank_sample_num / num_workers))
+        sample_indexes = sample_indexes[worker_id *
+                                        per_worker_sample_num:(worker_id + 1) *
+                                        per_worker_sample_num]
+
+        # seed with a sequence,so different (seed,epoch,rank,worker_id) never share one shuffle buffer stream
+        random_state = np.random.RandomState(
+            [self.seed, self.epoch, rank, worker_id])
+
+        return sample_indexes, random_state
+
+    def read_samples(self, sample_indexes):
+        opened_shard_id, shard_file = -1, None
+        for idx in sample_indexes:
+            shard_id = int(self.shard_ids[idx])
+            if shard_id != opened_shard_id:
+                shard_file.close() if shard_file is not None else None
+                shard_file = open(self.shard_path_list[shard_id], 'rb')
+                shard_file.seek(int(self.offsets[idx]))
+                opened_shard_id = shard_id
+
+            # samples in sample_indexes are contiguous inside one shard,no seek needed
+            image_bytes = shard_file.read(int(self.lengths[idx]))
+
+            yield idx, image_bytes
+
+        shard_file.close() if shard_file is not None else None
+
+    def build_sample(self, idx, image_bytes):
+        shard_id = self.shard_ids[idx]
+        path = f'{self.shard_path_list[shard_id]}:{self.offsets[idx]}'
+        image = decode_image_bytes(image_bytes, self.keep_uint8)
+        label = np.array(self.labels[idx]).astype(np.float32)
+
+        sample = {
+            'path': path,
+            'image': image,
+            'label': label,
+        }
+
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
+
+    def __iter__(self):
+        sample_indexes, random_state = self.get_worker_sample_indexes()
+
+        if not self.shuffle or self.shuffle_buffer_size <= 1:
+            for idx, image_bytes in self.read_samples(sample_indexes):
+                yield self.build_sample(idx, image_bytes)
+            return
+
+        # keep encoded bytes in shuffle buffer,decode only when the sample is yielded
+        shuffle_buffer = []
+        for idx, image_bytes in self.read_samples(sample_indexes):
+            if len(shuffle_buffer) < self.shuffle_buffer_size:
+                shuffle_buffer.append((idx, image_bytes))
+                continue
+
+            choose_idx = random_state.randint(0, len(shuffle_buffer))
+            yield self.build_sample(*shuffle_buffer[choose_idx])
+            shuffle_buffer[choose_idx] = (idx, image_bytes)
+
+        random_state.shuffle(shuffle_buffer)
+        for idx, image_bytes in shuffle_buffer:
+            yield self.build_sample(idx, image_bytes)
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    import numpy as np
+    import torch
+    seed = 0
+    # for hash
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    # for python and numpy
+    random.seed(seed)
+    np.random.seed(seed)
+    # for cpu gpu
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+    import os
+    import sys
+
+    BASE_DIR = os.path.dirname(
+        os.path.dirname(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    sys.path.append(BASE_DIR)
+
+    from tools.path import ILSVRC2012_path, ILSVRC2012_packed_shards_path
+
+    import torchvision.transforms as transforms
+    from tqdm import tqdm
+
+    from simpleAICV.classification.common import Opencv2PIL, PIL2Opencv, TorchRandomResizedCrop, TorchRandomHorizontalFlip, RandomErasing, TorchResize, TorchCenterCrop, Normalize, AutoAugment, RandAugment, ClassificationCollater
+
+    # pack_image_folder_dataset_to_shards(root_dir=ILSVRC2012_path,
+    #                                     save_dir=ILSVRC2012_packed_shards_path,
+    #                                     set_name='train')
+    # pack_image_folder_dataset_to_shards(root_dir=ILSVRC2012_path,
+    #                                     save_dir=ILSVRC2012_packed_shards_path,
+    #                                     set_name='val',
+    #                                     shuffle_before_pack=False)
+
+    packedtraindataset = PackedShardsIterableDataset(
+        root_dir=ILSVRC2012_packed_shards_path,
+        set_name='train',
+        transform=transforms.Compose([
+            Opencv2PIL(),
+            TorchRandomResizedCrop(resize=224),
+            TorchRandomHorizontalFlip(prob=0.5),
+            PIL2Opencv(),
+            # Normalize(),
+        ]))
+
+    count = 0
+    for per_sample in tqdm(packedtraindataset):
+        print(per_sample['path'], per_sample['image'].shape,
+              per_sample['label'].shape, per_sample['label'],
+              type(per_sample['image']), type(per_sample['label']))
+
+        if count < 2:
+            count += 1
+        else:
+            break
+
+    from torch.utils.data import DataLoader
+    collater = ClassificationCollater()
+    train_loader = DataLoader(packedtraindataset,
+                              batch_size=128,
+                              num_workers=4,
+                              collate_fn=collater)
+
+    count = 0
+    for data in tqdm(train_loader):
+        images, labels = data['image'], data['label']
+        print(images.shape, labels.shape)
+        print(images.dtype, labels.dtype)
+        if count < 2:
+            count += 1
+        else:
+            break
+
+    packedvaldataset = PackedShardsDataset(
+        root_dir=ILSVRC2012_packed_shards_path,
+        set_name='val',
+        transform=transforms.Compose([
+            Opencv2PIL(),
+            TorchResize(resize=256),
+            TorchCenterCrop(resize=224),
+            PIL2Opencv(),
+            Normalize(),
+        ]))
+
+    count = 0
+    for per_sample in tqdm(packedvaldataset):
+        print(per_sample['path'], per_sample['image'].shape,
+              per_sample['label'].shape, per_sample['label'],
+              type(per_sample['image']), type(per_sample['label']))
+
+        if count < 2:
+            count += 1
+        else:
+            break
+
+    from torch.utils.data import DataLoader
+    collater = ClassificationCollater()
+    val_loader = DataLoader(packedvaldataset,
+                            batch_size=128,
+                            shuffle=False,
+                            num_workers=4,
+                            collate_fn=collater)
+
+    count = 0
+    for data in tqdm(val_loader):
+        images, labels = data['image'], data['label']
+        print(images.shape, labels.shape)
+        print(images.dtype, labels.dtype)
+        if count < 2:
+            count += 1
+        else:
+            break
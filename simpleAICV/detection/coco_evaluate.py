@@ -0,0 +1,515 @@
+import multiprocessing
+import numpy as np
+
+import torch
+
+import pycocotools.mask as mask_util
+
+__all__ = [
+    'COCOIncrementalEvaluator',
+]
+
+
+def evaluate_one_category(ious, gt_ignore, gt_iscrowd, dt_outside_area,
+                          iou_thresholds):
+    '''
+    same greedy matching as COCOeval.evaluateImg,all area ranges and iou thresholds are matched together
+    ious:[dt_num,gt_num],dt sorted by score
+    gt_ignore:[area_num,gt_num] bool
+    gt_iscrowd:[gt_num] bool
+    dt_outside_area:[area_num,dt_num] bool
+    return dt_matched,dt_ignore:[area_num,threshold_num,dt_num] bool
+    '''
+    area_num, gt_num = gt_ignore.shape
+    dt_num = dt_outside_area.shape[1]
+    threshold_num = len(iou_thresholds)
+
+    dt_matched = np.zeros((area_num, threshold_num, dt_num), dtype=bool)
+    dt_ignore = np.zeros((area_num, threshold_num, dt_num), dtype=bool)
+
+    if gt_num > 0 and dt_num > 0:
+        thresholds = np.minimum(iou_thresholds, 1 - 1e-10)[None, :, None]
+        gt_ignore = gt_ignore[:, None, :]
+        gt_matched = np.zeros((area_num, threshold_num, gt_num), dtype=bool)
+        gt_index = np.arange(gt_num)
+        for dt_idx in range(dt_num):
+            per_dt_ious = ious[dt_idx]
+            # crowd gt can be matched by several dts
+            candidate = (~gt_matched | gt_iscrowd) & (per_dt_ious
+                                                      >= thresholds)
+            # only match ignored gt when no unignored gt can be matched
+            unignored_candidate = candidate & ~gt_ignore
+            candidate = np.where(
+                unignored_candidate.any(axis=2, keepdims=True),
+                unignored_candidate, candidate & gt_ignore)
+            # max iou gt,last gt for same iou
+            candidate_ious = np.where(candidate, per_dt_ious, -1)
+            match_idx = gt_num - 1 - np.argmax(candidate_ious[:, :, ::-1],
+                                               axis=2)
+            matched = candidate.any(axis=2)
+
+            dt_matched[:, :, dt_idx] = matched
+            dt_ignore[:, :, dt_idx] = matched & np.take_along_axis(
+                np.broadcast_to(gt_ignore, gt_matched.shape),
+                match_idx[:, :, None],
+                axis=2)[:, :, 0]
+            gt_matched |= (gt_index == match_idx[:, :, None]) & matched[:, :,
+                                                                        None]
+
+    # unmatched dts out of area range are ignored
+    dt_ignore |= ~dt_matched & dt_outside_area[:, None, :]
+
+    return dt_matched, dt_ignore
+
+
+def annotation_to_rle(segmentation, image_h, image_w):
+    # same as COCO.annToRLE
+    if isinstance(segmentation, list):
+        rles = mask_util.frPyObjects(segmentation, image_h, image_w)
+        rle = mask_util.merge(rles)
+    elif isinstance(segmentation['counts'], list):
+        rle = mask_util.frPyObjects(segmentation, image_h, image_w)
+    else:
+        rle = segmentation
+
+    return rle
+
+
+def evaluate_one_image(gts, dts, iou_type, area_ranges, iou_thresholds,
+                       max_det):
+    '''
+    gts:dict,category_ids:[gt_num],areas:[gt_num],iscrowd:[gt_num],
+        boxes:[gt_num,4] x_min,y_min,w,h or segmentations:gt annotation segmentation list,image_h,image_w
+    dts:dict,category_ids:[dt_num],scores:[dt_num],boxes:[dt_num,4] x_min,y_min,w,h or rles:dt rle list
+    return:dict,category_id:[dt_scores,dt_matched,dt_ignore,unignored_gt_nums]
+    '''
+    if iou_type == 'segm':
+        gt_objects = [
+            annotation_to_rle(per_segmentation, gts['image_h'],
+                              gts['image_w'])
+            for per_segmentation in gts['segmentations']
+        ]
+        dt_objects = dts['rles']
+        dt_areas = mask_util.area(
+            dt_objects) if len(dt_objects) > 0 else np.zeros((0, ))
+    else:
+        gt_objects = gts['boxes']
+        dt_objects = dts['boxes']
+        dt_areas = dt_objects[:, 2] * dt_objects[:, 3]
+    dt_areas = np.array(dt_areas, dtype=np.float64)
+
+    area_ranges = np.array(area_ranges, dtype=np.float64)
+    image_results = {}
+    for category_id in np.unique(
+            np.concatenate([gts['category_ids'], dts['category_ids']])):
+        gt_idxs = np.nonzero(gts['category_ids'] == category_id)[0]
+        dt_idxs = np.nonzero(dts['category_ids'] == category_id)[0]
+        # dts sorted by score and keep max_det dts,same as COCOeval
+        dt_idxs = dt_idxs[np.argsort(-dts['scores'][dt_idxs],
+                                     kind='mergesort')][0:max_det]
+
+        gt_areas = gts['areas'][gt_idxs]
+        gt_iscrowd = gts['iscrowd'][gt_idxs]
+        gt_ignore = gt_iscrowd[None, :] | (
+            gt_areas[None, :] < area_ranges[:, 0:1]) | (gt_areas[None, :]
+                                                        > area_ranges[:, 1:2])
+        dt_outside_area = (dt_areas[dt_idxs][None, :] < area_ranges[:, 0:1]) | (
+            dt_areas[dt_idxs][None, :] > area_ranges[:, 1:2])
+
+        if len(gt_idxs) > 0 and len(dt_idxs) > 0:
+            ious = mask_util.iou([dt_objects[i] for i in dt_idxs]
+                                 if iou_type == 'segm' else
+                                 dt_objects[dt_idxs], [gt_objects[i]
+                                                       for i in gt_idxs]
+                                 if iou_type == 'segm' else
+                                 gt_objects[gt_idxs],
+                                 gt_iscrowd.astype(np.uint8).tolist())
+            ious = np.array(ious, dtype=np.float64).reshape(
+                len(dt_idxs), len(gt_idxs))
+        else:
+            ious = np.zeros((len(dt_idxs), len(gt_idxs)), dtype=np.float64)
+
+        dt_matched, dt_ignore = evaluate_one_category(ious, gt_ignore,
+                                                      gt_iscrowd,
+                                                      dt_outside_area,
+                                                      iou_thresholds)
+
+        image_results[int(category_id)] = [
+            dts['scores'][dt_idxs],
+            dt_matched,
+            dt_ignore,
+            (~gt_ignore).sum(axis=1),
+        ]
+
+    return image_results
+
+
+class COCOIncrementalEvaluator:
+    '''
+    incremental COCO evaluator,give same 12 stats as pycocotools COCOeval
+    per image matching is done when results of this image are updated(in worker processes if num_workers>0),
+    per image match results are gathered from all ddp ranks before accumulate
+    coco:pycocotools COCO object of ground truth
+    iou_type:'bbox' or 'segm'
+    '''
+
+    def __init__(self, coco, iou_type='bbox', num_workers=0):
+        assert iou_type in ['bbox', 'segm']
+        self.coco = coco
+        self.iou_type = iou_type
+        self.num_workers = num_workers
+
+        self.category_ids = sorted(coco.getCatIds())
+        self.category_id_to_idx = {
+            category_id: idx
+            for idx, category_id in enumerate(self.category_ids)
+        }
+        self.iou_thresholds = np.linspace(.5,
+                                          0.95,
+                                          int(np.round((0.95 - .5) / .05)) + 1,
+                                          endpoint=True)
+        self.recall_thresholds = np.linspace(.0,
+                                             1.00,
+                                             int(np.round((1.00 - .0) / .01)) +
+                                             1,
+                                             endpoint=True)
+        self.max_dets = [1, 10, 100]
+        self.area_ranges = [[0**2, 1e5**2], [0**2, 32**2], [32**2, 96**2],
+                            [96**2, 1e5**2]]
+        self.area_range_labels = ['all', 'small', 'medium', 'large']
+
+        self.pool = None
+        self.pending_results = {}
+        self.image_results = {}
+
+    def get_image_gts(self, image_id):
+        annots = [
+            per_annot for per_annot in self.coco.imgToAnns[image_id]
+            if per_annot['category_id'] in self.category_id_to_idx
+        ]
+        gts = {
+            'category_ids':
+            np.array([per_annot['category_id'] for per_annot in annots],
+                     dtype=np.int64),
+            'areas':
+            np.array([per_annot['area'] for per_annot in annots],
+                     dtype=np.float64),
+            'iscrowd':
+            np.array([
+                'iscrowd' in per_annot and bool(per_annot['iscrowd'])
+                for per_annot in annots
+            ],
+                     dtype=bool),
+        }
+        if self.iou_type == 'segm':
+            image_info = self.coco.imgs[image_id]
+            gts['segmentations'] = [
+                per_annot['segmentation'] for per_annot in annots
+            ]
+            gts['image_h'], gts['image_w'] = image_info['height'], image_info[
+                'width']
+        else:
+            gts['boxes'] = np.array(
+                [per_annot['bbox'] for per_annot in annots],
+                dtype=np.float64).reshape(-1, 4)
+
+        return gts
+
+    def update(self, image_id, scores, category_ids, boxes=None, rles=None):
+        '''
+        add results of one image,update an image without result with empty arrays
+        scores:[dt_num]
+        category_ids:[dt_num],coco category id
+        boxes:[dt_num,4],x_min,y_min,w,h,for bbox
+        rles:dt rle list,for segm
+        '''
+        category_ids = np.array(category_ids, dtype=np.int64).reshape(-1)
+        dts = {
+            'scores': np.array(scores, dtype=np.float64).reshape(-1),
+            'category_ids': category_ids,
+        }
+        if self.iou_type == 'segm':
+            dts['rles'] = list(rles) if rles is not None else []
+        else:
+            dts['boxes'] = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+        # dts of category not in ground truth are not evaluated by COCOeval
+        keep = np.array([
+            per_category_id in self.category_id_to_idx
+            for per_category_id in category_ids
+        ],
+                        dtype=bool).reshape(-1)
+        dts['scores'] = dts['scores'][keep]
+        dts['category_ids'] = dts['category_ids'][keep]
+        if self.iou_type == 'segm':
+            dts['rles'] = [
+                per_rle for per_rle, per_keep in zip(dts['rles'], keep)
+                if per_keep
+            ]
+        else:
+            dts['boxes'] = dts['boxes'][keep]
+
+        args = (self.get_image_gts(image_id), dts, self.iou_type,
+                self.area_ranges, self.iou_thresholds, self.max_dets[-1])
+        if self.num_workers > 0:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.num_workers)
+            self.pending_results[image_id] = self.pool.apply_async(
+                evaluate_one_image, args)
+        else:
+            self.image_results[image_id] = evaluate_one_image(*args)
+
+    def synchronize_between_processes(self):
+        for image_id, per_result in self.pending_results.items():
+            self.image_results[image_id] = per_result.get()
+        self.pending_results = {}
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        if torch.distributed.is_available(
+        ) and torch.distributed.is_initialized():
+            gathered_image_results = [
+                None for _ in range(torch.distributed.get_world_size())
+            ]
+            torch.distributed.all_gather_object(gathered_image_results,
+                                                self.image_results)
+            # padded samples of DistributedSampler are evaluated on two ranks,keep one
+            for per_rank_image_results in gathered_image_results:
+                for image_id, per_result in per_rank_image_results.items():
+                    if image_id not in self.image_results:
+                        self.image_results[image_id] = per_result
+
+    def accumulate(self):
+        '''
+        same as COCOeval.accumulate
+        precision:[threshold_num,recall_threshold_num,category_num,area_num,max_det_num]
+        recall:[threshold_num,category_num,area_num,max_det_num]
+        '''
+        threshold_num = len(self.iou_thresholds)
+        recall_threshold_num = len(self.recall_thresholds)
+        category_num = len(self.category_ids)
+        area_num = len(self.area_ranges)
+        max_det_num = len(self.max_dets)
+
+        precision = -np.ones((threshold_num, recall_threshold_num,
+                              category_num, area_num, max_det_num))
+        recall = -np.ones((threshold_num, category_num, area_num, max_det_num))
+
+        # COCOeval evaluates images in sorted image id order
+        category_results = [[] for _ in range(category_num)]
+        for image_id in sorted(self.image_results.keys()):
+            for category_id, per_result in self.image_results[image_id].items(
+            ):
+                category_results[self.category_id_to_idx[category_id]].append(
+                    per_result)
+
+        for category_idx, per_category_results in enumerate(
+                category_results):
+            if len(per_category_results) == 0:
+                continue
+            for area_idx in range(area_num):
+                unignored_gt_num = sum([
+                    per_result[3][area_idx]
+                    for per_result in per_category_results
+                ])
+                if unignored_gt_num == 0:
+                    continue
+                for max_det_idx, max_det in enumerate(self.max_dets):
+                    dt_scores = np.concatenate([
+                        per_result[0][0:max_det]
+                        for per_result in per_category_results
+                    ])
+                    sorted_idxs = np.argsort(-dt_scores, kind='mergesort')
+                    dt_matched = np.concatenate([
+                        per_result[1][area_idx, :, 0:max_det]
+                        for per_result in per_category_results
+                    ],
+                                                axis=1)[:, sorted_idxs]
+                    dt_ignore = np.concatenate([
+                        per_result[2][area_idx, :, 0:max_det]
+                        for per_result in per_category_results
+                    ],
+                                               axis=1)[:, sorted_idxs]
+
+                    tps = np.logical_and(dt_matched, np.logical_not(dt_ignore))
+                    fps = np.logical_and(np.logical_not(dt_matched),
+                                         np.logical_not(dt_ignore))
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+
+                    dt_num = tp_sum.shape[1]
+                    if dt_num == 0:
+                        recall[:, category_idx, area_idx, max_det_idx] = 0
+                        precision[:, :, category_idx, area_idx,
+                                  max_det_idx] = 0
+                        continue
+
+                    rc = tp_sum / unignored_gt_num
+                    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                    # make precision monotonically decreasing
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    recall[:, category_idx, area_idx, max_det_idx] = rc[:, -1]
+                    for threshold_idx in range(threshold_num):
+                        idxs = np.searchsorted(rc[threshold_idx],
+                                               self.recall_thresholds,
+                                               side='left')
+                        q = np.zeros((recall_threshold_num, ))
+                        valid = idxs < dt_num
+                        q[valid] = pr[threshold_idx][idxs[valid]]
+                        precision[threshold_idx, :, category_idx, area_idx,
+                                  max_det_idx] = q
+
+        return precision, recall
+
+    def summarize(self):
+        '''
+        same 12 stats as COCOeval.summarize
+        return zeros if no detection is added,same as old evaluate_coco_detection
+        '''
+        dt_num = sum([
+            len(per_result[0])
+            for per_image_results in self.image_results.values()
+            for per_result in per_image_results.values()
+        ])
+        if dt_num == 0:
+            return [0] * 12
+
+        precision, recall = self.accumulate()
+
+        def compute_mean(ap=1, iou_threshold=None, area='all', max_det=100):
+            area_idx = self.area_range_labels.index(area)
+            max_det_idx = self.max_dets.index(max_det)
+            s = precision if ap == 1 else recall
+            if iou_threshold is not None:
+                threshold_idx = np.where(
+                    iou_threshold == self.iou_thresholds)[0]
+                s = s[threshold_idx]
+            s = s[..., area_idx, max_det_idx]
+            if len(s[s > -1]) == 0:
+                return -1
+
+            return np.mean(s[s > -1])
+
+        stats = [
+            compute_mean(1),
+            compute_mean(1, iou_threshold=.5),
+            compute_mean(1, iou_threshold=.75),
+            compute_mean(1, area='small'),
+            compute_mean(1, area='medium'),
+            compute_mean(1, area='large'),
+            compute_mean(0, max_det=1),
+            compute_mean(0, max_det=10),
+            compute_mean(0, max_det=100),
+            compute_mean(0, area='small'),
+            compute_mean(0, area='medium'),
+            compute_mean(0, area='large'),
+        ]
+
+        return stats
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    BASE_DIR = os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.append(BASE_DIR)
+
+    import copy
+    import random
+    import time
+    seed = 0
+    # for hash
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    # for python and numpy
+    random.seed(seed)
+    np.random.seed(seed)
+
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+
+    from tools.path import COCO2017_path
+
+    coco = COCO(
+        os.path.join(COCO2017_path, 'annotations',
+                     'instances_val2017.json'))
+    image_ids = sorted(coco.getImgIds())
+    category_ids = sorted(coco.getCatIds())
+
+    # fake results:jittered gt boxes and random false positives
+    results = []
+    for image_id in image_ids:
+        image_info = coco.imgs[image_id]
+        for per_annot in coco.imgToAnns[image_id]:
+            x, y, w, h = per_annot['bbox']
+            results.append({
+                'image_id':
+                image_id,
+                'category_id':
+                per_annot['category_id']
+                if np.random.uniform() < 0.9 else random.choice(category_ids),
+                'score':
+                float(np.float32(np.random.uniform())),
+                'bbox': [
+                    float(np.float32(v)) for v in [
+                        x + np.random.uniform(-0.1, 0.1) * w, y +
+                        np.random.uniform(-0.1, 0.1) * h, w *
+                        np.random.uniform(0.8, 1.2), h *
+                        np.random.uniform(0.8, 1.2)
+                    ]
+                ],
+            })
+        for _ in range(np.random.randint(0, 20)):
+            w, h = np.random.uniform(4, image_info['width'] / 2), np.random.uniform(
+                4, image_info['height'] / 2)
+            results.append({
+                'image_id':
+                image_id,
+                'category_id':
+                random.choice(category_ids),
+                'score':
+                float(np.float32(np.random.uniform())),
+                'bbox': [
+                    float(np.float32(v)) for v in [
+                        np.random.uniform(0, image_info['width'] - w),
+                        np.random.uniform(0, image_info['height'] - h), w, h
+                    ]
+                ],
+            })
+
+    start_time = time.time()
+    coco_eval = COCOeval(coco, coco.loadRes(copy.deepcopy(results)), 'bbox')
+    coco_eval.params.imgIds = image_ids
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+    print(f'COCOeval time: {time.time() - start_time:.2f}s')
+
+    image_id_to_results = {image_id: [] for image_id in image_ids}
+    for per_result in results:
+        image_id_to_results[per_result['image_id']].append(per_result)
+
+    for num_workers in [0, 8]:
+        start_time = time.time()
+        evaluator = COCOIncrementalEvaluator(coco,
+                                             iou_type='bbox',
+                                             num_workers=num_workers)
+        for image_id in image_ids:
+            per_image_results = image_id_to_results[image_id]
+            evaluator.update(
+                image_id,
+                scores=[per_result['score'] for per_result in per_image_results],
+                category_ids=[
+                    per_result['category_id'] for per_result in per_image_results
+                ],
+                boxes=[per_result['bbox'] for per_result in per_image_results])
+        evaluator.synchronize_between_processes()
+        stats = evaluator.summarize()
+        print(
+            f'COCOIncrementalEvaluator num_workers={num_workers} time: {time.time() - start_time:.2f}s'
+        )
+        print('max stats diff:',
+              np.max(np.abs(np.array(stats) - coco_eval.stats)))
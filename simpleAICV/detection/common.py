@@ -6,6 +6,7 @@ BASE_DIR = os.path.dirname(
 sys.path.append(BASE_DIR)
 
 import cv2
+import math
 import numpy as np
 
 import torch
@@ -240,18 +241,36 @@ class Normalize:
         return sample
 
 
+def get_batch_pad_size(images, stride):
+    # pad to per batch max h/w,rounded up to multiple of stride
+    max_h = max([image.shape[0] for image in images])
+    max_w = max([image.shape[1] for image in images])
+    pad_h = int(math.ceil(max_h / stride) * stride)
+    pad_w = int(math.ceil(max_w / stride) * stride)
+
+    return pad_h, pad_w
+
+
 class DetectionCollater:
+    '''
+    pad_to_batch_max:if True,pad images to per batch max size rounded up to stride,
+    otherwise pad images to resize x resize square.
+    '''
 
     def __init__(self,
                  resize=800,
                  resize_type='retina_style',
-                 max_annots_num=100):
+                 max_annots_num=100,
+                 pad_to_batch_max=False,
+                 stride=32):
         assert resize_type in ['retina_style', 'yolo_style']
         self.resize = resize
         if resize_type == 'retina_style':
             self.resize = int(round(self.resize * 1333. / 800))
 
         self.max_annots_num = max_annots_num
+        self.pad_to_batch_max = pad_to_batch_max
+        self.stride = stride
 
     def __call__(self, data):
         images = [s['image'] for s in data]
@@ -259,7 +278,11 @@ class DetectionCollater:
         scales = [s['scale'] for s in data]
         sizes = [s['size'] for s in data]
 
-        input_images = np.zeros((len(images), self.resize, self.resize, 3),
+        pad_h, pad_w = get_batch_pad_size(
+            images,
+            self.stride) if self.pad_to_batch_max else (self.resize,
+                                                        self.resize)
+        input_images = np.zeros((len(images), pad_h, pad_w, 3),
                                 dtype=np.float32)
         for i, image in enumerate(images):
             input_images[i, 0:image.shape[0], 0:image.shape[1], :] = image
@@ -287,16 +310,24 @@ class DetectionCollater:
 
 
 class DETRDetectionCollater:
+    '''
+    pad_to_batch_max:if True,pad images to per batch max size rounded up to stride,
+    otherwise pad images to resize x resize square.
+    '''
 
     def __init__(self,
                  resize=800,
                  resize_type='yolo_style',
-                 max_annots_num=100):
+                 max_annots_num=100,
+                 pad_to_batch_max=False,
+                 stride=32):
         assert resize_type in ['retina_style', 'yolo_style']
         self.resize = resize
         if resize_type == 'retina_style':
             self.resize = int(round(self.resize * 1333. / 800))
         self.max_annots_num = max_annots_num
+        self.pad_to_batch_max = pad_to_batch_max
+        self.stride = stride
 
     def __call__(self, data):
         images = [s['image'] for s in data]
@@ -304,10 +335,13 @@ class DETRDetectionCollater:
         scales = [s['scale'] for s in data]
         sizes = [s['size'] for s in data]
 
-        input_images = np.zeros((len(images), self.resize, self.resize, 3),
+        pad_h, pad_w = get_batch_pad_size(
+            images,
+            self.stride) if self.pad_to_batch_max else (self.resize,
+                                                        self.resize)
+        input_images = np.zeros((len(images), pad_h, pad_w, 3),
                                 dtype=np.float32)
-        masks = torch.ones((len(images), self.resize, self.resize),
-                           dtype=torch.bool)
+        masks = torch.ones((len(images), pad_h, pad_w), dtype=torch.bool)
         scaled_sizes = []
         for i, image in enumerate(images):
             scaled_sizes.append([image.shape[0], image.shape[1]])
@@ -357,3 +391,111 @@ class DETRDetectionCollater:
             'scaled_annots': scaled_annots,
             'scaled_size': scaled_sizes,
         }
+
+
+class AspectRatioGroupedDistributedBatchSampler:
+    '''
+    group images by aspect ratio(h/w) bucket,every batch only contains images from one bucket,
+    use with DetectionCollater/DETRDetectionCollater(pad_to_batch_max=True) to reduce padding.
+    dataset must have get_image_hw_array function,image h/w are read from annotation file.
+    batches are built on global batch(batch_size x num_replicas),so every rank gets same batch num
+    and same bucket at every iter.
+    leftover images of every bucket are merged into mixed batches.
+    batch_size:per gpu batch size
+    '''
+
+    def __init__(self,
+                 dataset,
+                 batch_size,
+                 aspect_ratio_boundaries=[0.5, 0.75, 1.0, 1.333, 2.0],
+                 shuffle=True,
+                 drop_last=True,
+                 seed=0,
+                 num_replicas=None,
+                 rank=None):
+        image_hw_array = dataset.get_image_hw_array()
+        aspect_ratios = image_hw_array[:, 0] / image_hw_array[:, 1]
+        self.group_ids = np.digitize(aspect_ratios,
+                                     sorted(aspect_ratio_boundaries))
+        self.group_num = len(aspect_ratio_boundaries) + 1
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size(
+            ) if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank(
+            ) if torch.distributed.is_initialized() else 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # skip first start_index batches of one epoch,for mid epoch resume
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+    def get_global_batches(self):
+        global_batch_size = self.batch_size * self.num_replicas
+        indices = np.arange(len(self.group_ids))
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            indices = rng.permutation(indices)
+
+        global_batches, leftover_indices = [], []
+        for group_id in range(self.group_num):
+            group_indices = indices[self.group_ids[indices] == group_id]
+            full_batch_num = len(group_indices) // global_batch_size
+            for i in range(full_batch_num):
+                global_batches.append(
+                    group_indices[i * global_batch_size:(i + 1) *
+                                  global_batch_size])
+            leftover_indices.append(group_indices[full_batch_num *
+                                                  global_batch_size:])
+
+        leftover_indices = np.concatenate(leftover_indices)
+        for i in range(0, len(leftover_indices), global_batch_size):
+            per_batch = leftover_indices[i:i + global_batch_size]
+            if len(per_batch) < global_batch_size:
+                if self.drop_last:
+                    continue
+                # repeat indices to make last batch full
+                per_batch = np.concatenate([
+                    per_batch,
+                    np.resize(indices, global_batch_size - len(per_batch))
+                ])
+            global_batches.append(per_batch)
+
+        if self.shuffle:
+            batch_order = rng.permutation(len(global_batches))
+            global_batches = [global_batches[i] for i in batch_order]
+
+        return global_batches
+
+    def __iter__(self):
+        global_batches = self.get_global_batches()[self.start_index:]
+        self.start_index = 0
+        for per_global_batch in global_batches:
+            yield per_global_batch[self.rank *
+                                   self.batch_size:(self.rank + 1) *
+                                   self.batch_size].tolist()
+
+    def __len__(self):
+        global_batch_size = self.batch_size * self.num_replicas
+        group_sizes = np.bincount(self.group_ids, minlength=self.group_num)
+        batch_num = int(np.sum(group_sizes // global_batch_size))
+        leftover_num = int(np.sum(group_sizes % global_batch_size))
+        if self.drop_last:
+            batch_num += leftover_num // global_batch_size
+        else:
+            batch_num += int(math.ceil(leftover_num / global_batch_size))
+        batch_num -= self.start_index
+
+        return batch_num
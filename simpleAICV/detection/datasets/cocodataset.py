@@ -99,6 +99,16 @@ class CocoDetection(Dataset):
     def __len__(self):
         return len(self.image_ids)
 
+    def get_image_hw_array(self):
+        # image h,w from annotation file,no need to decode images
+        image_infos = self.coco.loadImgs(self.image_ids)
+        image_hw_array = np.array(
+            [[per_info['height'], per_info['width']]
+             for per_info in image_infos],
+            dtype=np.float32)
+
+        return image_hw_array
+
     def __getitem__(self, idx):
         file_name = self.coco.loadImgs(self.image_ids[idx])[0]['file_name']
         path = os.path.join(self.image_dir, file_name)
@@ -994,3 +1004,54 @@ if __name__ == '__main__':
             count += 1
         else:
             break
+
+    # compare square padding with aspect ratio grouped batches padded to batch max size
+    import time
+    from simpleAICV.detection.common import AspectRatioGroupedDistributedBatchSampler
+
+    retina_style_cocodataset = CocoDetection(
+        COCO2017_path,
+        set_name='train2017',
+        transform=transforms.Compose([
+            RandomHorizontalFlip(prob=0.5),
+            DetectionResize(resize=800,
+                            stride=32,
+                            resize_type='retina_style',
+                            multi_scale=False,
+                            multi_scale_range=[0.8, 1.0]),
+            Normalize(),
+        ]))
+    square_train_loader = DataLoader(retina_style_cocodataset,
+                                     batch_size=8,
+                                     shuffle=True,
+                                     num_workers=4,
+                                     collate_fn=DetectionCollater(
+                                         resize=800,
+                                         resize_type='retina_style',
+                                         max_annots_num=100))
+    group_train_loader = DataLoader(
+        retina_style_cocodataset,
+        batch_sampler=AspectRatioGroupedDistributedBatchSampler(
+            retina_style_cocodataset, batch_size=8, num_replicas=1, rank=0),
+        num_workers=4,
+        collate_fn=DetectionCollater(resize=800,
+                                     resize_type='retina_style',
+                                     max_annots_num=100,
+                                     pad_to_batch_max=True,
+                                     stride=32))
+
+    for name, loader in [['square', square_train_loader],
+                         ['group', group_train_loader]]:
+        start_time, image_num, valid_pixel_num, total_pixel_num = time.time(
+        ), 0, 0, 0
+        for i, data in enumerate(tqdm(loader)):
+            images, sizes = data['image'], data['size']
+            image_num += images.shape[0]
+            valid_pixel_num += float(np.sum(sizes[:, 0] * sizes[:, 1]))
+            total_pixel_num += float(images.shape[0] * images.shape[2] *
+                                     images.shape[3])
+            if i == 100:
+                break
+        print(
+            f'{name}: {image_num / (time.time() - start_time):.1f} images/sec, padding ratio: {1. - valid_pixel_num / total_pixel_num:.3f}'
+        )
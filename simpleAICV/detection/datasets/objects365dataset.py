@@ -229,6 +229,16 @@ class Objects365Detection(Dataset):
     def __len__(self):
         return len(self.image_ids)
 
+    def get_image_hw_array(self):
+        # image h,w from annotation file,no need to decode images
+        image_infos = self.coco.loadImgs(self.image_ids)
+        image_hw_array = np.array(
+            [[per_info['height'], per_info['width']]
+             for per_info in image_infos],
+            dtype=np.float32)
+
+        return image_hw_array
+
     def __getitem__(self, idx):
         file_name = self.coco.loadImgs(self.image_ids[idx])[0]['file_name']
         file_name = file_name[10:]
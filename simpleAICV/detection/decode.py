@@ -11,7 +11,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from torchvision.ops import nms
+from torchvision.ops import nms, batched_nms
 
 from simpleAICV.detection.models.anchor import RetinaAnchors, FCOSPositions
 
@@ -172,6 +172,189 @@ class DecodeMethod:
         return [batch_scores, batch_classes, batch_bboxes]
 
 
+class BatchDetNMSMethod:
+    '''
+    nms for all images of a batch at once on device
+    torch_nms:torchvision batched_nms,image index is used as category offset
+    python_nms/diou_python_nms:same results as DetNMSMethod,use batch iou matrix,
+    greedy nms is computed as fixed point of keep mask,iteration num is the longest suppression chain length.
+    '''
+
+    def __init__(self, nms_type='python_nms', nms_threshold=0.5):
+        assert nms_type in ['torch_nms', 'python_nms',
+                            'diou_python_nms'], 'wrong nms type!'
+        self.nms_type = nms_type
+        self.nms_threshold = nms_threshold
+
+    def __call__(self, sorted_bboxes, sorted_scores, valid_mask):
+        '''
+        sorted_bboxes:[batch_size,topn,4],4:x_min,y_min,x_max,y_max
+        sorted_scores:[batch_size,topn],descending sorted classification predict scores
+        valid_mask:[batch_size,topn],bool
+        return keep mask:[batch_size,topn],bool
+        '''
+        batch_size, topn = sorted_scores.shape
+        device = sorted_scores.device
+
+        if self.nms_type == 'torch_nms':
+            image_idxs = torch.arange(batch_size, device=device).unsqueeze(
+                -1).expand(batch_size, topn)
+            flat_valid_idxs = torch.nonzero(valid_mask.reshape(-1),
+                                            as_tuple=False).squeeze(-1)
+            keep_idxs = batched_nms(
+                sorted_bboxes.reshape(-1, 4)[flat_valid_idxs].float(),
+                sorted_scores.reshape(-1)[flat_valid_idxs].float(),
+                image_idxs.reshape(-1)[flat_valid_idxs], self.nms_threshold)
+            keep = torch.zeros(batch_size * topn,
+                               dtype=torch.bool,
+                               device=device)
+            keep[flat_valid_idxs[keep_idxs]] = True
+            keep = keep.reshape(batch_size, topn)
+        else:
+            ious = self.compute_batch_ious(sorted_bboxes.float())
+            # suppress[b,i,j]:box i suppress box j(i<j) if box i is kept
+            suppress = (ious >= self.nms_threshold) & torch.triu(
+                torch.ones((topn, topn), dtype=torch.bool, device=device),
+                diagonal=1).unsqueeze(0)
+            suppress = suppress & valid_mask.unsqueeze(-1)
+
+            keep = valid_mask.clone()
+            while True:
+                new_keep = valid_mask & (~torch.any(
+                    suppress & keep.unsqueeze(-1), dim=1))
+                if torch.equal(new_keep, keep):
+                    break
+                keep = new_keep
+
+        return keep
+
+    def compute_batch_ious(self, boxes):
+        '''
+        boxes:[batch_size,topn,4]
+        return ious:[batch_size,topn,topn]
+        '''
+        boxes_wh = boxes[:, :, 2:4] - boxes[:, :, 0:2]
+        boxes_areas = torch.clamp(boxes_wh[:, :, 0] * boxes_wh[:, :, 1], min=0)
+
+        overlap_area_top_left = torch.max(boxes[:, :, None, 0:2],
+                                          boxes[:, None, :, 0:2])
+        overlap_area_bot_right = torch.min(boxes[:, :, None, 2:4],
+                                           boxes[:, None, :, 2:4])
+        overlap_area_sizes = torch.clamp(overlap_area_bot_right -
+                                         overlap_area_top_left,
+                                         min=0)
+        overlap_area = overlap_area_sizes[:, :, :,
+                                          0] * overlap_area_sizes[:, :, :, 1]
+
+        union_area = boxes_areas[:, :, None] + boxes_areas[:,
+                                                           None, :] - overlap_area
+        union_area = torch.clamp(union_area, min=1e-4)
+        ious = overlap_area / union_area
+
+        if self.nms_type == 'diou_python_nms':
+            enclose_area_top_left = torch.min(boxes[:, :, None, 0:2],
+                                              boxes[:, None, :, 0:2])
+            enclose_area_bot_right = torch.max(boxes[:, :, None, 2:4],
+                                               boxes[:, None, :, 2:4])
+            enclose_area_sizes = torch.clamp(enclose_area_bot_right -
+                                             enclose_area_top_left,
+                                             min=0)
+            # c2:convex diagonal squared
+            c2 = torch.clamp((enclose_area_sizes**2).sum(dim=-1), min=1e-4)
+            # p2:center distance squared
+            boxes_ctr = (boxes[:, :, 2:4] + boxes[:, :, 0:2]) / 2
+            p2 = ((boxes_ctr[:, :, None, :] -
+                   boxes_ctr[:, None, :, :])**2).sum(dim=-1)
+            ious = ious - p2 / c2
+
+        return ious
+
+
+class BatchDecodeMethod:
+    '''
+    same as DecodeMethod,but all inputs are tensors and all images are decoded at once on device
+    '''
+
+    def __init__(self,
+                 max_object_num=100,
+                 min_score_threshold=0.05,
+                 topn=1000,
+                 nms_type='python_nms',
+                 nms_threshold=0.5):
+        self.max_object_num = max_object_num
+        self.min_score_threshold = min_score_threshold
+        self.topn = topn
+        self.nms_function = BatchDetNMSMethod(nms_type=nms_type,
+                                              nms_threshold=nms_threshold)
+
+    def __call__(self, cls_scores, cls_classes, pred_bboxes):
+        '''
+        cls_scores:[batch_size,anchor_nums]
+        cls_classes:[batch_size,anchor_nums]
+        pred_bboxes:[batch_size,anchor_nums,4]
+        '''
+        batch_size = cls_scores.shape[0]
+        device = cls_scores.device
+
+        cls_scores = cls_scores.float()
+        masked_scores = torch.where(cls_scores > self.min_score_threshold,
+                                    cls_scores,
+                                    torch.full_like(cls_scores, -1))
+        topn = min(self.topn, masked_scores.shape[1])
+        sorted_scores, sorted_indexes = torch.topk(masked_scores,
+                                                   topn,
+                                                   dim=1,
+                                                   largest=True,
+                                                   sorted=True)
+        valid_mask = sorted_scores > self.min_score_threshold
+        sorted_score_classes = torch.gather(cls_classes, 1,
+                                            sorted_indexes).float()
+        sorted_bboxes = torch.gather(
+            pred_bboxes, 1,
+            sorted_indexes.unsqueeze(-1).expand(-1, -1, 4)).float()
+
+        # nms
+        keep = self.nms_function(sorted_bboxes, sorted_scores, valid_mask)
+
+        # kept boxes are still in descending score order,take first max_object_num
+        keep_scores = torch.where(keep, sorted_scores,
+                                  torch.full_like(sorted_scores, -1))
+        final_num = min(self.max_object_num, topn)
+        keep_scores, keep_indexes = torch.topk(keep_scores,
+                                               final_num,
+                                               dim=1,
+                                               largest=True,
+                                               sorted=True)
+        keep_valid = keep_scores > -1
+        keep_classes = torch.gather(sorted_score_classes, 1, keep_indexes)
+        keep_bboxes = torch.gather(
+            sorted_bboxes, 1,
+            keep_indexes.unsqueeze(-1).expand(-1, -1, 4))
+
+        batch_scores = torch.ones((batch_size, self.max_object_num),
+                                  dtype=torch.float32,
+                                  device=device) * (-1)
+        batch_classes = torch.ones((batch_size, self.max_object_num),
+                                   dtype=torch.float32,
+                                   device=device) * (-1)
+        batch_bboxes = torch.zeros((batch_size, self.max_object_num, 4),
+                                   dtype=torch.float32,
+                                   device=device)
+        batch_scores[:, 0:final_num] = torch.where(keep_valid, keep_scores,
+                                                   batch_scores[:,
+                                                                0:final_num])
+        batch_classes[:, 0:final_num] = torch.where(
+            keep_valid, keep_classes, batch_classes[:, 0:final_num])
+        batch_bboxes[:, 0:final_num, :] = torch.where(
+            keep_valid.unsqueeze(-1), keep_bboxes,
+            batch_bboxes[:, 0:final_num, :])
+
+        # batch_scores shape:[batch_size,max_object_num]
+        # batch_classes shape:[batch_size,max_object_num]
+        # batch_bboxes shape[batch_size,max_object_num,4]
+        return [batch_scores, batch_classes, batch_bboxes]
+
+
 class RetinaDecoder:
 
     def __init__(self,
@@ -184,25 +367,47 @@ class RetinaDecoder:
                  min_score_threshold=0.05,
                  topn=1000,
                  nms_type='python_nms',
-                 nms_threshold=0.5):
+                 nms_threshold=0.5,
+                 decode_on_device=False,
+                 return_numpy=True):
+        '''
+        decode_on_device:if True,decode all images at once on preds device
+        return_numpy:only for decode_on_device=True,if False,return padded tensors on device
+        '''
         assert nms_type in ['torch_nms', 'python_nms',
                             'diou_python_nms'], 'wrong nms type!'
         self.anchors = RetinaAnchors(areas=areas,
                                      ratios=ratios,
                                      scales=scales,
                                      strides=strides)
-        self.decode_function = DecodeMethod(
-            max_object_num=max_object_num,
-            min_score_threshold=min_score_threshold,
-            topn=topn,
-            nms_type=nms_type,
-            nms_threshold=nms_threshold)
+        self.decode_on_device = decode_on_device
+        self.return_numpy = return_numpy
+        if self.decode_on_device:
+            self.decode_function = BatchDecodeMethod(
+                max_object_num=max_object_num,
+                min_score_threshold=min_score_threshold,
+                topn=topn,
+                nms_type=nms_type,
+                nms_threshold=nms_threshold)
+        else:
+            self.decode_function = DecodeMethod(
+                max_object_num=max_object_num,
+                min_score_threshold=min_score_threshold,
+                topn=topn,
+                nms_type=nms_type,
+                nms_threshold=nms_threshold)
 
     def __call__(self, preds):
         cls_preds, reg_preds = preds
         feature_size = [[
             per_level_cls_pred.shape[2], per_level_cls_pred.shape[1]
         ] for per_level_cls_pred in cls_preds]
+        if self.decode_on_device:
+            one_image_anchors = self.anchors.get_one_image_anchors_tensor(
+                feature_size, cls_preds[0].device)
+            return self.decode_on_device_function(cls_preds, reg_preds,
+                                                  one_image_anchors)
+
         one_image_anchors = self.anchors(feature_size)
 
         cls_preds = np.concatenate([
@@ -270,6 +475,52 @@ class RetinaDecoder:
         # pred bboxes shape:[batch,anchor_nums,4]
         return pred_bboxes
 
+    def decode_on_device_function(self, cls_preds, reg_preds,
+                                  one_image_anchors):
+        '''
+        one_image_anchors:[anchor_nums,4] cached anchors tensor on device
+        '''
+        cls_preds = torch.cat([
+            per_cls_pred.detach().reshape(per_cls_pred.shape[0], -1,
+                                          per_cls_pred.shape[-1])
+            for per_cls_pred in cls_preds
+        ],
+                              dim=1)
+        reg_preds = torch.cat([
+            per_reg_pred.detach().reshape(per_reg_pred.shape[0], -1,
+                                          per_reg_pred.shape[-1])
+            for per_reg_pred in reg_preds
+        ],
+                              dim=1)
+
+        cls_scores, cls_classes = torch.max(cls_preds, dim=2)
+
+        # snap reg heads to pred bboxes
+        anchors_wh = one_image_anchors[:, 2:4] - one_image_anchors[:, 0:2]
+        anchors_ctr = one_image_anchors[:, 0:2] + 0.5 * anchors_wh
+        pred_bboxes_wh = torch.exp(reg_preds[:, :, 2:4].float()) * anchors_wh
+        pred_bboxes_ctr = reg_preds[:, :, :2].float() * anchors_wh + anchors_ctr
+        pred_bboxes = torch.cat([
+            pred_bboxes_ctr - 0.5 * pred_bboxes_wh,
+            pred_bboxes_ctr + 0.5 * pred_bboxes_wh
+        ],
+                                dim=2)
+        # same as astype(np.int32)
+        pred_bboxes = torch.trunc(pred_bboxes)
+
+        [batch_scores, batch_classes,
+         batch_bboxes] = self.decode_function(cls_scores, cls_classes,
+                                              pred_bboxes)
+
+        if self.return_numpy:
+            batch_scores, batch_classes, batch_bboxes = batch_scores.cpu(
+            ).numpy(), batch_classes.cpu().numpy(), batch_bboxes.cpu().numpy()
+
+        # batch_scores shape:[batch_size,max_object_num]
+        # batch_classes shape:[batch_size,max_object_num]
+        # batch_bboxes shape[batch_size,max_object_num,4]
+        return [batch_scores, batch_classes, batch_bboxes]
+
 
 class FCOSDecoder:
 
@@ -279,22 +530,45 @@ class FCOSDecoder:
                  min_score_threshold=0.05,
                  topn=1000,
                  nms_type='python_nms',
-                 nms_threshold=0.6):
+                 nms_threshold=0.6,
+                 decode_on_device=False,
+                 return_numpy=True):
+        '''
+        decode_on_device:if True,decode all images at once on preds device
+        return_numpy:only for decode_on_device=True,if False,return padded tensors on device
+        '''
         assert nms_type in ['torch_nms', 'python_nms',
                             'diou_python_nms'], 'wrong nms type!'
         self.positions = FCOSPositions(strides=strides)
-        self.decode_function = DecodeMethod(
-            max_object_num=max_object_num,
-            min_score_threshold=min_score_threshold,
-            topn=topn,
-            nms_type=nms_type,
-            nms_threshold=nms_threshold)
+        self.decode_on_device = decode_on_device
+        self.return_numpy = return_numpy
+        if self.decode_on_device:
+            self.decode_function = BatchDecodeMethod(
+                max_object_num=max_object_num,
+                min_score_threshold=min_score_threshold,
+                topn=topn,
+                nms_type=nms_type,
+                nms_threshold=nms_threshold)
+        else:
+            self.decode_function = DecodeMethod(
+                max_object_num=max_object_num,
+                min_score_threshold=min_score_threshold,
+                topn=topn,
+                nms_type=nms_type,
+                nms_threshold=nms_threshold)
 
     def __call__(self, preds):
         cls_preds, reg_preds, center_preds = preds
         feature_size = [[
             per_level_cls_pred.shape[2], per_level_cls_pred.shape[1]
         ] for per_level_cls_pred in cls_preds]
+        if self.decode_on_device:
+            one_image_positions, _ = self.positions.get_one_image_positions_tensor(
+                feature_size, cls_preds[0].device)
+            return self.decode_on_device_function(cls_preds, reg_preds,
+                                                  center_preds,
+                                                  one_image_positions)
+
         one_image_positions = self.positions(feature_size)
 
         cls_preds = [
@@ -363,6 +637,56 @@ class FCOSDecoder:
         # pred bboxes shape:[batch,points_num,4]
         return pred_bboxes
 
+    def decode_on_device_function(self, cls_preds, reg_preds, center_preds,
+                                  one_image_positions):
+        '''
+        one_image_positions:[points_num,2] cached positions tensor on device
+        '''
+        cls_preds = torch.cat([
+            per_cls_pred.detach().reshape(per_cls_pred.shape[0], -1,
+                                          per_cls_pred.shape[-1])
+            for per_cls_pred in cls_preds
+        ],
+                              dim=1)
+        reg_preds = torch.cat([
+            per_reg_pred.detach().reshape(per_reg_pred.shape[0], -1,
+                                          per_reg_pred.shape[-1])
+            for per_reg_pred in reg_preds
+        ],
+                              dim=1)
+        center_preds = torch.cat([
+            per_center_pred.detach().reshape(per_center_pred.shape[0], -1,
+                                             per_center_pred.shape[-1])
+            for per_center_pred in center_preds
+        ],
+                                 dim=1)
+
+        cls_scores, cls_classes = torch.max(cls_preds.float(), dim=2)
+        cls_scores = torch.sqrt(cls_scores * center_preds.float().squeeze(-1))
+
+        # snap reg preds to pred bboxes
+        reg_preds = torch.exp(reg_preds.float())
+        pred_bboxes = torch.cat([
+            one_image_positions - reg_preds[:, :, 0:2],
+            one_image_positions + reg_preds[:, :, 2:4]
+        ],
+                                dim=2)
+        # same as astype(np.int32)
+        pred_bboxes = torch.trunc(pred_bboxes)
+
+        [batch_scores, batch_classes,
+         batch_bboxes] = self.decode_function(cls_scores, cls_classes,
+                                              pred_bboxes)
+
+        if self.return_numpy:
+            batch_scores, batch_classes, batch_bboxes = batch_scores.cpu(
+            ).numpy(), batch_classes.cpu().numpy(), batch_bboxes.cpu().numpy()
+
+        # batch_scores shape:[batch_size,max_object_num]
+        # batch_classes shape:[batch_size,max_object_num]
+        # batch_bboxes shape[batch_size,max_object_num,4]
+        return [batch_scores, batch_classes, batch_bboxes]
+
 
 class DETRDecoder:
 
@@ -761,3 +1085,57 @@ if __name__ == '__main__':
         print('3333', batch_scores.shape, batch_classes.shape,
               batch_pred_bboxes.shape)
         break
+
+    ############################################################################
+    # decode latency benchmark:numpy decode vs batch decode on device
+    import time
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    for data in tqdm(train_loader):
+        images = data['image'].to(device)
+        break
+
+    net = resnet50_retinanet().to(device)
+    net.eval()
+    with torch.no_grad():
+        retina_preds = net(images)
+    net = resnet50_fcos().to(device)
+    net.eval()
+    with torch.no_grad():
+        fcos_preds = net(images)
+
+    for decoder_class, preds in [[RetinaDecoder, retina_preds],
+                                 [FCOSDecoder, fcos_preds]]:
+        for nms_type in ['torch_nms', 'python_nms', 'diou_python_nms']:
+            numpy_decode = decoder_class(topn=1000,
+                                         min_score_threshold=0.01,
+                                         nms_type=nms_type,
+                                         max_object_num=100)
+            device_decode = decoder_class(topn=1000,
+                                          min_score_threshold=0.01,
+                                          nms_type=nms_type,
+                                          max_object_num=100,
+                                          decode_on_device=True,
+                                          return_numpy=True)
+            decode_results, decode_times = [], []
+            for decode in [numpy_decode, device_decode]:
+                # warm up
+                decode(preds)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                start_time = time.time()
+                for _ in range(10):
+                    batch_scores, batch_classes, batch_pred_bboxes = decode(
+                        preds)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                decode_times.append((time.time() - start_time) / 10)
+                decode_results.append(
+                    [batch_scores, batch_classes, batch_pred_bboxes])
+
+            same_object_num = np.sum(
+                (decode_results[0][1] > -1).sum(axis=1) == (
+                    decode_results[1][1] > -1).sum(axis=1))
+            print(
+                f'{decoder_class.__name__} {nms_type}: numpy decode {decode_times[0] * 1000:.2f}ms/batch, device decode {decode_times[1] * 1000:.2f}ms/batch, same object num images: {same_object_num}/{images.shape[0]}'
+            )
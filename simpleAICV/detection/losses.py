@@ -7,9 +7,11 @@ BASE_DIR = os.path.dirname(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(BASE_DIR)
 
+import concurrent.futures
 import math
 import numpy as np
 import scipy
+import scipy.optimize
 
 import torch
 import torch.nn as nn
@@ -123,6 +125,24 @@ class IoUMethod:
                     return ious - (enclose_area - union_area) / enclose_area
 
 
+def compact_batch_annotations(annotations):
+    '''
+    move valid annotations(class index>=0) of every image to the front and
+    cut padded annotations to max valid annotation num in batch
+    annotations:[batch_size,max_annots_num,5]
+    return annotations:[batch_size,max_valid_num,5],valid_mask:[batch_size,max_valid_num]
+    '''
+    valid_mask = annotations[:, :, 4] >= 0
+    _, order = torch.sort((~valid_mask).int(), dim=1, stable=True)
+    annotations = torch.gather(
+        annotations, 1,
+        order.unsqueeze(-1).expand(-1, -1, annotations.shape[-1]))
+    valid_mask = torch.gather(valid_mask, 1, order)
+    max_valid_num = int(valid_mask.sum(dim=1).max())
+
+    return annotations[:, 0:max_valid_num], valid_mask[:, 0:max_valid_num]
+
+
 class RetinaLoss(nn.Module):
 
     def __init__(self,
@@ -136,7 +156,8 @@ class RetinaLoss(nn.Module):
                  beta=1.0 / 9.0,
                  cls_loss_weight=1.,
                  box_loss_weight=1.,
-                 box_loss_type='SmoothL1'):
+                 box_loss_type='SmoothL1',
+                 use_batch_assigner=True):
         super(RetinaLoss, self).__init__()
         assert box_loss_type in [
             'SmoothL1',
@@ -157,6 +178,8 @@ class RetinaLoss(nn.Module):
         self.box_loss_weight = box_loss_weight
         self.box_loss_type = box_loss_type
         self.iou_function = IoUMethod()
+        # batch assigner gives same targets as per image assigner
+        self.use_batch_assigner = use_batch_assigner
 
     def forward(self, preds, annotations):
         '''
@@ -169,16 +192,17 @@ class RetinaLoss(nn.Module):
         feature_size = [[
             per_level_cls_pred.shape[2], per_level_cls_pred.shape[1]
         ] for per_level_cls_pred in cls_preds]
-        one_image_anchors = self.anchors(feature_size)
-        one_image_anchors = torch.cat([
-            torch.tensor(per_level_anchor).view(-1, per_level_anchor.shape[-1])
-            for per_level_anchor in one_image_anchors
-        ],
-                                      dim=0)
-        batch_anchors = one_image_anchors.unsqueeze(0).repeat(
-            batch_size, 1, 1).to(device)
-        batch_anchors_annotations = self.get_batch_anchors_annotations(
-            batch_anchors, annotations)
+        # cached anchors on device,broadcast to batch without copy
+        one_image_anchors = self.anchors.get_one_image_anchors_tensor(
+            feature_size, device)
+        batch_anchors = one_image_anchors.unsqueeze(0).expand(
+            batch_size, -1, -1)
+        if self.use_batch_assigner:
+            batch_anchors_annotations = self.assign_batch_anchors_annotations(
+                one_image_anchors, annotations)
+        else:
+            batch_anchors_annotations = self.get_batch_anchors_annotations(
+                batch_anchors, annotations)
 
         cls_preds = [
             per_cls_pred.view(per_cls_pred.shape[0], -1,
@@ -197,7 +221,6 @@ class RetinaLoss(nn.Module):
 
         cls_preds = cls_preds.view(-1, cls_preds.shape[-1])
         reg_preds = reg_preds.view(-1, reg_preds.shape[-1])
-        batch_anchors = batch_anchors.view(-1, batch_anchors.shape[-1])
         batch_anchors_annotations = batch_anchors_annotations.view(
             -1, batch_anchors_annotations.shape[-1])
 
@@ -266,12 +289,13 @@ class RetinaLoss(nn.Module):
         compute batch smoothl1 loss(reg loss)
         reg_preds:[batch_size*anchor_num,4]
         batch_anchors_annotations:[batch_size*anchor_num,5]
-        batch_anchors:[batch_size*anchor_num,4]
+        batch_anchors:[batch_size,anchor_num,4],broadcast view of one image anchors
         '''
         # Filter anchors with gt class=-1, this part of anchor doesn't calculate smoothl1 loss
         device = reg_preds.device
         reg_preds = reg_preds[batch_anchors_annotations[:, 4] > 0]
-        batch_anchors = batch_anchors[batch_anchors_annotations[:, 4] > 0]
+        batch_anchors = batch_anchors[(batch_anchors_annotations[:, 4] > 0).view(
+            batch_anchors.shape[0], batch_anchors.shape[1])]
         batch_anchors_annotations = batch_anchors_annotations[
             batch_anchors_annotations[:, 4] > 0]
         positive_anchor_num = batch_anchors_annotations.shape[0]
@@ -387,6 +411,98 @@ class RetinaLoss(nn.Module):
         # batch anchors annotations shape:[batch_size, anchor_nums, 5]
         return batch_anchors_annotations
 
+    def assign_batch_anchors_annotations(self, one_image_anchors,
+                                         annotations):
+        '''
+        same targets as get_batch_anchors_annotations,assign all images at once
+        one_image_anchors:[anchor_nums,4]
+        annotations:[batch_size,max_annots_num,5],padded with -1
+        memory:[batch_size,anchor_nums,max_valid_annots_num]
+        '''
+        device = annotations.device
+        batch_size, anchor_nums = annotations.shape[0], one_image_anchors.shape[
+            0]
+
+        annotations, valid_mask = compact_batch_annotations(annotations)
+        if annotations.shape[1] == 0:
+            return torch.ones([batch_size, anchor_nums, 5],
+                              dtype=torch.float32,
+                              device=device) * (-1)
+
+        gt_bboxes = annotations[:, :, 0:4]
+        gt_class = annotations[:, :, 4]
+
+        # ious:[batch_size,anchor_nums,max_valid_num],same float ops as IoUMethod
+        anchors_x1, anchors_y1, anchors_x2, anchors_y2 = [
+            one_image_anchors[None, :, None, i] for i in range(4)
+        ]
+        gt_x1, gt_y1, gt_x2, gt_y2 = [
+            gt_bboxes[:, None, :, i] for i in range(4)
+        ]
+        overlap_w = torch.clamp(
+            torch.min(anchors_x2, gt_x2) - torch.max(anchors_x1, gt_x1),
+            min=0)
+        overlap_h = torch.clamp(
+            torch.min(anchors_y2, gt_y2) - torch.max(anchors_y1, gt_y1),
+            min=0)
+        overlap_area = overlap_w * overlap_h
+        anchors_area = torch.clamp(
+            anchors_x2 - anchors_x1, min=0) * torch.clamp(
+                anchors_y2 - anchors_y1, min=0)
+        gt_area = torch.clamp(gt_x2 - gt_x1, min=0) * torch.clamp(
+            gt_y2 - gt_y1, min=0)
+        union_area = torch.clamp(anchors_area + gt_area - overlap_area,
+                                 min=1e-4)
+        ious = overlap_area / union_area
+        del overlap_w, overlap_h, overlap_area, union_area
+
+        # padded annotations never be the max iou annotation
+        ious = torch.where(valid_mask.unsqueeze(1), ious,
+                           torch.full_like(ious, -1))
+        overlap, indices = ious.max(dim=2)
+        del ious
+
+        anchors_gt_class = torch.ones_like(overlap) * -1
+        # if iou <0.4,assign anchors gt class as 0:background
+        anchors_gt_class = torch.where(overlap < 0.4,
+                                       torch.zeros_like(anchors_gt_class),
+                                       anchors_gt_class)
+        # if iou >=0.5,assign anchors gt class as same as the max iou annotation class:80 classes index from 1 to 80
+        anchors_gt_class = torch.where(
+            overlap >= 0.5,
+            torch.gather(gt_class, 1, indices) + 1, anchors_gt_class)
+
+        # assgin each anchor gt bboxes for max iou annotation
+        anchors_gt_bboxes = torch.gather(
+            gt_bboxes, 1,
+            indices.unsqueeze(-1).expand(-1, -1, 4))
+        if self.box_loss_type == 'SmoothL1':
+            # transform gt bboxes to [tx,ty,tw,th] format for each anchor,anchors are broadcast
+            anchors_w_h = one_image_anchors[:, 2:] - one_image_anchors[:, :2]
+            anchors_ctr = one_image_anchors[:, :2] + 0.5 * anchors_w_h
+            anchors_gt_bboxes_w_h = anchors_gt_bboxes[:, :, 2:] - anchors_gt_bboxes[:, :, :2]
+            anchors_gt_bboxes_w_h = torch.clamp(anchors_gt_bboxes_w_h,
+                                                min=1e-4)
+            anchors_gt_bboxes_ctr = anchors_gt_bboxes[:, :, :
+                                                      2] + 0.5 * anchors_gt_bboxes_w_h
+            anchors_gt_bboxes = torch.cat(
+                [(anchors_gt_bboxes_ctr - anchors_ctr) / anchors_w_h,
+                 torch.log(anchors_gt_bboxes_w_h / anchors_w_h)],
+                dim=2)
+
+        batch_anchors_annotations = torch.cat(
+            [anchors_gt_bboxes,
+             anchors_gt_class.unsqueeze(-1)], dim=2)
+
+        # images without annotations:all anchors annotations are -1
+        has_annotation = valid_mask.any(dim=1).view(-1, 1, 1)
+        batch_anchors_annotations = torch.where(
+            has_annotation, batch_anchors_annotations,
+            torch.full_like(batch_anchors_annotations, -1))
+
+        # batch anchors annotations shape:[batch_size, anchor_nums, 5]
+        return batch_anchors_annotations
+
     def snap_annotations_to_txtytwth(self, anchors_gt_bboxes, anchors):
         '''
         snap each anchor ground truth bbox form format:[x_min,y_min,x_max,y_max] to format:[tx,ty,tw,th]
@@ -442,7 +558,8 @@ class FCOSLoss(nn.Module):
                  center_ness_loss_weight=1.,
                  box_loss_iou_type='GIoU',
                  center_sample_radius=1.5,
-                 use_center_sample=True):
+                 use_center_sample=True,
+                 use_batch_assigner=True):
         super(FCOSLoss, self).__init__()
         assert box_loss_iou_type in ['IoU', 'GIoU', 'DIoU', 'CIoU',
                                      'EIoU'], 'wrong IoU type!'
@@ -459,31 +576,56 @@ class FCOSLoss(nn.Module):
         self.use_center_sample = use_center_sample
         self.iou_function = IoUMethod()
 
+        self.mi_tensor = torch.tensor(mi, dtype=torch.float32)
+        self.strides_tensor = torch.tensor(strides, dtype=torch.float32)
+        # batch assigner gives same targets as per image assigner
+        self.use_batch_assigner = use_batch_assigner
+
     def forward(self, preds, annotations):
         '''
         compute cls loss, reg loss and center-ness loss in one batch
         '''
         device = annotations.device
-        batch_size = annotations.shape[0]
         cls_preds, reg_preds, center_preds = preds
 
         feature_size = [[
             per_level_cls_pred.shape[2], per_level_cls_pred.shape[1]
         ] for per_level_cls_pred in cls_preds]
-        one_image_positions = self.positions(feature_size)
-        batch_positions = [
-            torch.tensor(per_level_position).unsqueeze(0).repeat(
-                batch_size, 1, 1, 1).to(device)
-            for per_level_position in one_image_positions
-        ]
-
-        cls_preds, reg_preds, center_preds, batch_targets = self.get_batch_position_annotations(
-            cls_preds,
-            reg_preds,
-            center_preds,
-            batch_positions,
-            annotations,
-            use_center_sample=self.use_center_sample)
+        # cached positions on device
+        one_image_positions, one_image_level_idxs = self.positions.get_one_image_positions_tensor(
+            feature_size, device)
+
+        if self.use_batch_assigner:
+            cls_preds = torch.cat([
+                cls_pred.view(cls_pred.shape[0], -1, cls_pred.shape[-1])
+                for cls_pred in cls_preds
+            ],
+                                  dim=1)
+            reg_preds = torch.cat([
+                reg_pred.view(reg_pred.shape[0], -1, reg_pred.shape[-1])
+                for reg_pred in reg_preds
+            ],
+                                  dim=1)
+            center_preds = torch.cat([
+                center_pred.view(center_pred.shape[0], -1,
+                                 center_pred.shape[-1])
+                for center_pred in center_preds
+            ],
+                                     dim=1)
+            batch_targets = self.assign_batch_position_annotations(
+                one_image_positions,
+                one_image_level_idxs,
+                annotations,
+                use_center_sample=self.use_center_sample)
+        else:
+            cls_preds, reg_preds, center_preds, batch_targets = self.get_batch_position_annotations(
+                cls_preds,
+                reg_preds,
+                center_preds,
+                one_image_positions,
+                one_image_level_idxs,
+                annotations,
+                use_center_sample=self.use_center_sample)
 
         cls_preds = cls_preds.view(-1, cls_preds.shape[-1])
         reg_preds = reg_preds.view(-1, reg_preds.shape[-1])
@@ -609,56 +751,151 @@ class FCOSLoss(nn.Module):
 
         return center_ness_loss
 
+    def assign_batch_position_annotations(self,
+                                          one_image_positions,
+                                          one_image_level_idxs,
+                                          annotations,
+                                          use_center_sample=True):
+        '''
+        same targets as get_batch_position_annotations,assign all images at once,
+        ltrb candidates are computed by broadcasting,no [points_num,annotation_num,4] repeat
+        one_image_positions:[points_num,2]
+        one_image_level_idxs:[points_num]
+        annotations:[batch_size,max_annots_num,5],padded with -1
+        memory:[batch_size,points_num,max_valid_annots_num]
+        '''
+        device = annotations.device
+        batch_size, points_num = annotations.shape[0], one_image_positions.shape[
+            0]
+
+        if self.mi_tensor.device != device:
+            self.mi_tensor = self.mi_tensor.to(device)
+            self.strides_tensor = self.strides_tensor.to(device)
+
+        all_points_position = one_image_positions.unsqueeze(0).expand(
+            batch_size, -1, -1)
+
+        annotations, valid_mask = compact_batch_annotations(annotations)
+        if annotations.shape[1] == 0:
+            # 6:l,t,r,b,class_index,center-ness_gt
+            batch_targets = torch.zeros([batch_size, points_num, 6],
+                                        dtype=torch.float32,
+                                        device=device)
+            return torch.cat([batch_targets, all_points_position], dim=2)
+
+        # [1,points_num,1]
+        points_x = one_image_positions[None, :, 0:1]
+        points_y = one_image_positions[None, :, 1:2]
+        points_mi = self.mi_tensor[one_image_level_idxs]
+        points_mi_min = points_mi[None, :, 0:1]
+        points_mi_max = points_mi[None, :, 1:2]
+        # [batch_size,1,max_valid_num]
+        gt_x1, gt_y1, gt_x2, gt_y2 = [
+            annotations[:, None, :, i] for i in range(4)
+        ]
+
+        # ltrb candidates:[batch_size,points_num,max_valid_num]
+        l = points_x - gt_x1
+        t = points_y - gt_y1
+        r = gt_x2 - points_x
+        b = gt_y2 - points_y
+
+        # points ctr in gt box
+        positive_flag = torch.min(torch.min(l, t), torch.min(r, b)) > 0
+        positive_flag = positive_flag & valid_mask.unsqueeze(1)
+
+        # points in center circle
+        if use_center_sample:
+            gt_ctr_x = (gt_x2 + gt_x1) / 2
+            gt_ctr_y = (gt_y2 + gt_y1) / 2
+            judge_distance = self.strides_tensor[one_image_level_idxs][
+                None, :, None] * self.center_sample_radius
+            compute_distance = torch.sqrt((points_x - gt_ctr_x)**2 +
+                                          (points_y - gt_ctr_y)**2)
+            positive_flag = positive_flag & (compute_distance
+                                             < judge_distance)
+            del compute_distance
+
+        # max reg target in range of mi
+        candidates_max_value = torch.max(torch.max(l, t), torch.max(r, b))
+        positive_flag = positive_flag & (
+            candidates_max_value > points_mi_min) & (candidates_max_value
+                                                     < points_mi_max)
+        del candidates_max_value
+
+        # if a positive point sample have serveral object candidates,then choose the smallest area object candidate
+        INF = 100000000
+        gts_area = (annotations[:, :, 2] - annotations[:, :, 0]) * (
+            annotations[:, :, 3] - annotations[:, :, 1])
+        candidates_area = torch.where(
+            positive_flag, gts_area.unsqueeze(1).expand_as(positive_flag),
+            torch.full_like(l, INF))
+        _, min_index = candidates_area.min(dim=2, keepdim=True)
+        del candidates_area
+
+        positive_points = positive_flag.any(dim=2, keepdim=True)
+        l = torch.gather(l, 2, min_index)
+        t = torch.gather(t, 2, min_index)
+        r = torch.gather(r, 2, min_index)
+        b = torch.gather(b, 2, min_index)
+        cls_gts = torch.gather(annotations[:, :, 4], 1,
+                               min_index.squeeze(-1)).unsqueeze(-1) + 1
+        center_ness_gts = torch.sqrt((torch.min(l, r) / torch.max(l, r)) *
+                                     (torch.min(t, b) / torch.max(t, b)))
+
+        # 6:l,t,r,b,class_index,center-ness_gt
+        batch_targets = torch.cat([l, t, r, b, cls_gts, center_ness_gts],
+                                  dim=2)
+        batch_targets = torch.where(positive_points, batch_targets,
+                                    torch.zeros_like(batch_targets))
+        batch_targets = torch.cat([batch_targets, all_points_position], dim=2)
+
+        # batch_targets shape:[batch_size, points_num, 8],8:l,t,r,b,class_index,center-ness_gt,point_ctr_x,point_ctr_y
+        return batch_targets
+
     def get_batch_position_annotations(self,
                                        cls_heads,
                                        reg_heads,
                                        center_heads,
-                                       batch_positions,
+                                       one_image_positions,
+                                       one_image_level_idxs,
                                        annotations,
                                        use_center_sample=True):
         '''
         Assign a ground truth target for each position on feature map
+        one_image_positions:[points_num,2]
+        one_image_level_idxs:[points_num],fpn level index of every point
         '''
         device = annotations.device
-        batch_mi, batch_stride = [], []
-        for reg_head, mi, stride in zip(reg_heads, self.mi, self.strides):
-            mi = torch.tensor(mi).to(device)
-            B, H, W, _ = reg_head.shape
-            per_level_mi = torch.zeros(B, H, W, 2).to(device)
-            per_level_mi = per_level_mi + mi
-            batch_mi.append(per_level_mi)
-            per_level_stride = torch.zeros(B, H, W, 1).to(device)
-            per_level_stride = per_level_stride + stride
-            batch_stride.append(per_level_stride)
-
-        cls_preds,reg_preds,center_preds,all_points_position,all_points_mi,all_points_stride=[],[],[],[],[],[]
-        for cls_pred, reg_pred, center_pred, per_level_position, per_level_mi, per_level_stride in zip(
-                cls_heads, reg_heads, center_heads, batch_positions, batch_mi,
-                batch_stride):
-            cls_pred = cls_pred.view(cls_pred.shape[0], -1, cls_pred.shape[-1])
-            reg_pred = reg_pred.view(reg_pred.shape[0], -1, reg_pred.shape[-1])
-            center_pred = center_pred.view(center_pred.shape[0], -1,
-                                           center_pred.shape[-1])
-            per_level_position = per_level_position.view(
-                per_level_position.shape[0], -1, per_level_position.shape[-1])
-            per_level_mi = per_level_mi.view(per_level_mi.shape[0], -1,
-                                             per_level_mi.shape[-1])
-            per_level_stride = per_level_stride.view(
-                per_level_stride.shape[0], -1, per_level_stride.shape[-1])
-
-            cls_preds.append(cls_pred)
-            reg_preds.append(reg_pred)
-            center_preds.append(center_pred)
-            all_points_position.append(per_level_position)
-            all_points_mi.append(per_level_mi)
-            all_points_stride.append(per_level_stride)
+        batch_size = annotations.shape[0]
 
-        cls_preds = torch.cat(cls_preds, dim=1)
-        reg_preds = torch.cat(reg_preds, dim=1)
-        center_preds = torch.cat(center_preds, dim=1)
-        all_points_position = torch.cat(all_points_position, dim=1)
-        all_points_mi = torch.cat(all_points_mi, dim=1)
-        all_points_stride = torch.cat(all_points_stride, dim=1)
+        if self.mi_tensor.device != device:
+            self.mi_tensor = self.mi_tensor.to(device)
+            self.strides_tensor = self.strides_tensor.to(device)
+
+        cls_preds = torch.cat([
+            cls_pred.view(cls_pred.shape[0], -1, cls_pred.shape[-1])
+            for cls_pred in cls_heads
+        ],
+                              dim=1)
+        reg_preds = torch.cat([
+            reg_pred.view(reg_pred.shape[0], -1, reg_pred.shape[-1])
+            for reg_pred in reg_heads
+        ],
+                              dim=1)
+        center_preds = torch.cat([
+            center_pred.view(center_pred.shape[0], -1, center_pred.shape[-1])
+            for center_pred in center_heads
+        ],
+                                 dim=1)
+
+        # broadcast one image positions/mi/stride to batch without copy
+        all_points_position = one_image_positions.unsqueeze(0).expand(
+            batch_size, -1, -1)
+        all_points_mi = self.mi_tensor[one_image_level_idxs].unsqueeze(
+            0).expand(batch_size, -1, -1)
+        all_points_stride = self.strides_tensor[one_image_level_idxs].view(
+            1, -1, 1).expand(batch_size, -1, -1)
 
         batch_targets = []
         for per_image_position, per_image_mi, per_image_stride, per_image_annotations in zip(
@@ -833,6 +1070,146 @@ class FCOSLoss(nn.Module):
         return cls_preds, reg_preds, center_preds, batch_targets
 
 
+class BatchHungarianMatcher:
+    '''
+    hungarian matching for all images of a batch
+    only block-diagonal per image costs are computed on padded annotations [B,max_annots_num,5],
+    costs and valid annotation mask are copied to cpu in one transfer,
+    per image assignments are solved in a thread pool.
+    '''
+
+    def __init__(self, num_threads=4):
+        self.num_threads = num_threads
+        self.executor = None
+
+    def compute_batch_box_cost(self, reg_preds, gt_boxes):
+        '''
+        reg_preds:[batch_size,query_nums,4],gt_boxes:[batch_size,max_annots_num,4],4:cx,cy,w,h
+        return box l1 cost and giou cost:[batch_size,query_nums,max_annots_num]
+        '''
+        box_cost = torch.cdist(reg_preds, gt_boxes, p=1)
+
+        reg_preds = self.transform_cxcywh_box_to_xyxy_box(reg_preds)
+        gt_boxes = self.transform_cxcywh_box_to_xyxy_box(gt_boxes)
+        giou_cost = -self.compute_batch_box_giou(reg_preds, gt_boxes)
+
+        return box_cost, giou_cost
+
+    def transform_cxcywh_box_to_xyxy_box(self, boxes):
+        boxes = torch.cat([
+            boxes[:, :, 0:2] - 0.5 * boxes[:, :, 2:4],
+            boxes[:, :, 0:2] + 0.5 * boxes[:, :, 2:4]
+        ],
+                          dim=-1)
+
+        return boxes
+
+    def compute_batch_box_giou(self, boxes1, boxes2):
+        '''
+        boxes1:[B,N,4],boxes2:[B,M,4],4:x_min,y_min,x_max,y_max
+        return [B,N,M] pairwise giou matrix
+        '''
+        area1 = (boxes1[:, :, 2] - boxes1[:, :, 0]) * (boxes1[:, :, 3] -
+                                                       boxes1[:, :, 1])
+        area2 = (boxes2[:, :, 2] - boxes2[:, :, 0]) * (boxes2[:, :, 3] -
+                                                       boxes2[:, :, 1])
+        area1 = torch.clamp(area1, min=0)
+        area2 = torch.clamp(area2, min=0)
+
+        lt = torch.max(boxes1[:, :, None, 0:2], boxes2[:, None, :, 0:2])
+        rb = torch.min(boxes1[:, :, None, 2:4], boxes2[:, None, :, 2:4])
+
+        wh = (rb - lt).clamp(min=0)
+        inter = wh[:, :, :, 0] * wh[:, :, :, 1]
+        inter = torch.clamp(inter, min=0)
+
+        union = area1[:, :, None] + area2[:, None, :] - inter
+        union = torch.clamp(union, min=1e-4)
+
+        iou = inter / union
+
+        enclose_lt = torch.min(boxes1[:, :, None, 0:2], boxes2[:, None, :,
+                                                               0:2])
+        enclose_rb = torch.max(boxes1[:, :, None, 2:4], boxes2[:, None, :,
+                                                               2:4])
+
+        enclose_wh = (enclose_rb - enclose_lt).clamp(min=0)
+        enclose_area = enclose_wh[:, :, :, 0] * enclose_wh[:, :, :, 1]
+        enclose_area = torch.clamp(enclose_area, min=1e-4)
+
+        return iou - (enclose_area - union) / enclose_area
+
+    def __call__(self, total_cost, valid_mask):
+        '''
+        total_cost:[batch_size,query_nums,max_annots_num]
+        valid_mask:[batch_size,max_annots_num],bool,valid annotations
+        return per image (pred_idxs,target_idxs),target_idxs index valid annotations of per image
+        '''
+        batch_size, query_nums = total_cost.shape[0], total_cost.shape[1]
+
+        total_cost = torch.where(torch.isnan(total_cost),
+                                 torch.full_like(total_cost, 1e5), total_cost)
+        # append valid mask as last row,copy costs and mask to cpu in one transfer
+        total_cost = torch.cat(
+            [total_cost.float(),
+             valid_mask.float().unsqueeze(1)], dim=1)
+        total_cost = total_cost.cpu().numpy()
+        valid_mask = total_cost[:, query_nums, :] > 0.5
+        # total_cost[i, 0:query_nums, valid_mask[i]] moves masked gt axis to front,
+        # per image cost must be [query_nums,valid_annots_num]
+        per_image_costs = [
+            total_cost[i][0:query_nums][:, valid_mask[i]]
+            for i in range(batch_size)
+        ]
+
+        if self.num_threads > 1 and batch_size > 1:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.num_threads)
+            results = list(
+                self.executor.map(self.linear_sum_assignment_with_inf,
+                                  per_image_costs))
+        else:
+            results = [
+                self.linear_sum_assignment_with_inf(per_image_cost)
+                for per_image_cost in per_image_costs
+            ]
+
+        indices = [(torch.as_tensor(i, dtype=torch.int64),
+                    torch.as_tensor(j, dtype=torch.int64)) for i, j in results]
+
+        return indices
+
+    def linear_sum_assignment_with_inf(self, cost_matrix):
+        # nan has been replaced on device
+        min_inf = np.isneginf(cost_matrix).any()
+        max_inf = np.isposinf(cost_matrix).any()
+        if min_inf and max_inf:
+            raise ValueError("matrix contains both inf and -inf")
+
+        if min_inf or max_inf:
+            cost_matrix = cost_matrix.copy()
+            values = cost_matrix[~np.isinf(cost_matrix)]
+            min_values = values.min()
+            max_values = values.max()
+            m = min(cost_matrix.shape)
+
+            positive = m * (max_values - min_values + np.abs(max_values) +
+                            np.abs(min_values) + 1)
+            if max_inf:
+                place_holder = (max_values + (m - 1) *
+                                (max_values - min_values)) + positive
+            elif min_inf:
+                place_holder = (min_values + (m - 1) *
+                                (min_values - max_values)) - positive
+
+            cost_matrix[np.isinf(cost_matrix)] = place_holder
+
+        results = scipy.optimize.linear_sum_assignment(cost_matrix)
+
+        return results
+
+
 class DETRLoss(nn.Module):
 
     def __init__(self,
@@ -843,7 +1220,9 @@ class DETRLoss(nn.Module):
                  box_l1_loss_weight=5.0,
                  iou_loss_weight=2.0,
                  no_object_cls_weight=0.1,
-                 num_classes=80):
+                 num_classes=80,
+                 use_batch_matcher=True,
+                 matcher_num_threads=4):
         super(DETRLoss, self).__init__()
         self.cls_match_cost = cls_match_cost
         self.box_match_cost = box_match_cost
@@ -858,6 +1237,10 @@ class DETRLoss(nn.Module):
         self.no_object_cls_weight = no_object_cls_weight
         self.num_classes = num_classes
 
+        # batch matcher gives same matching as per image matching
+        self.use_batch_matcher = use_batch_matcher
+        self.matcher = BatchHungarianMatcher(num_threads=matcher_num_threads)
+
         assert self.cls_match_cost != 0 or self.box_match_cost != 0 or self.giou_match_cost != 0, "all costs cant be 0"
 
     def forward(self, preds, annotations):
@@ -865,9 +1248,12 @@ class DETRLoss(nn.Module):
         reg_preds = torch.clamp(reg_preds, min=1e-4, max=1. - 1e-4)
 
         # Retrieve the matching between the outputs of the last layer and the targets
-        indices = self.get_matched_pred_target_idxs(cls_preds[-1, :, :, :],
-                                                    reg_preds[-1, :, :, :],
-                                                    annotations)
+        if self.use_batch_matcher:
+            indices = self.get_batch_matched_pred_target_idxs(
+                cls_preds[-1, :, :, :], reg_preds[-1, :, :, :], annotations)
+        else:
+            indices = self.get_matched_pred_target_idxs(
+                cls_preds[-1, :, :, :], reg_preds[-1, :, :, :], annotations)
         loss_dict = {}
         for idx, (per_level_cls_preds,
                   per_level_reg_preds) in enumerate(zip(cls_preds, reg_preds)):
@@ -994,6 +1380,37 @@ class DETRLoss(nn.Module):
 
         return iou - (enclose_area - union) / enclose_area
 
+    @torch.no_grad()
+    def get_batch_matched_pred_target_idxs(self, cls_preds, reg_preds,
+                                           annotations):
+        '''
+        same matching as get_matched_pred_target_idxs,but only compute per image cost blocks
+        '''
+        query_nums = cls_preds.shape[1]
+
+        cls_preds = F.softmax(cls_preds.float(), dim=-1)
+        cls_preds = torch.clamp(cls_preds, min=1e-4, max=1. - 1e-4)
+        reg_preds = reg_preds.float()
+
+        annotations = annotations.float()
+        valid_mask = annotations[:, :, 4] >= 0
+        gt_boxes = annotations[:, :, 0:4]
+        gt_labels = torch.where(valid_mask, annotations[:, :, 4],
+                                torch.zeros_like(annotations[:, :,
+                                                             4])).long()
+
+        # approximate NLL cls cost by -proba[target class]
+        cls_cost = -torch.gather(
+            cls_preds, 2,
+            gt_labels.unsqueeze(1).expand(-1, query_nums, -1))
+        box_cost, giou_cost = self.matcher.compute_batch_box_cost(
+            reg_preds, gt_boxes)
+        total_cost = self.cls_match_cost * cls_cost + self.box_match_cost * box_cost + self.giou_match_cost * giou_cost
+
+        indices = self.matcher(total_cost, valid_mask)
+
+        return indices
+
     @torch.no_grad()
     def get_matched_pred_target_idxs(self, cls_preds, reg_preds, annotations):
         batch_size, query_nums = cls_preds.shape[0], cls_preds.shape[1]
@@ -1092,7 +1509,10 @@ class DINODETRLoss(nn.Module):
                  iou_loss_weight=2.0,
                  alpha=0.25,
                  gamma=2.0,
-                 num_classes=80):
+                 num_classes=80,
+                 use_batch_matcher=True,
+                 matcher_num_threads=4,
+                 share_aux_matching=False):
         super(DINODETRLoss, self).__init__()
         self.cls_match_cost = cls_match_cost
         self.box_match_cost = box_match_cost
@@ -1108,6 +1528,12 @@ class DINODETRLoss(nn.Module):
         self.gamma = gamma
         self.num_classes = num_classes
 
+        # batch matcher gives same matching as per image matching
+        self.use_batch_matcher = use_batch_matcher
+        self.matcher = BatchHungarianMatcher(num_threads=matcher_num_threads)
+        # if True,aux layers reuse last layer matching instead of matching again
+        self.share_aux_matching = share_aux_matching
+
         assert self.cls_match_cost != 0 or self.box_match_cost != 0 or self.giou_match_cost != 0, "all costs cant be 0"
 
     def forward(self, preds, annotations):
@@ -1115,8 +1541,8 @@ class DINODETRLoss(nn.Module):
             'pred_boxes']
 
         # Retrieve the matching between the outputs of the last layer and the targets
-        last_indices = self.get_matched_pred_target_idxs(
-            last_cls_preds, last_reg_preds, annotations)
+        last_indices = self.match(last_cls_preds, last_reg_preds,
+                                  annotations)
 
         # Compute all the requested loss_dict
         loss_dict = {}
@@ -1193,9 +1619,12 @@ class DINODETRLoss(nn.Module):
                 per_level_aux_cls_preds, per_level_aux_reg_preds = per_level_aux_outputs[
                     'pred_logits'], per_level_aux_outputs['pred_boxes']
 
-                per_level_indices = self.get_matched_pred_target_idxs(
-                    per_level_aux_cls_preds, per_level_aux_reg_preds,
-                    annotations)
+                if self.share_aux_matching:
+                    per_level_indices = last_indices
+                else:
+                    per_level_indices = self.match(per_level_aux_cls_preds,
+                                                   per_level_aux_reg_preds,
+                                                   annotations)
 
                 per_level_cls_loss = self.compute_batch_cls_loss(
                     per_level_aux_cls_preds, annotations, per_level_indices)
@@ -1249,8 +1678,8 @@ class DINODETRLoss(nn.Module):
             interm_cls_preds, interm_reg_preds = interm_outputs[
                 'pred_logits'], interm_outputs['pred_boxes']
 
-            interm_indices = self.get_matched_pred_target_idxs(
-                interm_cls_preds, interm_reg_preds, annotations)
+            interm_indices = self.match(interm_cls_preds, interm_reg_preds,
+                                        annotations)
 
             interm_cls_loss = self.compute_batch_cls_loss(
                 interm_cls_preds, annotations, interm_indices)
@@ -1402,6 +1831,49 @@ class DINODETRLoss(nn.Module):
 
         return iou - (enclose_area - union) / enclose_area
 
+    def match(self, cls_preds, reg_preds, annotations):
+        if self.use_batch_matcher:
+            return self.get_batch_matched_pred_target_idxs(
+                cls_preds, reg_preds, annotations)
+        else:
+            return self.get_matched_pred_target_idxs(cls_preds, reg_preds,
+                                                     annotations)
+
+    @torch.no_grad()
+    def get_batch_matched_pred_target_idxs(self, cls_preds, reg_preds,
+                                           annotations):
+        '''
+        same matching as get_matched_pred_target_idxs,but only compute per image cost blocks
+        '''
+        query_nums = cls_preds.shape[1]
+
+        cls_preds = torch.sigmoid(cls_preds.float())
+        cls_preds = torch.clamp(cls_preds, min=1e-4, max=1. - 1e-4)
+        reg_preds = torch.clamp(reg_preds.float(), min=1e-4, max=1. - 1e-4)
+
+        annotations = annotations.float()
+        valid_mask = annotations[:, :, 4] >= 0
+        gt_boxes = annotations[:, :, 0:4]
+        gt_labels = torch.where(valid_mask, annotations[:, :, 4],
+                                torch.zeros_like(annotations[:, :,
+                                                             4])).long()
+        gt_labels = gt_labels.unsqueeze(1).expand(-1, query_nums, -1)
+
+        # Compute the classification cost.
+        neg_cls_cost = (1 - self.alpha) * (cls_preds**self.gamma) * (
+            -torch.log(1 - cls_preds + 1e-4))
+        pos_cls_cost = self.alpha * (
+            (1 - cls_preds)**self.gamma) * (-torch.log(cls_preds + 1e-4))
+        cls_cost = torch.gather(pos_cls_cost, 2, gt_labels) - torch.gather(
+            neg_cls_cost, 2, gt_labels)
+        box_cost, giou_cost = self.matcher.compute_batch_box_cost(
+            reg_preds, gt_boxes)
+        total_cost = self.cls_match_cost * cls_cost + self.box_match_cost * box_cost + self.giou_match_cost * giou_cost
+
+        indices = self.matcher(total_cost, valid_mask)
+
+        return indices
+
     @torch.no_grad()
     def get_matched_pred_target_idxs(self, cls_preds, reg_preds, annotations):
         batch_size, query_nums = cls_preds.shape[0], cls_preds.shape[1]
@@ -1683,3 +2155,136 @@ if __name__ == '__main__':
         loss_dict = loss(preds, annots)
         print('3333', loss_dict)
         break
+
+    # hungarian matching microbenchmark:per image matching vs batch matcher
+    import time
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    batch_size, query_nums, max_annots_num = 16, 900, 100
+    bench_cls_preds = torch.randn(batch_size, query_nums, 80, device=device)
+    bench_reg_preds = torch.rand(batch_size, query_nums, 4, device=device)
+    bench_annots = torch.ones(batch_size, max_annots_num, 5,
+                              device=device) * (-1)
+    for i in range(batch_size):
+        gt_num = np.random.randint(0, 60)
+        bench_annots[i, 0:gt_num, 0:2] = torch.rand(gt_num, 2,
+                                                    device=device) * 0.8 + 0.1
+        bench_annots[i, 0:gt_num, 2:4] = torch.rand(gt_num, 2,
+                                                    device=device) * 0.2 + 0.01
+        bench_annots[i, 0:gt_num,
+                     4] = torch.randint(0, 80, (gt_num, ),
+                                        device=device).float()
+
+    loss = DINODETRLoss(num_classes=80)
+    for name, match_function in [
+        ['per image', loss.get_matched_pred_target_idxs],
+        ['batch', loss.get_batch_matched_pred_target_idxs],
+    ]:
+        match_function(bench_cls_preds, bench_reg_preds, bench_annots)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(20):
+            indices = match_function(bench_cls_preds, bench_reg_preds,
+                                     bench_annots)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print(
+            f'{name} matching: {(time.time() - start_time) / 20 * 1000:.2f}ms/batch'
+        )
+
+    per_image_indices = loss.get_matched_pred_target_idxs(
+        bench_cls_preds, bench_reg_preds, bench_annots)
+    batch_indices = loss.get_batch_matched_pred_target_idxs(
+        bench_cls_preds, bench_reg_preds, bench_annots)
+    same_num = sum([
+        torch.equal(i1, i2) and torch.equal(j1, j2)
+        for (i1, j1), (i2, j2) in zip(per_image_indices, batch_indices)
+    ])
+    print(f'same matching images: {same_num}/{batch_size}')
+
+    # target assign regression and benchmark:per image assigner vs batch assigner
+    def build_bench_annotations(batch_size, image_h, image_w, max_annots_num):
+        annotations = torch.ones(batch_size, max_annots_num, 5,
+                                 device=device) * (-1)
+        for i in range(batch_size):
+            gt_num = np.random.randint(0, 60)
+            x1y1 = torch.rand(gt_num, 2, device=device) * torch.tensor(
+                [image_w, image_h], device=device) * 0.8
+            wh = torch.rand(gt_num, 2, device=device) * torch.tensor(
+                [image_w, image_h], device=device) * 0.4 + 4
+            annotations[i, 0:gt_num, 0:2] = x1y1
+            annotations[i, 0:gt_num, 2:4] = x1y1 + wh
+            annotations[i, 0:gt_num,
+                        4] = torch.randint(0, 80, (gt_num, ),
+                                           device=device).float()
+            # shuffle padded rows between valid rows
+            annotations[i] = annotations[i][torch.randperm(max_annots_num,
+                                                           device=device)]
+
+        return annotations
+
+    def benchmark_assign_function(name, assign_function):
+        assign_function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start_time = time.time()
+        for _ in range(10):
+            targets = assign_function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() / 1024**2 if torch.cuda.is_available(
+        ) else 0
+        print(
+            f'{name}: {(time.time() - start_time) / 10 * 1000:.2f}ms/batch, peak memory: {peak_memory:.1f}MB'
+        )
+
+        return targets
+
+    retina_loss = RetinaLoss()
+    fcos_loss = FCOSLoss()
+    for image_h, image_w in [[800, 800], [800, 1333], [1333, 1333]]:
+        batch_size = 8
+        bench_annots = build_bench_annotations(batch_size, image_h, image_w,
+                                               100)
+        feature_size = [[math.ceil(image_w / stride),
+                         math.ceil(image_h / stride)]
+                        for stride in [8, 16, 32, 64, 128]]
+        print(f'input size: {image_h}x{image_w}')
+
+        one_image_anchors = retina_loss.anchors.get_one_image_anchors_tensor(
+            feature_size, device)
+        batch_anchors = one_image_anchors.unsqueeze(0).expand(
+            batch_size, -1, -1)
+        per_image_targets = benchmark_assign_function(
+            'retina per image assigner',
+            lambda: retina_loss.get_batch_anchors_annotations(
+                batch_anchors, bench_annots))
+        batch_targets = benchmark_assign_function(
+            'retina batch assigner',
+            lambda: retina_loss.assign_batch_anchors_annotations(
+                one_image_anchors, bench_annots))
+        positive = per_image_targets[:, :, 4] > 0
+        print(
+            'retina same class targets:',
+            torch.equal(per_image_targets[:, :, 4], batch_targets[:, :, 4]),
+            'same positive box targets:',
+            torch.equal(per_image_targets[positive], batch_targets[positive]))
+
+        one_image_positions, one_image_level_idxs = fcos_loss.positions.get_one_image_positions_tensor(
+            feature_size, device)
+        bench_heads = [
+            torch.zeros(batch_size, h, w, 1, device=device)
+            for w, h in feature_size
+        ]
+        per_image_targets = benchmark_assign_function(
+            'fcos per image assigner',
+            lambda: fcos_loss.get_batch_position_annotations(
+                bench_heads, bench_heads, bench_heads, one_image_positions,
+                one_image_level_idxs, bench_annots)[3])
+        batch_targets = benchmark_assign_function(
+            'fcos batch assigner',
+            lambda: fcos_loss.assign_batch_position_annotations(
+                one_image_positions, one_image_level_idxs, bench_annots))
+        print('fcos same targets:',
+              torch.equal(per_image_targets, batch_targets))
@@ -1,6 +1,9 @@
+import collections
 import math
 import numpy as np
 
+import torch
+
 
 class RetinaAnchors:
 
@@ -9,20 +12,28 @@ class RetinaAnchors:
                                                                      512]],
                  ratios=[0.5, 1, 2],
                  scales=[2**0, 2**(1.0 / 3.0), 2**(2.0 / 3.0)],
-                 strides=[8, 16, 32, 64, 128]):
+                 strides=[8, 16, 32, 64, 128],
+                 cache_size=16):
         self.areas = np.array(areas, dtype=np.float32)
         self.ratios = np.array(ratios, dtype=np.float32)
         self.scales = np.array(scales, dtype=np.float32)
         self.strides = np.array(strides, dtype=np.float32)
 
+        self.base_anchors = [
+            self.generate_base_anchors(area, self.scales, self.ratios)
+            for area in self.areas
+        ]
+        # cache flatten one image anchors tensor for (fpn_feature_sizes,device,dtype)
+        # multi scale training produces different feature sizes,so cache is LRU and bounded
+        self.cache_size = cache_size
+        self.anchors_tensor_cache = collections.OrderedDict()
+
     def __call__(self, fpn_feature_sizes):
         '''
         generate one image anchors
         '''
         one_image_anchors = []
-        for index, area in enumerate(self.areas):
-            base_anchors = self.generate_base_anchors(area, self.scales,
-                                                      self.ratios)
+        for index, base_anchors in enumerate(self.base_anchors):
             feature_anchors = self.generate_anchors_on_feature_map(
                 base_anchors, fpn_feature_sizes[index], self.strides[index])
             one_image_anchors.append(feature_anchors)
@@ -32,6 +43,35 @@ class RetinaAnchors:
         # per anchor format:[x_min,y_min,x_max,y_max]
         return one_image_anchors
 
+    def get_one_image_anchors_tensor(self,
+                                     fpn_feature_sizes,
+                                     device,
+                                     dtype=torch.float32):
+        '''
+        get flatten one image anchors tensor on device,shape:[anchor_nums,4]
+        use one_image_anchors.unsqueeze(0).expand(batch_size,-1,-1) for batch anchors
+        '''
+        key = (tuple(
+            tuple(int(x) for x in per_level_size)
+            for per_level_size in fpn_feature_sizes), str(device), dtype)
+        if key in self.anchors_tensor_cache:
+            self.anchors_tensor_cache.move_to_end(key)
+            return self.anchors_tensor_cache[key]
+
+        one_image_anchors = np.concatenate([
+            per_level_anchor.reshape(-1, per_level_anchor.shape[-1])
+            for per_level_anchor in self(fpn_feature_sizes)
+        ],
+                                           axis=0)
+        one_image_anchors = torch.from_numpy(one_image_anchors).to(
+            device=device, dtype=dtype)
+
+        self.anchors_tensor_cache[key] = one_image_anchors
+        if len(self.anchors_tensor_cache) > self.cache_size:
+            self.anchors_tensor_cache.popitem(last=False)
+
+        return one_image_anchors
+
     def generate_base_anchors(self, area, scales, ratios):
         '''
         generate base anchor
@@ -62,23 +102,19 @@ class RetinaAnchors:
         generate one feature map anchors
         '''
         # shifts_x shape:[w],shifts_y shape:[h]
-        shifts_x = (np.arange(0, feature_map_size[0]) + 0.5) * stride
-        shifts_y = (np.arange(0, feature_map_size[1]) + 0.5) * stride
+        shifts_x = ((np.arange(0, feature_map_size[0]) + 0.5) *
+                    stride).astype(np.float32)
+        shifts_y = ((np.arange(0, feature_map_size[1]) + 0.5) *
+                    stride).astype(np.float32)
 
-        # shifts shape:[w,h,2] -> [w,h,4] -> [w,h,1,4]
-        shifts = np.array([[[shift_x, shift_y] for shift_y in shifts_y]
-                           for shift_x in shifts_x],
-                          dtype=np.float32)
-        shifts = np.expand_dims(np.tile(shifts, (1, 1, 2)), axis=2)
-
-        # base anchors shape:[9,4] -> [1,1,9,4]
-        base_anchors = np.expand_dims(base_anchors, axis=0)
-        base_anchors = np.expand_dims(base_anchors, axis=0)
+        # shifts shape:[h,w,2] -> [h,w,4] -> [h,w,1,4]
+        shift_xx, shift_yy = np.meshgrid(shifts_x, shifts_y)
+        shifts = np.stack([shift_xx, shift_yy, shift_xx, shift_yy], axis=-1)
+        shifts = np.expand_dims(shifts, axis=2)
 
         # generate all featrue map anchors on each feature map points
-        # featrue map anchors shape:[w,h,9,4] -> [h,w,9,4]
-        feature_map_anchors = np.transpose(base_anchors + shifts,
-                                           axes=(1, 0, 2, 3))
+        # base anchors shape:[9,4] -> [1,1,9,4],featrue map anchors shape:[h,w,9,4]
+        feature_map_anchors = base_anchors[np.newaxis, np.newaxis, :, :] + shifts
         feature_map_anchors = np.ascontiguousarray(feature_map_anchors,
                                                    dtype=np.float32)
 
@@ -88,9 +124,13 @@ class RetinaAnchors:
 
 class FCOSPositions:
 
-    def __init__(self, strides=[8, 16, 32, 64, 128]):
+    def __init__(self, strides=[8, 16, 32, 64, 128], cache_size=16):
         self.strides = np.array(strides, dtype=np.float32)
 
+        # cache flatten one image positions tensor for (fpn_feature_sizes,device,dtype)
+        self.cache_size = cache_size
+        self.positions_tensor_cache = collections.OrderedDict()
+
     def __call__(self, fpn_feature_sizes):
         '''
         generate one image positions
@@ -107,22 +147,62 @@ class FCOSPositions:
         # per position format:[x_center,y_center]
         return one_image_positions
 
+    def get_one_image_positions_tensor(self,
+                                       fpn_feature_sizes,
+                                       device,
+                                       dtype=torch.float32):
+        '''
+        get flatten one image positions tensor on device
+        return:
+        one_image_positions:[points_num,2],2:[x_center,y_center]
+        one_image_level_idxs:[points_num],fpn level index of every point
+        '''
+        key = (tuple(
+            tuple(int(x) for x in per_level_size)
+            for per_level_size in fpn_feature_sizes), str(device), dtype)
+        if key in self.positions_tensor_cache:
+            self.positions_tensor_cache.move_to_end(key)
+            return self.positions_tensor_cache[key]
+
+        one_image_positions = self(fpn_feature_sizes)
+        one_image_level_idxs = np.concatenate([
+            np.full(per_level_position.shape[0] * per_level_position.shape[1],
+                    level_idx,
+                    dtype=np.int64)
+            for level_idx, per_level_position in enumerate(one_image_positions)
+        ],
+                                              axis=0)
+        one_image_positions = np.concatenate([
+            per_level_position.reshape(-1, per_level_position.shape[-1])
+            for per_level_position in one_image_positions
+        ],
+                                             axis=0)
+        one_image_positions = torch.from_numpy(one_image_positions).to(
+            device=device, dtype=dtype)
+        one_image_level_idxs = torch.from_numpy(one_image_level_idxs).to(
+            device=device)
+
+        self.positions_tensor_cache[key] = (one_image_positions,
+                                            one_image_level_idxs)
+        if len(self.positions_tensor_cache) > self.cache_size:
+            self.positions_tensor_cache.popitem(last=False)
+
+        return one_image_positions, one_image_level_idxs
+
     def generate_positions_on_feature_map(self, feature_map_size, stride):
         '''
         generate one feature map positions
         '''
 
         # shifts_x shape:[w],shifts_x shape:[h]
-        shifts_x = (np.arange(0, feature_map_size[0]) + 0.5) * stride
-        shifts_y = (np.arange(0, feature_map_size[1]) + 0.5) * stride
-
-        # feature_map_positions shape:[w,h,2] -> [h,w,2]
-        feature_map_positions = np.array([[[shift_x, shift_y]
-                                           for shift_y in shifts_y]
-                                          for shift_x in shifts_x],
-                                         dtype=np.float32)
-        feature_map_positions = np.transpose(feature_map_positions,
-                                             axes=(1, 0, 2))
+        shifts_x = ((np.arange(0, feature_map_size[0]) + 0.5) *
+                    stride).astype(np.float32)
+        shifts_y = ((np.arange(0, feature_map_size[1]) + 0.5) *
+                    stride).astype(np.float32)
+
+        # feature_map_positions shape:[h,w,2]
+        shift_xx, shift_yy = np.meshgrid(shifts_x, shifts_y)
+        feature_map_positions = np.stack([shift_xx, shift_yy], axis=-1)
         feature_map_positions = np.ascontiguousarray(feature_map_positions,
                                                      dtype=np.float32)
 
@@ -177,3 +257,25 @@ if __name__ == '__main__':
 
     for per_level_positions in one_image_positions:
         print('2222', per_level_positions.shape)
+
+    # check cached tensors are same as numpy anchors/positions
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    one_image_anchors_tensor = anchors.get_one_image_anchors_tensor(
+        fpn_feature_sizes, device)
+    print('3333', one_image_anchors_tensor.shape,
+          np.array_equal(
+              one_image_anchors_tensor.cpu().numpy(),
+              np.concatenate([
+                  per_level_anchors.reshape(-1, 4)
+                  for per_level_anchors in one_image_anchors
+              ],
+                             axis=0)))
+    one_image_positions_tensor, one_image_level_idxs = positions.get_one_image_positions_tensor(
+        fpn_feature_sizes, device)
+    print('4444', one_image_positions_tensor.shape, one_image_level_idxs.shape)
+
+    import time
+    start_time = time.time()
+    for _ in range(100):
+        anchors.get_one_image_anchors_tensor(fpn_feature_sizes, device)
+    print(f'cached anchors: {(time.time() - start_time) * 10:.3f}ms/iter')
@@ -32,7 +32,8 @@ class DDIMSampler(nn.Module):
                  ddim_t=50,
                  ddim_eta=0.0,
                  ddim_discr_method='uniform',
-                 clip_denoised=True):
+                 clip_denoised=True,
+                 use_compile_step=False):
         super(DDIMSampler, self).__init__()
         assert beta_schedule_mode in [
             'linear',
@@ -58,6 +59,9 @@ class DDIMSampler(nn.Module):
         self.ddim_discr_method = ddim_discr_method
 
         self.clip_denoised = clip_denoised
+        # torch.compile denoise_step,all step inputs are fixed shape tensors
+        self.use_compile_step = use_compile_step
+        self.compiled_denoise_step = None
 
         self.update_schedule(self.beta_schedule_mode, self.ddpm_t, self.ddim_t,
                              self.ddim_eta, self.ddim_discr_method)
@@ -122,6 +126,32 @@ class DDIMSampler(nn.Module):
             (1 - self.ddim_alphas / self.ddim_alphas_prev))
         self.ddim_sqrt_one_minus_alphas = torch.sqrt(1. - self.ddim_alphas)
 
+        # per sampling step tensors in sampling order(reversed ddim timesteps),
+        # moved to model device once in sample_step_images,no per step host to device copy
+        step_indexes = list(reversed(range(len(self.ddim_timesteps))))
+        self.step_time_steps = torch.from_numpy(
+            self.ddim_timesteps[step_indexes]).long()
+        a_t = self.ddim_alphas[step_indexes].float()
+        a_prev_t = self.ddim_alphas_prev[step_indexes].float()
+        sigma_t = self.ddim_sigmas[step_indexes].float()
+        sqrt_one_minus_at = self.ddim_sqrt_one_minus_alphas[
+            step_indexes].float()
+        # [S,5]
+        self.step_coefs = torch.stack([
+            sqrt_one_minus_at,
+            torch.sqrt(a_t),
+            torch.sqrt(a_prev_t),
+            torch.sqrt(1. - a_prev_t - sigma_t**2),
+            sigma_t,
+        ],
+                                      dim=1)
+        # [S,2],add_noise coefficients for input_masks
+        self.step_noise_coefs = torch.stack([
+            self.sqrt_alphas_cumprod[self.step_time_steps].float(),
+            self.sqrt_one_minus_alphas_cumprod[self.step_time_steps].float(),
+        ],
+                                            dim=1)
+
     # forward diffusion (using the nice property): q(x_t | x_0)
     def add_noise(self, x_start, t, noise):
         sqrt_alphas_cumprod_t = extract(self.sqrt_alphas_cumprod, t,
@@ -132,6 +162,83 @@ class DDIMSampler(nn.Module):
 
         return x_noisy
 
+    def move_schedule_to_device(self, device):
+        if self.step_coefs.device != device:
+            self.step_time_steps = self.step_time_steps.to(device)
+            self.step_coefs = self.step_coefs.to(device)
+            self.step_noise_coefs = self.step_noise_coefs.to(device)
+
+    def denoise_step(self, sample_images, pred_noise, step_coefs, noise):
+        '''
+        one ddim step,only fixed shape tensor inputs,no python scalar or host sync per step
+        step_coefs:[5],sqrt(1-a_t),sqrt(a_t),sqrt(a_prev_t),sqrt(1-a_prev_t-sigma_t**2),sigma_t
+        '''
+        # current prediction for x_0
+        pred_x0 = (sample_images - step_coefs[0] * pred_noise) / step_coefs[1]
+
+        if self.clip_denoised:
+            pred_x0 = torch.clamp(pred_x0, min=-1., max=1.)
+
+        # direction pointing to x_t
+        pred_dir_xt = step_coefs[3] * pred_noise
+        noise = step_coefs[4] * noise
+
+        x_prev = step_coefs[2] * pred_x0 + pred_dir_xt + noise
+
+        return x_prev
+
+    @torch.no_grad()
+    def sample_step_images(self,
+                           model,
+                           shape,
+                           class_label=None,
+                           input_images=None,
+                           input_masks=None):
+        '''
+        yield step index and sample images of every ddim step,sample images stay on model device
+        '''
+        device = next(model.parameters()).device
+        self.move_schedule_to_device(device)
+        b, c, h, w = shape[0], shape[1], shape[2], shape[3]
+
+        if input_images is None:
+            # start from pure noise (for each example in the batch)
+            sample_images = torch.randn((b, c, h, w)).to(device)
+        else:
+            sample_images = input_images
+
+        denoise_step = self.denoise_step
+        if self.use_compile_step:
+            if self.compiled_denoise_step is None:
+                self.compiled_denoise_step = torch.compile(self.denoise_step,
+                                                           dynamic=False)
+            denoise_step = self.compiled_denoise_step
+
+        # [S,B]
+        step_times = self.step_time_steps.unsqueeze(1).repeat(1, b)
+        for idx in tqdm(range(step_times.shape[0]),
+                        desc='ddim sampler time step',
+                        total=step_times.shape[0]):
+            time = step_times[idx]
+
+            if input_masks is not None and input_images is not None:
+                # input_masks:1. is mask region, 0. is keep region
+                noise = torch.randn_like(sample_images)
+                x_noisy = self.step_noise_coefs[
+                    idx, 0] * sample_images + self.step_noise_coefs[idx,
+                                                                    1] * noise
+                sample_images = x_noisy * input_masks + (
+                    1. - input_masks) * sample_images
+
+            # predict noise using model
+            pred_noise = model(sample_images, time, class_label=class_label)
+
+            sample_images = denoise_step(sample_images, pred_noise,
+                                         self.step_coefs[idx],
+                                         torch.randn_like(sample_images))
+
+            yield idx, sample_images
+
     @torch.no_grad()
     def forward(self,
                 model,
@@ -140,11 +247,17 @@ class DDIMSampler(nn.Module):
                 input_images=None,
                 input_masks=None,
                 return_intermediates=False,
+                intermediate_stride=1,
                 update_beta_schedule_mode=None,
                 update_ddpm_t=None,
                 update_ddim_t=None,
                 update_ddim_eta=None,
                 update_ddim_discr_method=None):
+        '''
+        return last step images,[B,C,H,W] numpy array
+        return_intermediates=True:also return images of every intermediate_stride steps(and last step),
+        only these steps are copied to host.
+        '''
         if update_beta_schedule_mode is not None or update_ddpm_t is not None or update_ddim_t is not None or update_ddim_eta is not None or update_ddim_discr_method is not None:
             if update_beta_schedule_mode is None:
                 update_beta_schedule_mode = self.beta_schedule_mode
@@ -163,71 +276,22 @@ class DDIMSampler(nn.Module):
                                  ddim_eta=update_ddim_eta,
                                  ddim_discr_method=update_ddim_discr_method)
 
-        device = next(model.parameters()).device
-        b, c, h, w = shape[0], shape[1], shape[2], shape[3]
-
-        if input_images is None:
-            # start from pure noise (for each example in the batch)
-            sample_images = torch.randn((b, c, h, w)).to(device)
-        else:
-            sample_images = input_images
-
-        all_step_images = []
-        all_steps = list(reversed(self.ddim_timesteps))
-        for idx, time_step in enumerate(
-                tqdm(all_steps,
-                     desc='ddim sampler time step',
-                     total=len(all_steps))):
-            ddim_step_index_before_flip = len(all_steps) - idx - 1
-
-            time = (torch.ones((b, )) * time_step).long().to(device)
-
-            if input_masks is not None and input_images is not None:
-                # input_masks:1. is mask region, 0. is keep region
-                noise = torch.randn_like(sample_images).to(device)
-                x_noisy = self.add_noise(sample_images, time, noise)
-                sample_images = x_noisy * input_masks + (
-                    1. - input_masks) * sample_images
-
-            # predict noise using model
-            pred_noise = model(sample_images, time, class_label=class_label)
-
-            a_t = (torch.ones((b, 1, 1, 1)) *
-                   self.ddim_alphas[ddim_step_index_before_flip]).to(device)
-            a_prev_t = (
-                torch.ones((b, 1, 1, 1)) *
-                self.ddim_alphas_prev[ddim_step_index_before_flip]).to(device)
-            sigma_t = (
-                torch.ones((b, 1, 1, 1)) *
-                self.ddim_sigmas[ddim_step_index_before_flip]).to(device)
-            sqrt_one_minus_at = (
-                torch.ones((b, 1, 1, 1)) *
-                self.ddim_sqrt_one_minus_alphas[ddim_step_index_before_flip]
-            ).to(device)
-
-            # current prediction for x_0
-            pred_x0 = (sample_images -
-                       sqrt_one_minus_at * pred_noise) / torch.sqrt(a_t)
-
-            if self.clip_denoised:
-                pred_x0 = torch.clamp(pred_x0, min=-1., max=1.)
-
-            # direction pointing to x_t
-            pred_dir_xt = torch.sqrt(1. - a_prev_t - sigma_t**2) * pred_noise
-            noise = sigma_t * torch.randn_like(sample_images)
-
-            x_prev = torch.sqrt(a_prev_t) * pred_x0 + pred_dir_xt + noise
-
-            sample_images = x_prev
-
-            all_step_images.append(sample_images.cpu().numpy())
-
-        last_step_images = all_step_images[-1]
+        all_steps_num = len(self.step_time_steps)
+        intermediate_images = []
+        for idx, sample_images in self.sample_step_images(
+                model,
+                shape,
+                class_label=class_label,
+                input_images=input_images,
+                input_masks=input_masks):
+            if return_intermediates and ((idx + 1) % intermediate_stride == 0
+                                         or idx == all_steps_num - 1):
+                intermediate_images.append(sample_images.cpu().numpy())
 
         if return_intermediates:
-            return all_step_images, last_step_images
+            return intermediate_images, intermediate_images[-1]
         else:
-            return all_step_images
+            return sample_images.cpu().numpy()
 
 
 if __name__ == '__main__':
@@ -375,3 +439,85 @@ if __name__ == '__main__':
         print('7474', len(all_step_images), last_step_images.shape)
 
         break
+
+    import time
+
+    def reference_ddim_sample(sampler, model, shape):
+        # per step python scalar coefficients and per step host copy of all step images
+        device = next(model.parameters()).device
+        b = shape[0]
+        sample_images = torch.randn(shape).to(device)
+        all_step_images = []
+        all_steps = list(reversed(sampler.ddim_timesteps))
+        for idx, time_step in enumerate(all_steps):
+            ddim_step_index_before_flip = len(all_steps) - idx - 1
+            time = (torch.ones((b, )) * time_step).long().to(device)
+            pred_noise = model(sample_images, time, class_label=None)
+            a_t = (torch.ones((b, 1, 1, 1)) *
+                   sampler.ddim_alphas[ddim_step_index_before_flip]).to(device)
+            a_prev_t = (torch.ones((b, 1, 1, 1)) * sampler.ddim_alphas_prev[
+                ddim_step_index_before_flip]).to(device)
+            sigma_t = (torch.ones((b, 1, 1, 1)) *
+                       sampler.ddim_sigmas[ddim_step_index_before_flip]).to(device)
+            sqrt_one_minus_at = (torch.ones(
+                (b, 1, 1, 1)) * sampler.ddim_sqrt_one_minus_alphas[
+                    ddim_step_index_before_flip]).to(device)
+            pred_x0 = (sample_images -
+                       sqrt_one_minus_at * pred_noise) / torch.sqrt(a_t)
+            if sampler.clip_denoised:
+                pred_x0 = torch.clamp(pred_x0, min=-1., max=1.)
+            pred_dir_xt = torch.sqrt(1. - a_prev_t - sigma_t**2) * pred_noise
+            noise = sigma_t * torch.randn_like(sample_images)
+            sample_images = torch.sqrt(a_prev_t) * pred_x0 + pred_dir_xt + noise
+            all_step_images.append(sample_images.cpu().numpy())
+
+        return all_step_images[-1]
+
+    # sampler latency benchmark
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    net = DiffusionUNet(inplanes=3,
+                        planes=64,
+                        planes_multi=[1, 2, 2, 2],
+                        time_embedding_ratio=4,
+                        block_nums=1,
+                        dropout_prob=0.,
+                        num_groups=32,
+                        use_attention_planes_multi_idx=[1],
+                        num_classes=None,
+                        use_gradient_checkpoint=False).to(device)
+    net.eval()
+    for ddim_eta in [0.0, 1.0]:
+        ddim_sampler = DDIMSampler(ddpm_t=1000,
+                                   ddim_t=50,
+                                   ddim_eta=ddim_eta,
+                                   clip_denoised=True)
+        with torch.no_grad():
+            torch.manual_seed(0)
+            reference_images = reference_ddim_sample(ddim_sampler, net,
+                                                     [64, 3, 32, 32])
+        torch.manual_seed(0)
+        last_step_images = ddim_sampler(net, [64, 3, 32, 32])
+        print(f'ddim_eta {ddim_eta} max abs diff with reference sampler:',
+              np.abs(reference_images - last_step_images).max())
+
+        for name, sample_function in [
+            ('reference', lambda: reference_ddim_sample(
+                ddim_sampler, net, [64, 3, 32, 32])),
+            ('final only', lambda: ddim_sampler(net, [64, 3, 32, 32])),
+            ('stride 10 intermediates', lambda: ddim_sampler(
+                net, [64, 3, 32, 32],
+                return_intermediates=True,
+                intermediate_stride=10)),
+        ]:
+            with torch.no_grad():
+                sample_function()
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                start_time = time.time()
+                for _ in range(3):
+                    sample_function()
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+            print(
+                f'ddim_eta {ddim_eta} {name}: {(time.time() - start_time) / 3 * 1000:.2f}ms per batch'
+            )
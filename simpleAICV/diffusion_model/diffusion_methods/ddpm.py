@@ -90,7 +90,8 @@ class DDPMSampler(nn.Module):
                  t=1000,
                  mean_type='epsilon',
                  var_type='fixedsmall',
-                 clip_denoised=True):
+                 clip_denoised=True,
+                 use_compile_step=False):
         super(DDPMSampler, self).__init__()
         assert beta_schedule_mode in [
             'linear',
@@ -122,6 +123,9 @@ class DDPMSampler(nn.Module):
         self.var_type = var_type
 
         self.clip_denoised = clip_denoised
+        # torch.compile denoise_step,all step inputs are fixed shape tensors
+        self.use_compile_step = use_compile_step
+        self.compiled_denoise_step = None
 
         self.update_schedule(self.beta_schedule_mode, self.t)
 
@@ -172,6 +176,33 @@ class DDPMSampler(nn.Module):
             1.0 - self.alphas_cumprod_prev) * torch.sqrt(
                 self.alphas) / (1.0 - self.alphas_cumprod)
 
+        # per sampling step tensors in sampling order(t-1,...,0),
+        # moved to model device once in sample_step_images,no per step host to device copy
+        self.step_time_steps = torch.arange(self.t - 1, -1, -1).long()
+        if self.var_type == 'fixedlarge':
+            model_log_variance = torch.log(
+                torch.cat([self.posterior_variance[1:2], self.betas[1:]]))
+        elif self.var_type == 'fixedsmall':
+            model_log_variance = self.posterior_log_variance_clipped
+        model_log_variance = model_log_variance[self.step_time_steps].float()
+        # no noise when t == 0
+        nonzero_mask = 1 - (self.step_time_steps == 0).float()
+        # [S,5]
+        self.step_coefs = torch.stack([
+            self.sqrt_recip_alphas_cumprod[self.step_time_steps].float(),
+            self.sqrt_recipm1_alphas_cumprod[self.step_time_steps].float(),
+            self.posterior_mean_coef1[self.step_time_steps].float(),
+            self.posterior_mean_coef2[self.step_time_steps].float(),
+            torch.exp(0.5 * model_log_variance) * nonzero_mask,
+        ],
+                                      dim=1)
+        # [S,2],add_noise coefficients for input_masks
+        self.step_noise_coefs = torch.stack([
+            self.sqrt_alphas_cumprod[self.step_time_steps].float(),
+            self.sqrt_one_minus_alphas_cumprod[self.step_time_steps].float(),
+        ],
+                                            dim=1)
+
     # Compute the mean and variance of the diffusion posterior: q(x_{t-1} | x_t, x_0)
     def q_mean_variance(self, x_start, x_t, t):
         assert x_start.shape == x_t.shape
@@ -255,6 +286,86 @@ class DDPMSampler(nn.Module):
 
         return pred_img
 
+    def move_schedule_to_device(self, device):
+        if self.step_coefs.device != device:
+            self.step_time_steps = self.step_time_steps.to(device)
+            self.step_coefs = self.step_coefs.to(device)
+            self.step_noise_coefs = self.step_noise_coefs.to(device)
+
+    def denoise_step(self, sample_images, pred, step_coefs, noise):
+        '''
+        same as sample_per_time_step,only fixed shape tensor inputs,no python scalar or host sync per step
+        step_coefs:[5],sqrt_recip_alphas_cumprod,sqrt_recipm1_alphas_cumprod,
+        posterior_mean_coef1,posterior_mean_coef2,std(0 when t == 0)
+        x_0 clamp in p_mean_variance does not change model_mean,so it is not computed here
+        '''
+        # the model predicts x_{t-1}
+        if self.mean_type == 'xprev':
+            model_mean = pred
+        # the model predicts x_0
+        elif self.mean_type == 'xstart':
+            model_mean = step_coefs[2] * pred + step_coefs[3] * sample_images
+        # the model predicts epsilon
+        elif self.mean_type == 'epsilon':
+            x_0 = step_coefs[0] * sample_images - step_coefs[1] * pred
+            model_mean = step_coefs[2] * x_0 + step_coefs[3] * sample_images
+
+        # compute x_{t-1}
+        pred_img = model_mean + step_coefs[4] * noise
+
+        return pred_img
+
+    @torch.no_grad()
+    def sample_step_images(self,
+                           model,
+                           shape,
+                           class_label=None,
+                           input_images=None,
+                           input_masks=None):
+        '''
+        yield step index and sample images of every ddpm step,sample images stay on model device
+        '''
+        device = next(model.parameters()).device
+        self.move_schedule_to_device(device)
+        b, c, h, w = shape[0], shape[1], shape[2], shape[3]
+
+        if input_images is None:
+            # start from pure noise (for each example in the batch)
+            sample_images = torch.randn((b, c, h, w)).to(device)
+        else:
+            sample_images = input_images
+
+        denoise_step = self.denoise_step
+        if self.use_compile_step:
+            if self.compiled_denoise_step is None:
+                self.compiled_denoise_step = torch.compile(self.denoise_step,
+                                                           dynamic=False)
+            denoise_step = self.compiled_denoise_step
+
+        # [S,B]
+        step_times = self.step_time_steps.unsqueeze(1).repeat(1, b)
+        for idx in tqdm(range(step_times.shape[0]),
+                        desc='ddpm sampler time step',
+                        total=step_times.shape[0]):
+            time = step_times[idx]
+
+            if input_masks is not None and input_images is not None:
+                # input_masks:1. is mask region, 0. is keep region
+                noise = torch.randn_like(sample_images)
+                x_noisy = self.step_noise_coefs[
+                    idx, 0] * sample_images + self.step_noise_coefs[idx,
+                                                                    1] * noise
+                sample_images = x_noisy * input_masks + (
+                    1. - input_masks) * sample_images
+
+            pred = model(sample_images, time, class_label=class_label)
+
+            sample_images = denoise_step(sample_images, pred,
+                                         self.step_coefs[idx],
+                                         torch.randn_like(sample_images))
+
+            yield idx, sample_images
+
     @torch.no_grad()
     def forward(self,
                 model,
@@ -263,8 +374,14 @@ class DDPMSampler(nn.Module):
                 input_images=None,
                 input_masks=None,
                 return_intermediates=False,
+                intermediate_stride=1,
                 update_beta_schedule_mode=None,
                 update_t=None):
+        '''
+        return last step images,[B,C,H,W] numpy array
+        return_intermediates=True:also return images of every intermediate_stride steps(and last step),
+        only these steps are copied to host.
+        '''
         if update_beta_schedule_mode is not None or update_t is not None:
             if update_beta_schedule_mode is None:
                 update_beta_schedule_mode = self.beta_schedule_mode
@@ -273,41 +390,22 @@ class DDPMSampler(nn.Module):
             self.update_schedule(beta_schedule_mode=update_beta_schedule_mode,
                                  t=update_t)
 
-        device = next(model.parameters()).device
-        b, c, h, w = shape[0], shape[1], shape[2], shape[3]
-
-        if input_images is None:
-            # start from pure noise (for each example in the batch)
-            sample_images = torch.randn((b, c, h, w)).to(device)
-        else:
-            sample_images = input_images
-
-        all_step_images = []
-        all_steps = list(reversed(range(0, self.t)))
-        for time_step in tqdm(all_steps,
-                              desc='ddpm sampler time step',
-                              total=self.t):
-            time = (torch.ones((b, )) * time_step).long().to(device)
-
-            if input_masks is not None and input_images is not None:
-                # input_masks:1. is mask region, 0. is keep region
-                noise = torch.randn_like(sample_images).to(device)
-                x_noisy = self.add_noise(sample_images, time, noise)
-                sample_images = x_noisy * input_masks + (
-                    1. - input_masks) * sample_images
-
-            sample_images = self.sample_per_time_step(model,
-                                                      sample_images,
-                                                      time,
-                                                      class_label=class_label)
-            all_step_images.append(sample_images.cpu().numpy())
-
-        last_step_images = all_step_images[-1]
+        all_steps_num = len(self.step_time_steps)
+        intermediate_images = []
+        for idx, sample_images in self.sample_step_images(
+                model,
+                shape,
+                class_label=class_label,
+                input_images=input_images,
+                input_masks=input_masks):
+            if return_intermediates and ((idx + 1) % intermediate_stride == 0
+                                         or idx == all_steps_num - 1):
+                intermediate_images.append(sample_images.cpu().numpy())
 
         if return_intermediates:
-            return all_step_images, last_step_images
+            return intermediate_images, intermediate_images[-1]
         else:
-            return all_step_images
+            return sample_images.cpu().numpy()
 
 
 if __name__ == '__main__':
@@ -656,3 +754,66 @@ if __name__ == '__main__':
         print('7474', len(all_step_images), last_step_images.shape)
 
         break
+
+    import time
+
+    def reference_ddpm_sample(sampler, model, shape):
+        # per step sample_per_time_step and per step host copy of all step images
+        device = next(model.parameters()).device
+        b = shape[0]
+        sample_images = torch.randn(shape).to(device)
+        all_step_images = []
+        for time_step in reversed(range(0, sampler.t)):
+            time = (torch.ones((b, )) * time_step).long().to(device)
+            sample_images = sampler.sample_per_time_step(model,
+                                                         sample_images,
+                                                         time,
+                                                         class_label=None)
+            all_step_images.append(sample_images.cpu().numpy())
+
+        return all_step_images[-1]
+
+    # sampler latency benchmark
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    net = DiffusionUNet(inplanes=3,
+                        planes=64,
+                        planes_multi=[1, 2, 2, 2],
+                        time_embedding_ratio=4,
+                        block_nums=1,
+                        dropout_prob=0.,
+                        num_groups=32,
+                        use_attention_planes_multi_idx=[1],
+                        num_classes=None,
+                        use_gradient_checkpoint=False).to(device)
+    net.eval()
+    for var_type in ['fixedsmall', 'fixedlarge']:
+        ddpm_sampler = DDPMSampler(t=1000,
+                                   mean_type='epsilon',
+                                   var_type=var_type,
+                                   clip_denoised=True)
+        with torch.no_grad():
+            torch.manual_seed(0)
+            reference_images = reference_ddpm_sample(ddpm_sampler, net,
+                                                     [64, 3, 32, 32])
+        torch.manual_seed(0)
+        last_step_images = ddpm_sampler(net, [64, 3, 32, 32])
+        print(f'{var_type} max abs diff with reference sampler:',
+              np.abs(reference_images - last_step_images).max())
+
+        for name, sample_function in [
+            ('reference', lambda: reference_ddpm_sample(
+                ddpm_sampler, net, [64, 3, 32, 32])),
+            ('final only', lambda: ddpm_sampler(net, [64, 3, 32, 32])),
+            ('stride 100 intermediates', lambda: ddpm_sampler(
+                net, [64, 3, 32, 32],
+                return_intermediates=True,
+                intermediate_stride=100)),
+        ]:
+            with torch.no_grad():
+                start_time = time.time()
+                sample_function()
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+            print(
+                f'{var_type} {name}: {(time.time() - start_time) * 1000:.2f}ms per batch'
+            )
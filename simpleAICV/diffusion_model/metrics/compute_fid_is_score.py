@@ -1,11 +1,14 @@
 '''
 https://github.com/mseitzer/pytorch-fid/blob/master/src/pytorch_fid/fid_score.py
 '''
+import os
+import hashlib
 import numpy as np
 
 from PIL import Image
 from scipy import linalg
 
+import torch
 from torch.utils.data import Dataset
 
 
@@ -107,3 +110,192 @@ def compute_inception_score(images_cls_pred, data_split_num=10):
     is_score_std = np.std(split_scores)
 
     return is_score_mean, is_score_std
+
+
+class FIDISStatisticsMeter:
+    '''
+    streaming fid/is statistics,no N x 2048 feature array and no N x 1008 prob array.
+    features:accumulate count,feature sum and feature outer product sum in float64 on device.
+    probs:images are assigned to data_split_num splits by running index,
+    accumulate per split count,prob sum and sum(p*log(p)),
+    split kl = mean(sum(p*log(p))) - sum(p_mean*log(p_mean)),same as compute_inception_score.
+    all sums can be summed over ranks by all_reduce.
+    '''
+
+    def __init__(self,
+                 feature_dim=2048,
+                 class_num=1008,
+                 data_split_num=10,
+                 device=None):
+        self.feature_dim = feature_dim
+        self.class_num = class_num
+        self.data_split_num = data_split_num
+        self.device = device if device is not None else torch.device('cpu')
+
+        self.reset()
+
+    def reset(self):
+        self.feature_count = torch.zeros([],
+                                         dtype=torch.float64,
+                                         device=self.device)
+        self.feature_sum = torch.zeros([self.feature_dim],
+                                       dtype=torch.float64,
+                                       device=self.device)
+        self.feature_outer_sum = torch.zeros(
+            [self.feature_dim, self.feature_dim],
+            dtype=torch.float64,
+            device=self.device)
+
+        self.prob_image_index = 0
+        self.split_count = torch.zeros([self.data_split_num],
+                                       dtype=torch.float64,
+                                       device=self.device)
+        self.split_prob_sum = torch.zeros(
+            [self.data_split_num, self.class_num],
+            dtype=torch.float64,
+            device=self.device)
+        self.split_plogp_sum = torch.zeros([self.data_split_num],
+                                           dtype=torch.float64,
+                                           device=self.device)
+
+    def update(self, features=None, probs=None):
+        '''
+        features:[B,feature_dim]
+        probs:[B,class_num]
+        '''
+        if features is not None:
+            features = features.to(self.device).double()
+            self.feature_count += features.shape[0]
+            self.feature_sum += features.sum(dim=0)
+            self.feature_outer_sum += features.t() @ features
+
+        if probs is not None:
+            probs = probs.to(self.device).double()
+            split_ids = (self.prob_image_index + torch.arange(
+                probs.shape[0], device=self.device)) % self.data_split_num
+            self.prob_image_index += probs.shape[0]
+            self.split_count.index_add_(
+                0, split_ids, torch.ones_like(split_ids, dtype=torch.float64))
+            self.split_prob_sum.index_add_(0, split_ids, probs)
+            self.split_plogp_sum.index_add_(0, split_ids,
+                                            torch.xlogy(probs, probs).sum(dim=1))
+
+    def all_reduce(self, group=None):
+        for per_tensor in [
+                self.feature_count,
+                self.feature_sum,
+                self.feature_outer_sum,
+                self.split_count,
+                self.split_prob_sum,
+                self.split_plogp_sum,
+        ]:
+            torch.distributed.all_reduce(per_tensor,
+                                         op=torch.distributed.ReduceOp.SUM,
+                                         group=group)
+
+    def get_feature_statistics(self):
+        # mu and sigma same as np.mean and np.cov(rowvar=False)
+        count = self.feature_count.item()
+        mu = self.feature_sum / count
+        sigma = (self.feature_outer_sum -
+                 count * torch.outer(mu, mu)) / (count - 1)
+
+        return mu.cpu().numpy(), sigma.cpu().numpy()
+
+    def get_inception_score(self):
+        split_prob_mean = self.split_prob_sum / self.split_count.unsqueeze(1)
+        split_kl = self.split_plogp_sum / self.split_count - torch.xlogy(
+            split_prob_mean, split_prob_mean).sum(dim=1)
+        split_scores = torch.exp(split_kl).cpu().numpy()
+
+        # Inception Score = is_score_mean ± is_score_std
+        is_score_mean = np.mean(split_scores)
+        is_score_std = np.std(split_scores)
+
+        return is_score_mean, is_score_std
+
+
+def get_object_key(obj):
+    '''
+    stable string key of dataset/transform settings,no memory address in key
+    '''
+    if isinstance(obj, (bool, int, float, str, type(None))):
+        return repr(obj)
+    if isinstance(obj, np.ndarray):
+        return f'ndarray{obj.shape}{hashlib.md5(np.ascontiguousarray(obj).tobytes()).hexdigest()}'
+    if isinstance(obj, torch.Tensor):
+        return get_object_key(obj.detach().cpu().numpy())
+    if isinstance(obj, (list, tuple)):
+        return '[' + ','.join([get_object_key(per_obj) for per_obj in obj]) + ']'
+    if isinstance(obj, dict):
+        return '{' + ','.join([
+            f'{get_object_key(key)}:{get_object_key(obj[key])}'
+            for key in sorted(obj.keys(), key=str)
+        ]) + '}'
+    if hasattr(obj, '__dict__'):
+        return type(obj).__name__ + get_object_key({
+            key: value
+            for key, value in vars(obj).items() if not key.startswith('_')
+        })
+
+    return type(obj).__name__
+
+
+def get_fid_reference_statistics_key(dataset, input_image_size, fid_model_name=''):
+    '''
+    md5 key of reference dataset content,transform,fid input image size and fid model
+    '''
+    dataset_key = get_object_key(dataset)
+    key = f'{dataset_key}|{input_image_size}|{fid_model_name}'
+
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def load_fid_reference_statistics(statistics_path):
+    if not os.path.exists(statistics_path):
+        return None
+
+    statistics = np.load(statistics_path)
+
+    return statistics['mu'], statistics['sigma'], int(statistics['image_num'])
+
+
+def save_fid_reference_statistics(statistics_path, mu, sigma, image_num):
+    # write to a temp file then rename,readers never see a partial file
+    temp_statistics_path = f'{statistics_path}.{os.getpid()}.tmp.npz'
+    np.savez(temp_statistics_path, mu=mu, sigma=sigma, image_num=image_num)
+    os.replace(temp_statistics_path, statistics_path)
+
+
+if __name__ == '__main__':
+    import time
+
+    image_num, data_split_num = 5000, 10
+    features = np.random.rand(image_num, 2048).astype(np.float32)
+    logits = np.random.randn(image_num, 1008).astype(np.float32) * 3
+    probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+
+    start_time = time.time()
+    mu, sigma = np.mean(features.astype(np.float64),
+                        axis=0), np.cov(features.astype(np.float64),
+                                        rowvar=False)
+    # streaming meter assigns image i to split i % data_split_num
+    split_order = np.concatenate(
+        [np.arange(k, image_num, data_split_num) for k in range(data_split_num)])
+    is_score_mean, is_score_std = compute_inception_score(
+        probs[split_order].astype(np.float64), data_split_num)
+    print(f'numpy statistics: {(time.time() - start_time) * 1000:.2f}ms')
+
+    meter = FIDISStatisticsMeter(data_split_num=data_split_num)
+    start_time = time.time()
+    for i in range(0, image_num, 512):
+        meter.update(features=torch.from_numpy(features[i:i + 512]),
+                     probs=torch.from_numpy(probs[i:i + 512]))
+    stream_mu, stream_sigma = meter.get_feature_statistics()
+    stream_is_score_mean, stream_is_score_std = meter.get_inception_score()
+    print(f'streaming statistics: {(time.time() - start_time) * 1000:.2f}ms')
+
+    print('mu max abs diff:', np.abs(mu - stream_mu).max())
+    print('sigma max abs diff:', np.abs(sigma - stream_sigma).max())
+    print('is score:', is_score_mean, is_score_std, stream_is_score_mean,
+          stream_is_score_std)
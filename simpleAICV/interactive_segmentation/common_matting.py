@@ -593,6 +593,13 @@ class SAMMattingBatchCollater:
         self.positive_point_num_range = positive_point_num_range
 
     def __call__(self, data):
+        # per image sample mode,every image returns list of mask samples
+        if isinstance(data[0], list):
+            data = [
+                per_sample for per_image_samples in data
+                for per_sample in per_image_samples
+            ]
+
         images = [s['image'] for s in data]
         boxes = [x['box'] for x in data]
         masks = [x['mask'] for x in data]
@@ -0,0 +1,446 @@
+import os
+import json
+import math
+import numpy as np
+
+from tqdm import tqdm
+from pycocotools import mask as mask_utils
+
+from simpleAICV.classification.datasets.imagefolderindex import save_array_atomically
+
+index_meta_file_name = 'meta.json'
+
+
+def build_sam_annotation_index(set_dir, json_path_list, index_dir,
+                               per_image_mask_max_num):
+    '''
+    build compact annotation index for sa_1b format json files,only keep first per_image_mask_max_num annotations per image
+    meta.json:json path(relative to set_dir) list and per_image_mask_max_num
+    image_info.npy:int64 [image_num,2],image_h,image_w
+    annotation_info.npy:int64 [annotation_num,4],image_idx,annotation idx in json,rle counts offset,rle counts length
+    annotation_box.npy:float64 [annotation_num,5],bbox x_min,y_min,w,h and area
+    rle_counts.npy:uint8 [total_length],all compressed rle counts strings
+    '''
+    os.makedirs(index_dir) if not os.path.exists(index_dir) else None
+
+    image_info, annotation_info, annotation_box = [], [], []
+    rle_counts = bytearray()
+    relative_json_path_list = []
+    for image_idx, per_json_path in enumerate(tqdm(json_path_list)):
+        relative_json_path_list.append(os.path.relpath(per_json_path, set_dir))
+        with open(per_json_path, encoding='utf-8') as f:
+            per_image_json_data = json.load(f)
+
+        image_info.append([
+            per_image_json_data['image']['height'],
+            per_image_json_data['image']['width'],
+        ])
+
+        per_image_annotation = per_image_json_data['annotations'][
+            0:per_image_mask_max_num]
+        for annot_idx, per_annot in enumerate(per_image_annotation):
+            per_counts = per_annot['segmentation']['counts']
+            if isinstance(per_counts, str):
+                per_counts = per_counts.encode('utf-8')
+
+            annotation_info.append(
+                [image_idx, annot_idx,
+                 len(rle_counts),
+                 len(per_counts)])
+            annotation_box.append(
+                list(per_annot['bbox'][0:4]) + [per_annot['area']])
+            rle_counts.extend(per_counts)
+
+    image_info = np.array(image_info, dtype=np.int64).reshape(-1, 2)
+    annotation_info = np.array(annotation_info, dtype=np.int64).reshape(-1, 4)
+    annotation_box = np.array(annotation_box, dtype=np.float64).reshape(-1, 5)
+    rle_counts = np.frombuffer(bytes(rle_counts), dtype=np.uint8)
+
+    save_array_atomically(image_info, os.path.join(index_dir,
+                                                   'image_info.npy'))
+    save_array_atomically(annotation_info,
+                          os.path.join(index_dir, 'annotation_info.npy'))
+    save_array_atomically(annotation_box,
+                          os.path.join(index_dir, 'annotation_box.npy'))
+    save_array_atomically(rle_counts, os.path.join(index_dir,
+                                                   'rle_counts.npy'))
+
+    # write meta last,index is valid only when meta exists
+    meta_path = os.path.join(index_dir, index_meta_file_name)
+    temp_meta_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(temp_meta_path, 'w', encoding='utf-8') as f:
+        json.dump(
+            {
+                'json_path_list': relative_json_path_list,
+                'per_image_mask_max_num': per_image_mask_max_num,
+            }, f)
+    os.replace(temp_meta_path, meta_path)
+
+
+def load_sam_annotation_index(index_dir):
+    '''
+    all arrays are memory-mapped,only touched pages are read from disk
+    '''
+    with open(os.path.join(index_dir, index_meta_file_name),
+              encoding='utf-8') as f:
+        index_meta = json.load(f)
+
+    annotation_index = {
+        'json_path_list': index_meta['json_path_list'],
+        'per_image_mask_max_num': index_meta['per_image_mask_max_num'],
+    }
+    for key in [
+            'image_info', 'annotation_info', 'annotation_box', 'rle_counts'
+    ]:
+        annotation_index[key] = np.load(os.path.join(index_dir, f'{key}.npy'),
+                                        mmap_mode='r')
+
+    return annotation_index
+
+
+def load_or_build_sam_annotation_index(set_dir, json_path_list, index_dir,
+                                       per_image_mask_max_num):
+    '''
+    load index if it covers all json files and enough masks per image,else rebuild it
+    '''
+    meta_path = os.path.join(index_dir, index_meta_file_name)
+    if os.path.exists(meta_path):
+        annotation_index = load_sam_annotation_index(index_dir)
+        index_json_path_set = set(annotation_index['json_path_list'])
+        if annotation_index[
+                'per_image_mask_max_num'] >= per_image_mask_max_num and all(
+                    os.path.relpath(per_json_path, set_dir) in
+                    index_json_path_set for per_json_path in json_path_list):
+            return annotation_index
+
+    print(f'Building annotation index for {set_dir}')
+    build_sam_annotation_index(set_dir, json_path_list, index_dir,
+                               per_image_mask_max_num)
+
+    return load_sam_annotation_index(index_dir)
+
+
+def filter_sam_annotation_index(annotation_index,
+                                per_image_mask_chosse_max_num,
+                                area_filter_ratio):
+    '''
+    same box/area filter as json annotation loop in SAMSegmentationDataset,but vectorized on index arrays
+    return:list of kept annotation rows for each image in annotation_index['json_path_list']
+    '''
+    annotation_info = np.asarray(annotation_index['annotation_info'])
+    annotation_box = np.asarray(annotation_index['annotation_box'])
+    image_info = np.asarray(annotation_index['image_info'])
+
+    image_idxs, annot_idxs = annotation_info[:, 0], annotation_info[:, 1]
+    x, y = annotation_box[:, 0], annotation_box[:, 1]
+    w, h = annotation_box[:, 2], annotation_box[:, 3]
+    area = annotation_box[:, 4]
+    image_h, image_w = image_info[image_idxs, 0], image_info[image_idxs, 1]
+
+    keep = annot_idxs < per_image_mask_chosse_max_num
+    keep &= ~((np.ceil(w * h) < 25) | (np.ceil(w) < 5) | (np.ceil(h) < 5))
+
+    x_min = np.ceil(np.maximum(x, 0))
+    y_min = np.ceil(np.maximum(y, 0))
+    x_max = np.ceil(np.minimum(x + w, image_w))
+    y_max = np.ceil(np.minimum(y + h, image_h))
+    box_w = np.ceil(x_max - x_min)
+    box_h = np.ceil(y_max - y_min)
+    keep &= ~((box_w * box_h < 25) | (box_w < 5) | (box_h < 5))
+
+    area_ratio = area / (image_h * image_w).astype(np.float64)
+    keep &= ~((area_ratio < area_filter_ratio) | (area_ratio > 0.9))
+
+    keep_rows = np.nonzero(keep)[0]
+    # annotation rows are sorted by image_idx
+    image_split_idxs = np.searchsorted(image_idxs[keep_rows],
+                                       np.arange(1, image_info.shape[0]))
+    per_image_keep_rows = np.split(keep_rows, image_split_idxs)
+
+    return per_image_keep_rows
+
+
+def load_sam_annotation_index_mask(annotation_index, annotation_row):
+    '''
+    return:box [x_min,y_min,x_max,y_max],binary mask [h,w] and compressed rle counts string of one annotation
+    '''
+    image_idx, _, rle_offset, rle_length = annotation_index['annotation_info'][
+        annotation_row]
+    per_image_h, per_image_w = annotation_index['image_info'][image_idx]
+    per_image_h, per_image_w = int(per_image_h), int(per_image_w)
+
+    target_box = annotation_index['annotation_box'][annotation_row][0:4]
+
+    # transform bbox targets from [x_min, y_min, w, h] to [x_min, y_min, x_max, y_max]
+    x_min = math.ceil(max(target_box[0], 0))
+    y_min = math.ceil(max(target_box[1], 0))
+    x_max = math.ceil(min(target_box[0] + target_box[2], per_image_w))
+    y_max = math.ceil(min(target_box[1] + target_box[3], per_image_h))
+
+    target_box = np.array([x_min, y_min, x_max, y_max])
+
+    counts_string = annotation_index['rle_counts'][rle_offset:rle_offset +
+                                                   rle_length].tobytes()
+    target_mask = mask_utils.decode({
+        'size': [per_image_h, per_image_w],
+        'counts': counts_string,
+    })
+    target_mask[target_mask > 0] = 1
+
+    return target_box.astype(np.float32), target_mask.astype(
+        np.float32), counts_string
+
+
+def decode_rle_counts_string(counts_string):
+    '''
+    decode coco compressed rle counts string to run lengths,same as rleFrString in pycocotools
+    runs are in column-major order and start with background run
+    '''
+    if isinstance(counts_string, str):
+        counts_string = counts_string.encode('utf-8')
+
+    counts = []
+    p, string_length = 0, len(counts_string)
+    while p < string_length:
+        x, k, more = 0, 0, 1
+        while more:
+            c = counts_string[p] - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+
+    return np.array(counts, dtype=np.int64)
+
+
+def sample_points_from_rle_counts(counts, image_h, points_num, label):
+    '''
+    uniform sample points from foreground(label=1) or background(label=0) runs of rle counts,
+    same distribution as np.random.choice on np.argwhere of dense mask without decoding the dense mask
+    return:[points_num,3] x,y,label,or [0,3] if area < points_num
+    '''
+    counts = np.asarray(counts, dtype=np.int64)
+    run_starts = np.cumsum(counts) - counts
+
+    # even runs are background,odd runs are foreground
+    run_idxs = np.arange(1 if label == 1 else 0, len(counts), 2)
+    run_lengths, run_starts = counts[run_idxs], run_starts[run_idxs]
+    area = int(run_lengths.sum())
+
+    if area < points_num or points_num <= 0:
+        return np.zeros((0, 3), dtype=np.float32)
+
+    run_ends = np.cumsum(run_lengths)
+    sample_idxs = np.random.randint(0, area, points_num)
+    sample_run_idxs = np.searchsorted(run_ends, sample_idxs, side='right')
+    sample_pixel_idxs = run_starts[sample_run_idxs] + (
+        sample_idxs -
+        (run_ends[sample_run_idxs] - run_lengths[sample_run_idxs]))
+
+    # column-major pixel idx to x,y
+    points = np.zeros((points_num, 3), dtype=np.float32)
+    points[:, 0] = sample_pixel_idxs // image_h
+    points[:, 1] = sample_pixel_idxs % image_h
+    points[:, 2] = label
+
+    return points
+
+
+class SAMDatasetMixin:
+    '''
+    shared annotation index and per image sample functions of SAMSegmentationDataset and SAMMattingDataset
+    dataset needs:all_set_image_path_list(json path at index 2 of per image info),
+    all_image_mask_path_list(image path at index 2 of per mask info),all_image_mask_idx_list,
+    annotation_index_dir_dict,annotation_index_dict,per_image_sample_mask_num,positive_points_num,
+    negative_points_num,load_image,load_masks and get_per_mask_sample
+    '''
+
+    def load_annotation_index_keep_rows(self, root_dir, set_type,
+                                        annotation_index_dir,
+                                        per_image_mask_chosse_max_num,
+                                        area_filter_ratio,
+                                        index_set_name_list):
+        '''
+        build/load annotation index of every set in index_set_name_list and filter annotation rows
+        return:
+        json_path_set_dict:normalized json path -> [set_name,image_idx in annotation index]
+        per_image_keep_rows_dict:set_name -> [per image keep rows,image_info,annotation_info]
+        '''
+        json_path_set_dict, per_image_keep_rows_dict = {}, {}
+        for per_set_name in index_set_name_list:
+            per_set_image_path_list = self.all_set_image_path_list[
+                per_set_name]
+            per_set_dir = os.path.join(root_dir, per_set_name, set_type)
+            per_set_json_path_list = sorted([
+                per_image_info[2] for per_image_info in per_set_image_path_list
+            ])
+            per_set_index_dir = os.path.join(annotation_index_dir,
+                                             f'{per_set_name}_{set_type}')
+            self.annotation_index_dir_dict[per_set_name] = per_set_index_dir
+
+            annotation_index = load_or_build_sam_annotation_index(
+                per_set_dir, per_set_json_path_list, per_set_index_dir,
+                per_image_mask_chosse_max_num)
+            per_image_keep_rows = filter_sam_annotation_index(
+                annotation_index, per_image_mask_chosse_max_num,
+                area_filter_ratio)
+
+            for image_idx, per_relative_json_path in enumerate(
+                    annotation_index['json_path_list']):
+                per_json_path = os.path.normpath(
+                    os.path.join(per_set_dir, per_relative_json_path))
+                json_path_set_dict[per_json_path] = [per_set_name, image_idx]
+            per_image_keep_rows_dict[per_set_name] = [
+                per_image_keep_rows, annotation_index['image_info'],
+                annotation_index['annotation_info']
+            ]
+
+        return json_path_set_dict, per_image_keep_rows_dict
+
+    def get_image_annotation_rows(self, per_json_path, json_path_set_dict,
+                                  per_image_keep_rows_dict):
+        '''
+        return:image_h,image_w and [mask_list_idx,set_name,annotation_row] list of kept annotations of one image
+        '''
+        per_set_name, image_idx = json_path_set_dict[os.path.normpath(
+            per_json_path)]
+        per_image_keep_rows, image_info, annotation_info = per_image_keep_rows_dict[
+            per_set_name]
+        per_image_h, per_image_w = int(image_info[image_idx][0]), int(
+            image_info[image_idx][1])
+
+        per_image_annotation_rows = []
+        for annotation_row in per_image_keep_rows[image_idx]:
+            per_image_annotation_rows.append([
+                int(annotation_info[annotation_row][1]),
+                per_set_name,
+                int(annotation_row),
+            ])
+
+        return per_image_h, per_image_w, per_image_annotation_rows
+
+    def get_annotation_index(self, per_set_name):
+        # open memory-mapped index lazily in each dataloader worker
+        if per_set_name not in self.annotation_index_dict.keys():
+            self.annotation_index_dict[
+                per_set_name] = load_sam_annotation_index(
+                    self.annotation_index_dir_dict[per_set_name])
+
+        return self.annotation_index_dict[per_set_name]
+
+    def is_new_image_group(self, mask_idx):
+        return mask_idx == 0 or self.all_image_mask_path_list[mask_idx][
+            2] != self.all_image_mask_path_list[mask_idx - 1][2]
+
+    def group_mask_idxs_by_image(self):
+        # group masks by image for per image sample mode,masks of one image are continuous
+        all_image_mask_idx_list = []
+        for mask_idx in range(len(self.all_image_mask_path_list)):
+            if self.is_new_image_group(mask_idx):
+                all_image_mask_idx_list.append([])
+            all_image_mask_idx_list[-1].append(mask_idx)
+
+        return all_image_mask_idx_list
+
+    def get_per_image_sample_mask_num(self, per_image_mask_idxs):
+        return self.per_image_sample_mask_num
+
+    def get_per_image_samples(self, idx):
+        per_image_mask_idxs = self.all_image_mask_idx_list[idx]
+        per_image_sample_mask_num = self.get_per_image_sample_mask_num(
+            per_image_mask_idxs)
+        # 图片mask数不足per_image_sample_mask_num时有放回采样,保证每张图样本数固定
+        replace = len(per_image_mask_idxs) < per_image_sample_mask_num
+        choose_mask_idxs = np.random.choice(per_image_mask_idxs,
+                                            per_image_sample_mask_num,
+                                            replace=replace)
+        choose_mask_idxs = [int(mask_idx) for mask_idx in choose_mask_idxs]
+
+        # image only decode once,annotation only load once
+        image = self.load_image(choose_mask_idxs[0])
+        per_image_masks = self.load_masks(choose_mask_idxs)
+
+        samples = []
+        for mask_idx, (image_box, image_mask,
+                       rle_counts) in zip(choose_mask_idxs, per_image_masks):
+            samples.append(
+                self.get_per_mask_sample(mask_idx, image, image_box,
+                                         image_mask, rle_counts))
+
+        return samples
+
+    def sample_points_from_rle(self, rle_counts, image_h):
+        # compressed rle counts string or uncompressed rle counts list
+        if isinstance(rle_counts, (str, bytes)):
+            rle_counts = decode_rle_counts_string(rle_counts)
+        positive_prompt_point = sample_points_from_rle_counts(
+            rle_counts, image_h, self.positive_points_num, 1)
+        negative_prompt_point = sample_points_from_rle_counts(
+            rle_counts, image_h, self.negative_points_num, 0)
+
+        return positive_prompt_point, negative_prompt_point
+
+
+if __name__ == '__main__':
+    import random
+    seed = 0
+    # for hash
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    # for python and numpy
+    random.seed(seed)
+    np.random.seed(seed)
+
+    from pycocotools import mask as mask_utils
+
+    # rle decode and rle point sample check with dense mask
+    for _ in range(100):
+        h, w = np.random.randint(1, 64), np.random.randint(1, 64)
+        dense_mask = (np.random.uniform(0, 1, (h, w))
+                      > np.random.uniform(0, 1)).astype(np.uint8)
+        rle = mask_utils.encode(np.asfortranarray(dense_mask))
+        counts = decode_rle_counts_string(rle['counts'])
+        assert counts.sum() == h * w
+        decode_mask = np.zeros((h * w), dtype=np.uint8)
+        start = 0
+        for i, per_count in enumerate(counts):
+            decode_mask[start:start + per_count] = i % 2
+            start += per_count
+        assert (decode_mask.reshape(w, h).T == dense_mask).all()
+
+        for label in [0, 1]:
+            points = sample_points_from_rle_counts(counts, h, 9, label)
+            label_area = int((dense_mask == label).sum())
+            if label_area < 9:
+                assert points.shape[0] == 0
+            else:
+                assert points.shape[0] == 9
+                assert (dense_mask[points[:, 1].astype(np.int64),
+                                   points[:,
+                                          0].astype(np.int64)] == label).all()
+    print('1111, rle decode and rle point sample check pass')
+
+    import time
+    dense_mask = np.zeros((1500, 2250), dtype=np.uint8)
+    dense_mask[300:900, 400:1600] = 1
+    rle = mask_utils.encode(np.asfortranarray(dense_mask))
+    start_time = time.time()
+    for _ in range(100):
+        coords = np.argwhere(dense_mask)
+        coords[np.random.choice(len(coords), 9)]
+        coords = np.argwhere(1 - dense_mask)
+        coords[np.random.choice(len(coords), 9)]
+    argwhere_time = (time.time() - start_time) / 100
+    start_time = time.time()
+    for _ in range(100):
+        counts = decode_rle_counts_string(rle['counts'])
+        sample_points_from_rle_counts(counts, 1500, 9, 1)
+        sample_points_from_rle_counts(counts, 1500, 9, 0)
+    rle_time = (time.time() - start_time) / 100
+    print(
+        f'2222, argwhere point sample: {argwhere_time * 1000:.3f}ms, rle point sample: {rle_time * 1000:.3f}ms'
+    )
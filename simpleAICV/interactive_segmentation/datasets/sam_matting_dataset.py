@@ -15,6 +15,8 @@ from pycocotools import mask as mask_utils
 
 from torch.utils.data import Dataset
 
+from simpleAICV.interactive_segmentation.datasets.sam_annotation_index import load_sam_annotation_index_mask, SAMDatasetMixin
+
 FOREGROUND_CLASSES = [
     'global_foreground_area',
     'local_foreground_area',
@@ -43,7 +45,7 @@ matting_dataset_name_list = [
 ]
 
 
-class SAMMattingDataset(Dataset):
+class SAMMattingDataset(SAMDatasetMixin, Dataset):
 
     def __init__(
             self,
@@ -76,8 +78,16 @@ class SAMMattingDataset(Dataset):
             box_noise_wh_ratio=0.1,
             mask_noise_area_ratio=0.04,
             resample_num=1,
+            per_image_sample_mask_num=0,
+            annotation_index_dir=None,
+            use_rle_point_sample=False,
             transform=None):
-
+        '''
+        per_image_sample_mask_num:0:every mask is a sample,>0:every image is a sample,decode image once and return list of per_image_sample_mask_num mask samples
+        matting dataset image only has one mask,return list of one sample
+        annotation_index_dir:not None:build/load memory-mapped annotation index(bbox,area,rle counts) for sa_1b format sets instead of parsing json files
+        use_rle_point_sample:sample prompt points from rle runs instead of np.argwhere on dense mask for sa_1b format sets
+        '''
         self.all_set_image_path_list = collections.OrderedDict()
         self.all_set_image_nums = collections.OrderedDict()
         for per_set_name in tqdm(set_name):
@@ -144,6 +154,20 @@ class SAMMattingDataset(Dataset):
 
         # get all mask for all images
         self.all_image_mask_path_list = []
+        # [set_name,annotation_row] in annotation index for each mask,None for matting dataset mask
+        self.all_image_mask_annotation_index_list = []
+        self.annotation_index_dir_dict = collections.OrderedDict()
+        self.annotation_index_dict = {}
+        json_path_set_dict, per_image_keep_rows_dict = {}, {}
+        if annotation_index_dir is not None:
+            json_path_set_dict, per_image_keep_rows_dict = self.load_annotation_index_keep_rows(
+                root_dir, set_type, annotation_index_dir,
+                per_image_mask_chosse_max_num, area_filter_ratio, [
+                    per_set_name
+                    for per_set_name in self.all_set_image_path_list.keys()
+                    if per_set_name not in matting_dataset_name_list
+                ])
+
         for per_image_name, per_image_path, per_json_path, per_set_name in tqdm(
                 self.image_path_list):
             matting_dataset_flag = False
@@ -162,6 +186,24 @@ class SAMMattingDataset(Dataset):
                     per_image_w,
                     per_set_name,
                 ])
+                self.all_image_mask_annotation_index_list.append(None)
+            elif annotation_index_dir is not None:
+                per_image_h, per_image_w, per_image_annotation_rows = self.get_image_annotation_rows(
+                    per_json_path, json_path_set_dict,
+                    per_image_keep_rows_dict)
+
+                for mask_list_idx, _, annotation_row in per_image_annotation_rows:
+                    self.all_image_mask_path_list.append([
+                        per_image_name,
+                        mask_list_idx,
+                        per_image_path,
+                        per_json_path,
+                        per_image_h,
+                        per_image_w,
+                        per_set_name,
+                    ])
+                    self.all_image_mask_annotation_index_list.append(
+                        [per_set_name, annotation_row])
             else:
                 with open(per_json_path, encoding='utf-8') as f:
                     per_image_json_data = json.load(f)
@@ -214,6 +256,9 @@ class SAMMattingDataset(Dataset):
                             per_image_w,
                             per_set_name,
                         ])
+                        self.all_image_mask_annotation_index_list.append(None)
+
+        self.all_image_mask_idx_list = self.group_mask_idxs_by_image()
 
         self.max_side = max_side
         self.kernel_size_range = kernel_size_range
@@ -222,23 +267,65 @@ class SAMMattingDataset(Dataset):
         self.area_filter_ratio = area_filter_ratio
         self.box_noise_wh_ratio = box_noise_wh_ratio
         self.mask_noise_area_ratio = mask_noise_area_ratio
+        self.per_image_sample_mask_num = per_image_sample_mask_num
+        self.use_rle_point_sample = use_rle_point_sample
         self.transform = transform
 
         print(f'Image Size:{len(self.image_path_list)}')
         print(f'Dataset Size:{len(self.all_image_mask_path_list)}')
+        if self.per_image_sample_mask_num > 0:
+            print(
+                f'Per Image Sample Dataset Size:{len(self.all_image_mask_idx_list)}'
+            )
+
+    def is_new_image_group(self, mask_idx):
+        # every resampled matting dataset mask is a group
+        return self.all_image_mask_path_list[
+            mask_idx][6] in matting_dataset_name_list or super(
+                SAMMattingDataset, self).is_new_image_group(mask_idx)
+
+    def get_per_image_sample_mask_num(self, per_image_mask_idxs):
+        # matting dataset image only has one mask,return one sample instead of per_image_sample_mask_num copies of same mask,
+        # so matting data keeps the same share of the batch as in per mask sample mode
+        if self.all_image_mask_path_list[
+                per_image_mask_idxs[0]][6] in matting_dataset_name_list:
+            return 1
+
+        return self.per_image_sample_mask_num
 
     def __len__(self):
+        if self.per_image_sample_mask_num > 0:
+            return len(self.all_image_mask_idx_list)
+
         return len(self.all_image_mask_path_list)
 
     def __getitem__(self, idx):
-        _, _, image_path, json_path, _, _, _ = self.all_image_mask_path_list[
-            idx]
+        if self.per_image_sample_mask_num > 0:
+            return self.get_per_image_samples(idx)
 
         image = self.load_image(idx)
-        image_box, image_mask = self.load_mask(idx)
+        [[image_box, image_mask, rle_counts]] = self.load_masks([idx])
+
+        sample = self.get_per_mask_sample(idx, image, image_box, image_mask,
+                                          rle_counts)
+
+        return sample
+
+    def get_per_mask_sample(self,
+                            idx,
+                            image,
+                            image_box,
+                            image_mask,
+                            rle_counts=None):
+        _, _, image_path, json_path, _, _, _ = self.all_image_mask_path_list[
+            idx]
 
         image_h, image_w = image.shape[0], image.shape[1]
 
+        # rle runs are in origin image coords,only sample from rle when image not resized
+        use_rle_point_sample = self.use_rle_point_sample and rle_counts is not None and max(
+            image_h, image_w) <= self.max_side
+
         if max(image_h, image_w) > self.max_side:
             factor = self.max_side / max(image_h, image_w)
             resize_w, resize_h = int(image_w * float(factor) +
@@ -252,6 +339,42 @@ class SAMMattingDataset(Dataset):
         trimap = self.generate_trimap_from_mask(image_mask)
         fg_map, bg_map = self.generate_fg_bg_map_from_mask(image, image_mask)
 
+        if use_rle_point_sample:
+            positive_prompt_point, negative_prompt_point = self.sample_points_from_rle(
+                rle_counts, image_h)
+        else:
+            positive_prompt_point, negative_prompt_point = self.sample_points_from_mask(
+                image_mask)
+
+        prompt_box = copy.deepcopy(image_box)
+        if self.box_noise_wh_ratio > 0:
+            prompt_box = self.noise_bbox(prompt_box, size)
+
+        prompt_mask = copy.deepcopy((image_mask > 0.5).astype(np.float32))
+        prompt_mask = self.noise_mask(prompt_mask, idx)
+
+        sample = {
+            'image_path': image_path,
+            'json_path': json_path,
+            'image': image,
+            'box': image_box,
+            'mask': image_mask,
+            'size': size,
+            'positive_prompt_point': positive_prompt_point,
+            'negative_prompt_point': negative_prompt_point,
+            'prompt_box': prompt_box,
+            'prompt_mask': prompt_mask,
+            'trimap': trimap,
+            'fg_map': fg_map,
+            'bg_map': bg_map,
+        }
+
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
+
+    def sample_points_from_mask(self, image_mask):
         image_mask_all_points_coords = np.argwhere((image_mask
                                                     > 0.5).astype(np.float32))
         image_mask_all_points_num = len(image_mask_all_points_coords)
@@ -298,33 +421,7 @@ class SAMMattingDataset(Dataset):
             else:
                 negative_prompt_point = np.zeros((0, 3), dtype=np.float32)
 
-        prompt_box = copy.deepcopy(image_box)
-        if self.box_noise_wh_ratio > 0:
-            prompt_box = self.noise_bbox(prompt_box, size)
-
-        prompt_mask = copy.deepcopy((image_mask > 0.5).astype(np.float32))
-        prompt_mask = self.noise_mask(prompt_mask, idx)
-
-        sample = {
-            'image_path': image_path,
-            'json_path': json_path,
-            'image': image,
-            'box': image_box,
-            'mask': image_mask,
-            'size': size,
-            'positive_prompt_point': positive_prompt_point,
-            'negative_prompt_point': negative_prompt_point,
-            'prompt_box': prompt_box,
-            'prompt_mask': prompt_mask,
-            'trimap': trimap,
-            'fg_map': fg_map,
-            'bg_map': bg_map,
-        }
-
-        if self.transform:
-            sample = self.transform(sample)
-
-        return sample
+        return positive_prompt_point, negative_prompt_point
 
     def load_image(self, idx):
         _, _, per_image_path, _, _, _, _ = self.all_image_mask_path_list[idx]
@@ -335,13 +432,23 @@ class SAMMattingDataset(Dataset):
         return image.astype(np.float32)
 
     def load_mask(self, idx):
-        _, mask_list_idx, _, per_json_path, per_image_h, per_image_w, per_set_name = self.all_image_mask_path_list[
-            idx]
+        image_box, image_mask, _ = self.load_masks([idx])[0]
+
+        return image_box, image_mask
+
+    def load_masks(self, mask_idxs):
+        '''
+        load masks of one image,json file only open once,return list of [box,mask,rle counts string]
+        rle counts string is None for matting dataset mask
+        '''
+        _, _, _, per_json_path, per_image_h, per_image_w, per_set_name = self.all_image_mask_path_list[
+            mask_idxs[0]]
 
         matting_dataset_flag = False
         if per_set_name in matting_dataset_name_list:
             matting_dataset_flag = True
 
+        per_image_masks = []
         if matting_dataset_flag:
             target_mask = np.array(Image.open(per_json_path).convert('L'),
                                    dtype=np.uint8)
@@ -359,31 +466,60 @@ class SAMMattingDataset(Dataset):
 
             target_box = np.array([x_min, y_min, x_max, y_max])
             target_mask = target_mask / 255.
-        else:
-            with open(per_json_path, encoding='utf-8') as f:
-                per_image_json_data = json.load(f)
-                per_image_annotation = per_image_json_data['annotations']
-                per_annot = per_image_annotation[mask_list_idx]
 
-                per_image_h, per_image_w = per_image_json_data['image'][
-                    'height'], per_image_json_data['image']['width']
+            for _ in mask_idxs:
+                per_image_masks.append([
+                    target_box.astype(np.float32),
+                    target_mask.astype(np.float32),
+                    None,
+                ])
+
+            return per_image_masks
 
-                target_box = np.array(per_annot['bbox'])
+        if self.all_image_mask_annotation_index_list[mask_idxs[0]] is not None:
+            for mask_idx in mask_idxs:
+                per_set_name, annotation_row = self.all_image_mask_annotation_index_list[
+                    mask_idx]
+                annotation_index = self.get_annotation_index(per_set_name)
+                per_image_masks.append(
+                    list(
+                        load_sam_annotation_index_mask(annotation_index,
+                                                       annotation_row)))
 
-                # transform bbox targets from [x_min, y_min, w, h] to [x_min, y_min, x_max, y_max]
-                x_min = math.ceil(max(target_box[0], 0))
-                y_min = math.ceil(max(target_box[1], 0))
-                x_max = math.ceil(
-                    min(target_box[0] + target_box[2], per_image_w))
-                y_max = math.ceil(
-                    min(target_box[1] + target_box[3], per_image_h))
+            return per_image_masks
+
+        with open(per_json_path, encoding='utf-8') as f:
+            per_image_json_data = json.load(f)
+            per_image_annotation = per_image_json_data['annotations']
+
+            per_image_h, per_image_w = per_image_json_data['image'][
+                'height'], per_image_json_data['image']['width']
+
+        for mask_idx in mask_idxs:
+            _, mask_list_idx, _, _, _, _, _ = self.all_image_mask_path_list[
+                mask_idx]
+            per_annot = per_image_annotation[mask_list_idx]
+
+            target_box = np.array(per_annot['bbox'])
+
+            # transform bbox targets from [x_min, y_min, w, h] to [x_min, y_min, x_max, y_max]
+            x_min = math.ceil(max(target_box[0], 0))
+            y_min = math.ceil(max(target_box[1], 0))
+            x_max = math.ceil(min(target_box[0] + target_box[2], per_image_w))
+            y_max = math.ceil(min(target_box[1] + target_box[3], per_image_h))
+
+            target_box = np.array([x_min, y_min, x_max, y_max])
 
-                target_box = np.array([x_min, y_min, x_max, y_max])
+            target_mask = mask_utils.decode(per_annot['segmentation'])
+            target_mask[target_mask > 0] = 1
 
-                target_mask = mask_utils.decode(per_annot['segmentation'])
-                target_mask[target_mask > 0] = 1
+            per_image_masks.append([
+                target_box.astype(np.float32),
+                target_mask.astype(np.float32),
+                per_annot['segmentation']['counts'],
+            ])
 
-        return target_box.astype(np.float32), target_mask.astype(np.float32)
+        return per_image_masks
 
     def generate_trimap_from_mask(self, alpha):
         alpha_h, alpha_w = alpha.shape[0], alpha.shape[1]
@@ -12,8 +12,10 @@ from pycocotools import mask as mask_utils
 
 from torch.utils.data import Dataset
 
+from simpleAICV.interactive_segmentation.datasets.sam_annotation_index import load_sam_annotation_index_mask, SAMDatasetMixin
 
-class SAMSegmentationDataset(Dataset):
+
+class SAMSegmentationDataset(SAMDatasetMixin, Dataset):
 
     def __init__(
             self,
@@ -49,8 +51,15 @@ class SAMSegmentationDataset(Dataset):
             area_filter_ratio=0.0001,
             box_noise_wh_ratio=0.1,
             mask_noise_area_ratio=0.04,
+            per_image_sample_mask_num=0,
+            annotation_index_dir=None,
+            use_rle_point_sample=False,
             transform=None):
-
+        '''
+        per_image_sample_mask_num:0:every mask is a sample,>0:every image is a sample,decode image once and return list of per_image_sample_mask_num mask samples
+        annotation_index_dir:not None:build/load memory-mapped annotation index(bbox,area,rle counts) instead of parsing json files
+        use_rle_point_sample:sample prompt points from rle runs instead of np.argwhere on dense mask
+        '''
         self.all_set_image_path_list = collections.OrderedDict()
         self.all_set_image_nums = collections.OrderedDict()
         for per_set_name in tqdm(set_name):
@@ -92,6 +101,38 @@ class SAMSegmentationDataset(Dataset):
 
         # get all mask for all images
         self.all_image_mask_path_list = []
+        # [set_name,annotation_row] in annotation index for each mask
+        self.all_image_mask_annotation_index_list = []
+        self.annotation_index_dir_dict = collections.OrderedDict()
+        self.annotation_index_dict = {}
+        if annotation_index_dir is not None:
+            self.get_all_image_mask_from_annotation_index(
+                root_dir, set_type, annotation_index_dir,
+                per_image_mask_chosse_max_num, area_filter_ratio)
+        else:
+            self.get_all_image_mask_from_json(per_image_mask_chosse_max_num,
+                                              area_filter_ratio)
+
+        self.all_image_mask_idx_list = self.group_mask_idxs_by_image()
+
+        self.positive_points_num = positive_points_num
+        self.negative_points_num = negative_points_num
+        self.area_filter_ratio = area_filter_ratio
+        self.box_noise_wh_ratio = box_noise_wh_ratio
+        self.mask_noise_area_ratio = mask_noise_area_ratio
+        self.per_image_sample_mask_num = per_image_sample_mask_num
+        self.use_rle_point_sample = use_rle_point_sample
+        self.transform = transform
+
+        print(f'Image Size:{len(self.image_path_list)}')
+        print(f'Dataset Size:{len(self.all_image_mask_path_list)}')
+        if self.per_image_sample_mask_num > 0:
+            print(
+                f'Per Image Sample Dataset Size:{len(self.all_image_mask_idx_list)}'
+            )
+
+    def get_all_image_mask_from_json(self, per_image_mask_chosse_max_num,
+                                     area_filter_ratio):
         for per_image_name, per_image_path, per_json_path in tqdm(
                 self.image_path_list):
             with open(per_json_path, encoding='utf-8') as f:
@@ -143,28 +184,68 @@ class SAMSegmentationDataset(Dataset):
                         per_image_w,
                     ])
 
-        self.positive_points_num = positive_points_num
-        self.negative_points_num = negative_points_num
-        self.area_filter_ratio = area_filter_ratio
-        self.box_noise_wh_ratio = box_noise_wh_ratio
-        self.mask_noise_area_ratio = mask_noise_area_ratio
-        self.transform = transform
+    def get_all_image_mask_from_annotation_index(self, root_dir, set_type,
+                                                 annotation_index_dir,
+                                                 per_image_mask_chosse_max_num,
+                                                 area_filter_ratio):
+        json_path_set_dict, per_image_keep_rows_dict = self.load_annotation_index_keep_rows(
+            root_dir, set_type, annotation_index_dir,
+            per_image_mask_chosse_max_num, area_filter_ratio,
+            list(self.all_set_image_path_list.keys()))
 
-        print(f'Image Size:{len(self.image_path_list)}')
-        print(f'Dataset Size:{len(self.all_image_mask_path_list)}')
+        for per_image_name, per_image_path, per_json_path in tqdm(
+                self.image_path_list):
+            per_image_h, per_image_w, per_image_annotation_rows = self.get_image_annotation_rows(
+                per_json_path, json_path_set_dict, per_image_keep_rows_dict)
+
+            for mask_list_idx, per_set_name, annotation_row in per_image_annotation_rows:
+                self.all_image_mask_path_list.append([
+                    per_image_name,
+                    mask_list_idx,
+                    per_image_path,
+                    per_json_path,
+                    per_image_h,
+                    per_image_w,
+                ])
+                self.all_image_mask_annotation_index_list.append(
+                    [per_set_name, annotation_row])
 
     def __len__(self):
+        if self.per_image_sample_mask_num > 0:
+            return len(self.all_image_mask_idx_list)
+
         return len(self.all_image_mask_path_list)
 
     def __getitem__(self, idx):
-        _, _, image_path, json_path, _, _ = self.all_image_mask_path_list[idx]
+        if self.per_image_sample_mask_num > 0:
+            return self.get_per_image_samples(idx)
 
         image = self.load_image(idx)
         # image_mask:[0,1]二值化mask
-        image_box, image_mask = self.load_mask(idx)
+        [[image_box, image_mask, rle_counts]] = self.load_masks([idx])
+
+        sample = self.get_per_mask_sample(idx, image, image_box, image_mask,
+                                          rle_counts)
+
+        return sample
+
+    def get_per_mask_sample(self,
+                            idx,
+                            image,
+                            image_box,
+                            image_mask,
+                            rle_counts=None):
+        _, _, image_path, json_path, _, _ = self.all_image_mask_path_list[idx]
 
         size = np.array([image.shape[0], image.shape[1]]).astype(np.float32)
 
+        if self.use_rle_point_sample and rle_counts is not None:
+            positive_prompt_point, negative_prompt_point = self.sample_points_from_rle(
+                rle_counts, image_mask.shape[0])
+            return self.get_sample_with_prompt_points(
+                idx, image_path, json_path, image, image_box, image_mask, size,
+                positive_prompt_point, negative_prompt_point)
+
         image_mask_all_points_coords = np.argwhere(image_mask)
         image_mask_all_points_num = len(image_mask_all_points_coords)
 
@@ -209,6 +290,15 @@ class SAMSegmentationDataset(Dataset):
             else:
                 negative_prompt_point = np.zeros((0, 3), dtype=np.float32)
 
+        return self.get_sample_with_prompt_points(idx, image_path, json_path,
+                                                  image, image_box, image_mask,
+                                                  size, positive_prompt_point,
+                                                  negative_prompt_point)
+
+    def get_sample_with_prompt_points(self, idx, image_path, json_path, image,
+                                      image_box, image_mask, size,
+                                      positive_prompt_point,
+                                      negative_prompt_point):
         prompt_box = copy.deepcopy(image_box)
         if self.box_noise_wh_ratio > 0:
             prompt_box = self.noise_bbox(prompt_box, size)
@@ -243,16 +333,41 @@ class SAMSegmentationDataset(Dataset):
         return image.astype(np.float32)
 
     def load_mask(self, idx):
-        _, mask_list_idx, _, per_json_path, _, _ = self.all_image_mask_path_list[
-            idx]
+        image_box, image_mask, _ = self.load_masks([idx])[0]
+
+        return image_box, image_mask
+
+    def load_masks(self, mask_idxs):
+        '''
+        load masks of one image,json file only open once,return list of [box,mask,rle counts string]
+        '''
+        per_image_masks = []
+        if len(self.all_image_mask_annotation_index_list) > 0:
+            for mask_idx in mask_idxs:
+                per_set_name, annotation_row = self.all_image_mask_annotation_index_list[
+                    mask_idx]
+                annotation_index = self.get_annotation_index(per_set_name)
+                per_image_masks.append(
+                    list(
+                        load_sam_annotation_index_mask(annotation_index,
+                                                       annotation_row)))
+
+            return per_image_masks
+
+        _, _, _, per_json_path, _, _ = self.all_image_mask_path_list[
+            mask_idxs[0]]
         with open(per_json_path, encoding='utf-8') as f:
             per_image_json_data = json.load(f)
             per_image_annotation = per_image_json_data['annotations']
-            per_annot = per_image_annotation[mask_list_idx]
 
             per_image_h, per_image_w = per_image_json_data['image'][
                 'height'], per_image_json_data['image']['width']
 
+        for mask_idx in mask_idxs:
+            _, mask_list_idx, _, _, _, _ = self.all_image_mask_path_list[
+                mask_idx]
+            per_annot = per_image_annotation[mask_list_idx]
+
             target_box = np.array(per_annot['bbox'])
 
             # transform bbox targets from [x_min, y_min, w, h] to [x_min, y_min, x_max, y_max]
@@ -264,10 +379,15 @@ class SAMSegmentationDataset(Dataset):
             target_box = np.array([x_min, y_min, x_max, y_max])
 
             target_mask = mask_utils.decode(per_annot['segmentation'])
+            target_mask[target_mask > 0] = 1
 
-        target_mask[target_mask > 0] = 1
+            per_image_masks.append([
+                target_box.astype(np.float32),
+                target_mask.astype(np.float32),
+                per_annot['segmentation']['counts'],
+            ])
 
-        return target_box.astype(np.float32), target_mask.astype(np.float32)
+        return per_image_masks
 
     def noise_bbox(self, properties_bbox, mask_np_shape):
         w, h = properties_bbox[2] - properties_bbox[0], properties_bbox[
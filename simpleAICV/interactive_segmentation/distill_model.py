@@ -172,23 +172,56 @@ class SAMDistillModel(nn.Module):
             for m in self.teacher.parameters():
                 m.requires_grad = False
 
-    def forward(self, batch_images, batch_prompts, mask_out_idxs=[0, 1, 2, 3]):
+    def forward(self,
+                batch_images,
+                batch_prompts,
+                mask_out_idxs=[0, 1, 2, 3],
+                batch_image_embeddings=None,
+                only_image_encoder=False):
+        '''
+        batch_image_embeddings:[tea_image_embeddings,stu_image_embeddings]
+        only_image_encoder=True:return batch_image_embeddings only
+        batch_image_embeddings is not None:skip teacher/student image encoder and reuse the embeddings
+        '''
+        if batch_image_embeddings is None:
+            batch_image_embeddings = self.forward_image_encoder(batch_images)
+
+        if only_image_encoder:
+            return batch_image_embeddings
+
+        tea_image_embeddings, stu_image_embeddings = batch_image_embeddings
+
         if self.freeze_teacher:
             with torch.no_grad():
-                tea_out = self.teacher(batch_images,
-                                       batch_prompts,
-                                       mask_out_idxs=mask_out_idxs)
+                tea_out = self.teacher.forward_prompt_encoder_mask_decoder(
+                    tea_image_embeddings,
+                    batch_prompts,
+                    mask_out_idxs=mask_out_idxs)
         else:
-            tea_out = self.teacher(batch_images,
-                                   batch_prompts,
-                                   mask_out_idxs=mask_out_idxs)
+            tea_out = self.teacher.forward_prompt_encoder_mask_decoder(
+                tea_image_embeddings,
+                batch_prompts,
+                mask_out_idxs=mask_out_idxs)
 
-        stu_out = self.student(batch_images,
-                               batch_prompts,
-                               mask_out_idxs=mask_out_idxs)
+        stu_out = self.student.forward_prompt_encoder_mask_decoder(
+            stu_image_embeddings, batch_prompts, mask_out_idxs=mask_out_idxs)
 
         return tea_out, stu_out
 
+    def forward_image_encoder(self, batch_images):
+        if self.freeze_teacher:
+            with torch.no_grad():
+                tea_image_embeddings = self.teacher.forward_image_encoder(
+                    batch_images)
+        else:
+            tea_image_embeddings = self.teacher.forward_image_encoder(
+                batch_images)
+
+        stu_image_embeddings = self.student.forward_image_encoder(
+            batch_images)
+
+        return [tea_image_embeddings, stu_image_embeddings]
+
 
 class SAMLightDistillModel(nn.Module):
 
@@ -232,23 +265,56 @@ class SAMLightDistillModel(nn.Module):
             for m in self.teacher.parameters():
                 m.requires_grad = False
 
-    def forward(self, batch_images, batch_prompts, mask_out_idxs=[0, 1, 2, 3]):
+    def forward(self,
+                batch_images,
+                batch_prompts,
+                mask_out_idxs=[0, 1, 2, 3],
+                batch_image_embeddings=None,
+                only_image_encoder=False):
+        '''
+        batch_image_embeddings:[tea_image_embeddings,stu_image_embeddings]
+        only_image_encoder=True:return batch_image_embeddings only
+        batch_image_embeddings is not None:skip teacher/student image encoder and reuse the embeddings
+        '''
+        if batch_image_embeddings is None:
+            batch_image_embeddings = self.forward_image_encoder(batch_images)
+
+        if only_image_encoder:
+            return batch_image_embeddings
+
+        tea_image_embeddings, stu_image_embeddings = batch_image_embeddings
+
         if self.freeze_teacher:
             with torch.no_grad():
-                tea_out = self.teacher(batch_images,
-                                       batch_prompts,
-                                       mask_out_idxs=mask_out_idxs)
+                tea_out = self.teacher.forward_prompt_encoder_mask_decoder(
+                    tea_image_embeddings,
+                    batch_prompts,
+                    mask_out_idxs=mask_out_idxs)
         else:
-            tea_out = self.teacher(batch_images,
-                                   batch_prompts,
-                                   mask_out_idxs=mask_out_idxs)
+            tea_out = self.teacher.forward_prompt_encoder_mask_decoder(
+                tea_image_embeddings,
+                batch_prompts,
+                mask_out_idxs=mask_out_idxs)
 
-        stu_out = self.student(batch_images,
-                               batch_prompts,
-                               mask_out_idxs=mask_out_idxs)
+        stu_out = self.student.forward_prompt_encoder_mask_decoder(
+            stu_image_embeddings, batch_prompts, mask_out_idxs=mask_out_idxs)
 
         return tea_out, stu_out
 
+    def forward_image_encoder(self, batch_images):
+        if self.freeze_teacher:
+            with torch.no_grad():
+                tea_image_embeddings = self.teacher.forward_image_encoder(
+                    batch_images)
+        else:
+            tea_image_embeddings = self.teacher.forward_image_encoder(
+                batch_images)
+
+        stu_image_embeddings = self.student.forward_image_encoder(
+            batch_images)
+
+        return [tea_image_embeddings, stu_image_embeddings]
+
 
 if __name__ == '__main__':
     import os
@@ -0,0 +1,334 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(BASE_DIR)
+
+import collections
+import cv2
+import hashlib
+import threading
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+from simpleAICV.interactive_segmentation.models.segment_anything.sam import decode_per_image_prompts
+
+__all__ = [
+    'SAMInteractiveEngine',
+]
+
+
+class SAMInteractiveEngine:
+    '''
+    interactive segmentation engine for sam/light sam model
+    image embeddings are cached by image content hash in a lru cache with size budget,
+    each click only run prompt encoder and mask decoder,all prompts of one image are decoded in batch.
+    model:sam/light sam model,must have forward_image_encoder and forward_prompt_encoder_mask_decoder
+    cache_max_bytes:max bytes of all cached image embeddings
+    cache_on_host:True:cache image embeddings in host memory,False:cache image embeddings on model device
+    pad_points:True:pad prompt points to same point num,so prompts with different point num decode in one call
+    '''
+
+    def __init__(self,
+                 model,
+                 input_image_size=1024,
+                 mean=[123.675, 116.28, 103.53],
+                 std=[58.395, 57.12, 57.375],
+                 cache_max_bytes=2 * 1024 * 1024 * 1024,
+                 cache_on_host=False,
+                 pad_points=False):
+        self.model = model
+        self.input_image_size = input_image_size
+        self.mean = np.array(mean, dtype=np.float32)
+        self.std = np.array(std, dtype=np.float32)
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_on_host = cache_on_host
+        self.pad_points = pad_points
+
+        self.embedding_cache = collections.OrderedDict()
+        self.cache_bytes = 0
+        self.cache_hit_num = 0
+        self.cache_miss_num = 0
+
+        # gradio queue and http server may call engine from multi threads
+        self.lock = threading.RLock()
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def get_image_key(self, image):
+        '''
+        image:RGB image,PIL image or numpy array
+        '''
+        image = np.ascontiguousarray(np.asarray(image))
+        image_hash = hashlib.sha1()
+        image_hash.update(str(image.shape).encode('utf-8'))
+        image_hash.update(str(image.dtype).encode('utf-8'))
+        image_hash.update(image.data)
+
+        return image_hash.hexdigest()
+
+    def preprocess_image(self, image):
+        # PIL image(RGB) to opencv image(RGB)
+        image = np.asarray(image).astype(np.float32)
+        h, w, _ = image.shape
+        origin_size = [h, w]
+
+        factor = self.input_image_size / max(h, w)
+        resize_h, resize_w = int(round(h * factor)), int(round(w * factor))
+        image = cv2.resize(image, (resize_w, resize_h))
+
+        # normalize
+        image = (image - self.mean) / self.std
+
+        padded_image = np.zeros(
+            (max(resize_h, resize_w), max(resize_h, resize_w), 3),
+            dtype=np.float32)
+        padded_image[:resize_h, :resize_w, :] = image
+
+        scale = factor
+        scaled_size = [resize_h, resize_w]
+
+        return padded_image, scale, scaled_size, origin_size
+
+    def set_image(self, image):
+        '''
+        encode image if image not in cache,return image_key
+        '''
+        image_key = self.get_image_key(image)
+
+        with self.lock:
+            if image_key in self.embedding_cache:
+                self.embedding_cache.move_to_end(image_key)
+                self.cache_hit_num += 1
+                return image_key
+
+            self.cache_miss_num += 1
+
+            padded_image, scale, scaled_size, origin_size = self.preprocess_image(
+                image)
+            padded_image = torch.from_numpy(padded_image).permute(
+                2, 0, 1).unsqueeze(0).to(self.device)
+
+            with torch.no_grad():
+                per_image_embedding = self.model.forward_image_encoder(
+                    padded_image)
+
+            if self.cache_on_host:
+                per_image_embedding = per_image_embedding.cpu()
+                if torch.cuda.is_available():
+                    per_image_embedding = per_image_embedding.pin_memory()
+
+            embedding_bytes = per_image_embedding.numel(
+            ) * per_image_embedding.element_size()
+
+            self.embedding_cache[image_key] = {
+                'image_embedding': per_image_embedding,
+                'embedding_bytes': embedding_bytes,
+                'scale': scale,
+                'scaled_size': scaled_size,
+                'origin_size': origin_size,
+            }
+            self.cache_bytes += embedding_bytes
+
+            # evict least recently used image embeddings,always keep newest one
+            while self.cache_bytes > self.cache_max_bytes and len(
+                    self.embedding_cache) > 1:
+                _, evict_info = self.embedding_cache.popitem(last=False)
+                self.cache_bytes -= evict_info['embedding_bytes']
+
+        return image_key
+
+    def get_prompt_tensors(self, per_prompt, scale):
+        '''
+        per_prompt:dict,prompt coords are in origin image
+        prompt_point:[n,3],x,y,label(1 foreground,0 background)
+        prompt_box:[4],x_min,y_min,x_max,y_max
+        prompt_mask:[input_image_size//4,input_image_size//4] mask logits,e.g. last predict low res mask
+        '''
+        device = self.device
+
+        prompt_point = None
+        if 'prompt_point' in per_prompt.keys(
+        ) and per_prompt['prompt_point'] is not None:
+            prompt_point = np.array(per_prompt['prompt_point'],
+                                    dtype=np.float32).reshape(-1, 3)
+            prompt_point[:, 0:2] = prompt_point[:, 0:2] * scale
+            prompt_point = torch.from_numpy(prompt_point).unsqueeze(0).to(
+                device)
+
+        prompt_box = None
+        if 'prompt_box' in per_prompt.keys(
+        ) and per_prompt['prompt_box'] is not None:
+            prompt_box = np.array(per_prompt['prompt_box'],
+                                  dtype=np.float32).reshape(4) * scale
+            prompt_box = torch.from_numpy(prompt_box).unsqueeze(0).to(device)
+
+        prompt_mask = None
+        if 'prompt_mask' in per_prompt.keys(
+        ) and per_prompt['prompt_mask'] is not None:
+            prompt_mask = np.array(per_prompt['prompt_mask'],
+                                   dtype=np.float32)
+            prompt_mask = torch.from_numpy(prompt_mask).reshape(
+                1, 1, prompt_mask.shape[-2],
+                prompt_mask.shape[-1]).to(device)
+
+        assert prompt_point is not None or prompt_box is not None or prompt_mask is not None, 'no prompt!'
+
+        return {
+            'prompt_point': prompt_point,
+            'prompt_box': prompt_box,
+            'prompt_mask': prompt_mask,
+        }
+
+    def predict(self, image_or_key, prompts, mask_out_idxs=[0]):
+        '''
+        image_or_key:RGB image or image_key returned by set_image
+        prompts:list of per prompt dict,see get_prompt_tensors
+        return:
+        masks:[prompt_num,len(mask_out_idxs),origin_h,origin_w] float32 mask outputs
+        iou_preds:[prompt_num,len(mask_out_idxs)]
+        '''
+        if isinstance(image_or_key, str):
+            image_key = image_or_key
+        else:
+            image_key = self.set_image(image_or_key)
+
+        with self.lock:
+            assert image_key in self.embedding_cache.keys(
+            ), f'image {image_key} not in cache,call set_image first!'
+            self.embedding_cache.move_to_end(image_key)
+            image_info = self.embedding_cache[image_key]
+
+            device = self.device
+            per_image_embedding = image_info['image_embedding'].to(
+                device, non_blocking=True)
+            scale = image_info['scale']
+            scaled_size = image_info['scaled_size']
+            origin_size = image_info['origin_size']
+
+            batch_prompts = [
+                self.get_prompt_tensors(per_prompt, scale)
+                for per_prompt in prompts
+            ]
+
+            with torch.no_grad():
+                masks, iou_preds = decode_per_image_prompts(
+                    self.model,
+                    per_image_embedding,
+                    batch_prompts,
+                    mask_out_idxs=mask_out_idxs,
+                    pad_points=self.pad_points)
+
+                masks = masks[:, :, :scaled_size[0], :scaled_size[1]].float()
+                masks = F.interpolate(masks, (origin_size[0], origin_size[1]),
+                                      mode='bilinear',
+                                      align_corners=False)
+
+        masks = masks.cpu().numpy()
+        iou_preds = iou_preds.float().cpu().numpy()
+
+        return masks, iou_preds
+
+    def cache_info(self):
+        with self.lock:
+            return {
+                'image_num': len(self.embedding_cache),
+                'cache_bytes': self.cache_bytes,
+                'cache_max_bytes': self.cache_max_bytes,
+                'cache_hit_num': self.cache_hit_num,
+                'cache_miss_num': self.cache_miss_num,
+            }
+
+    def clear_cache(self):
+        with self.lock:
+            self.embedding_cache.clear()
+            self.cache_bytes = 0
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    import numpy as np
+    import torch
+    seed = 0
+    # for hash
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    # for python and numpy
+    random.seed(seed)
+    np.random.seed(seed)
+    # for cpu gpu
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+    import time
+
+    from simpleAICV.interactive_segmentation.models.segment_anything.sam import sam_b
+
+    net = sam_b(image_size=1024,
+                frozen_image_encoder=False,
+                frozen_prompt_encoder=False,
+                frozen_mask_decoder=False,
+                use_gradient_checkpoint=False,
+                sigmoid_out=False,
+                binary_mask_out=False,
+                mask_threshold=0.0)
+    if torch.cuda.is_available():
+        net = net.cuda()
+    net.eval()
+
+    engine = SAMInteractiveEngine(net,
+                                  input_image_size=1024,
+                                  cache_max_bytes=64 * 1024 * 1024,
+                                  cache_on_host=False,
+                                  pad_points=False)
+
+    image = np.random.randint(0, 256, (480, 640, 3)).astype(np.uint8)
+    prompts = []
+    for point_num in [1, 2, 2, 3, 1]:
+        prompt_point = np.concatenate([
+            np.random.uniform(0, 480, (point_num, 2)),
+            np.random.randint(0, 2, (point_num, 1))
+        ],
+                                      axis=1)
+        prompts.append({'prompt_point': prompt_point})
+    prompts.append({'prompt_box': [100, 100, 300, 400]})
+
+    # batched decode must be same as decode prompts one by one
+    image_key = engine.set_image(image)
+    masks, iou_preds = engine.predict(image_key,
+                                      prompts,
+                                      mask_out_idxs=[0, 1, 2, 3])
+    max_mask_diff, max_iou_diff = 0., 0.
+    for prompt_idx, per_prompt in enumerate(prompts):
+        per_masks, per_iou_preds = engine.predict(image_key, [per_prompt],
+                                                  mask_out_idxs=[0, 1, 2, 3])
+        max_mask_diff = max(
+            max_mask_diff,
+            float(np.abs(per_masks[0] - masks[prompt_idx]).max()))
+        max_iou_diff = max(
+            max_iou_diff,
+            float(np.abs(per_iou_preds[0] - iou_preds[prompt_idx]).max()))
+    print('1111', masks.shape, iou_preds.shape, max_mask_diff, max_iou_diff)
+
+    # per click time:encode image every click vs cached image embedding
+    for name, use_cache in [('encode_every_click', False),
+                            ('cached_embedding', True)]:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(10):
+            if not use_cache:
+                engine.clear_cache()
+            engine.predict(image, prompts[0:1], mask_out_idxs=[0])
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        per_click_time = (time.time() - start_time) / 10
+        print(f'2222, {name}, per click time: {per_click_time * 1000:.2f}ms')
+
+    print('3333', engine.cache_info())
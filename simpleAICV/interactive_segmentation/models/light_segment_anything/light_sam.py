@@ -82,11 +82,39 @@ class LightSAM(nn.Module):
             for param in self.mask_decoder.parameters():
                 param.requires_grad = False
 
-    def forward(self, batch_images, batch_prompts, mask_out_idxs=[0, 1, 2, 3]):
-        device = batch_images.device
+    def forward(self,
+                batch_images,
+                batch_prompts,
+                mask_out_idxs=[0, 1, 2, 3],
+                batch_image_embeddings=None,
+                only_image_encoder=False):
+        '''
+        only_image_encoder=True:return batch_image_embeddings only
+        batch_image_embeddings is not None:skip image encoder and reuse the embeddings,
+        image encoder only need run once for multi prompt/decoder iters of one batch
+        '''
+        if batch_image_embeddings is None:
+            batch_image_embeddings = self.forward_image_encoder(batch_images)
+
+        if only_image_encoder:
+            return batch_image_embeddings
+
+        batch_mask_outputs, batch_iou_outputs = self.forward_prompt_encoder_mask_decoder(
+            batch_image_embeddings, batch_prompts, mask_out_idxs=mask_out_idxs)
 
+        return batch_mask_outputs, batch_iou_outputs
+
+    def forward_image_encoder(self, batch_images):
         batch_image_embeddings = self.image_encoder(batch_images)
 
+        return batch_image_embeddings
+
+    def forward_prompt_encoder_mask_decoder(self,
+                                            batch_image_embeddings,
+                                            batch_prompts,
+                                            mask_out_idxs=[0, 1, 2, 3]):
+        device = batch_image_embeddings.device
+
         prompt_points = None
         if batch_prompts['prompt_point'] is not None:
             prompt_points = batch_prompts['prompt_point']
@@ -112,10 +140,11 @@ class LightSAM(nn.Module):
             dense_prompt_embeddings=dense_embeddings,
             mask_out_idxs=mask_out_idxs)
 
-        batch_mask_outputs = F.interpolate(masks,
-                                           (self.image_size, self.image_size),
-                                           mode="bilinear",
-                                           align_corners=False)
+        batch_mask_outputs = F.interpolate(
+            masks,
+            (self.image_size, self.image_size),
+            mode="bilinear",
+            align_corners=False)
 
         if self.sigmoid_out:
             batch_mask_outputs = batch_mask_outputs.float()
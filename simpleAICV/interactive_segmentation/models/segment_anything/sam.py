@@ -7,6 +7,8 @@ BASE_DIR = os.path.dirname(
             os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
 sys.path.append(BASE_DIR)
 
+import collections
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -89,11 +91,39 @@ class SAM(nn.Module):
             for param in self.mask_decoder.parameters():
                 param.requires_grad = False
 
-    def forward(self, batch_images, batch_prompts, mask_out_idxs=[0, 1, 2, 3]):
-        device = batch_images.device
+    def forward(self,
+                batch_images,
+                batch_prompts,
+                mask_out_idxs=[0, 1, 2, 3],
+                batch_image_embeddings=None,
+                only_image_encoder=False):
+        '''
+        only_image_encoder=True:return batch_image_embeddings only
+        batch_image_embeddings is not None:skip image encoder and reuse the embeddings,
+        image encoder only need run once for multi prompt/decoder iters of one batch
+        '''
+        if batch_image_embeddings is None:
+            batch_image_embeddings = self.forward_image_encoder(batch_images)
+
+        if only_image_encoder:
+            return batch_image_embeddings
+
+        batch_mask_outputs, batch_iou_outputs = self.forward_prompt_encoder_mask_decoder(
+            batch_image_embeddings, batch_prompts, mask_out_idxs=mask_out_idxs)
+
+        return batch_mask_outputs, batch_iou_outputs
 
+    def forward_image_encoder(self, batch_images):
         batch_image_embeddings = self.image_encoder(batch_images)
 
+        return batch_image_embeddings
+
+    def forward_prompt_encoder_mask_decoder(self,
+                                            batch_image_embeddings,
+                                            batch_prompts,
+                                            mask_out_idxs=[0, 1, 2, 3]):
+        device = batch_image_embeddings.device
+
         prompt_points = None
         if batch_prompts['prompt_point'] is not None:
             prompt_points = batch_prompts['prompt_point']
@@ -147,57 +177,114 @@ class SAM(nn.Module):
                                                       per_image_embedding,
                                                       batch_prompts,
                                                       mask_out_idxs=[1, 2, 3]):
-        device = per_image_embedding.device
-
-        batch_mask_outputs, batch_iou_outputs = [], []
-        for per_prompt in batch_prompts:
-            prompt_points = None
-            if per_prompt['prompt_point'] is not None:
-                prompt_points = per_prompt['prompt_point']
-                prompt_points = prompt_points.to(device)
-
-            prompt_boxes = None
-            if per_prompt['prompt_box'] is not None:
-                prompt_boxes = per_prompt['prompt_box']
-                prompt_boxes = prompt_boxes.to(device)
-
-            prompt_mask = None
-            if per_prompt['prompt_mask'] is not None:
-                prompt_mask = per_prompt['prompt_mask']
-                prompt_mask = prompt_mask.to(device)
-
-            sparse_embeddings, dense_embeddings = self.prompt_encoder(
-                points=prompt_points, boxes=prompt_boxes, masks=prompt_mask)
-
-            masks, iou_predictions = self.mask_decoder(
-                image_embeddings=per_image_embedding,
-                image_pe=self.prompt_encoder.get_dense_pe_layer(),
-                sparse_prompt_embeddings=sparse_embeddings,
-                dense_prompt_embeddings=dense_embeddings,
-                mask_out_idxs=mask_out_idxs)
-
-            masks = F.interpolate(
-                masks,
-                (self.image_encoder.image_size, self.image_encoder.image_size),
-                mode="bilinear",
-                align_corners=False)
-
-            if self.sigmoid_out:
-                masks = masks.float()
-                masks = self.sigmoid(masks)
-
-            if self.binary_mask_out:
-                masks = masks > self.mask_threshold
-
-            batch_mask_outputs.append(masks)
-            batch_iou_outputs.append(iou_predictions)
-
-        batch_mask_outputs = torch.cat(batch_mask_outputs, dim=0)
-        batch_iou_outputs = torch.cat(batch_iou_outputs, dim=0)
+        batch_mask_outputs, batch_iou_outputs = decode_per_image_prompts(
+            self,
+            per_image_embedding,
+            batch_prompts,
+            mask_out_idxs=mask_out_idxs,
+            pad_points=False)
 
         return batch_mask_outputs, batch_iou_outputs
 
 
+def pad_prompt_points(prompt_points, point_num):
+    '''
+    prompt_points:[b,n,3],pad to [b,point_num,3] with not a point(label=-1)
+    '''
+    if prompt_points.shape[1] == point_num:
+        return prompt_points
+
+    padding_points = torch.zeros(
+        (prompt_points.shape[0], point_num - prompt_points.shape[1], 3),
+        dtype=prompt_points.dtype,
+        device=prompt_points.device)
+    padding_points[:, :, 2] = -1
+    prompt_points = torch.cat([prompt_points, padding_points], dim=1)
+
+    return prompt_points
+
+
+def decode_per_image_prompts(model,
+                             per_image_embedding,
+                             batch_prompts,
+                             mask_out_idxs=[1, 2, 3],
+                             pad_points=False):
+    '''
+    per_image_embedding:[1,c,h,w],image embedding of one image
+    batch_prompts:list of per prompt dict,each dict has prompt_point/prompt_box/prompt_mask
+    prompts with same prompt shapes are concatenated and decoded in one prompt encoder/mask decoder call,
+    pad_points=True:pad prompt points to same point num with not a point,prompts with different point num
+    can be decoded together,mask outputs will be slightly different from unpadded prompts
+    '''
+    assert per_image_embedding.shape[0] == 1
+
+    prompt_keys = ['prompt_point', 'prompt_box', 'prompt_mask']
+
+    # group prompts by prompt shapes,keep origin prompt order in outputs
+    prompt_groups = collections.OrderedDict()
+    for prompt_idx, per_prompt in enumerate(batch_prompts):
+        group_key = []
+        for key in prompt_keys:
+            if per_prompt[key] is None:
+                group_key.append(None)
+            elif key == 'prompt_point' and pad_points:
+                group_key.append(-1)
+            else:
+                group_key.append(tuple(per_prompt[key].shape[1:]))
+        group_key = tuple(group_key)
+
+        if group_key not in prompt_groups:
+            prompt_groups[group_key] = []
+        prompt_groups[group_key].append(prompt_idx)
+
+    batch_mask_outputs = [None for _ in range(len(batch_prompts))]
+    batch_iou_outputs = [None for _ in range(len(batch_prompts))]
+    for group_key, group_prompt_idxs in prompt_groups.items():
+        group_prompts = {}
+        for key, key_shape in zip(prompt_keys, group_key):
+            if key_shape is None:
+                group_prompts[key] = None
+                continue
+
+            per_key_prompts = [
+                batch_prompts[prompt_idx][key]
+                for prompt_idx in group_prompt_idxs
+            ]
+            if key == 'prompt_point' and pad_points:
+                point_num = max(
+                    [per_prompt.shape[1] for per_prompt in per_key_prompts])
+                per_key_prompts = [
+                    pad_prompt_points(per_prompt, point_num)
+                    for per_prompt in per_key_prompts
+                ]
+            group_prompts[key] = torch.cat(per_key_prompts, dim=0)
+
+        group_sizes = []
+        for prompt_idx in group_prompt_idxs:
+            for key in prompt_keys:
+                if batch_prompts[prompt_idx][key] is not None:
+                    group_sizes.append(
+                        batch_prompts[prompt_idx][key].shape[0])
+                    break
+
+        group_mask_outputs, group_iou_outputs = model.forward_prompt_encoder_mask_decoder(
+            per_image_embedding, group_prompts, mask_out_idxs=mask_out_idxs)
+
+        group_mask_outputs = torch.split(group_mask_outputs,
+                                         group_sizes,
+                                         dim=0)
+        group_iou_outputs = torch.split(group_iou_outputs, group_sizes, dim=0)
+        for prompt_idx, per_mask_outputs, per_iou_outputs in zip(
+                group_prompt_idxs, group_mask_outputs, group_iou_outputs):
+            batch_mask_outputs[prompt_idx] = per_mask_outputs
+            batch_iou_outputs[prompt_idx] = per_iou_outputs
+
+    batch_mask_outputs = torch.cat(batch_mask_outputs, dim=0)
+    batch_iou_outputs = torch.cat(batch_iou_outputs, dim=0)
+
+    return batch_mask_outputs, batch_iou_outputs
+
+
 def _sam(image_size, patch_size, image_encoder_embedding_planes,
          image_encoder_block_nums, image_encoder_head_nums,
          image_encoder_global_attn_indexes, prompt_encoder_embedding_planes,
@@ -355,3 +442,78 @@ if __name__ == '__main__':
               preds[1].dtype)
 
         break
+
+    # per step timing:image encoder run per decoder iter vs image encoder run once per batch
+    import time
+
+    decoder_iters = 5
+    net = sam_b(image_size=1024,
+                frozen_image_encoder=False,
+                frozen_prompt_encoder=False,
+                frozen_mask_decoder=False,
+                use_gradient_checkpoint=False,
+                sigmoid_out=False,
+                binary_mask_out=False,
+                mask_threshold=0.0).cuda()
+    net.train()
+
+    input_images = torch.randn(2, 3, 1024, 1024).cuda()
+    input_prompts = {
+        'prompt_point': torch.cat([
+            torch.randint(0, 1024, (2, 1, 2)).float(),
+            torch.ones(2, 1, 1)
+        ],
+                                  dim=-1).cuda(),
+        'prompt_box': None,
+        'prompt_mask': None,
+    }
+
+    def per_iter_encoder_step():
+        for _ in range(decoder_iters):
+            preds = net(input_images, input_prompts, mask_out_idxs=[0, 1, 2, 3])
+            loss = (preds[0].float().mean() +
+                    preds[1].float().mean()) / decoder_iters
+            loss.backward()
+
+    def encode_once_step():
+        batch_image_embeddings = net(input_images,
+                                     input_prompts,
+                                     only_image_encoder=True)
+        for iter_i in range(decoder_iters):
+            preds = net(input_images,
+                        input_prompts,
+                        mask_out_idxs=[0, 1, 2, 3],
+                        batch_image_embeddings=batch_image_embeddings)
+            loss = (preds[0].float().mean() +
+                    preds[1].float().mean()) / decoder_iters
+            loss.backward(retain_graph=iter_i < decoder_iters - 1)
+
+    # same prompts in every iter,so accumulated grads must be same
+    net.zero_grad()
+    per_iter_encoder_step()
+    per_iter_grads = [
+        p.grad.clone() for p in net.parameters() if p.grad is not None
+    ]
+    net.zero_grad()
+    encode_once_step()
+    encode_once_grads = [
+        p.grad.clone() for p in net.parameters() if p.grad is not None
+    ]
+    max_grad_diff = max([(a - b).abs().max().item()
+                         for a, b in zip(per_iter_grads, encode_once_grads)])
+    print('4444', len(per_iter_grads), len(encode_once_grads), max_grad_diff)
+
+    for name, step_func in [('per_iter_encoder', per_iter_encoder_step),
+                            ('encode_once', encode_once_step)]:
+        for _ in range(3):
+            net.zero_grad()
+            step_func()
+        torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(10):
+            net.zero_grad()
+            step_func()
+        torch.cuda.synchronize()
+        per_step_time = (time.time() - start_time) / 10
+        print(f'5555, {name}, decoder_iters: {decoder_iters}, '
+              f'per step time: {per_step_time * 1000:.2f}ms')
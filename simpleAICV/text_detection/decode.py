@@ -5,6 +5,7 @@ BASE_DIR = os.path.dirname(
     os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(BASE_DIR)
 
+import concurrent.futures
 import cv2
 import pyclipper
 import numpy as np
@@ -27,7 +28,9 @@ class DBNetDecoder:
                  rectangle_similarity=0.6,
                  min_box_size=3,
                  line_text_expand_ratio=1.2,
-                 curve_text_expand_ratio=1.5):
+                 curve_text_expand_ratio=1.5,
+                 use_roi_score=True,
+                 num_threads=1):
         self.use_morph_open = use_morph_open
         self.hard_border_threshold = hard_border_threshold
         self.box_score_threshold = box_score_threshold
@@ -37,137 +40,169 @@ class DBNetDecoder:
         self.min_box_size = min_box_size
         self.line_text_expand_ratio = line_text_expand_ratio
         self.curve_text_expand_ratio = curve_text_expand_ratio
+        # 只在轮廓外接矩形ROI内计算面积和分数,结果与整图mask相同
+        self.use_roi_score = use_roi_score
+        # 多张图像后处理分配到线程池
+        self.num_threads = num_threads
+        self.executor = None
 
     def __call__(self, preds, sizes):
         probability_map, threshold_map = preds[:, 0, :, :], preds[:, 1, :, :]
         probability_map, threshold_map = probability_map.cpu().detach().numpy(
         ), threshold_map.cpu().detach().numpy()
 
-        binary_map = np.where(probability_map > self.hard_border_threshold,
-                              1.0,
-                              0.0) if self.hard_border_threshold else np.where(
-                                  probability_map > threshold_map, 1.0, 0.0)
+        # 0/1 uint8 binary map,与float 0/1 map的形态学开运算和轮廓结果相同
+        binary_map = (probability_map > self.hard_border_threshold).astype(
+            np.uint8) if self.hard_border_threshold else (
+                probability_map > threshold_map).astype(np.uint8)
 
-        batch_boxes, batch_scores = [], []
+        per_image_inputs = []
         for i, per_image_binary_map in enumerate(binary_map):
             image_h, image_w = sizes[i]
-            per_image_probability_map = probability_map[i][0:image_h,
-                                                           0:image_w]
-            per_image_binary_map = per_image_binary_map[0:image_h, 0:image_w]
-
-            if self.use_morph_open:
-                per_image_binary_map = cv2.morphologyEx(per_image_binary_map,
-                                                        cv2.MORPH_OPEN,
-                                                        kernel=np.ones(
-                                                            (3, 3),
-                                                            dtype=np.uint8),
-                                                        iterations=1)
-
-            # 求每张图像上预测出的文本轮廓
-            per_image_contours, _ = cv2.findContours(
-                (per_image_binary_map * 255).astype(np.uint8), cv2.RETR_LIST,
-                cv2.CHAIN_APPROX_SIMPLE)
-
-            # 使用最小面积和最小预测分数过滤所有文本轮廓
-            filter_image_contours, filter_image_areas,filter_image_scores = [], [],[]
-            for per_contour in per_image_contours:
+            image_h, image_w = int(image_h), int(image_w)
+            per_image_inputs.append([
+                per_image_binary_map[0:image_h, 0:image_w],
+                probability_map[i][0:image_h, 0:image_w],
+                image_h,
+                image_w,
+            ])
+
+        if self.num_threads > 1 and len(per_image_inputs) > 1:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.num_threads)
+            results = list(
+                self.executor.map(lambda x: self.decode_one_image(*x),
+                                  per_image_inputs))
+        else:
+            results = [
+                self.decode_one_image(*per_image_input)
+                for per_image_input in per_image_inputs
+            ]
+
+        batch_boxes = [per_result[0] for per_result in results]
+        batch_scores = [per_result[1] for per_result in results]
+
+        return batch_boxes, batch_scores
+
+    def decode_one_image(self, per_image_binary_map,
+                         per_image_probability_map, image_h, image_w):
+        if self.use_morph_open:
+            per_image_binary_map = cv2.morphologyEx(per_image_binary_map,
+                                                    cv2.MORPH_OPEN,
+                                                    kernel=np.ones(
+                                                        (3, 3),
+                                                        dtype=np.uint8),
+                                                    iterations=1)
+
+        # 求每张图像上预测出的文本轮廓
+        per_image_contours, _ = cv2.findContours(per_image_binary_map * 255,
+                                                 cv2.RETR_LIST,
+                                                 cv2.CHAIN_APPROX_SIMPLE)
+
+        # 使用最小面积和最小预测分数过滤所有文本轮廓
+        filter_image_contours, filter_image_areas, filter_image_scores = [], [], []
+        for per_contour in per_image_contours:
+            if self.use_roi_score:
+                area, score = self.compute_contour_roi_area_and_score(
+                    per_contour, per_image_probability_map)
+            else:
                 area, score = self.compute_contour_area_and_score(
                     per_contour, per_image_probability_map)
-                if area > self.min_area_size and score > self.box_score_threshold:
-                    filter_image_contours.append(per_contour)
-                    filter_image_areas.append(area)
-                    filter_image_scores.append(score)
-
-            # 若文本轮廓数量大于max_box_num,则保留分数最高的max_box_num个本文轮廓
-            if len(filter_image_scores) > self.max_box_num:
-                topk_indexes = np.argsort(
-                    filter_image_scores)[-self.max_box_num:]
-                filter_image_contours = [
-                    filter_image_contours[idx] for idx in topk_indexes
-                ]
-                filter_image_areas = [
-                    filter_image_areas[idx] for idx in topk_indexes
-                ]
-                filter_image_scores = [
-                    filter_image_scores[idx] for idx in topk_indexes
-                ]
-
-            # 计算各文本轮廓最小外接矩形面积
-            enclose_boxes = [
-                cv2.minAreaRect(per_contour)
-                for per_contour in filter_image_contours
+            if area > self.min_area_size and score > self.box_score_threshold:
+                filter_image_contours.append(per_contour)
+                filter_image_areas.append(area)
+                filter_image_scores.append(score)
+
+        # 若文本轮廓数量大于max_box_num,则保留分数最高的max_box_num个本文轮廓
+        if len(filter_image_scores) > self.max_box_num:
+            topk_indexes = np.argsort(filter_image_scores)[-self.max_box_num:]
+            filter_image_contours = [
+                filter_image_contours[idx] for idx in topk_indexes
             ]
-            enclose_boxes_area = [
-                per_contour_enclose_box[1][0] * per_contour_enclose_box[1][1]
-                for per_contour_enclose_box in enclose_boxes
+            filter_image_areas = [
+                filter_image_areas[idx] for idx in topk_indexes
+            ]
+            filter_image_scores = [
+                filter_image_scores[idx] for idx in topk_indexes
             ]
 
-            image_matrix = np.array([[0, 0], [image_w, 0], [image_w, image_h],
-                                     [0, image_h]])
-            image_boxes, image_scores = [], []
-            for i in range(len(filter_image_contours)):
-                per_contour = np.squeeze(filter_image_contours[i], axis=1)
-                # 通过轮廓面积与最小外接矩形面积的比值判断是直线文本还是弯曲文本
-                # 如果小于,则是弯曲文本
-                if enclose_boxes_area[i] < 1:
-                    continue
-
-                if filter_image_areas[i] / enclose_boxes_area[
-                        i] < self.rectangle_similarity:
-                    epsilon = 1e-3 * cv2.arcLength(per_contour, True)
-                    per_contour = cv2.approxPolyDP(per_contour, epsilon, True)
-                    per_contour = np.squeeze(per_contour, axis=1)
-
-                # 若轮廓多边形少于4个点则抛弃
-                if per_contour.shape[0] < 4:
-                    continue
-
-                # 根据expand比例扩大轮廓
-                text_expand_ratio = self.curve_text_expand_ratio if filter_image_areas[
-                    i] / enclose_boxes_area[
-                        i] < self.rectangle_similarity else self.line_text_expand_ratio
-                polygon = Polygon(per_contour)
-                distance = polygon.area * text_expand_ratio / polygon.length
-                offset = pyclipper.PyclipperOffset()
-                offset.AddPath(per_contour, pyclipper.JT_ROUND,
-                               pyclipper.ET_CLOSEDPOLYGON)
-                per_contour = offset.Execute(distance)
-                if len(per_contour) != 1:
-                    continue
-
-                # 图像h,w的矩形和contour求交集区域，保证每个expand之后的contour不越界
-                per_contour = np.array(per_contour, dtype=np.float32)
-                pc = pyclipper.Pyclipper()
-                pc.AddPath(image_matrix, pyclipper.PT_CLIP, True)
-                pc.AddPaths(per_contour, pyclipper.PT_SUBJECT, True)
-                per_contour = pc.Execute(pyclipper.CT_INTERSECTION,
-                                         pyclipper.PFT_EVENODD,
-                                         pyclipper.PFT_EVENODD)
-                if len(per_contour) != 1:
-                    continue
-                per_box = np.array(per_contour, dtype=np.float32)[0]
-
-                enclose_box = cv2.minAreaRect(per_box)
-                box_sizes = enclose_box[1]
-
-                # 如果是直线文本，则以最小外接矩形为最终矩形
-                if filter_image_areas[i] / enclose_boxes_area[
-                        i] >= self.rectangle_similarity:
-                    enclose_box = cv2.boxPoints(enclose_box)
-                    per_box = self.order_box_points(enclose_box)
-
-                if min(box_sizes) < self.min_box_size:
-                    continue
-
-                per_box = per_box.astype(np.int32)
-
-                image_boxes.append(per_box)
-                image_scores.append(filter_image_scores[i])
-
-            batch_boxes.append(image_boxes)
-            batch_scores.append(image_scores)
-
-        return batch_boxes, batch_scores
+        # 计算各文本轮廓最小外接矩形面积
+        enclose_boxes = [
+            cv2.minAreaRect(per_contour)
+            for per_contour in filter_image_contours
+        ]
+        enclose_boxes_area = [
+            per_contour_enclose_box[1][0] * per_contour_enclose_box[1][1]
+            for per_contour_enclose_box in enclose_boxes
+        ]
+
+        image_matrix = np.array([[0, 0], [image_w, 0], [image_w, image_h],
+                                 [0, image_h]])
+        # 一张图像的所有轮廓复用同一个offset和clip对象
+        offset = pyclipper.PyclipperOffset()
+        pc = pyclipper.Pyclipper()
+        image_boxes, image_scores = [], []
+        for i in range(len(filter_image_contours)):
+            per_contour = np.squeeze(filter_image_contours[i], axis=1)
+            # 通过轮廓面积与最小外接矩形面积的比值判断是直线文本还是弯曲文本
+            # 如果小于,则是弯曲文本
+            if enclose_boxes_area[i] < 1:
+                continue
+
+            if filter_image_areas[i] / enclose_boxes_area[
+                    i] < self.rectangle_similarity:
+                epsilon = 1e-3 * cv2.arcLength(per_contour, True)
+                per_contour = cv2.approxPolyDP(per_contour, epsilon, True)
+                per_contour = np.squeeze(per_contour, axis=1)
+
+            # 若轮廓多边形少于4个点则抛弃
+            if per_contour.shape[0] < 4:
+                continue
+
+            # 根据expand比例扩大轮廓
+            text_expand_ratio = self.curve_text_expand_ratio if filter_image_areas[
+                i] / enclose_boxes_area[
+                    i] < self.rectangle_similarity else self.line_text_expand_ratio
+            polygon = Polygon(per_contour)
+            distance = polygon.area * text_expand_ratio / polygon.length
+            offset.Clear()
+            offset.AddPath(per_contour, pyclipper.JT_ROUND,
+                           pyclipper.ET_CLOSEDPOLYGON)
+            per_contour = offset.Execute(distance)
+            if len(per_contour) != 1:
+                continue
+
+            # 图像h,w的矩形和contour求交集区域，保证每个expand之后的contour不越界
+            per_contour = np.array(per_contour, dtype=np.float32)
+            pc.Clear()
+            pc.AddPath(image_matrix, pyclipper.PT_CLIP, True)
+            pc.AddPaths(per_contour, pyclipper.PT_SUBJECT, True)
+            per_contour = pc.Execute(pyclipper.CT_INTERSECTION,
+                                     pyclipper.PFT_EVENODD,
+                                     pyclipper.PFT_EVENODD)
+            if len(per_contour) != 1:
+                continue
+            per_box = np.array(per_contour, dtype=np.float32)[0]
+
+            enclose_box = cv2.minAreaRect(per_box)
+            box_sizes = enclose_box[1]
+
+            # 如果是直线文本，则以最小外接矩形为最终矩形
+            if filter_image_areas[i] / enclose_boxes_area[
+                    i] >= self.rectangle_similarity:
+                enclose_box = cv2.boxPoints(enclose_box)
+                per_box = self.order_box_points(enclose_box)
+
+            if min(box_sizes) < self.min_box_size:
+                continue
+
+            per_box = per_box.astype(np.int32)
+
+            image_boxes.append(per_box)
+            image_scores.append(filter_image_scores[i])
+
+        return image_boxes, image_scores
 
     def compute_contour_area_and_score(self, per_contour,
                                        per_image_probability_map):
@@ -181,6 +216,24 @@ class DBNetDecoder:
 
         return area, score
 
+    def compute_contour_roi_area_and_score(self, per_contour,
+                                           per_image_probability_map):
+        # 轮廓填充区域一定在轮廓外接矩形内,只在外接矩形ROI内填充和求和
+        per_contour = per_contour.astype(np.int32)
+        x, y, w, h = cv2.boundingRect(per_contour)
+        # 填充像素数不超过外接矩形面积
+        if w * h <= self.min_area_size:
+            return np.float32(w * h), np.float32(0.)
+
+        per_contour_area_mask = np.zeros((h, w), dtype=np.float32)
+        cv2.fillPoly(per_contour_area_mask, [per_contour - np.array([x, y])],
+                     1.0)
+        area = per_contour_area_mask.sum()
+        score = (per_image_probability_map[y:y + h, x:x + w] *
+                 per_contour_area_mask).sum() / area
+
+        return area, score
+
     def order_box_points(self, box):
         # 根据box各点x坐标从小到大对点进行排序
         x_sorted = box[np.argsort(box[:, 0]), :]
@@ -320,3 +373,66 @@ if __name__ == '__main__':
             count += 1
         else:
             break
+
+    # post-process benchmark:full image mask score vs roi score
+    import time
+    image_dir = os.path.join(BASE_DIR,
+                             'gradio_demo/test_ocr_text_detection_images')
+    resize = 1024
+    benchmark_probability_maps, benchmark_sizes = [], []
+    for per_image_name in sorted(os.listdir(image_dir)):
+        per_image = cv2.imdecode(
+            np.fromfile(os.path.join(image_dir, per_image_name),
+                        dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        factor = resize / max(per_image.shape[0], per_image.shape[1])
+        resize_h, resize_w = int(round(per_image.shape[0] * factor)), int(
+            round(per_image.shape[1] * factor))
+        per_image = cv2.resize(per_image, (resize_w, resize_h))
+        # 用图像边缘响应模拟文本概率图,得到大量文本轮廓
+        per_probability_map = cv2.GaussianBlur(
+            np.abs(cv2.Laplacian(per_image.astype(np.float32), cv2.CV_32F)),
+            (9, 9), 0)
+        per_probability_map = per_probability_map / max(
+            per_probability_map.max(), 1e-4)
+        padded_probability_map = np.zeros((resize, resize), dtype=np.float32)
+        padded_probability_map[0:resize_h, 0:resize_w] = per_probability_map
+        benchmark_probability_maps.append(padded_probability_map)
+        benchmark_sizes.append([resize_h, resize_w])
+    benchmark_probability_maps = np.stack(benchmark_probability_maps, axis=0)
+    benchmark_preds = torch.tensor(
+        np.stack((benchmark_probability_maps,
+                  np.ones_like(benchmark_probability_maps) * 0.1),
+                 axis=1))
+
+    decode_outputs = {}
+    for name, use_roi_score, num_threads in [
+        ['full image score', False, 1],
+        ['roi score', True, 1],
+        ['roi score 4 threads', True, 4],
+    ]:
+        decoder = DBNetDecoder(box_score_threshold=0.2,
+                               use_roi_score=use_roi_score,
+                               num_threads=num_threads)
+        start_time = time.time()
+        for _ in range(5):
+            batch_boxes, batch_scores = decoder(benchmark_preds,
+                                                benchmark_sizes)
+        print(
+            f'{name}: {(time.time() - start_time) / 5 * 1000:.2f}ms/batch of {len(benchmark_sizes)} images, box nums: {[len(x) for x in batch_boxes]}'
+        )
+        decode_outputs[name] = [batch_boxes, batch_scores]
+
+    reference_boxes, reference_scores = decode_outputs['full image score']
+    for name, (batch_boxes, batch_scores) in decode_outputs.items():
+        same_boxes = all([
+            len(b1) == len(b2)
+            and all([np.array_equal(x1, x2) for x1, x2 in zip(b1, b2)])
+            for b1, b2 in zip(reference_boxes, batch_boxes)
+        ])
+        max_score_diff = max([
+            np.max(np.abs(np.array(s1) - np.array(s2))) if len(s1) > 0 else 0
+            for s1, s2 in zip(reference_scores, batch_scores)
+        ])
+        print(
+            f'{name}: same boxes: {same_boxes}, max score diff: {max_score_diff}'
+        )
@@ -6,6 +6,7 @@ BASE_DIR = os.path.dirname(
 sys.path.append(BASE_DIR)
 
 import cv2
+import collections
 import json
 import math
 import numpy as np
@@ -13,6 +14,7 @@ import numpy as np
 import torch
 
 from simpleAICV.classification.common import load_state_dict, AverageMeter
+from simpleAICV.detection.common import AspectRatioGroupedDistributedBatchSampler
 
 
 class RandomScale:
@@ -541,39 +543,130 @@ class Normalize:
         return sample
 
 
-class KeepRatioResizeTextRecognitionCollater:
+class KeepRatioResize:
+    '''
+    resize image to resize_h and keep w/h ratio in dataset workers,
+    same resize as KeepRatioResizeTextRecognitionCollater,put it after Normalize.
+    size is not changed,same as collater output.
+    '''
 
     def __init__(self, resize_h=32):
         self.resize_h = resize_h
 
+    def __call__(self, sample):
+        image, label, scale, size = sample['image'], sample['label'], sample[
+            'scale'], sample['size']
+
+        ratio = image.shape[1] / float(image.shape[0])
+        image = cv2.resize(
+            image,
+            (max(1, int(math.floor(self.resize_h * ratio))), self.resize_h))
+
+        sample['image'], sample['label'], sample['scale'], sample[
+            'size'] = image, label, scale, size
+
+        return sample
+
+
+class KeepRatioResizeTextRecognitionCollater:
+
+    def __init__(self, resize_h=32, converter=None):
+        self.resize_h = resize_h
+        # if converter is not None,encode labels into text index in dataloader workers
+        self.converter = converter
+
     def __call__(self, data):
         images = [s['image'] for s in data]
         labels = [s['label'] for s in data]
         scales = [s['scale'] for s in data]
         sizes = [s['size'] for s in data]
 
-        ratios = [image.shape[1] / float(image.shape[0]) for image in images]
-        max_w = int(math.floor(max(ratios) * self.resize_h))
+        # images with h=resize_h are already resized by KeepRatioResize in dataset
+        resized_ws = [
+            image.shape[1] if image.shape[0] == self.resize_h else max(
+                1,
+                int(
+                    math.floor(self.resize_h * image.shape[1] /
+                               float(image.shape[0])))) for image in images
+        ]
+        max_w = max(resized_ws)
         max_w = int(((max_w // 32) + 1) * 32)
 
         input_images = np.zeros((len(images), self.resize_h, max_w, 3),
                                 dtype=np.float32)
 
         for i, image in enumerate(images):
-            image = cv2.resize(image, (max(
-                1, int(math.floor(self.resize_h * ratios[i]))), self.resize_h))
+            if image.shape[0] != self.resize_h:
+                image = cv2.resize(image, (resized_ws[i], self.resize_h))
             input_images[i, 0:image.shape[0], 0:image.shape[1], :] = image
         input_images = torch.from_numpy(input_images)
         # B H W 3 ->B 3 H W
         input_images = input_images.permute(0, 3, 1, 2)
 
-        return {
+        # padding pixel ratio of this batch
+        padding_ratio = 1. - sum(resized_ws) / float(len(images) * max_w)
+
+        batch = {
             'image': input_images,
             'label': labels,
             'scale': scales,
             'size': sizes,
+            'padding_ratio': padding_ratio,
         }
 
+        if self.converter is not None:
+            if 'label_index' in data[0]:
+                # label index precomputed in dataset
+                lengths = np.array([len(s['label_index']) for s in data],
+                                   dtype=np.int64)
+                flat_indexes = np.concatenate(
+                    [s['label_index'] for s in data])
+                trans_labels, label_lengths = self.converter.pad_flat_indexes(
+                    flat_indexes, lengths)
+            else:
+                trans_labels, label_lengths = self.converter.encode(labels)
+            batch['trans_label'] = trans_labels
+            batch['label_length'] = label_lengths
+
+        return batch
+
+
+class WidthBucketDistributedBatchSampler(
+        AspectRatioGroupedDistributedBatchSampler):
+    '''
+    group text line images by width after keep ratio resize to resize_h,
+    every batch only contains images from one width bucket to reduce padding.
+    dataset must have get_image_hw_array function,image h/w are read by imagesize at dataset init.
+    batches are built on global batch(batch_size x num_replicas) as AspectRatioGroupedDistributedBatchSampler.
+    batch_size:per gpu batch size
+    '''
+
+    def __init__(self,
+                 dataset,
+                 batch_size,
+                 resize_h=32,
+                 width_boundaries=[64, 128, 192, 256, 320, 384, 512, 640],
+                 shuffle=True,
+                 drop_last=True,
+                 seed=0,
+                 num_replicas=None,
+                 rank=None):
+        super(WidthBucketDistributedBatchSampler,
+              self).__init__(dataset,
+                             batch_size,
+                             aspect_ratio_boundaries=[],
+                             shuffle=shuffle,
+                             drop_last=drop_last,
+                             seed=seed,
+                             num_replicas=num_replicas,
+                             rank=rank)
+        image_hw_array = dataset.get_image_hw_array()
+        resized_ws = np.maximum(
+            np.floor(resize_h * image_hw_array[:, 1] / image_hw_array[:, 0]),
+            1)
+        self.group_ids = np.digitize(resized_ws, sorted(width_boundaries))
+        self.group_num = len(width_boundaries) + 1
+
 
 class CTCTextLabelConverter:
     """
@@ -601,6 +694,46 @@ class CTCTextLabelConverter:
 
         self.num_classes = len(self.ctc_chars_set)
 
+        # index to char lookup table,garbage class index = self.num_classes
+        self.index_to_char_array = np.array(
+            chars_set_list + [''] + [garbage_char], dtype=object)
+
+    def encode_to_flat_indexes(self, text):
+        """
+        convert text-label into flat text-index,one dict lookup pass for all chars.
+        input:
+            text: text labels. [batch_size]
+        output:
+            flat_indexes: text index of all chars. [total_char_nums]
+            lengths: length of each text. [batch_size]
+        """
+        lengths = np.array([len(s) for s in text], dtype=np.int64)
+        # garbage class index = self.num_classes
+        flat_indexes = np.array([
+            self.ctc_chars_dict.get(char, self.num_classes)
+            for per_text in text for char in per_text
+        ],
+                                dtype=np.int64)
+
+        return flat_indexes, lengths
+
+    def pad_flat_indexes(self, flat_indexes, lengths):
+        """
+        pad flat text-index into [batch_size, str_max_length] text-index.
+        """
+        flat_indexes = torch.as_tensor(flat_indexes, dtype=torch.int64)
+        lengths = torch.as_tensor(lengths, dtype=torch.int64)
+
+        # The index used for padding CTC blank index would not affect the CTC loss calculation.
+        batch_text = torch.full((lengths.shape[0], self.str_max_length),
+                                self.blank_index,
+                                dtype=torch.int64)
+        mask = torch.arange(self.str_max_length).unsqueeze(
+            0) < lengths.unsqueeze(1)
+        batch_text[mask] = flat_indexes
+
+        return batch_text, lengths.int()
+
     def encode(self, text):
         """
         convert text-label into text-index.
@@ -610,50 +743,549 @@ class CTCTextLabelConverter:
             text: text index for CTCLoss. [batch_size, str_max_length]
             length: length of each text. [batch_size]
         """
-        length = [len(s) for s in text]
+        flat_indexes, lengths = self.encode_to_flat_indexes(text)
+        assert lengths.max(initial=0) <= self.str_max_length, 'text is longer than str_max_length!'
 
-        # The index used for padding CTC blank index would not affect the CTC loss calculation.
-        batch_text = torch.LongTensor(len(text), self.str_max_length).fill_(
-            self.blank_index)
-        for i, t in enumerate(text):
-            text = list(t)
-            tmp = []
-            for char in text:
-                if char not in self.ctc_chars_dict:
-                    # garbage class index = self.num_classes
-                    tmp.append(self.num_classes)
-                else:
-                    tmp.append(self.ctc_chars_dict[char])
-            batch_text[i][:len(tmp)] = torch.LongTensor(tmp)
+        return self.pad_flat_indexes(flat_indexes, lengths)
+
+    def get_greedy_keep_mask(self, text_index, length=None):
+        """
+        removing repeated characters and blank as tensor op,
+        garbage class index is always kept.
+        text_index: [batch_size, time_step] tensor on any device
+        """
+        keep = text_index < self.num_classes - 1
+        keep[:, 1:] &= text_index[:, 1:] != text_index[:, :-1]
+        keep |= text_index == self.num_classes
+        if length is not None:
+            length = torch.as_tensor(length, device=text_index.device)
+            keep &= torch.arange(text_index.shape[1],
+                                 device=text_index.device).unsqueeze(
+                                     0) < length.unsqueeze(1)
+
+        return keep
+
+    def join_kept_indexes(self, text_index, keep):
+        # single index to char lookup for whole batch,then split by string
+        if text_index.shape[0] == 0:
+            return []
+
+        chars = self.index_to_char_array[text_index[keep]]
+        split_points = np.cumsum(keep.sum(axis=1))[:-1]
+        texts = [
+            ''.join(per_chars.tolist())
+            for per_chars in np.split(chars, split_points)
+        ]
 
-        return batch_text, torch.IntTensor(length)
+        return texts
 
     def decode(self, text_index, length):
         """
         convert text-index into text-label.
+        text_index: [batch_size, time_step] numpy array or tensor,tensor is decoded on its device
+        length: [batch_size]
         """
-        texts = []
-        for index, l in enumerate(length):
-            t = text_index[index, :]
+        text_index = torch.as_tensor(text_index)
+        keep = self.get_greedy_keep_mask(text_index, length)
 
-            char_list = []
-            for i in range(l):
-                # removing repeated characters and blank.
-                if t[i] == self.num_classes:
-                    char_list.append(self.garbage_char)
-                if t[i] < self.num_classes - 1 and (
-                        not (i > 0 and t[i - 1] == t[i])):
-                    char_list.append(self.ctc_chars_set[t[i]])
-            text = ''.join(char_list)
-            texts.append(text)
+        text_index, keep = text_index.cpu().numpy(), keep.cpu().numpy()
+        texts = self.join_kept_indexes(text_index, keep)
 
         return texts
 
+    def greedy_decode(self, preds, length=None):
+        """
+        greedy decode with confidence.
+        preds: [batch_size, time_step, num_classes+1] model outputs(logits)
+        return texts and confidences,confidence is mean max probability of kept chars,0 for empty text
+        """
+        probs, text_index = torch.softmax(preds.float(), dim=2).max(dim=2)
+        keep = self.get_greedy_keep_mask(text_index, length)
+        keep_nums = keep.sum(dim=1)
+        confidences = (probs * keep).sum(dim=1) / keep_nums.clamp(min=1)
+
+        text_index, keep, confidences = text_index.cpu().numpy(), keep.cpu(
+        ).numpy(), confidences.cpu().numpy()
+        texts = self.join_kept_indexes(text_index, keep)
+
+        return texts, confidences
+
+    def beam_search_decode(self, preds, length=None, beam_size=10):
+        """
+        CTC prefix beam search with confidence.
+        preds: [batch_size, time_step, num_classes+1] model outputs(logits)
+        beam_size: max kept prefixes per step,also top chars per step
+        return texts and confidences,confidence is probability of best prefix
+        """
+        log_probs = torch.log_softmax(preds.float(), dim=2)
+        beam_size = min(beam_size, log_probs.shape[2])
+        topk_log_probs, topk_indexes = log_probs.topk(beam_size, dim=2)
+        blank_log_probs = log_probs[:, :, self.blank_index]
+
+        topk_log_probs, topk_indexes, blank_log_probs = topk_log_probs.cpu(
+        ).numpy(), topk_indexes.cpu().numpy(), blank_log_probs.cpu().numpy()
+        time_steps = [log_probs.shape[1]] * log_probs.shape[0] if length is None else [
+            int(x) for x in length
+        ]
+
+        texts, confidences = [], []
+        for i in range(log_probs.shape[0]):
+            # prefix:[blank ending log probability,non-blank ending log probability]
+            beams = {(): [0., -np.inf]}
+            for t in range(time_steps[i]):
+                next_beams = collections.defaultdict(
+                    lambda: [-np.inf, -np.inf])
+                for prefix, (blank_prob, non_blank_prob) in beams.items():
+                    total_prob = np.logaddexp(blank_prob, non_blank_prob)
+                    next_beam = next_beams[prefix]
+                    next_beam[0] = np.logaddexp(
+                        next_beam[0], total_prob + blank_log_probs[i, t])
+                    for char_index, char_log_prob in zip(
+                            topk_indexes[i, t], topk_log_probs[i, t]):
+                        if char_index == self.blank_index:
+                            continue
+                        new_prefix = prefix + (char_index, )
+                        new_beam = next_beams[new_prefix]
+                        if len(prefix) > 0 and prefix[-1] == char_index:
+                            # repeated char only extends prefix after blank
+                            new_beam[1] = np.logaddexp(
+                                new_beam[1], blank_prob + char_log_prob)
+                            next_beam[1] = np.logaddexp(
+                                next_beam[1], non_blank_prob + char_log_prob)
+                        else:
+                            new_beam[1] = np.logaddexp(
+                                new_beam[1], total_prob + char_log_prob)
+                beams = dict(
+                    sorted(next_beams.items(),
+                           key=lambda x: np.logaddexp(x[1][0], x[1][1]),
+                           reverse=True)[0:beam_size])
+
+            best_prefix, (blank_prob, non_blank_prob) = max(
+                beams.items(), key=lambda x: np.logaddexp(x[1][0], x[1][1]))
+            texts.append(''.join(
+                self.index_to_char_array[list(best_prefix)].tolist()))
+            confidences.append(
+                float(np.exp(np.logaddexp(blank_prob, non_blank_prob))))
+
+        return texts, np.array(confidences, dtype=np.float32)
+
+
+def compute_edit_distance(str1, str2):
+    '''
+    Levenshtein distance,same as nltk edit_distance(str1, str2),
+    bit-parallel algorithm(Myers 1999,Hyyrö 2001) with python int as bit vector,
+    O(len(str2)) big int operations instead of O(len(str1)*len(str2)) python loops.
+    '''
+    if len(str1) == 0:
+        return len(str2)
+    if len(str2) == 0:
+        return len(str1)
+
+    # bit i of char_masks[char] is 1 if str1[i]==char
+    char_masks = {}
+    for i, per_char in enumerate(str1):
+        char_masks[per_char] = char_masks.get(per_char, 0) | (1 << i)
+
+    mask = (1 << len(str1)) - 1
+    last_bit = 1 << (len(str1) - 1)
+    # vertical positive/negative delta vectors of dp column
+    pv, mv, distance = mask, 0, len(str1)
+    for per_char in str2:
+        eq = char_masks.get(per_char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & last_bit:
+            distance += 1
+        elif mh & last_bit:
+            distance -= 1
+        # first row of dp is 0,1,2,...,so horizontal delta of row 0 is +1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+
+    return distance
+
+
+def compute_lcs_length(str1, str2):
+    '''
+    longest common subsequence length,same as last value of lcs dp matrix,
+    bit-parallel algorithm(Allison-Dix 1986,Hyyrö 2004) with python int as bit vector.
+    '''
+    if len(str1) == 0 or len(str2) == 0:
+        return 0
+
+    char_masks = {}
+    for i, per_char in enumerate(str1):
+        char_masks[per_char] = char_masks.get(per_char, 0) | (1 << i)
+
+    mask = (1 << len(str1)) - 1
+    v = mask
+    for per_char in str2:
+        u = v & char_masks.get(per_char, 0)
+        v = ((v + u) | (v - u)) & mask
+
+    # zero bits of v are lcs matched positions
+    return len(str1) - bin(v).count('1')
+
+
+class TextRecognitionMetricMeter:
+    '''
+    single pass text recognition metrics,decode once per batch and update all metric counters:
+    str acc/normalized edit distance,order PR,chars PR,lcs PR for all/num/alpha/first/second/third chars.
+    update must be called per batch,chars PR correct nums are clipped per batch.
+    counters are int/float values,sum them over ranks by all_reduce before compute.
+    '''
+    counter_names = [
+        'total_str_nums',
+        'correct_str_nums',
+        'not_included_str_nums',
+        'ne_distances',
+        'order_c_char_nums',
+        'order_p_char_nums',
+        'order_t_char_nums',
+        'correct_char_nums',
+        'pred_char_nums',
+        'target_char_nums',
+        'not_include_target_char_nums',
+        'c_char_nums',
+        'p_char_nums',
+        't_char_nums',
+        'c_num_char_nums',
+        'p_num_char_nums',
+        't_num_char_nums',
+        'c_alpha_char_nums',
+        'p_alpha_char_nums',
+        't_alpha_char_nums',
+        'c_first_char_nums',
+        'p_first_char_nums',
+        't_first_char_nums',
+        'c_second_char_nums',
+        'p_second_char_nums',
+        't_second_char_nums',
+        'c_third_char_nums',
+        'p_third_char_nums',
+        't_third_char_nums',
+    ]
+    char_class_names = ['num', 'alpha', 'first', 'second', 'third']
+
+    def __init__(self,
+                 all_char_table,
+                 num_char_table,
+                 alpha_char_table,
+                 common_standard_chinese_char_first_table,
+                 common_standard_chinese_char_second_table,
+                 common_standard_chinese_char_third_table,
+                 garbage_char='㍿',
+                 case_insensitve=True):
+        self.support_chars_set = set(all_char_table)
+        self.garbage_char = garbage_char
+        self.case_insensitve = case_insensitve
+
+        # char->char class indexes,one dict lookup per char for all char classes
+        self.char_class_dict = collections.defaultdict(list)
+        for class_index, per_char_table in enumerate([
+                num_char_table,
+                alpha_char_table,
+                common_standard_chinese_char_first_table,
+                common_standard_chinese_char_second_table,
+                common_standard_chinese_char_third_table,
+        ]):
+            for per_char in set(per_char_table):
+                self.char_class_dict[per_char].append(class_index)
+        self.char_class_dict = dict(self.char_class_dict)
+
+        self.reset()
+
+    def reset(self):
+        self.counters = collections.OrderedDict([
+            (per_name, 0) for per_name in self.counter_names
+        ])
+
+    def split_char_class_strs(self, per_str):
+        per_class_chars = [[] for _ in range(len(self.char_class_names))]
+        for per_char in per_str:
+            for class_index in self.char_class_dict.get(per_char, ()):
+                per_class_chars[class_index].append(per_char)
+
+        return [''.join(per_chars) for per_chars in per_class_chars]
+
+    def update(self, pred_strs, targets):
+        counters = self.counters
+        # none:"㍿",space:" "
+        batch_none_target_nums, batch_space_target_nums = 0, 0
+        batch_space_pred_nums, batch_correct_pred_nums = 0, 0
+        batch_pred_length, batch_target_length = 0, 0
+
+        for per_pred_str, per_target in zip(pred_strs, targets):
+            counters['total_str_nums'] += 1
+
+            # convert not include char to garbage char
+            not_include_char_nums = 0
+            for per_char in per_target:
+                if per_char not in self.support_chars_set:
+                    not_include_char_nums += 1
+            if not_include_char_nums > 0:
+                counters['not_included_str_nums'] += 1
+                counters[
+                    'not_include_target_char_nums'] += not_include_char_nums
+                per_target = ''.join([
+                    per_char if per_char in self.support_chars_set else
+                    self.garbage_char for per_char in per_target
+                ])
+
+            # chars PR,keep space,multiset intersection of pred chars and target chars
+            if per_target.replace(' ', '') != '㍿':
+                pred_length, target_length = len(per_pred_str), len(per_target)
+                batch_pred_length += pred_length
+                batch_target_length += target_length
+                batch_space_target_nums += per_target.count(' ')
+                batch_none_target_nums += per_target.count('㍿')
+                batch_space_pred_nums += per_pred_str.count(' ')
+
+                target_char_counter = collections.Counter(per_target)
+                target_char_counter.pop(' ', None)
+                target_char_counter.pop('㍿', None)
+                pred_char_counter = collections.Counter(per_pred_str)
+                pred_char_counter.pop(' ', None)
+                batch_correct_pred_nums += sum(
+                    (pred_char_counter & target_char_counter).values())
+
+            per_pred_str = per_pred_str.replace(' ', '')
+            per_target = per_target.replace(' ', '')
+
+            if per_target == '㍿' or per_target == '':
+                continue
+
+            # lcs PR,case sensitive
+            counters['c_char_nums'] += compute_lcs_length(
+                per_pred_str, per_target)
+            counters['p_char_nums'] += len(per_pred_str)
+            counters['t_char_nums'] += len(per_target)
+            for per_class_name, per_class_pred_str, per_class_target_str in zip(
+                    self.char_class_names,
+                    self.split_char_class_strs(per_pred_str),
+                    self.split_char_class_strs(per_target)):
+                counters[f'c_{per_class_name}_char_nums'] += compute_lcs_length(
+                    per_class_pred_str, per_class_target_str)
+                counters[f'p_{per_class_name}_char_nums'] += len(
+                    per_class_pred_str)
+                counters[f't_{per_class_name}_char_nums'] += len(
+                    per_class_target_str)
+
+            if self.case_insensitve:
+                per_pred_str = per_pred_str.lower()
+                per_target = per_target.lower()
+
+            if per_pred_str == per_target:
+                counters['correct_str_nums'] += 1
+
+            # ICDAR2019 Normalized Edit Distance,ne_distances [0,1]
+            if len(per_pred_str) > 0:
+                counters['ne_distances'] += 1 - compute_edit_distance(
+                    per_pred_str, per_target) / max(len(per_pred_str),
+                                                    len(per_target))
+
+            # order PR
+            for per_pred_char, per_target_char in zip(per_pred_str,
+                                                      per_target):
+                if per_pred_char == per_target_char:
+                    counters['order_c_char_nums'] += 1
+            counters['order_p_char_nums'] += len(per_pred_str)
+            counters['order_t_char_nums'] += len(per_target)
+
+        counters['correct_char_nums'] += min(
+            batch_correct_pred_nums + batch_none_target_nums,
+            batch_pred_length - batch_space_pred_nums)
+        counters['pred_char_nums'] += (batch_pred_length -
+                                       batch_space_pred_nums)
+        counters['target_char_nums'] += (batch_target_length -
+                                         batch_space_target_nums)
+
+    def compute(self, ignore_threhold=1000):
+        counters = self.counters
+
+        def get_percent(numerator, denominator):
+            return numerator / float(
+                denominator) * 100 if denominator != 0 else 0
+
+        def get_lcs_percent(numerator, denominator, target_nums):
+            if denominator == 0:
+                return 0
+            if target_nums < ignore_threhold:
+                return -1
+            return numerator / float(denominator) * 100
+
+        metric_dict = collections.OrderedDict()
+        metric_dict['str_acc'] = get_percent(counters['correct_str_nums'],
+                                             counters['total_str_nums'])
+        metric_dict['not_included_str_percent'] = get_percent(
+            counters['not_included_str_nums'], counters['total_str_nums'])
+        metric_dict['final_edit_distance'] = get_percent(
+            counters['ne_distances'], counters['total_str_nums'])
+        metric_dict['order_precision'] = get_percent(
+            counters['order_c_char_nums'], counters['order_p_char_nums'])
+        metric_dict['order_recall'] = get_percent(
+            counters['order_c_char_nums'], counters['order_t_char_nums'])
+        metric_dict['chars_precision'] = min(
+            get_percent(counters['correct_char_nums'],
+                        counters['pred_char_nums']), 100)
+        metric_dict['chars_recall'] = min(
+            get_percent(counters['correct_char_nums'],
+                        counters['target_char_nums']), 100)
+        metric_dict['not_include_chars_percent'] = get_percent(
+            counters['not_include_target_char_nums'],
+            counters['target_char_nums'])
+        for per_class_name in self.char_class_names + ['']:
+            prefix = f'{per_class_name}_' if per_class_name else ''
+            c_nums = counters[f'c_{prefix}char_nums']
+            p_nums = counters[f'p_{prefix}char_nums']
+            t_nums = counters[f't_{prefix}char_nums']
+            metric_dict[f'{prefix}lcs_precision'] = get_lcs_percent(
+                c_nums, p_nums, t_nums)
+            metric_dict[f'{prefix}lcs_recall'] = get_lcs_percent(
+                c_nums, t_nums, t_nums)
+
+        return metric_dict
+
 
 if __name__ == '__main__':
+    import random
+
     from simpleAICV.text_recognition.char_sets.final_char_table import final_char_table
 
     converter = CTCTextLabelConverter(final_char_table,
                                       str_max_length=80,
                                       garbage_char='㍿')
     print("1111", converter.num_classes)
+
+    import time
+
+    def reference_decode(text_index, length):
+        # per time step python decode
+        texts = []
+        for index, l in enumerate(length):
+            t = text_index[index, :]
+            char_list = []
+            for i in range(l):
+                if t[i] == converter.num_classes:
+                    char_list.append(converter.garbage_char)
+                if t[i] < converter.num_classes - 1 and (
+                        not (i > 0 and t[i - 1] == t[i])):
+                    char_list.append(converter.ctc_chars_set[t[i]])
+            texts.append(''.join(char_list))
+
+        return texts
+
+    batch_size, time_step = 512, 80
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    preds = torch.randn(batch_size,
+                        time_step,
+                        converter.num_classes + 1,
+                        device=device)
+    # make blank and repeats frequent like real ctc outputs
+    preds[:, :, converter.blank_index] += 3.
+    _, pred_indexes = preds.max(dim=2)
+    pred_lengths = torch.randint(1, time_step + 1, (batch_size, ),
+                                 device=device)
+
+    start_time = time.time()
+    reference_strs = reference_decode(pred_indexes.cpu().numpy(),
+                                      pred_lengths.cpu().numpy())
+    print(f'reference decode: {(time.time() - start_time) * 1000:.2f}ms')
+    start_time = time.time()
+    pred_strs = converter.decode(pred_indexes, pred_lengths)
+    print(f'vectorized decode: {(time.time() - start_time) * 1000:.2f}ms')
+    print('same decode results:', reference_strs == pred_strs)
+
+    labels = [
+        ''.join(random.choices(final_char_table, k=random.randint(1, 80)))
+        for _ in range(batch_size)
+    ]
+    start_time = time.time()
+    trans_labels, label_lengths = converter.encode(labels)
+    print(f'batch encode: {(time.time() - start_time) * 1000:.2f}ms')
+    print('encode decode round trip:',
+          converter.decode(trans_labels, label_lengths) == [
+              ''.join([
+                  char for i, char in enumerate(label)
+                  if i == 0 or label[i - 1] != char
+              ]) for label in labels
+          ])
+
+    greedy_strs, greedy_confidences = converter.greedy_decode(
+        preds, pred_lengths)
+    print('greedy decode same as decode:', greedy_strs == pred_strs,
+          greedy_confidences[0:4])
+    start_time = time.time()
+    beam_strs, beam_confidences = converter.beam_search_decode(preds[0:16],
+                                                               pred_lengths[0:16],
+                                                               beam_size=5)
+    print(
+        f'beam search decode: {(time.time() - start_time) * 1000:.2f}ms for 16 strs',
+        beam_confidences[0:4])
+
+    from nltk.metrics.distance import edit_distance
+
+    def reference_lcs_length(str1, str2):
+        m, n = len(str1), len(str2)
+        dp = [[0] * (n + 1) for _ in range(m + 1)]
+        for i in range(1, m + 1):
+            for j in range(1, n + 1):
+                if str1[i - 1] == str2[j - 1]:
+                    dp[i][j] = dp[i - 1][j - 1] + 1
+                else:
+                    dp[i][j] = max(dp[i - 1][j], dp[i][j - 1])
+
+        return dp[-1][-1]
+
+    pred_labels = [
+        ''.join(
+            random.choices(list(label) + final_char_table[0:10],
+                           k=random.randint(0, 80))) for label in labels
+    ]
+    start_time = time.time()
+    reference_distances = [
+        edit_distance(pred, label) for pred, label in zip(pred_labels, labels)
+    ]
+    reference_lcs_lengths = [
+        reference_lcs_length(pred, label)
+        for pred, label in zip(pred_labels, labels)
+    ]
+    print(
+        f'reference edit distance and lcs: {(time.time() - start_time) * 1000:.2f}ms'
+    )
+    start_time = time.time()
+    distances = [
+        compute_edit_distance(pred, label)
+        for pred, label in zip(pred_labels, labels)
+    ]
+    lcs_lengths = [
+        compute_lcs_length(pred, label)
+        for pred, label in zip(pred_labels, labels)
+    ]
+    print(
+        f'bit-parallel edit distance and lcs: {(time.time() - start_time) * 1000:.2f}ms'
+    )
+    print('same edit distance:', distances == reference_distances,
+          'same lcs:', lcs_lengths == reference_lcs_lengths)
+
+    from simpleAICV.text_recognition.char_sets.num_and_alpha_char_table import num_char_table, alpha_char_table
+    from simpleAICV.text_recognition.char_sets.common_standard_chinese_char_table import common_standard_chinese_char_first_table, common_standard_chinese_char_second_table, common_standard_chinese_char_third_table
+    metric_meter = TextRecognitionMetricMeter(
+        final_char_table,
+        num_char_table,
+        alpha_char_table,
+        common_standard_chinese_char_first_table,
+        common_standard_chinese_char_second_table,
+        common_standard_chinese_char_third_table,
+        garbage_char='㍿',
+        case_insensitve=True)
+    start_time = time.time()
+    metric_meter.update(pred_labels, labels)
+    print(
+        f'single pass metrics: {(time.time() - start_time) * 1000:.2f}ms for {len(labels)} strs'
+    )
+    print(metric_meter.compute(ignore_threhold=0))
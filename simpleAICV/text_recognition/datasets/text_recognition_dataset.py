@@ -30,6 +30,7 @@ class CNENTextRecognition(Dataset):
                  ],
                  set_type='train',
                  str_max_length=80,
+                 converter=None,
                  transform=None):
         assert set_type in ['train', 'test'], 'Wrong set name!'
 
@@ -59,6 +60,8 @@ class CNENTextRecognition(Dataset):
         self.chars_set = set()
         self.image_path_list = []
         self.image_label_dict = collections.OrderedDict()
+        # image h,w read by imagesize,used by width bucket batch sampler
+        self.image_size_dict = {}
         for per_set_image_dir_path, per_set_label_path in tqdm(
                 zip(all_image_dirs_list, all_labels_path_list)):
             with open(per_set_label_path, 'r', encoding='UTF-8') as json_f:
@@ -89,6 +92,9 @@ class CNENTextRecognition(Dataset):
                     if 1 <= len(per_image_label) <= str_max_length:
                         self.image_path_list.append(per_image_path)
                         self.image_label_dict[per_image_name] = per_image_label
+                        self.image_size_dict[per_image_path] = [
+                            text_image_h, text_image_w
+                        ]
 
                         list_label = list(per_image_label)
                         for per_char in list_label:
@@ -97,6 +103,19 @@ class CNENTextRecognition(Dataset):
 
         self.chars_set = list(sorted(self.chars_set, reverse=False))
 
+        # precompute text index of all labels with converter,stored as one flat array and offsets
+        self.label_flat_indexes, self.label_offsets = None, None
+        if converter is not None:
+            all_labels = [
+                self.image_label_dict[per_image_path.split("/")[-1]]
+                for per_image_path in self.image_path_list
+            ]
+            self.label_flat_indexes, label_lengths = converter.encode_to_flat_indexes(
+                all_labels)
+            self.label_offsets = np.concatenate(
+                [np.zeros((1, ), dtype=np.int64),
+                 np.cumsum(label_lengths)])
+
         self.transform = transform
 
         print(f"Dataset Num:{len(self.image_path_list)}")
@@ -122,6 +141,10 @@ class CNENTextRecognition(Dataset):
             'size': size,
         }
 
+        if self.label_flat_indexes is not None:
+            sample['label_index'] = self.label_flat_indexes[
+                self.label_offsets[idx]:self.label_offsets[idx + 1]]
+
         if self.transform:
             sample = self.transform(sample)
 
@@ -136,6 +159,14 @@ class CNENTextRecognition(Dataset):
 
         return image.astype(np.float32)
 
+    def get_image_hw_array(self):
+        # image h,w of all images,same order as image_path_list
+        return np.array([
+            self.image_size_dict[per_image_path]
+            for per_image_path in self.image_path_list
+        ],
+                        dtype=np.float32).reshape(-1, 2)
+
     def load_label(self, idx):
         image_name = self.image_path_list[idx].split("/")[-1]
         label = self.image_label_dict[image_name]
@@ -241,6 +272,40 @@ if __name__ == '__main__':
         else:
             break
 
+    # compare padding ratio of random batches and width bucket batches
+    from simpleAICV.text_recognition.common import KeepRatioResize, WidthBucketDistributedBatchSampler
+    textrecognitiondataset.transform = transforms.Compose([
+        Normalize(),
+        KeepRatioResize(resize_h=32),
+    ])
+    bucket_sampler = WidthBucketDistributedBatchSampler(
+        textrecognitiondataset,
+        batch_size=64,
+        resize_h=32,
+        width_boundaries=[64, 128, 192, 256, 320, 384, 512, 640],
+        shuffle=True,
+        drop_last=True,
+        seed=0,
+        num_replicas=1,
+        rank=0)
+    random_loader = DataLoader(textrecognitiondataset,
+                               batch_size=64,
+                               shuffle=True,
+                               num_workers=2,
+                               collate_fn=collater)
+    bucket_loader = DataLoader(textrecognitiondataset,
+                               batch_sampler=bucket_sampler,
+                               num_workers=2,
+                               collate_fn=collater)
+    for loader_name, per_loader in [('random', random_loader),
+                                    ('width_bucket', bucket_loader)]:
+        padding_ratios = []
+        for count, data in enumerate(tqdm(per_loader)):
+            padding_ratios.append(data['padding_ratio'])
+            if count >= 50:
+                break
+        print(f'{loader_name} padding_ratio: {np.mean(padding_ratios):.4f}')
+
     textrecognitiondataset = CNENTextRecognition(
         text_recognition_dataset_path,
         set_name=[
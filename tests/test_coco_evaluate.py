@@ -0,0 +1,65 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('pycocotools')
+
+from pycocotools.coco import COCO
+
+from simpleAICV.detection.coco_evaluate import COCOIncrementalEvaluator
+
+
+def build_coco():
+    coco = COCO()
+    coco.dataset = {
+        'images': [{
+            'id': 1,
+            'height': 100,
+            'width': 100,
+        }, {
+            'id': 2,
+            'height': 100,
+            'width': 100,
+        }],
+        'annotations': [{
+            'id': 1,
+            'image_id': 1,
+            'category_id': 1,
+            'bbox': [10, 10, 40, 40],
+            'area': 1600,
+            'iscrowd': 0,
+        }],
+        'categories': [{
+            'id': 1,
+            'name': 'object',
+        }],
+    }
+    coco.createIndex()
+
+    return coco
+
+
+def test_summarize_without_detections_returns_zeros():
+    evaluator = COCOIncrementalEvaluator(build_coco(), iou_type='bbox')
+    evaluator.update(1, [], [], boxes=[])
+    evaluator.update(2, [], [], boxes=[])
+    evaluator.synchronize_between_processes()
+
+    assert evaluator.summarize() == [0] * 12
+
+
+def test_summarize_with_detections():
+    evaluator = COCOIncrementalEvaluator(build_coco(), iou_type='bbox')
+    evaluator.update(1, [0.9], [1], boxes=[[10, 10, 40, 40]])
+    evaluator.update(2, [], [], boxes=[])
+    evaluator.synchronize_between_processes()
+
+    stats = evaluator.summarize()
+    assert stats[0] == pytest.approx(1.)
+    assert stats[8] == pytest.approx(1.)
@@ -0,0 +1,199 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import math
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+pytest.importorskip('scipy')
+
+from simpleAICV.detection.losses import RetinaLoss, FCOSLoss, BatchHungarianMatcher, DETRLoss, DINODETRLoss
+
+
+def build_padded_annotations(batch_size, max_annots_num, num_classes,
+                             generator):
+    '''
+    padded annotations [B,max_annots_num,5],padded rows(-1) are shuffled between valid rows,
+    image 0 has no annotation
+    '''
+    annotations = torch.ones(batch_size, max_annots_num, 5) * (-1)
+    for i in range(1, batch_size):
+        gt_num = int(
+            torch.randint(1, max_annots_num + 1, (1, ),
+                          generator=generator).item())
+        annotations[
+            i, 0:gt_num,
+            0:2] = torch.rand(gt_num, 2, generator=generator) * 0.8 + 0.1
+        annotations[
+            i, 0:gt_num,
+            2:4] = torch.rand(gt_num, 2, generator=generator) * 0.2 + 0.01
+        annotations[i, 0:gt_num,
+                    4] = torch.randint(0,
+                                       num_classes, (gt_num, ),
+                                       generator=generator).float()
+        annotations[i] = annotations[i][torch.randperm(max_annots_num,
+                                                       generator=generator)]
+
+    return annotations
+
+
+def build_padded_box_annotations(batch_size, image_h, image_w, max_annots_num,
+                                 num_classes, generator):
+    '''
+    padded xyxy annotations [B,max_annots_num,5] in pixel,padded rows(-1) are shuffled between valid rows,
+    image 0 has no annotation,image 1 has same boxes with different classes(iou/area ties)
+    '''
+    annotations = torch.ones(batch_size, max_annots_num, 5) * (-1)
+    image_wh = torch.tensor([image_w, image_h], dtype=torch.float32)
+    for i in range(1, batch_size):
+        gt_num = int(
+            torch.randint(2, max_annots_num + 1, (1, ),
+                          generator=generator).item())
+        x1y1 = torch.rand(gt_num, 2, generator=generator) * image_wh * 0.6
+        wh = torch.rand(gt_num, 2, generator=generator) * image_wh * 0.4 + 8
+        annotations[i, 0:gt_num, 0:2] = x1y1
+        annotations[i, 0:gt_num, 2:4] = x1y1 + wh
+        annotations[i, 0:gt_num,
+                    4] = torch.randint(0,
+                                       num_classes, (gt_num, ),
+                                       generator=generator).float()
+        if i == 1:
+            annotations[i, 1, 0:4] = annotations[i, 0, 0:4]
+            annotations[i, 1, 4] = (annotations[i, 0, 4] + 1) % num_classes
+        annotations[i] = annotations[i][torch.randperm(max_annots_num,
+                                                       generator=generator)]
+
+    return annotations
+
+
+def get_feature_size(image_h, image_w, strides=[8, 16, 32, 64, 128]):
+    # [w,h] of every fpn level
+    return [[math.ceil(image_w / stride),
+             math.ceil(image_h / stride)] for stride in strides]
+
+
+@pytest.mark.parametrize('num_threads', [1, 4])
+def test_batch_hungarian_matcher_cost_orientation(num_threads):
+    generator = torch.Generator().manual_seed(0)
+    batch_size, query_nums, max_annots_num = 4, 30, 12
+    total_cost = torch.rand(batch_size,
+                            query_nums,
+                            max_annots_num,
+                            generator=generator)
+    valid_mask = torch.rand(batch_size, max_annots_num,
+                            generator=generator) > 0.4
+    valid_mask[0] = False
+
+    from scipy.optimize import linear_sum_assignment
+
+    matcher = BatchHungarianMatcher(num_threads=num_threads)
+    indices = matcher(total_cost, valid_mask)
+    for i, (pred_idxs, target_idxs) in enumerate(indices):
+        per_image_cost = total_cost[i][:, valid_mask[i]].numpy()
+        expected_pred_idxs, expected_target_idxs = linear_sum_assignment(
+            per_image_cost)
+        assert pred_idxs.tolist() == expected_pred_idxs.tolist()
+        assert target_idxs.tolist() == expected_target_idxs.tolist()
+        assert len(pred_idxs) == int(valid_mask[i].sum())
+        if len(pred_idxs) > 0:
+            assert int(pred_idxs.max()) < query_nums
+            assert int(target_idxs.max()) < int(valid_mask[i].sum())
+
+
+@pytest.mark.parametrize('loss_class', [DETRLoss, DINODETRLoss])
+def test_batch_matching_same_as_per_image_matching(loss_class):
+    generator = torch.Generator().manual_seed(0)
+    batch_size, query_nums, max_annots_num, num_classes = 4, 50, 10, 80
+    cls_preds = torch.randn(batch_size,
+                            query_nums,
+                            num_classes,
+                            generator=generator)
+    reg_preds = torch.rand(batch_size, query_nums, 4, generator=generator)
+    annotations = build_padded_annotations(batch_size, max_annots_num,
+                                           num_classes, generator)
+
+    loss = loss_class(num_classes=num_classes)
+    per_image_indices = loss.get_matched_pred_target_idxs(
+        cls_preds, reg_preds, annotations)
+    batch_indices = loss.get_batch_matched_pred_target_idxs(
+        cls_preds, reg_preds, annotations)
+
+    assert len(per_image_indices) == len(batch_indices) == batch_size
+    for (pred_idxs, target_idxs), (batch_pred_idxs, batch_target_idxs) in zip(
+            per_image_indices, batch_indices):
+        assert torch.equal(pred_idxs, batch_pred_idxs)
+        assert torch.equal(target_idxs, batch_target_idxs)
+
+
+@pytest.mark.parametrize('box_loss_type', ['SmoothL1', 'GIoU'])
+@pytest.mark.parametrize('all_empty', [False, True])
+def test_retina_batch_assigner_same_as_per_image_assigner(
+        box_loss_type, all_empty):
+    generator = torch.Generator().manual_seed(0)
+    batch_size, image_h, image_w, max_annots_num, num_classes = 4, 256, 320, 12, 80
+    annotations = build_padded_box_annotations(batch_size, image_h, image_w,
+                                               max_annots_num, num_classes,
+                                               generator)
+    if all_empty:
+        annotations = torch.ones_like(annotations) * (-1)
+
+    loss = RetinaLoss(box_loss_type=box_loss_type)
+    one_image_anchors = loss.anchors.get_one_image_anchors_tensor(
+        get_feature_size(image_h, image_w), torch.device('cpu'))
+    batch_anchors = one_image_anchors.unsqueeze(0).expand(batch_size, -1, -1)
+    per_image_targets = loss.get_batch_anchors_annotations(
+        batch_anchors, annotations)
+    batch_targets = loss.assign_batch_anchors_annotations(
+        one_image_anchors, annotations)
+
+    assert per_image_targets.shape == batch_targets.shape
+    assert torch.equal(per_image_targets[:, :, 4], batch_targets[:, :, 4])
+    positive = per_image_targets[:, :, 4] > 0
+    assert torch.equal(per_image_targets[positive], batch_targets[positive])
+    # image without annotation:all anchors are ignored
+    assert torch.all(batch_targets[0] == -1)
+    if not all_empty:
+        assert int(positive.sum()) > 0
+
+
+@pytest.mark.parametrize('use_center_sample', [True, False])
+@pytest.mark.parametrize('all_empty', [False, True])
+def test_fcos_batch_assigner_same_as_per_image_assigner(
+        use_center_sample, all_empty):
+    generator = torch.Generator().manual_seed(0)
+    batch_size, image_h, image_w, max_annots_num, num_classes = 4, 256, 320, 12, 80
+    annotations = build_padded_box_annotations(batch_size, image_h, image_w,
+                                               max_annots_num, num_classes,
+                                               generator)
+    if all_empty:
+        annotations = torch.ones_like(annotations) * (-1)
+
+    loss = FCOSLoss(use_center_sample=use_center_sample)
+    feature_size = get_feature_size(image_h, image_w)
+    one_image_positions, one_image_level_idxs = loss.positions.get_one_image_positions_tensor(
+        feature_size, torch.device('cpu'))
+    heads = [torch.zeros(batch_size, h, w, 1) for w, h in feature_size]
+    per_image_targets = loss.get_batch_position_annotations(
+        heads,
+        heads,
+        heads,
+        one_image_positions,
+        one_image_level_idxs,
+        annotations,
+        use_center_sample=use_center_sample)[3]
+    batch_targets = loss.assign_batch_position_annotations(
+        one_image_positions,
+        one_image_level_idxs,
+        annotations,
+        use_center_sample=use_center_sample)
+
+    assert per_image_targets.shape == batch_targets.shape
+    assert torch.equal(per_image_targets, batch_targets)
+    # image without annotation:no positive point
+    assert torch.all(batch_targets[0, :, 0:6] == 0)
+    if not all_empty:
+        assert int((batch_targets[:, :, 4] > 0).sum()) > 0
@@ -0,0 +1,83 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('torch')
+pytest.importorskip('shapely')
+pytest.importorskip('nltk')
+
+from tools.text_scripts import compute_pred_gt_ious
+
+
+def compute_dense_pred_gt_ious(pred_boxes, gt_boxes, size):
+    '''
+    full image mask iou
+    '''
+    insection_pred_ious = np.zeros((len(gt_boxes), len(pred_boxes)),
+                                   dtype=np.float32)
+    insection_target_ious = np.zeros((len(gt_boxes), len(pred_boxes)),
+                                     dtype=np.float32)
+    h, w = size[0], size[1]
+
+    for gt_idx, per_gt_box in enumerate(gt_boxes):
+        gt_mask = np.zeros((h, w), dtype=np.float32)
+        cv2.fillPoly(gt_mask, [per_gt_box.astype(np.int32)], 1.0)
+        for pred_idx, per_pred_box in enumerate(pred_boxes):
+            pred_mask = np.zeros((h, w), dtype=np.float32)
+            cv2.fillPoly(pred_mask, [per_pred_box.astype(np.int32)], 1.0)
+            insection_mask = gt_mask * pred_mask
+            insection_pred_ious[gt_idx][pred_idx] = insection_mask.sum() / (
+                pred_mask.sum() + 1e-4)
+            insection_target_ious[gt_idx][pred_idx] = insection_mask.sum() / (
+                gt_mask.sum() + 1e-4)
+
+    return insection_pred_ious, insection_target_ious
+
+
+def test_compute_pred_gt_ious_clipped_polygons():
+    gt_boxes = [
+        np.array([[33, 0], [57, 0], [55, 34], [31, 33]], dtype=np.float32)
+    ]
+    pred_boxes = [
+        np.array([[35, 34], [59, 17], [79, 47], [56, 57]], dtype=np.float32)
+    ]
+    size = [58, 142]
+
+    pred_ious, target_ious = compute_pred_gt_ious(pred_boxes, gt_boxes, size)
+    dense_pred_ious, dense_target_ious = compute_dense_pred_gt_ious(
+        pred_boxes, gt_boxes, size)
+
+    assert np.array_equal(pred_ious, dense_pred_ious)
+    assert np.array_equal(target_ious, dense_target_ious)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_compute_pred_gt_ious_same_as_dense_ious(seed):
+    rng = np.random.RandomState(seed)
+    size = [int(rng.randint(40, 160)), int(rng.randint(40, 160))]
+    h, w = size
+
+    def random_boxes(box_num):
+        boxes = []
+        for _ in range(box_num):
+            center = rng.uniform([-10, -10], [w + 10, h + 10])
+            box = center + rng.uniform(-30, 30, size=(4, 2))
+            boxes.append(box.astype(np.float32))
+
+        return boxes
+
+    gt_boxes = random_boxes(int(rng.randint(1, 8)))
+    pred_boxes = random_boxes(int(rng.randint(1, 8)))
+
+    pred_ious, target_ious = compute_pred_gt_ious(pred_boxes, gt_boxes, size)
+    dense_pred_ious, dense_target_ious = compute_dense_pred_gt_ious(
+        pred_boxes, gt_boxes, size)
+
+    assert np.array_equal(pred_ious, dense_pred_ious)
+    assert np.array_equal(target_ious, dense_target_ious)
@@ -0,0 +1,480 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import collections
+import copy
+import re
+import shutil
+import threading
+
+import torch
+from torch.utils.data.distributed import DistributedSampler
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    '''
+    DistributedSampler can skip first start_index samples of one epoch on this rank,
+    used for mid epoch resume,start_index is reset to 0 after one epoch iteration.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(ResumableDistributedSampler, self).__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+    def __iter__(self):
+        indices = list(super(ResumableDistributedSampler, self).__iter__())
+        indices = indices[self.start_index:]
+        self.start_index = 0
+
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+
+def atomic_torch_save(obj, path, rank=0):
+    '''
+    write to a per rank tmp file first,then rename to path,
+    a crash during writing never leaves a broken checkpoint at path
+    '''
+    tmp_path = f'{path}.tmp{rank}'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointer:
+    '''
+    checkpoint states are snapshotted to host(pinned) memory on calling thread,
+    then written to disk in a background thread,train loop only waits for device to host copy.
+    config.save_checkpoint_interval:>0:save iter checkpoint every save_checkpoint_interval optimizer steps
+    config.keep_iter_checkpoint_num:keep newest iter checkpoint num,default 2
+    config.shard_optimizer_checkpoint:True:every rank writes 1/world_size of optimizer state,
+    needs a checkpoint_dir shared by all ranks
+    iter checkpoint:checkpoint_dir/iter_checkpoints/epoch{epoch}_iter{iter_index}/
+    checkpoint.pth(local_rank 0):same keys as epoch latest.pth and iter_index/scaler_state_dict,
+    'epoch' is finished epoch num,so resume code start from interrupted epoch
+    optimizer_rank{rank}_of{world_size}.pth(every rank):optimizer state shard
+    '''
+
+    def __init__(self, config, checkpoint_dir, model, optimizer, scheduler,
+                 train_loader):
+        self.config = config
+        self.checkpoint_dir = checkpoint_dir
+        self.iter_checkpoint_dir = os.path.join(checkpoint_dir,
+                                                'iter_checkpoints')
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.train_loader = train_loader
+
+        self.save_interval = config.save_checkpoint_interval if hasattr(
+            config, 'save_checkpoint_interval') else 0
+        self.keep_num = config.keep_iter_checkpoint_num if hasattr(
+            config, 'keep_iter_checkpoint_num') else 2
+        self.shard_optimizer = hasattr(
+            config, 'shard_optimizer_checkpoint'
+        ) and config.shard_optimizer_checkpoint
+        assert self.keep_num >= 1, 'illegal keep_iter_checkpoint_num!'
+        # slow ranks may still write shards of previous iter checkpoint
+        assert not self.shard_optimizer or self.keep_num >= 2, 'shard_optimizer_checkpoint need keep_iter_checkpoint_num >= 2!'
+
+        self.local_rank = config.local_rank
+        self.rank = torch.distributed.get_rank(
+        ) if torch.distributed.is_initialized() else 0
+        self.world_size = torch.distributed.get_world_size(
+        ) if torch.distributed.is_initialized() else 1
+
+        # non state dict values of last epoch checkpoint,e.g. time/best_acc1
+        self.extra_state = {}
+        self.resume_iter_index = 0
+
+        self.host_buffers = {}
+        self.write_thread = None
+        self.write_exception = None
+
+    def update_extra_state(self, extra_state):
+        '''
+        extra_state:epoch checkpoint dict,keep non state dict values for iter checkpoints
+        '''
+        for key, value in extra_state.items():
+            if key.endswith('state_dict') or key in [
+                    'epoch', 'iter_index', 'lr', 'batch_size',
+                    'optimizer_shard_num'
+            ]:
+                continue
+            self.extra_state[key] = copy.deepcopy(value)
+
+    def snapshot_to_host(self, obj, name=None):
+        '''
+        copy all tensors to host memory
+        name:None:synchronous copy,else reuse pinned buffers of last snapshot with same name
+        '''
+        if torch.is_tensor(obj):
+            obj = obj.detach()
+            if not obj.is_cuda:
+                return obj.clone()
+            if name is None:
+                return obj.cpu()
+
+            buffer = self.host_buffers.get(name, None)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape,
+                                     dtype=obj.dtype,
+                                     device='cpu',
+                                     pin_memory=True)
+                self.host_buffers[name] = buffer
+            buffer.copy_(obj, non_blocking=True)
+
+            return buffer
+        elif isinstance(obj, dict):
+            snapshot = collections.OrderedDict() if isinstance(
+                obj, collections.OrderedDict) else {}
+            for key, value in obj.items():
+                snapshot[key] = self.snapshot_to_host(
+                    value, None if name is None else name + (key, ))
+            # keep module state dict version info
+            if hasattr(obj, '_metadata'):
+                snapshot._metadata = copy.deepcopy(obj._metadata)
+
+            return snapshot
+        elif isinstance(obj, (list, tuple)):
+            snapshot = [
+                self.snapshot_to_host(value,
+                                      None if name is None else name + (idx, ))
+                for idx, value in enumerate(obj)
+            ]
+
+            return snapshot if isinstance(obj, list) else tuple(snapshot)
+        else:
+            return copy.deepcopy(obj)
+
+    def wait(self):
+        '''
+        wait for last background write,raise exception of last write
+        '''
+        if self.write_thread is not None:
+            self.write_thread.join()
+            self.write_thread = None
+
+        if self.write_exception is not None:
+            write_exception = self.write_exception
+            self.write_exception = None
+            raise write_exception
+
+    def write_files(self, save_list, remove_dirs):
+        try:
+            for obj, path in save_list:
+                atomic_torch_save(obj, path, rank=self.rank)
+            for per_dir in remove_dirs:
+                shutil.rmtree(per_dir, ignore_errors=True)
+        except Exception as e:
+            self.write_exception = e
+
+    def async_save(self, save_list, remove_dirs=[]):
+        '''
+        save_list:list of (obj,path),objs must be snapshotted to host memory
+        '''
+        if len(save_list) == 0 and len(remove_dirs) == 0:
+            return
+
+        if torch.cuda.is_available():
+            # pinned buffers are copied with non_blocking=True
+            torch.cuda.current_stream().synchronize()
+
+        self.write_thread = threading.Thread(target=self.write_files,
+                                             args=(save_list, remove_dirs),
+                                             daemon=True)
+        self.write_thread.start()
+
+    def save_checkpoint(self, state, path):
+        '''
+        replace torch.save(state,path),return after state is copied to host memory,
+        epoch checkpoints are not frequent,copy to pageable memory instead of holding more pinned buffers
+        '''
+        self.wait()
+        if isinstance(state, dict) and 'model_state_dict' in state.keys():
+            self.update_extra_state(state)
+        self.async_save([(self.snapshot_to_host(state), path)])
+
+    def get_shard_optimizer_state_dict(self, optimizer_state_dict):
+        return {
+            'state': {
+                key: value
+                for key, value in optimizer_state_dict['state'].items()
+                if key % self.world_size == self.rank
+            },
+        }
+
+    def get_iter_checkpoint_dirs(self):
+        '''
+        return iter checkpoint dirs,newest first
+        '''
+        if not os.path.exists(self.iter_checkpoint_dir):
+            return []
+
+        iter_checkpoint_dirs = []
+        for per_dir_name in os.listdir(self.iter_checkpoint_dir):
+            per_match = re.match(r'^epoch(\d+)_iter(\d+)$', per_dir_name)
+            if per_match is None:
+                continue
+            iter_checkpoint_dirs.append(
+                (int(per_match.group(1)), int(per_match.group(2)),
+                 os.path.join(self.iter_checkpoint_dir, per_dir_name)))
+        iter_checkpoint_dirs = sorted(iter_checkpoint_dirs, reverse=True)
+        iter_checkpoint_dirs = [
+            per_dir for _, _, per_dir in iter_checkpoint_dirs
+        ]
+
+        return iter_checkpoint_dirs
+
+    def is_complete_iter_checkpoint(self, iter_checkpoint_dir):
+        if not os.path.exists(
+                os.path.join(iter_checkpoint_dir, 'checkpoint.pth')):
+            return False
+
+        if self.shard_optimizer:
+            for rank in range(self.world_size):
+                if not os.path.exists(
+                        os.path.join(
+                            iter_checkpoint_dir,
+                            f'optimizer_rank{rank}_of{self.world_size}.pth')):
+                    return False
+
+        return True
+
+    def save_iter_checkpoint(self, epoch, iter_index, accumulation_steps=1):
+        '''
+        call after optimizer step,ema update and scheduler step
+        '''
+        if self.save_interval <= 0:
+            return
+        if int(iter_index // accumulation_steps) % self.save_interval != 0:
+            return
+
+        self.wait()
+
+        iter_checkpoint_dir = os.path.join(
+            self.iter_checkpoint_dir, f'epoch{epoch:0>4d}_iter{iter_index:0>8d}')
+        os.makedirs(iter_checkpoint_dir, exist_ok=True)
+
+        save_list, remove_dirs = [], []
+        optimizer_state_dict = None
+        if self.shard_optimizer or self.local_rank == 0:
+            optimizer_state_dict = self.optimizer.state_dict()
+
+        if self.shard_optimizer:
+            save_list.append(
+                (self.snapshot_to_host(
+                    self.get_shard_optimizer_state_dict(optimizer_state_dict),
+                    ('optimizer_shard', )),
+                 os.path.join(
+                     iter_checkpoint_dir,
+                     f'optimizer_rank{self.rank}_of{self.world_size}.pth')))
+
+        if self.local_rank == 0:
+            state = copy.deepcopy(self.extra_state)
+            state.update({
+                'epoch': epoch - 1,
+                'iter_index': iter_index,
+                'lr': self.scheduler.current_lr,
+                'model_state_dict': self.model.state_dict(),
+                'scheduler_state_dict': self.scheduler.state_dict(),
+            })
+            if self.shard_optimizer:
+                state['optimizer_state_dict'] = {
+                    'param_groups': optimizer_state_dict['param_groups'],
+                }
+                state['optimizer_shard_num'] = self.world_size
+            else:
+                state['optimizer_state_dict'] = optimizer_state_dict
+            if hasattr(self.config,
+                       'ema_model') and self.config.ema_model is not None:
+                state[
+                    'ema_model_state_dict'] = self.config.ema_model.ema_model.state_dict(
+                    )
+            if hasattr(self.config,
+                       'scaler') and self.config.scaler is not None:
+                state['scaler_state_dict'] = self.config.scaler.state_dict()
+            if self.train_loader is not None and self.train_loader.batch_size is not None:
+                state['batch_size'] = self.train_loader.batch_size
+
+            save_list.append((self.snapshot_to_host(state, ('checkpoint', )),
+                              os.path.join(iter_checkpoint_dir,
+                                           'checkpoint.pth')))
+
+            # rotate old iter checkpoints
+            remove_dirs = self.get_iter_checkpoint_dirs()[self.keep_num:]
+
+        self.async_save(save_list, remove_dirs)
+
+    def set_sampler_start(self, iter_index, checkpoint):
+        if self.train_loader is None:
+            return
+
+        sampler = self.train_loader.sampler
+        batch_sampler = self.train_loader.batch_sampler
+        if isinstance(sampler, ResumableDistributedSampler):
+            batch_size = checkpoint[
+                'batch_size'] if 'batch_size' in checkpoint.keys(
+                ) else self.train_loader.batch_size
+            sampler.set_start_index(iter_index * batch_size)
+        elif hasattr(batch_sampler, 'set_start_index'):
+            batch_sampler.set_start_index(iter_index)
+
+    def load_checkpoint(self, resume_model):
+        '''
+        return newest checkpoint of epoch checkpoint resume_model and iter checkpoints,None if no checkpoint
+        iter checkpoint also restores GradScaler state and train sampler position
+        '''
+        checkpoint = None
+        if os.path.exists(resume_model):
+            checkpoint = torch.load(resume_model,
+                                    map_location=torch.device('cpu'))
+
+        iter_checkpoint_dir = None
+        for per_dir in self.get_iter_checkpoint_dirs():
+            if self.is_complete_iter_checkpoint(per_dir):
+                iter_checkpoint_dir = per_dir
+                break
+
+        if iter_checkpoint_dir is None:
+            return checkpoint
+
+        iter_checkpoint = torch.load(os.path.join(iter_checkpoint_dir,
+                                                  'checkpoint.pth'),
+                                     map_location=torch.device('cpu'))
+        # epoch checkpoint is newer
+        if checkpoint is not None and iter_checkpoint['epoch'] < checkpoint[
+                'epoch']:
+            return checkpoint
+
+        if 'optimizer_shard_num' in iter_checkpoint.keys():
+            optimizer_state = {}
+            shard_num = iter_checkpoint['optimizer_shard_num']
+            for rank in range(shard_num):
+                per_shard = torch.load(os.path.join(
+                    iter_checkpoint_dir, f'optimizer_rank{rank}_of{shard_num}.pth'),
+                                       map_location=torch.device('cpu'))
+                optimizer_state.update(per_shard['state'])
+            iter_checkpoint['optimizer_state_dict']['state'] = optimizer_state
+
+        if 'scaler_state_dict' in iter_checkpoint.keys() and hasattr(
+                self.config, 'scaler') and self.config.scaler is not None:
+            self.config.scaler.load_state_dict(
+                iter_checkpoint['scaler_state_dict'])
+
+        self.resume_iter_index = iter_checkpoint['iter_index']
+        self.set_sampler_start(self.resume_iter_index, iter_checkpoint)
+        self.update_extra_state(iter_checkpoint)
+
+        return iter_checkpoint
+
+    def pop_start_iter_index(self):
+        '''
+        first iter_index of train loop,only first epoch after mid epoch resume skip finished iters
+        '''
+        start_iter_index = self.resume_iter_index + 1
+        self.resume_iter_index = 0
+
+        return start_iter_index
+
+    def close(self):
+        self.wait()
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    import numpy as np
+    import torch
+    seed = 0
+    # for hash
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    # for python and numpy
+    random.seed(seed)
+    np.random.seed(seed)
+    # for cpu gpu
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+    import tempfile
+    import time
+
+    from torch.utils.data import DataLoader
+
+    from simpleAICV.classification.backbones.resnet import resnet50
+    from tools.utils import Scheduler
+
+    class config:
+        local_rank = 0
+        epochs = 10
+        optimizer = ('SGD', {'lr': 0.1})
+        scheduler = ('CosineLR', {'warm_up_epochs': 0})
+        save_checkpoint_interval = 2
+        keep_iter_checkpoint_num = 2
+        scaler = None
+        ema_model = None
+
+    net = resnet50(num_classes=1000)
+    if torch.cuda.is_available():
+        net = net.cuda()
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+    net(torch.randn(2, 3, 224, 224,
+                    device=next(net.parameters()).device)).sum().backward()
+    optimizer.step()
+    scheduler = Scheduler(config, optimizer)
+
+    dataset = list(range(100))
+    train_sampler = ResumableDistributedSampler(dataset,
+                                                num_replicas=1,
+                                                rank=0,
+                                                shuffle=True)
+    train_loader = DataLoader(dataset,
+                              batch_size=4,
+                              sampler=train_sampler,
+                              drop_last=True)
+
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpointer = AsyncCheckpointer(config, checkpoint_dir, net,
+                                         optimizer, scheduler, train_loader)
+        checkpointer.update_extra_state({'time': 0., 'best_acc1': 0.})
+
+        # train loop only waits for device to host copy
+        for iter_index in range(1, 9):
+            start_time = time.time()
+            checkpointer.save_iter_checkpoint(3, iter_index)
+            print(
+                f'1111, iter {iter_index}, save time: {(time.time() - start_time) * 1000:.2f}ms'
+            )
+        checkpointer.close()
+        print('2222', sorted(os.listdir(checkpointer.iter_checkpoint_dir)))
+
+        # resume from newest iter checkpoint
+        train_sampler.set_epoch(3)
+        all_batches = [per_batch.tolist() for per_batch in train_loader]
+        new_checkpointer = AsyncCheckpointer(config, checkpoint_dir, net,
+                                             optimizer, scheduler,
+                                             train_loader)
+        checkpoint = new_checkpointer.load_checkpoint(
+            os.path.join(checkpoint_dir, 'latest.pth'))
+        start_iter_index = new_checkpointer.pop_start_iter_index()
+        resume_batches = [per_batch.tolist() for per_batch in train_loader]
+        max_diff = 0.
+        for key, value in net.state_dict().items():
+            max_diff = max(
+                max_diff,
+                float((value.cpu().float() -
+                       checkpoint['model_state_dict'][key].float()).abs().max()))
+        print('3333', checkpoint['epoch'], checkpoint['iter_index'],
+              start_iter_index, max_diff,
+              resume_batches == all_batches[start_iter_index - 1:])
@@ -11,14 +11,13 @@ import torch.nn.functional as F
 
 from torch.cuda.amp import autocast
 
-from simpleAICV.classification.common import AverageMeter
-from simpleAICV.diffusion_model.metrics.compute_fid_is_score import calculate_frechet_distance, compute_inception_score
-from tools.scripts import all_reduce_operation_in_group_for_variables
+from simpleAICV.diffusion_model.metrics.compute_fid_is_score import calculate_frechet_distance, compute_inception_score, FIDISStatisticsMeter, get_fid_reference_statistics_key, load_fid_reference_statistics, save_fid_reference_statistics
+from tools.train_step import TrainStepEngine
 
 
 def generate_diffusion_model_images(test_loader, model, sampler, config):
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        model = config.ema_model.ema_model
+        model = config.ema_model.get_eval_model()
 
     # switch to evaluate mode
     model.eval()
@@ -50,12 +49,13 @@ def generate_diffusion_model_images(test_loader, model, sampler, config):
             if config.use_input_images:
                 input_images = images
 
-            _, outputs = sampler(model,
-                                 images.shape,
-                                 class_label=labels,
-                                 input_images=input_images,
-                                 input_masks=input_masks,
-                                 return_intermediates=True)
+            # only last step images are copied to host
+            outputs = sampler(model,
+                              images.shape,
+                              class_label=labels,
+                              input_images=input_images,
+                              input_masks=input_masks,
+                              return_intermediates=False)
 
             torch.cuda.synchronize()
 
@@ -176,21 +176,178 @@ def compute_diffusion_model_metric(test_images_dataloader,
     return fid_value, is_score_mean, is_score_std
 
 
+def convert_to_fid_model_inputs(images, mean, std, input_image_size):
+    '''
+    same as images saved as uint8 and read back by ImagePathDataset with ToTensor
+    images:[B,3,H,W] normalized RGB images
+    return:[B,3,input_image_size,input_image_size] RGB images in range [0,1]
+    '''
+    images = torch.floor(torch.clamp((images * std + mean) * 255., 0, 255))
+    images = images / 255.
+
+    if images.shape[2] != input_image_size or images.shape[
+            3] != input_image_size:
+        images = F.interpolate(images,
+                               size=(input_image_size, input_image_size),
+                               mode='bilinear',
+                               align_corners=False,
+                               antialias=True)
+
+    return images
+
+
+def generate_and_compute_diffusion_model_metric(test_loader, model, sampler,
+                                                fid_model, config):
+    '''
+    generate images and compute fid/is in one pass,no image encode/decode,
+    generated images are fed into fid model directly and fid/is statistics are accumulated in float64.
+    reference statistics are loaded from cache,or computed in the same pass and saved to cache.
+    set config.save_images=True to save test/generated images as generate_diffusion_model_images.
+    '''
+    if hasattr(config, 'use_ema_model') and config.use_ema_model:
+        model = config.ema_model.get_eval_model()
+
+    for param in fid_model.parameters():
+        param.requires_grad = False
+
+    # switch to evaluate mode
+    model.eval()
+    fid_model.eval()
+
+    local_rank = config.local_rank
+    device = next(fid_model.parameters()).device
+
+    reference_statistics_key = get_fid_reference_statistics_key(
+        config.test_dataset,
+        config.input_image_size,
+        fid_model_name=config.fid_model_path
+        if hasattr(config, 'fid_model_path') else '')
+    reference_statistics_path = os.path.join(
+        config.fid_stats_cache_dir, f'{reference_statistics_key}.npz')
+    reference_statistics = load_fid_reference_statistics(
+        reference_statistics_path)
+
+    test_meter = FIDISStatisticsMeter(
+        data_split_num=config.is_data_split_num, device=device)
+    generate_meter = FIDISStatisticsMeter(
+        data_split_num=config.is_data_split_num, device=device)
+
+    mean = torch.tensor(config.mean, dtype=torch.float32,
+                        device=device).view(1, 3, 1, 1)
+    std = torch.tensor(config.std, dtype=torch.float32,
+                       device=device).view(1, 3, 1, 1)
+
+    save_images = hasattr(config, 'save_images') and config.save_images
+
+    with torch.no_grad():
+        model_on_cuda = next(model.parameters()).is_cuda
+        for batch_idx, data in tqdm(enumerate(test_loader)):
+            images = data['image']
+            if model_on_cuda:
+                images = images.cuda()
+
+            labels = None
+            if 'label' in data.keys(
+            ) and config.num_classes and config.use_condition_label:
+                labels = data['label']
+                if model_on_cuda:
+                    labels = labels.cuda()
+
+            if torch.any(torch.isinf(images)):
+                continue
+
+            if torch.any(torch.isnan(images)):
+                continue
+
+            input_images, input_masks = None, None
+            if config.use_input_images:
+                input_images = images
+
+            # last step images stay on device
+            for _, outputs in sampler.sample_step_images(
+                    model,
+                    images.shape,
+                    class_label=labels,
+                    input_images=input_images,
+                    input_masks=input_masks):
+                pass
+
+            images = convert_to_fid_model_inputs(images, mean, std,
+                                                 config.input_image_size)
+            outputs = convert_to_fid_model_inputs(outputs, mean, std,
+                                                  config.input_image_size)
+
+            if reference_statistics is None:
+                preds = fid_model(images)
+                test_meter.update(features=preds[0].flatten(1))
+
+            preds = fid_model(outputs)
+            generate_meter.update(features=preds[0].flatten(1), probs=preds[1])
+
+            if save_images:
+                images = (images * 255.).permute(0, 2, 3,
+                                                 1).cpu().numpy().astype(
+                                                     np.uint8)
+                outputs = (outputs * 255.).permute(0, 2, 3,
+                                                   1).cpu().numpy().astype(
+                                                       np.uint8)
+                for image_idx, (per_image, per_output) in enumerate(
+                        zip(images, outputs)):
+                    per_image = cv2.cvtColor(per_image, cv2.COLOR_RGB2BGR)
+                    per_output = cv2.cvtColor(per_output, cv2.COLOR_RGB2BGR)
+
+                    save_image_name = f'image_{local_rank}_{batch_idx}_{image_idx}.jpg'
+                    save_image_path = os.path.join(
+                        config.save_test_image_dir, save_image_name)
+                    cv2.imencode('.jpg', per_image)[1].tofile(save_image_path)
+
+                    save_output_name = f'output_{local_rank}_{batch_idx}_{image_idx}.jpg'
+                    save_output_path = os.path.join(
+                        config.save_generate_image_dir, save_output_name)
+                    cv2.imencode('.jpg',
+                                 per_output)[1].tofile(save_output_path)
+
+    # sum statistics over ranks
+    if reference_statistics is None:
+        test_meter.all_reduce(group=config.group)
+    generate_meter.all_reduce(group=config.group)
+
+    if reference_statistics is None:
+        mu1, sigma1 = test_meter.get_feature_statistics()
+        test_image_num = int(test_meter.feature_count.item())
+        if local_rank == 0:
+            os.makedirs(config.fid_stats_cache_dir) if not os.path.exists(
+                config.fid_stats_cache_dir) else None
+            save_fid_reference_statistics(reference_statistics_path, mu1,
+                                          sigma1, test_image_num)
+    else:
+        mu1, sigma1, test_image_num = reference_statistics
+
+    mu2, sigma2 = generate_meter.get_feature_statistics()
+    generate_image_num = int(generate_meter.feature_count.item())
+
+    fid_value = calculate_frechet_distance(mu1, sigma1, mu2, sigma2)
+
+    is_score_mean, is_score_std = generate_meter.get_inception_score()
+
+    return fid_value, is_score_mean, is_score_std, test_image_num, generate_image_num
+
+
 def train_diffusion_model(train_loader, model, criterion, trainer, optimizer,
                           scheduler, epoch, logger, config):
     '''
     train diffusion model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images = data['image']
         images = images.cuda()
@@ -200,150 +357,43 @@ def train_diffusion_model(train_loader, model, criterion, trainer, optimizer,
             labels = data['label']
             labels = labels.cuda()
 
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(images)):
-            skip_batch_flag = True
-
-        if torch.any(torch.isnan(images)):
-            skip_batch_flag = True
-
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    pred_noise, noise = trainer(model,
-                                                images,
-                                                class_label=labels)
-                    loss = criterion(pred_noise, noise)
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        pred_noise, noise = trainer(model,
-                                                    images,
-                                                    class_label=labels)
-                        loss = criterion(pred_noise, noise)
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        train_step.check_inputs([images])
+
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 pred_noise, noise = trainer(model, images, class_label=labels)
                 loss = criterion(pred_noise, noise)
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    pred_noise, noise = trainer(model,
-                                                images,
-                                                class_label=labels)
-                    loss = criterion(pred_noise, noise)
-
-        if loss == 0. or torch.any(torch.isinf(loss)) or torch.any(
-                torch.isnan(loss)):
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
-
-        loss = loss / config.accumulation_steps
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
+
+            train_step.check_loss(loss)
+            train_step.backward(loss)
+
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
+
+            if config.use_ema_model and train_step.optimizer_stepped():
                 config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
+            train_step.update_loss(loss, sample_num=images.size(0))
 
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss*config.accumulation_steps:.4f}'
+            loss, _, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}'
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
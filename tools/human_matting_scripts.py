@@ -15,7 +15,7 @@ from torch.cuda.amp import autocast
 from scipy.ndimage import gaussian_filter
 
 from simpleAICV.human_matting.common import AverageMeter
-from tools.scripts import all_reduce_operation_in_group_for_variables
+from tools.train_step import TrainStepEngine
 
 
 class EvalMeter:
@@ -192,7 +192,7 @@ def validate_human_matting(test_loader, model, criterion, config):
     eval_metric = EvalMeter(config)
 
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        model = config.ema_model.ema_model
+        model = config.ema_model.get_eval_model()
 
     # switch to evaluate mode
     model.eval()
@@ -272,16 +272,16 @@ def train_human_matting(train_loader, model, criterion, optimizer, scheduler,
     '''
     train human matting model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images, masks, trimaps, fg_maps, bg_maps = data['image'], data[
             'mask'], data['trimap'], data['fg_map'], data['bg_map']
@@ -289,88 +289,11 @@ def train_human_matting(train_loader, model, criterion, optimizer, scheduler,
         images, masks, trimaps, fg_maps, bg_maps = images.cuda(), masks.cuda(
         ), trimaps.cuda(), fg_maps.cuda(), bg_maps.cuda()
 
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(images)) or torch.any(torch.isinf(masks)):
-            skip_batch_flag = True
-
-        if torch.any(torch.isnan(images)) or torch.any(torch.isnan(masks)):
-            skip_batch_flag = True
-
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    outputs = model(images)
-                    global_preds, local_preds, fused_preds = outputs
-
-                    loss_value = {}
-                    for loss_name in criterion.keys():
-                        if loss_name in [
-                                'GlobalTrimapCELoss',
-                                'GloabelTrimapIouLoss',
-                        ]:
-                            temp_loss = criterion[loss_name](global_preds,
-                                                             trimaps)
-                        elif loss_name in [
-                                'LocalAlphaLoss',
-                                'LocalLaplacianLoss',
-                        ]:
-                            temp_loss = criterion[loss_name](local_preds,
-                                                             masks, trimaps)
-                        elif loss_name in [
-                                'FusionAlphaLoss',
-                                'FusionLaplacianLoss',
-                        ]:
-                            temp_loss = criterion[loss_name](fused_preds,
-                                                             masks)
-                        elif loss_name in [
-                                'CompositionLoss',
-                        ]:
-                            temp_loss = criterion[loss_name](images, masks,
-                                                             fg_maps, bg_maps,
-                                                             fused_preds)
-
-                        temp_loss = config.loss_ratio[loss_name] * temp_loss
-                        loss_value[loss_name] = temp_loss
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        outputs = model(images)
-                        global_preds, local_preds, fused_preds = outputs
-
-                        loss_value = {}
-                        for loss_name in criterion.keys():
-                            if loss_name in [
-                                    'GlobalTrimapCELoss',
-                                    'GloabelTrimapIouLoss',
-                            ]:
-                                temp_loss = criterion[loss_name](global_preds,
-                                                                 trimaps)
-                            elif loss_name in [
-                                    'LocalAlphaLoss',
-                                    'LocalLaplacianLoss',
-                            ]:
-                                temp_loss = criterion[loss_name](local_preds,
-                                                                 masks,
-                                                                 trimaps)
-                            elif loss_name in [
-                                    'FusionAlphaLoss',
-                                    'FusionLaplacianLoss',
-                            ]:
-                                temp_loss = criterion[loss_name](fused_preds,
-                                                                 masks)
-                            elif loss_name in [
-                                    'CompositionLoss',
-                            ]:
-                                temp_loss = criterion[loss_name](images, masks,
-                                                                 fg_maps,
-                                                                 bg_maps,
-                                                                 fused_preds)
-
-                            temp_loss = config.loss_ratio[loss_name] * temp_loss
-                            loss_value[loss_name] = temp_loss
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        train_step.check_inputs([images, masks])
+
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 outputs = model(images)
                 global_preds, local_preds, fused_preds = outputs
 
@@ -401,174 +324,42 @@ def train_human_matting(train_loader, model, criterion, optimizer, scheduler,
 
                     temp_loss = config.loss_ratio[loss_name] * temp_loss
                     loss_value[loss_name] = temp_loss
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    outputs = model(images)
-                    global_preds, local_preds, fused_preds = outputs
-
-                    loss_value = {}
-                    for loss_name in criterion.keys():
-                        if loss_name in [
-                                'GlobalTrimapCELoss',
-                                'GloabelTrimapIouLoss',
-                        ]:
-                            temp_loss = criterion[loss_name](global_preds,
-                                                             trimaps)
-                        elif loss_name in [
-                                'LocalAlphaLoss',
-                                'LocalLaplacianLoss',
-                        ]:
-                            temp_loss = criterion[loss_name](local_preds,
-                                                             masks, trimaps)
-                        elif loss_name in [
-                                'FusionAlphaLoss',
-                                'FusionLaplacianLoss',
-                        ]:
-                            temp_loss = criterion[loss_name](fused_preds,
-                                                             masks)
-                        elif loss_name in [
-                                'CompositionLoss',
-                        ]:
-                            temp_loss = criterion[loss_name](images, masks,
-                                                             fg_maps, bg_maps,
-                                                             fused_preds)
-
-                        temp_loss = config.loss_ratio[loss_name] * temp_loss
-                        loss_value[loss_name] = temp_loss
-
-        loss = 0.
-        for key, value in loss_value.items():
-            loss += value
-
-        inf_nan_flag = False
-        for key, value in loss_value.items():
-            if torch.any(torch.isinf(value)) or torch.any(torch.isnan(value)):
-                inf_nan_flag = True
-
-        if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-            inf_nan_flag = True
-
-        if loss == 0. or inf_nan_flag:
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
-
-        loss = loss / config.accumulation_steps
-        for key, value in loss_value.items():
-            loss_value[key] = value / config.accumulation_steps
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
+
+            loss = sum(loss_value.values())
+
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
+
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
+
+            if config.use_ema_model and train_step.optimizer_stepped():
                 config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            for key, value in loss_value.items():
-                [value] = all_reduce_operation_in_group_for_variables(
-                    variables=[value],
-                    operator=torch.distributed.ReduceOp.SUM,
-                    group=config.group)
-                loss_value[key] = value / float(config.gpus_num)
-
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
-
-        if iter_index % config.accumulation_steps == 0:
+            train_step.update_loss(loss,
+                                   loss_value,
+                                   sample_num=images.size(0))
+
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss*config.accumulation_steps:.4f}, '
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}, '
             for key, value in loss_value.items():
-                log_info += f'{key}: {value*config.accumulation_steps:.4f}, '
+                log_info += f'{key}: {value:.4f}, '
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
@@ -10,9 +10,8 @@ import torch.nn.functional as F
 
 from torch.cuda.amp import autocast
 
-from simpleAICV.classification.common import AverageMeter
 from tools.interactive_segmentation_scripts import get_and_combine_additional_prompt_points_and_masks_with_gt, get_amp_type
-from tools.scripts import all_reduce_operation_in_group_for_variables
+from tools.train_step import TrainStepEngine
 
 
 class MattingEvalMeter:
@@ -313,8 +312,6 @@ def validate_matting(test_loader, model, config):
 
 def train_sam_matting(train_loader, model, criterion, optimizer, scheduler,
                       epoch, logger, config):
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
@@ -335,7 +332,12 @@ def train_sam_matting(train_loader, model, criterion, optimizer, scheduler,
         total_rank = 0
 
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
+
+    train_step = TrainStepEngine(model,
+                                 optimizer,
+                                 config,
+                                 accumulation_steps=1)
+    iter_index = train_step.start_iter_index
 
     for _, data in enumerate(train_loader):
         batch_images, batch_masks = data['image'], data['mask']
@@ -416,13 +418,7 @@ def train_sam_matting(train_loader, model, criterion, optimizer, scheduler,
                 batch_prompts['prompt_mask'] = None
                 current_decoder_point_iters = 1
 
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(batch_images)):
-            skip_batch_flag = True
-
-        if torch.any(torch.isnan(batch_images)):
-            skip_batch_flag = True
+        train_step.check_inputs([batch_images])
 
         for iter_i in range(current_decoder_point_iters):
             if iter_i > 0:
@@ -431,22 +427,7 @@ def train_sam_matting(train_loader, model, criterion, optimizer, scheduler,
                         batch_prompts['prompt_point'], batch_masks,
                         batch_masks_fused_preds, config)
 
-            if config.use_amp:
-                with autocast(dtype=amp_type):
-                    batch_masks_global_preds, batch_masks_local_preds, batch_masks_fused_preds, batch_iou_preds = model(
-                        batch_images, batch_prompts, config.mask_out_idxs)
-                    loss_value = criterion(batch_images, [
-                        batch_masks_global_preds,
-                        batch_masks_local_preds,
-                        batch_masks_fused_preds,
-                        batch_iou_preds,
-                    ], [
-                        batch_masks,
-                        trimaps,
-                        fg_maps,
-                        bg_maps,
-                    ])
-            else:
+            with autocast(enabled=config.use_amp, dtype=amp_type):
                 batch_masks_global_preds, batch_masks_local_preds, batch_masks_fused_preds, batch_iou_preds = model(
                     batch_images, batch_prompts, config.mask_out_idxs)
                 loss_value = criterion(batch_images, [
@@ -463,113 +444,37 @@ def train_sam_matting(train_loader, model, criterion, optimizer, scheduler,
 
             loss = sum(loss_value.values())
 
-            inf_nan_flag = False
-            for key, value in loss_value.items():
-                if torch.any(torch.isinf(value)) or torch.any(
-                        torch.isnan(value)):
-                    inf_nan_flag = True
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
 
-            if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-                inf_nan_flag = True
+            # inputs flag is checked once per batch,keep it for all decoder point iters
+            train_step.step(
+                clear_input_flag=iter_i == current_decoder_point_iters - 1)
 
-            if loss == 0. or inf_nan_flag:
-                print(
-                    f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-                skip_batch_flag = True
-
-            if config.use_amp:
-                config.scaler.scale(loss).backward()
-            else:
-                loss.backward()
-
-            if hasattr(config,
-                       'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-                grad_inf_nan_flag = False
-                for _, param in model.named_parameters():
-                    per_weight_grad = param.grad
-                    if per_weight_grad is not None:
-                        if torch.any(
-                                torch.isnan(per_weight_grad)) or torch.any(
-                                    torch.isnan(per_weight_grad)):
-                            grad_inf_nan_flag = True
-                if grad_inf_nan_flag:
-                    print(f'GPU id:{local_rank},nan grad or inf grad!')
-                    skip_batch_flag = True
-
-            [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-                variables=[skip_batch_flag],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-
-            if skip_batch_flag:
-                log_info = f'skip this batch!'
-                logger.info(
-                    log_info) if local_rank == 0 and total_rank == 0 else None
-                optimizer.zero_grad()
-                continue
-
-            if config.use_amp:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-            else:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        for key, value in loss_value.items():
-            [value] = all_reduce_operation_in_group_for_variables(
-                variables=[value],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss_value[key] = value / float(config.gpus_num)
-
-        [loss] = all_reduce_operation_in_group_for_variables(
-            variables=[loss],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-        loss = loss / float(config.gpus_num)
-        losses.update(loss, batch_images.size(0))
+        train_step.update_loss(loss,
+                               loss_value,
+                               sample_num=batch_images.size(0))
 
         scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+        train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(iter_index), int(
             iters)
         if iter_index % int(config.print_interval) == 0:
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
             log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>6d}, {accumulation_iters:0>6d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}, '
             for key, value in loss_value.items():
                 log_info += f'{key}: {value:.4f}, '
             logger.info(
                 log_info) if local_rank == 0 and total_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(
+                    log_info) if local_rank == 0 and total_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
@@ -1,6 +1,7 @@
 import collections
 import numpy as np
 import time
+from contextlib import nullcontext
 from tqdm import tqdm
 
 import torch
@@ -8,8 +9,7 @@ import torch.nn.functional as F
 
 from torch.cuda.amp import autocast
 
-from simpleAICV.classification.common import AverageMeter
-from tools.scripts import all_reduce_operation_in_group_for_variables
+from tools.train_step import TrainStepEngine
 
 
 def get_amp_type(model):
@@ -152,6 +152,12 @@ def validate_segmentation(test_loader, model, config):
 
             torch.cuda.synchronize()
 
+            # image encoder only run once,loop mask iters only rerun prompt encoder and mask decoder
+            batch_image_embeddings = model(batch_images,
+                                           batch_prompts,
+                                           config.mask_out_idxs,
+                                           only_image_encoder=True)
+
             for iter_i in range(loop_mask_iters):
                 if iter_i > 0:
                     max_iou_idx = batch_iou_outputs.argmax(dim=1)
@@ -167,7 +173,10 @@ def validate_segmentation(test_loader, model, config):
                     batch_prompts['prompt_mask'] = iter_prompt_mask
 
                 batch_mask_outputs, batch_iou_outputs = model(
-                    batch_images, batch_prompts, config.mask_out_idxs)
+                    batch_images,
+                    batch_prompts,
+                    config.mask_out_idxs,
+                    batch_image_embeddings=batch_image_embeddings)
 
             batch_mask_outputs = (
                 batch_mask_outputs
@@ -197,8 +206,6 @@ def train_distill_sam_encoder(train_loader, model, criterion, optimizer,
     '''
     train distill sam model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
     if config.freeze_teacher:
@@ -213,170 +220,58 @@ def train_distill_sam_encoder(train_loader, model, criterion, optimizer,
         total_rank = 0
 
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         batch_images = data['image']
         batch_images = batch_images.cuda()
 
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(batch_images)):
-            skip_batch_flag = True
+        train_step.check_inputs([batch_images])
 
-        if torch.any(torch.isnan(batch_images)):
-            skip_batch_flag = True
-
-        if config.use_amp:
-            with autocast(dtype=amp_type):
-                if iter_index % config.accumulation_steps == 0:
-                    tea_outputs, stu_outputs = model(batch_images)
-                    loss_value = criterion(tea_outputs, stu_outputs)
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        tea_outputs, stu_outputs = model(batch_images)
-                        loss_value = criterion(tea_outputs, stu_outputs)
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp, dtype=amp_type):
                 tea_outputs, stu_outputs = model(batch_images)
                 loss_value = criterion(tea_outputs, stu_outputs)
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    tea_outputs, stu_outputs = model(batch_images)
-                    loss_value = criterion(tea_outputs, stu_outputs)
 
-        loss = sum(loss_value.values())
-
-        inf_nan_flag = False
-        for key, value in loss_value.items():
-            if torch.any(torch.isinf(value)) or torch.any(torch.isnan(value)):
-                inf_nan_flag = True
-
-        if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-            inf_nan_flag = True
-
-        if loss == 0. or inf_nan_flag:
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
-
-        loss = loss / config.accumulation_steps
-        for key, value in loss_value.items():
-            loss_value[key] = value / config.accumulation_steps
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(
-                log_info) if local_rank == 0 and total_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
+            loss = sum(loss_value.values())
 
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
 
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
 
-                optimizer.step()
-                optimizer.zero_grad()
+            train_step.update_loss(loss,
+                                   loss_value,
+                                   sample_num=batch_images.size(0))
 
-        if iter_index % config.accumulation_steps == 0:
-            for key, value in loss_value.items():
-                [value] = all_reduce_operation_in_group_for_variables(
-                    variables=[value],
-                    operator=torch.distributed.ReduceOp.SUM,
-                    group=config.group)
-                loss_value[key] = value / float(config.gpus_num)
-
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, batch_images.size(0))
-
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss*config.accumulation_steps:.4f}, '
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}, '
             for key, value in loss_value.items():
-                log_info += f'{key}: {value*config.accumulation_steps:.4f}, '
+                log_info += f'{key}: {value:.4f}, '
             logger.info(
                 log_info) if local_rank == 0 and total_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(
+                    log_info) if local_rank == 0 and total_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
 
@@ -572,8 +467,6 @@ def train_distill_sam_model(train_loader, model, criterion, optimizer,
     '''
     train distill sam model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
     if config.freeze_teacher:
@@ -595,7 +488,12 @@ def train_distill_sam_model(train_loader, model, criterion, optimizer,
         total_rank = 0
 
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
+
+    train_step = TrainStepEngine(model,
+                                 optimizer,
+                                 config,
+                                 accumulation_steps=1)
+    iter_index = train_step.start_iter_index
 
     for _, data in enumerate(train_loader):
         batch_images, batch_masks = data['image'], data['mask']
@@ -674,13 +572,21 @@ def train_distill_sam_model(train_loader, model, criterion, optimizer,
         assert config.sigmoid_out is False
         assert config.binary_mask_out is False
 
-        skip_batch_flag = False
+        train_step.check_inputs([batch_images])
 
-        if torch.any(torch.isinf(batch_images)):
-            skip_batch_flag = True
+        encode_image_once = hasattr(
+            config, 'encode_image_once') and config.encode_image_once
 
-        if torch.any(torch.isnan(batch_images)):
-            skip_batch_flag = True
+        # teacher/student image encoder only run once per batch,all decoder point iters reuse the image embeddings,
+        # grads of all iters are accumulated and optimizer only step once per batch
+        batch_image_embeddings = None
+        if encode_image_once:
+            with model.no_sync():
+                with autocast(enabled=config.use_amp, dtype=amp_type):
+                    batch_image_embeddings = model(batch_images,
+                                                   batch_prompts,
+                                                   config.mask_out_idxs,
+                                                   only_image_encoder=True)
 
         for iter_i in range(current_decoder_point_iters):
             if iter_i > 0:
@@ -689,139 +595,72 @@ def train_distill_sam_model(train_loader, model, criterion, optimizer,
                         batch_prompts['prompt_point'], tea_outputs,
                         stu_outputs, config)
 
-            if config.use_amp:
-                with autocast(dtype=amp_type):
-                    tea_outputs, stu_outputs = model(batch_images,
-                                                     batch_prompts,
-                                                     config.mask_out_idxs)
+            # not reduce gradient before last decoder point iter
+            is_last_iter = iter_i == current_decoder_point_iters - 1
+            sync_context = model.no_sync() if (
+                encode_image_once and not is_last_iter) else nullcontext()
+
+            with sync_context:
+                with autocast(enabled=config.use_amp, dtype=amp_type):
+                    tea_outputs, stu_outputs = model(
+                        batch_images,
+                        batch_prompts,
+                        config.mask_out_idxs,
+                        batch_image_embeddings=batch_image_embeddings)
                     loss_value = criterion(tea_outputs, stu_outputs,
                                            batch_masks)
-            else:
-                tea_outputs, stu_outputs = model(batch_images, batch_prompts,
-                                                 config.mask_out_idxs)
-                loss_value = criterion(tea_outputs, stu_outputs, batch_masks)
 
-            assert tea_outputs[0].shape[1] == len(config.mask_out_idxs)
-            assert stu_outputs[0].shape[1] == len(config.mask_out_idxs)
+                assert tea_outputs[0].shape[1] == len(config.mask_out_idxs)
+                assert stu_outputs[0].shape[1] == len(config.mask_out_idxs)
 
-            loss = sum(loss_value.values())
+                loss = sum(loss_value.values())
 
-            inf_nan_flag = False
-            for key, value in loss_value.items():
-                if torch.any(torch.isinf(value)) or torch.any(
-                        torch.isnan(value)):
-                    inf_nan_flag = True
+                train_step.check_loss(loss, loss_value)
 
-            if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-                inf_nan_flag = True
-
-            if loss == 0. or inf_nan_flag:
-                print(
-                    f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-                skip_batch_flag = True
+                if encode_image_once:
+                    # keep image encoder graph for next decoder point iters
+                    train_step.backward(loss / current_decoder_point_iters,
+                                        retain_graph=not is_last_iter)
+                else:
+                    train_step.backward(loss)
 
-            if config.use_amp:
-                config.scaler.scale(loss).backward()
-            else:
-                loss.backward()
-
-            if hasattr(config,
-                       'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-                grad_inf_nan_flag = False
-                for _, param in model.named_parameters():
-                    per_weight_grad = param.grad
-                    if per_weight_grad is not None:
-                        if torch.any(
-                                torch.isnan(per_weight_grad)) or torch.any(
-                                    torch.isnan(per_weight_grad)):
-                            grad_inf_nan_flag = True
-                if grad_inf_nan_flag:
-                    print(f'GPU id:{local_rank},nan grad or inf grad!')
-                    skip_batch_flag = True
-
-            [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-                variables=[skip_batch_flag],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-
-            if skip_batch_flag:
-                log_info = f'skip this batch!'
-                logger.info(
-                    log_info) if local_rank == 0 and total_rank == 0 else None
-                optimizer.zero_grad()
+            if encode_image_once and not is_last_iter:
                 continue
 
-            if config.use_amp:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
+            # inputs flag is checked once per batch,keep it for all decoder point iters
+            train_step.step(clear_input_flag=is_last_iter)
 
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-            else:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        for key, value in loss_value.items():
-            [value] = all_reduce_operation_in_group_for_variables(
-                variables=[value],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss_value[key] = value / float(config.gpus_num)
-
-        [loss] = all_reduce_operation_in_group_for_variables(
-            variables=[loss],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-        loss = loss / float(config.gpus_num)
-        losses.update(loss, batch_images.size(0))
+        train_step.update_loss(loss,
+                               loss_value,
+                               sample_num=batch_images.size(0))
 
         scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+        train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(iter_index), int(
             iters)
         if iter_index % int(config.print_interval) == 0:
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
             log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>6d}, {accumulation_iters:0>6d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}, '
             for key, value in loss_value.items():
                 log_info += f'{key}: {value:.4f}, '
             logger.info(
                 log_info) if local_rank == 0 and total_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(
+                    log_info) if local_rank == 0 and total_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
 
 
 def train_sam_segmentation(train_loader, model, criterion, optimizer,
                            scheduler, epoch, logger, config):
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
@@ -841,7 +680,12 @@ def train_sam_segmentation(train_loader, model, criterion, optimizer,
         total_rank = 0
 
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
+
+    train_step = TrainStepEngine(model,
+                                 optimizer,
+                                 config,
+                                 accumulation_steps=1)
+    iter_index = train_step.start_iter_index
 
     for _, data in enumerate(train_loader):
         batch_images, batch_masks = data['image'], data['mask']
@@ -921,13 +765,21 @@ def train_sam_segmentation(train_loader, model, criterion, optimizer,
         assert config.sigmoid_out is False
         assert config.binary_mask_out is False
 
-        skip_batch_flag = False
+        train_step.check_inputs([batch_images])
 
-        if torch.any(torch.isinf(batch_images)):
-            skip_batch_flag = True
+        encode_image_once = hasattr(
+            config, 'encode_image_once') and config.encode_image_once
 
-        if torch.any(torch.isnan(batch_images)):
-            skip_batch_flag = True
+        # image encoder only run once per batch,all decoder point iters reuse the image embeddings,
+        # grads of all iters are accumulated and optimizer only step once per batch
+        batch_image_embeddings = None
+        if encode_image_once:
+            with model.no_sync():
+                with autocast(enabled=config.use_amp, dtype=amp_type):
+                    batch_image_embeddings = model(batch_images,
+                                                   batch_prompts,
+                                                   config.mask_out_idxs,
+                                                   only_image_encoder=True)
 
         for iter_i in range(current_decoder_point_iters):
             if iter_i > 0:
@@ -936,129 +788,65 @@ def train_sam_segmentation(train_loader, model, criterion, optimizer,
                         batch_prompts['prompt_point'], batch_masks,
                         batch_mask_outputs, config)
 
-            if config.use_amp:
-                with autocast(dtype=amp_type):
+            # not reduce gradient before last decoder point iter
+            is_last_iter = iter_i == current_decoder_point_iters - 1
+            sync_context = model.no_sync() if (
+                encode_image_once and not is_last_iter) else nullcontext()
+
+            with sync_context:
+                with autocast(enabled=config.use_amp, dtype=amp_type):
                     batch_mask_outputs, batch_iou_outputs = model(
-                        batch_images, batch_prompts, config.mask_out_idxs)
+                        batch_images,
+                        batch_prompts,
+                        config.mask_out_idxs,
+                        batch_image_embeddings=batch_image_embeddings)
                     loss_value = criterion(
                         [batch_mask_outputs, batch_iou_outputs], batch_masks)
-            else:
-                batch_mask_outputs, batch_iou_outputs = model(
-                    batch_images, batch_prompts, config.mask_out_idxs)
-                loss_value = criterion([batch_mask_outputs, batch_iou_outputs],
-                                       batch_masks)
-
-            assert batch_mask_outputs.shape[1] == len(config.mask_out_idxs)
 
-            loss = sum(loss_value.values())
+                assert batch_mask_outputs.shape[1] == len(
+                    config.mask_out_idxs)
 
-            inf_nan_flag = False
-            for key, value in loss_value.items():
-                if torch.any(torch.isinf(value)) or torch.any(
-                        torch.isnan(value)):
-                    inf_nan_flag = True
+                loss = sum(loss_value.values())
 
-            if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-                inf_nan_flag = True
+                train_step.check_loss(loss, loss_value)
 
-            if loss == 0. or inf_nan_flag:
-                print(
-                    f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-                skip_batch_flag = True
+                if encode_image_once:
+                    # keep image encoder graph for next decoder point iters
+                    train_step.backward(loss / current_decoder_point_iters,
+                                        retain_graph=not is_last_iter)
+                else:
+                    train_step.backward(loss)
 
-            if config.use_amp:
-                config.scaler.scale(loss).backward()
-            else:
-                loss.backward()
-
-            if hasattr(config,
-                       'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-                grad_inf_nan_flag = False
-                for _, param in model.named_parameters():
-                    per_weight_grad = param.grad
-                    if per_weight_grad is not None:
-                        if torch.any(
-                                torch.isnan(per_weight_grad)) or torch.any(
-                                    torch.isnan(per_weight_grad)):
-                            grad_inf_nan_flag = True
-                if grad_inf_nan_flag:
-                    print(f'GPU id:{local_rank},nan grad or inf grad!')
-                    skip_batch_flag = True
-
-            [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-                variables=[skip_batch_flag],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-
-            if skip_batch_flag:
-                log_info = f'skip this batch!'
-                logger.info(
-                    log_info) if local_rank == 0 and total_rank == 0 else None
-                optimizer.zero_grad()
+            if encode_image_once and not is_last_iter:
                 continue
 
-            if config.use_amp:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
+            # inputs flag is checked once per batch,keep it for all decoder point iters
+            train_step.step(clear_input_flag=is_last_iter)
 
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-            else:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        for key, value in loss_value.items():
-            [value] = all_reduce_operation_in_group_for_variables(
-                variables=[value],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss_value[key] = value / float(config.gpus_num)
-
-        [loss] = all_reduce_operation_in_group_for_variables(
-            variables=[loss],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-        loss = loss / float(config.gpus_num)
-        losses.update(loss, batch_images.size(0))
+        train_step.update_loss(loss,
+                               loss_value,
+                               sample_num=batch_images.size(0))
 
         scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+        train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(iter_index), int(
             iters)
         if iter_index % int(config.print_interval) == 0:
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
             log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>6d}, {accumulation_iters:0>6d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}, '
             for key, value in loss_value.items():
                 log_info += f'{key}: {value:.4f}, '
             logger.info(
                 log_info) if local_rank == 0 and total_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(
+                    log_info) if local_rank == 0 and total_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
@@ -5,6 +5,8 @@ CIFAR10_path = '/root/autodl-tmp/CIFAR10'
 CIFAR100_path = '/root/autodl-tmp/CIFAR100'
 ILSVRC2012_path = '/root/autodl-tmp/ILSVRC2012'
 ImageNet21K_path = '/root/autodl-tmp/ImageNet21K'
+ILSVRC2012_packed_shards_path = '/root/autodl-tmp/ILSVRC2012_packed_shards'
+ImageNet21K_packed_shards_path = '/root/autodl-tmp/ImageNet21K_packed_shards'
 
 # detection
 COCO2017_path = '/root/autodl-tmp/COCO2017'
@@ -0,0 +1,395 @@
+import os
+import sys
+import warnings
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+warnings.filterwarnings('ignore')
+
+import argparse
+import functools
+import json
+import platform
+import random
+import time
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader
+
+from tools.utils import set_seed, worker_seed_init_fn
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='PyTorch Data Pipeline Profiling')
+    parser.add_argument('--work-dir',
+                        type=str,
+                        help='path for get training config')
+    parser.add_argument('--config-name',
+                        type=str,
+                        default='train_config',
+                        help='config module name in work dir')
+    parser.add_argument('--set-name',
+                        type=str,
+                        default='train',
+                        choices=['train', 'test'],
+                        help='profile config.train_dataset or config.test_dataset')
+    parser.add_argument('--gpus-num',
+                        type=int,
+                        default=1,
+                        help='per process batch size = config.batch_size // gpus_num')
+    parser.add_argument('--sample-num',
+                        type=int,
+                        default=64,
+                        help='sample num for per stage profiling')
+    parser.add_argument('--batch-num',
+                        type=int,
+                        default=20,
+                        help='batch num for every loader setting')
+    parser.add_argument('--warmup-batch-num',
+                        type=int,
+                        default=2,
+                        help='batch num not timed for every loader setting')
+    parser.add_argument('--num-workers-list',
+                        type=int,
+                        nargs='+',
+                        default=[0, 2, 4, 8],
+                        help='num_workers of loader sweep')
+    parser.add_argument('--prefetch-factor-list',
+                        type=int,
+                        nargs='+',
+                        default=[2, 4],
+                        help='prefetch_factor of loader sweep,only num_workers>0')
+    parser.add_argument('--output',
+                        type=str,
+                        default='',
+                        help='json report path,print report if not set')
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default='',
+        help='baseline json report,exit with code 1 if slower than baseline')
+    parser.add_argument('--max-slowdown',
+                        type=float,
+                        default=1.2,
+                        help='max allowed slowdown ratio compared with baseline')
+
+    return parser.parse_args()
+
+
+def compute_time_stats(times):
+    '''
+    times:list of seconds,return ms stats
+    '''
+    if len(times) == 0:
+        return None
+
+    times = np.array(times, dtype=np.float64) * 1000.
+
+    return {
+        'num': int(len(times)),
+        'mean_ms': float(np.mean(times)),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p90_ms': float(np.percentile(times, 90)),
+        'max_ms': float(np.max(times)),
+        'total_ms': float(np.sum(times)),
+    }
+
+
+class TimedTransform:
+    '''
+    wrap one transform in transforms.Compose,record per call time
+    '''
+
+    def __init__(self, transform, name, records):
+        self.transform = transform
+        self.name = name
+        self.records = records
+
+    def __call__(self, sample):
+        start_time = time.perf_counter()
+        sample = self.transform(sample)
+        self.records[self.name].append(time.perf_counter() - start_time)
+
+        return sample
+
+
+def get_timed_method(method, name, records):
+
+    @functools.wraps(method)
+    def timed_method(*args, **kwargs):
+        start_time = time.perf_counter()
+        result = method(*args, **kwargs)
+        records[name].append(time.perf_counter() - start_time)
+
+        return result
+
+    return timed_method
+
+
+def instrument_dataset(dataset, records):
+    '''
+    wrap dataset load_* methods and every transform of dataset.transform.transforms,
+    return restore function
+    load_* times are inclusive,a load_* function called in another load_* function is counted in both.
+    '''
+    patched_method_names = []
+    for name in dir(type(dataset)):
+        if not name.startswith('load_'):
+            continue
+        if not callable(getattr(type(dataset), name)):
+            continue
+        records[name] = []
+        # instance attribute override class method,__getitem__ calls self.load_* get timed method
+        setattr(dataset, name,
+                get_timed_method(getattr(dataset, name), name, records))
+        patched_method_names.append(name)
+
+    transform = dataset.transform if hasattr(dataset, 'transform') else None
+    origin_transforms = None
+    if transform is not None and hasattr(transform, 'transforms') and isinstance(
+            transform.transforms, list):
+        origin_transforms = transform.transforms
+        timed_transforms = []
+        for idx, per_transform in enumerate(origin_transforms):
+            name = f'transform.{idx}.{per_transform.__class__.__name__}'
+            records[name] = []
+            timed_transforms.append(
+                TimedTransform(per_transform, name, records))
+        transform.transforms = timed_transforms
+    elif transform is not None:
+        name = f'transform.{transform.__class__.__name__}'
+        records[name] = []
+        dataset.transform = TimedTransform(transform, name, records)
+
+    def restore():
+        for name in patched_method_names:
+            delattr(dataset, name)
+        if origin_transforms is not None:
+            transform.transforms = origin_transforms
+        elif transform is not None:
+            dataset.transform = transform
+
+    return restore
+
+
+def profile_stages(dataset, collater, batch_size, sample_num, seed):
+    '''
+    profile __getitem__,load_*,every transform and collater in main process
+    '''
+    records = {'getitem': [], 'collater_per_batch': []}
+    restore = instrument_dataset(dataset, records)
+
+    rng = random.Random(seed)
+    sample_indexes = [
+        rng.randint(0, len(dataset) - 1) for _ in range(sample_num)
+    ]
+
+    try:
+        samples = []
+        for idx in sample_indexes:
+            start_time = time.perf_counter()
+            samples.append(dataset[idx])
+            records['getitem'].append(time.perf_counter() - start_time)
+
+        for i in range(0, len(samples) - batch_size + 1, batch_size):
+            start_time = time.perf_counter()
+            collater(samples[i:i + batch_size])
+            records['collater_per_batch'].append(time.perf_counter() -
+                                                 start_time)
+    finally:
+        restore()
+
+    stage_profile = {}
+    for name, times in records.items():
+        stage_profile[name] = compute_time_stats(times)
+    if len(records['collater_per_batch']) > 0:
+        stage_profile['collater_per_sample'] = compute_time_stats([
+            per_time / batch_size for per_time in records['collater_per_batch']
+        ])
+
+    # getitem time not in load_* and transforms,e.g. annotation parsing and sample dict building
+    # load_* times are inclusive,other time may be underestimated when load_* calls nest
+    stage_sum_time = 0.
+    for name, times in records.items():
+        if name.startswith('load_') or name.startswith('transform.'):
+            stage_sum_time += float(np.sum(times))
+    stage_profile['getitem_other_mean_ms'] = float(
+        max(np.sum(records['getitem']) - stage_sum_time, 0.) * 1000. /
+        max(len(records['getitem']), 1))
+
+    return stage_profile
+
+
+def benchmark_loader(dataset, collater, batch_size, num_workers, pin_memory,
+                     prefetch_factor, batch_num, warmup_batch_num, seed):
+    loader_kwargs = {
+        'batch_size': batch_size,
+        'shuffle': True,
+        'pin_memory': pin_memory,
+        'drop_last': True,
+        'num_workers': num_workers,
+        'collate_fn': collater,
+        'generator': torch.Generator().manual_seed(seed),
+    }
+    if num_workers > 0:
+        loader_kwargs['prefetch_factor'] = prefetch_factor
+        loader_kwargs['worker_init_fn'] = functools.partial(
+            worker_seed_init_fn,
+            num_workers=num_workers,
+            local_rank=0,
+            seed=seed)
+    loader = DataLoader(dataset, **loader_kwargs)
+
+    batch_times = []
+    start_time = time.perf_counter()
+    first_batch_time = None
+    last_time = start_time
+    timed_sample_num = 0
+    for batch_idx, data in enumerate(loader):
+        current_time = time.perf_counter()
+        if first_batch_time is None:
+            first_batch_time = current_time - start_time
+        if batch_idx >= warmup_batch_num:
+            batch_times.append(current_time - last_time)
+            timed_sample_num += batch_size
+        last_time = current_time
+        if batch_idx + 1 >= warmup_batch_num + batch_num:
+            break
+    del loader
+
+    total_time = float(np.sum(batch_times))
+
+    return {
+        'num_workers': num_workers,
+        'pin_memory': pin_memory,
+        'prefetch_factor': prefetch_factor if num_workers > 0 else None,
+        'first_batch_s': first_batch_time,
+        'batch_time': compute_time_stats(batch_times),
+        'samples_per_second':
+        timed_sample_num / total_time if total_time > 0 else None,
+    }
+
+
+def compare_with_baseline(report, baseline, max_slowdown):
+    '''
+    compare best loader throughput and per stage mean time with baseline report
+    '''
+    regressions = []
+
+    def get_best_throughput(per_report):
+        throughputs = [
+            per_result['samples_per_second']
+            for per_result in per_report['loader_sweep']
+            if per_result['samples_per_second'] is not None
+        ]
+
+        return max(throughputs) if len(throughputs) > 0 else None
+
+    best_throughput = get_best_throughput(report)
+    baseline_best_throughput = get_best_throughput(baseline)
+    if best_throughput is not None and baseline_best_throughput is not None:
+        if best_throughput * max_slowdown < baseline_best_throughput:
+            regressions.append({
+                'name': 'best_samples_per_second',
+                'value': best_throughput,
+                'baseline': baseline_best_throughput,
+            })
+
+    for name, stats in report['stage_profile'].items():
+        if not isinstance(stats, dict):
+            continue
+        if name not in baseline['stage_profile'].keys() or not isinstance(
+                baseline['stage_profile'][name], dict):
+            continue
+        baseline_mean = baseline['stage_profile'][name]['mean_ms']
+        if stats['mean_ms'] > baseline_mean * max_slowdown:
+            regressions.append({
+                'name': name,
+                'value': stats['mean_ms'],
+                'baseline': baseline_mean,
+            })
+
+    return regressions
+
+
+def main():
+    args = parse_args()
+    sys.path.append(args.work_dir)
+    config = __import__(args.config_name).config
+
+    set_seed(config.seed)
+
+    if args.set_name == 'train':
+        dataset, collater = config.train_dataset, config.train_collater
+    else:
+        dataset, collater = config.test_dataset, config.test_collater
+    assert not isinstance(
+        dataset, torch.utils.data.IterableDataset
+    ), 'IterableDataset not support per sample profiling!'
+
+    assert config.batch_size % args.gpus_num == 0, 'config.batch_size is not divisible by gpus_num!'
+    batch_size = int(config.batch_size // args.gpus_num)
+
+    report = {
+        'work_dir': args.work_dir,
+        'config_name': args.config_name,
+        'set_name': args.set_name,
+        'dataset': dataset.__class__.__name__,
+        'dataset_size': len(dataset),
+        'collater': collater.__class__.__name__,
+        'batch_size': batch_size,
+        'torch_version': torch.__version__,
+        'python_version': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'cuda_available': torch.cuda.is_available(),
+    }
+    # gpu side transforms(e.g. train_device_transform) are not profiled
+    report['stage_profile'] = profile_stages(dataset, collater, batch_size,
+                                             args.sample_num, config.seed)
+
+    # pin memory needs gpu,only sweep pin_memory=True with gpu
+    pin_memory_list = [False, True] if torch.cuda.is_available() else [False]
+    loader_settings = []
+    for num_workers in args.num_workers_list:
+        for pin_memory in pin_memory_list:
+            if num_workers == 0:
+                loader_settings.append((num_workers, pin_memory, None))
+            else:
+                for prefetch_factor in args.prefetch_factor_list:
+                    loader_settings.append(
+                        (num_workers, pin_memory, prefetch_factor))
+
+    report['loader_sweep'] = []
+    for num_workers, pin_memory, prefetch_factor in loader_settings:
+        per_result = benchmark_loader(dataset, collater, batch_size,
+                                      num_workers, pin_memory,
+                                      prefetch_factor, args.batch_num,
+                                      args.warmup_batch_num, config.seed)
+        report['loader_sweep'].append(per_result)
+        print(
+            f'num_workers: {num_workers}, pin_memory: {pin_memory}, prefetch_factor: {prefetch_factor}, samples_per_second: {per_result["samples_per_second"]}',
+            file=sys.stderr)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        report['regressions'] = compare_with_baseline(report, baseline,
+                                                      args.max_slowdown)
+        if len(report['regressions']) > 0:
+            exit_code = 1
+
+    report_str = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report_str)
+    else:
+        print(report_str)
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,9 +10,10 @@ import torch.nn.functional as F
 from torch.cuda.amp import autocast
 
 import pycocotools.mask as mask_util
-from pycocotools.cocoeval import COCOeval
 
 from simpleAICV.classification.common import AverageMeter, AccMeter
+from simpleAICV.detection.coco_evaluate import COCOIncrementalEvaluator
+from tools.train_step import TrainStepEngine
 
 
 def all_reduce_operation_in_group_for_variables(variables, operator, group):
@@ -32,7 +33,7 @@ def test_classification(test_loader, model, criterion, config):
     accs = AccMeter()
 
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        model = config.ema_model.ema_model
+        model = config.ema_model.get_eval_model()
 
     # switch to evaluate mode
     model.eval()
@@ -43,7 +44,13 @@ def test_classification(test_loader, model, criterion, config):
         for _, data in tqdm(enumerate(test_loader)):
             images, labels = data['image'], data['label']
             if model_on_cuda:
-                images, labels = images.cuda(), labels.cuda()
+                images, labels = images.cuda(non_blocking=True), labels.cuda(
+                    non_blocking=True)
+
+            # uint8 data path,normalize images on gpu
+            if hasattr(config, 'device_mean_std_normalize'
+                       ) and config.device_mean_std_normalize:
+                images = config.device_mean_std_normalize(images)
 
             torch.cuda.synchronize()
             data_time.update(time.time() - end)
@@ -110,159 +117,71 @@ def train_classification(train_loader, model, criterion, optimizer, scheduler,
     '''
     train classification model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images, labels = data['image'], data['label']
-        images, labels = images.cuda(), labels.cuda()
-
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(images)) or torch.any(torch.isinf(labels)):
-            skip_batch_flag = True
+        images, labels = images.cuda(non_blocking=True), labels.cuda(
+            non_blocking=True)
+
+        # uint8 data path,normalize images on gpu
+        if hasattr(config, 'device_mean_std_normalize'
+                   ) and config.device_mean_std_normalize:
+            images = config.device_mean_std_normalize(images)
+
+        # batched augment on gpu,labels may be mixed by BatchMixupCutmix
+        if hasattr(config, 'train_device_transform'
+                   ) and config.train_device_transform:
+            data['image'], data['label'] = images, labels
+            data = config.train_device_transform(data)
+            images, labels = data['image'], data['label']
 
-        if torch.any(torch.isnan(images)) or torch.any(torch.isnan(labels)):
-            skip_batch_flag = True
+        train_step.check_inputs([images, labels])
 
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    outputs = model(images)
-                    loss = criterion(outputs, labels)
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        outputs = model(images)
-                        loss = criterion(outputs, labels)
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 outputs = model(images)
                 loss = criterion(outputs, labels)
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    outputs = model(images)
-                    loss = criterion(outputs, labels)
 
-        if loss == 0. or torch.any(torch.isinf(loss)) or torch.any(
-                torch.isnan(loss)):
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
+            train_step.check_loss(loss)
+            train_step.backward(loss)
 
-        loss = loss / config.accumulation_steps
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
 
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
+            if config.use_ema_model and train_step.optimizer_stepped():
                 config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
+            train_step.update_loss(loss, sample_num=images.size(0))
 
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss*config.accumulation_steps:.4f}'
+            loss, _, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}'
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
 
@@ -285,8 +204,6 @@ def train_distill_classification(train_loader, model, criterion, optimizer,
     '''
     train distill classification model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
@@ -295,22 +212,19 @@ def train_distill_classification(train_loader, model, criterion, optimizer,
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config, use_amp=False)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images, labels = data['image'], data['label']
         images, labels = images.cuda(), labels.cuda()
 
-        skip_batch_flag = False
+        train_step.check_inputs([images, labels])
 
-        if torch.any(torch.isinf(images)) or torch.any(torch.isinf(labels)):
-            skip_batch_flag = True
-
-        if torch.any(torch.isnan(images)) or torch.any(torch.isnan(labels)):
-            skip_batch_flag = True
-
-        if iter_index % config.accumulation_steps == 0:
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
             tea_outputs, stu_outputs = model(images)
             loss_value = {}
             for loss_name in criterion.keys():
@@ -328,126 +242,40 @@ def train_distill_classification(train_loader, model, criterion, optimizer,
                         stu_outputs,
                         tea_outputs) * config.loss_ratio[loss_name]
                     loss_value[loss_name] = temp_loss
-        else:
-            # not reduce gradient while iter_index % config.accumulation_steps != 0
-            with model.no_sync():
-                tea_outputs, stu_outputs = model(images)
-                loss_value = {}
-                for loss_name in criterion.keys():
-                    if loss_name in ['CELoss', 'OneHotLabelCELoss']:
-                        if not config.freeze_teacher:
-                            temp_loss = criterion[loss_name](
-                                tea_outputs,
-                                labels) * config.loss_ratio[loss_name]
-                            loss_value['tea_' + loss_name] = temp_loss
 
-                        temp_loss = criterion[loss_name](
-                            stu_outputs, labels) * config.loss_ratio[loss_name]
-                        loss_value['stu_' + loss_name] = temp_loss
-                    else:
-                        temp_loss = criterion[loss_name](
-                            stu_outputs,
-                            tea_outputs) * config.loss_ratio[loss_name]
-                        loss_value[loss_name] = temp_loss
-
-        loss = sum(loss_value.values())
-
-        inf_nan_flag = False
-        for key, value in loss_value.items():
-            if torch.any(torch.isinf(value)) or torch.any(torch.isnan(value)):
-                inf_nan_flag = True
-
-        if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-            inf_nan_flag = True
-
-        if loss == 0. or inf_nan_flag:
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
-
-        loss = loss / config.accumulation_steps
-        for key, value in loss_value.items():
-            loss_value[key] = value / config.accumulation_steps
-
-        if iter_index % config.accumulation_steps == 0:
-            loss.backward()
-        else:
-            # not reduce gradient while iter_index % config.accumulation_steps != 0
-            with model.no_sync():
-                loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if iter_index % config.accumulation_steps == 0:
-            if (hasattr(config, 'clip_grad_value')
-                    and config.clip_grad_value > 0) or (hasattr(
-                        config, 'clip_max_norm') and config.clip_max_norm > 0):
-
-                if hasattr(config, 'clip_grad_value'):
-                    torch.nn.utils.clip_grad_value_(model.parameters(),
-                                                    config.clip_grad_value)
+            loss = sum(loss_value.values())
 
-                if hasattr(config, 'clip_max_norm'):
-                    torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                   config.clip_max_norm)
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
 
-            optimizer.step()
-            optimizer.zero_grad()
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
 
-        if iter_index % config.accumulation_steps == 0:
-            for key, value in loss_value.items():
-                [value] = all_reduce_operation_in_group_for_variables(
-                    variables=[value],
-                    operator=torch.distributed.ReduceOp.SUM,
-                    group=config.group)
-                loss_value[key] = value / float(config.gpus_num)
+            train_step.update_loss(loss,
+                                   loss_value,
+                                   sample_num=images.size(0))
 
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
-
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss*config.accumulation_steps:.4f}, '
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}, '
             for key, value in loss_value.items():
-                log_info += f'{key}: {value*config.accumulation_steps:.4f}, '
+                log_info += f'{key}: {value:.4f}, '
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
 
@@ -700,11 +528,17 @@ def evaluate_coco_detection(test_loader, model, criterion, decoder, config):
     losses = AverageMeter()
 
     test_dataset = config.test_dataset
-    ids = [idx for idx in range(len(test_dataset))]
+    # dataset indexes of every batch,right for distributed test loader
+    batch_ids = list(test_loader.batch_sampler)
     batch_size = int(config.batch_size // config.gpus_num)
 
+    coco_evaluator = COCOIncrementalEvaluator(
+        test_dataset.coco,
+        iou_type='bbox',
+        num_workers=config.eval_num_workers if hasattr(
+            config, 'eval_num_workers') else 0)
+
     with torch.no_grad():
-        results, image_ids = [], []
         model_on_cuda = next(model.parameters()).is_cuda
         end = time.time()
         for i, data in tqdm(enumerate(test_loader)):
@@ -719,7 +553,7 @@ def evaluate_coco_detection(test_loader, model, criterion, decoder, config):
                 if model_on_cuda:
                     masks = masks.cuda()
 
-            per_batch_ids = ids[i * batch_size:(i + 1) * batch_size]
+            per_batch_ids = batch_ids[i]
 
             torch.cuda.synchronize()
             data_time.update(time.time() - end, images.size(0))
@@ -757,33 +591,32 @@ def evaluate_coco_detection(test_loader, model, criterion, decoder, config):
                 # for coco_eval,we need [x_min,y_min,w,h] format pred boxes
                 per_image_boxes[:, 2:] -= per_image_boxes[:, :2]
 
-                for object_score, object_class, object_box in zip(
-                        per_image_scores, per_image_classes, per_image_boxes):
-                    object_score = float(object_score)
-                    object_class = int(object_class)
-                    object_box = object_box.tolist()
-                    if object_class == -1:
-                        break
-
-                    image_result = {
-                        'image_id':
-                        test_dataset.image_ids[index],
-                        'category_id':
-                        test_dataset.coco_label_to_cat_id[object_class],
-                        'score':
-                        object_score,
-                        'bbox':
-                        object_box,
-                    }
-                    results.append(image_result)
-
-                image_ids.append(test_dataset.image_ids[index])
+                # keep objects before first padded object(class -1)
+                invalid_idxs = np.nonzero(per_image_classes == -1)[0]
+                object_num = invalid_idxs[0] if len(invalid_idxs) > 0 else len(
+                    per_image_classes)
+
+                coco_evaluator.update(
+                    test_dataset.image_ids[index],
+                    scores=per_image_scores[0:object_num],
+                    category_ids=[
+                        test_dataset.coco_label_to_cat_id[int(object_class)]
+                        for object_class in per_image_classes[0:object_num]
+                    ],
+                    boxes=per_image_boxes[0:object_num])
 
                 print('{}/{}'.format(index, len(test_dataset)), end='\r')
 
             end = time.time()
 
         test_loss = losses.avg
+        if torch.distributed.is_available(
+        ) and torch.distributed.is_initialized():
+            [test_loss] = all_reduce_operation_in_group_for_variables(
+                variables=[test_loss],
+                operator=torch.distributed.ReduceOp.SUM,
+                group=None)
+            test_loss = test_loss / float(torch.distributed.get_world_size())
 
         variable_definitions = {
             0: 'IoU=0.50:0.95,area=all,maxDets=100,mAP',
@@ -811,21 +644,9 @@ def evaluate_coco_detection(test_loader, model, criterion, decoder, config):
         result_dict[
             'per_image_inference_time'] = f'{per_image_inference_time:.3f}ms'
 
-        if len(results) == 0:
-            for _, value in variable_definitions.items():
-                result_dict[value] = 0
-            return result_dict
-
-        # load results in COCO evaluation tool
-        coco_true = test_dataset.coco
-        coco_pred = coco_true.loadRes(results)
-
-        coco_eval = COCOeval(coco_true, coco_pred, 'bbox')
-        coco_eval.params.imgIds = image_ids
-        coco_eval.evaluate()
-        coco_eval.accumulate()
-        coco_eval.summarize()
-        eval_result = coco_eval.stats
+        # gather per image match results from all ranks
+        coco_evaluator.synchronize_between_processes()
+        eval_result = coco_evaluator.summarize()
 
         for i, var in enumerate(eval_result):
             result_dict[variable_definitions[i]] = var * 100
@@ -837,7 +658,7 @@ def test_detection(test_loader, model, criterion, decoder, config):
     assert config.eval_type in ['COCO', 'VOC']
 
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        model = config.ema_model.ema_model
+        model = config.ema_model.get_eval_model()
 
     func_dict = {
         'COCO': evaluate_coco_detection,
@@ -854,16 +675,16 @@ def train_detection(train_loader, model, criterion, optimizer, scheduler,
     '''
     train detection model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images, targets = data['image'], data['annots']
         images, targets = images.cuda(), targets.cuda()
@@ -875,177 +696,53 @@ def train_detection(train_loader, model, criterion, optimizer, scheduler,
             masks = data['mask']
             masks = masks.cuda()
 
-        skip_batch_flag = False
+        train_step.check_inputs([images, targets])
 
-        if torch.any(torch.isinf(images)) or torch.any(torch.isinf(targets)):
-            skip_batch_flag = True
-
-        if torch.any(torch.isnan(images)) or torch.any(torch.isnan(targets)):
-            skip_batch_flag = True
-
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    if 'detr' in config.network:
-                        outs_tuple = model(images, masks)
-                    else:
-                        outs_tuple = model(images)
-                    loss_value = criterion(outs_tuple, targets)
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        if 'detr' in config.network:
-                            outs_tuple = model(images, masks)
-                        else:
-                            outs_tuple = model(images)
-                        loss_value = criterion(outs_tuple, targets)
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 if 'detr' in config.network:
                     outs_tuple = model(images, masks)
                 else:
                     outs_tuple = model(images)
                 loss_value = criterion(outs_tuple, targets)
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    if 'detr' in config.network:
-                        outs_tuple = model(images, masks)
-                    else:
-                        outs_tuple = model(images)
-                    loss_value = criterion(outs_tuple, targets)
-
-        loss = sum(loss_value.values())
-
-        inf_nan_flag = False
-        for key, value in loss_value.items():
-            if torch.any(torch.isinf(value)) or torch.any(torch.isnan(value)):
-                inf_nan_flag = True
-
-        if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-            inf_nan_flag = True
-
-        if loss == 0. or inf_nan_flag:
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
-
-        loss = loss / config.accumulation_steps
-        for key, value in loss_value.items():
-            loss_value[key] = value / config.accumulation_steps
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
-                config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            for key, value in loss_value.items():
-                [value] = all_reduce_operation_in_group_for_variables(
-                    variables=[value],
-                    operator=torch.distributed.ReduceOp.SUM,
-                    group=config.group)
-                loss_value[key] = value / float(config.gpus_num)
+            loss = sum(loss_value.values())
 
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
+
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
+
+            if config.use_ema_model and train_step.optimizer_stepped():
+                config.ema_model.update(model)
+
+            train_step.update_loss(loss,
+                                   loss_value,
+                                   sample_num=images.size(0))
 
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, total_loss: {loss*config.accumulation_steps:.4f}, '
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, total_loss: {loss:.4f}, '
             for key, value in loss_value.items():
-                log_info += f'{key}: {value*config.accumulation_steps:.4f}, '
+                log_info += f'{key}: {value:.4f}, '
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
 
@@ -1056,7 +753,7 @@ def test_semantic_segmentation(test_loader, model, criterion, config):
     losses = AverageMeter()
 
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        model = config.ema_model.ema_model
+        model = config.ema_model.get_eval_model()
 
     # switch to evaluate mode
     model.eval()
@@ -1229,198 +926,68 @@ def train_semantic_segmentation(train_loader, model, criterion, optimizer,
     '''
     train semantic segmentation model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images, masks = data['image'], data['mask']
         images, masks = images.cuda(), masks.cuda()
 
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(images)) or torch.any(torch.isinf(masks)):
-            skip_batch_flag = True
+        train_step.check_inputs([images, masks])
 
-        if torch.any(torch.isnan(images)) or torch.any(torch.isnan(masks)):
-            skip_batch_flag = True
-
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    outputs = model(images)
-                    loss_value = {}
-                    for loss_name in criterion.keys():
-                        temp_loss = criterion[loss_name](outputs, masks)
-                        temp_loss = config.loss_ratio[loss_name] * temp_loss
-                        loss_value[loss_name] = temp_loss
-
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        outputs = model(images)
-                        loss_value = {}
-                        for loss_name in criterion.keys():
-                            temp_loss = criterion[loss_name](outputs, masks)
-                            temp_loss = config.loss_ratio[loss_name] * temp_loss
-                            loss_value[loss_name] = temp_loss
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 outputs = model(images)
                 loss_value = {}
                 for loss_name in criterion.keys():
                     temp_loss = criterion[loss_name](outputs, masks)
                     temp_loss = config.loss_ratio[loss_name] * temp_loss
                     loss_value[loss_name] = temp_loss
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    outputs = model(images)
-                    loss_value = {}
-                    for loss_name in criterion.keys():
-                        temp_loss = criterion[loss_name](outputs, masks)
-                        temp_loss = config.loss_ratio[loss_name] * temp_loss
-                        loss_value[loss_name] = temp_loss
-
-        loss = 0.
-        for key, value in loss_value.items():
-            loss += value
-
-        inf_nan_flag = False
-        for key, value in loss_value.items():
-            if torch.any(torch.isinf(value)) or torch.any(torch.isnan(value)):
-                inf_nan_flag = True
-
-        if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-            inf_nan_flag = True
-
-        if loss == 0. or inf_nan_flag:
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
-
-        loss = loss / config.accumulation_steps
-        for key, value in loss_value.items():
-            loss_value[key] = value / config.accumulation_steps
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
-                config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            for key, value in loss_value.items():
-                [value] = all_reduce_operation_in_group_for_variables(
-                    variables=[value],
-                    operator=torch.distributed.ReduceOp.SUM,
-                    group=config.group)
-                loss_value[key] = value / float(config.gpus_num)
+            loss = sum(loss_value.values())
 
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
+
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
+
+            if config.use_ema_model and train_step.optimizer_stepped():
+                config.ema_model.update(model)
+
+            train_step.update_loss(loss,
+                                   loss_value,
+                                   sample_num=images.size(0))
 
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss*config.accumulation_steps:.4f}, '
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}, '
             for key, value in loss_value.items():
-                log_info += f'{key}: {value*config.accumulation_steps:.4f}, '
+                log_info += f'{key}: {value:.4f}, '
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
 
@@ -1435,11 +1002,17 @@ def evaluate_coco_instance_segmentation(test_loader, model, criterion, decoder,
     losses = AverageMeter()
 
     test_dataset = config.test_dataset
-    ids = [idx for idx in range(len(test_dataset))]
+    # dataset indexes of every batch,right for distributed test loader
+    batch_ids = list(test_loader.batch_sampler)
     batch_size = int(config.batch_size // config.gpus_num)
 
+    coco_evaluator = COCOIncrementalEvaluator(
+        test_dataset.coco,
+        iou_type='segm',
+        num_workers=config.eval_num_workers if hasattr(
+            config, 'eval_num_workers') else 0)
+
     with torch.no_grad():
-        results, image_ids = [], []
         model_on_cuda = next(model.parameters()).is_cuda
         end = time.time()
         for i, data in tqdm(enumerate(test_loader)):
@@ -1453,7 +1026,7 @@ def evaluate_coco_instance_segmentation(test_loader, model, criterion, decoder,
             scaled_size = data['size']
             origin_size = data['origin_size']
 
-            per_batch_ids = ids[i * batch_size:(i + 1) * batch_size]
+            per_batch_ids = batch_ids[i]
 
             torch.cuda.synchronize()
             data_time.update(time.time() - end, images.size(0))
@@ -1474,28 +1047,33 @@ def evaluate_coco_instance_segmentation(test_loader, model, criterion, decoder,
             for per_image_masks, per_image_labels, per_image_scores, index in zip(
                     batch_masks, batch_labels, batch_scores, per_batch_ids):
 
-                for per_mask, per_label, per_score in zip(
-                        per_image_masks, per_image_labels, per_image_scores):
-                    rle = mask_util.encode(
-                        np.array(per_mask[:, :, np.newaxis],
-                                 order='F'))[0].copy()
-                    rle['counts'] = rle['counts'].decode()
-                    image_result = {
-                        'image_id': test_dataset.image_ids[index],
-                        'category_id':
-                        test_dataset.coco_label_to_cat_id[per_label],
-                        'score': float(per_score),
-                        'segmentation': rle,
-                    }
-                    results.append(image_result)
-
-                image_ids.append(test_dataset.image_ids[index])
+                # encode all masks of one image at once
+                rles = mask_util.encode(
+                    np.asfortranarray(
+                        per_image_masks.transpose(1, 2, 0).astype(
+                            np.uint8))) if len(per_image_masks) > 0 else []
+
+                coco_evaluator.update(
+                    test_dataset.image_ids[index],
+                    scores=per_image_scores,
+                    category_ids=[
+                        test_dataset.coco_label_to_cat_id[int(per_label)]
+                        for per_label in per_image_labels
+                    ],
+                    rles=rles)
 
                 print('{}/{}'.format(index, len(test_dataset)), end='\r')
 
             end = time.time()
 
         test_loss = losses.avg
+        if torch.distributed.is_available(
+        ) and torch.distributed.is_initialized():
+            [test_loss] = all_reduce_operation_in_group_for_variables(
+                variables=[test_loss],
+                operator=torch.distributed.ReduceOp.SUM,
+                group=None)
+            test_loss = test_loss / float(torch.distributed.get_world_size())
 
         variable_definitions = {
             0: 'IoU=0.50:0.95,area=all,maxDets=100,mAP',
@@ -1523,21 +1101,9 @@ def evaluate_coco_instance_segmentation(test_loader, model, criterion, decoder,
         result_dict[
             'per_image_inference_time'] = f'{per_image_inference_time:.3f}ms'
 
-        if len(results) == 0:
-            for _, value in variable_definitions.items():
-                result_dict[value] = 0
-            return result_dict
-
-        # load results in COCO evaluation tool
-        coco_true = test_dataset.coco
-        coco_pred = coco_true.loadRes(results)
-
-        coco_eval = COCOeval(coco_true, coco_pred, 'segm')
-        coco_eval.params.imgIds = image_ids
-        coco_eval.evaluate()
-        coco_eval.accumulate()
-        coco_eval.summarize()
-        eval_result = coco_eval.stats
+        # gather per image match results from all ranks
+        coco_evaluator.synchronize_between_processes()
+        eval_result = coco_evaluator.summarize()
 
         for i, var in enumerate(eval_result):
             result_dict[variable_definitions[i]] = var * 100
@@ -1549,7 +1115,7 @@ def test_instance_segmentation(test_loader, model, criterion, decoder, config):
     assert config.eval_type in ['COCO']
 
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        model = config.ema_model.ema_model
+        model = config.ema_model.get_eval_model()
 
     func_dict = {
         'COCO': evaluate_coco_instance_segmentation,
@@ -1565,16 +1131,16 @@ def train_instance_segmentation(train_loader, model, criterion, optimizer,
     '''
     train instance segmentation model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images = data['image']
         images = images.cuda()
@@ -1582,165 +1148,50 @@ def train_instance_segmentation(train_loader, model, criterion, optimizer,
         gt_bboxes = data['box']
         gt_masks = data['mask']
 
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(images)):
-            skip_batch_flag = True
+        train_step.check_inputs([images])
 
-        if torch.any(torch.isnan(images)):
-            skip_batch_flag = True
-
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    outs_tuple = model(images)
-                    loss_value = criterion(outs_tuple, gt_bboxes, gt_masks)
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        outs_tuple = model(images)
-                        loss_value = criterion(outs_tuple, gt_bboxes, gt_masks)
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 outs_tuple = model(images)
                 loss_value = criterion(outs_tuple, gt_bboxes, gt_masks)
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    outs_tuple = model(images)
-                    loss_value = criterion(outs_tuple, gt_bboxes, gt_masks)
-
-        loss = sum(loss_value.values())
-
-        inf_nan_flag = False
-        for key, value in loss_value.items():
-            if torch.any(torch.isinf(value)) or torch.any(torch.isnan(value)):
-                inf_nan_flag = True
 
-        if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-            inf_nan_flag = True
+            loss = sum(loss_value.values())
 
-        if loss == 0. or inf_nan_flag:
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
 
-        loss = loss / config.accumulation_steps
-        for key, value in loss_value.items():
-            loss_value[key] = value / config.accumulation_steps
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
 
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
+            if config.use_ema_model and train_step.optimizer_stepped():
                 config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            for key, value in loss_value.items():
-                [value] = all_reduce_operation_in_group_for_variables(
-                    variables=[value],
-                    operator=torch.distributed.ReduceOp.SUM,
-                    group=config.group)
-                loss_value[key] = value / float(config.gpus_num)
+            train_step.update_loss(loss,
+                                   loss_value,
+                                   sample_num=images.size(0))
 
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
-
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, total_loss: {loss*config.accumulation_steps:.4f}, '
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, total_loss: {loss:.4f}, '
             for key, value in loss_value.items():
-                log_info += f'{key}: {value*config.accumulation_steps:.4f}, '
+                log_info += f'{key}: {value:.4f}, '
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
 
@@ -1751,158 +1202,57 @@ def train_mae_self_supervised_learning(train_loader, model, criterion,
     '''
     train mae self supervised model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images, labels = data['image'], data['label']
         images, labels = images.cuda(), labels.cuda()
 
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(images)) or torch.any(torch.isinf(labels)):
-            skip_batch_flag = True
-
-        if torch.any(torch.isnan(images)) or torch.any(torch.isnan(labels)):
-            skip_batch_flag = True
+        train_step.check_inputs([images, labels])
 
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    outputs, masks = model(images)
-                    loss = criterion(outputs, labels, masks)
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        outputs, masks = model(images)
-                        loss = criterion(outputs, labels, masks)
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 outputs, masks = model(images)
                 loss = criterion(outputs, labels, masks)
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    outputs, masks = model(images)
-                    loss = criterion(outputs, labels, masks)
 
-        if loss == 0. or torch.any(torch.isinf(loss)) or torch.any(
-                torch.isnan(loss)):
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
+            train_step.check_loss(loss)
+            train_step.backward(loss)
 
-        loss = loss / config.accumulation_steps
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
 
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                optimizer.step()
-                optimizer.zero_grad()
-
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
+            if config.use_ema_model and train_step.optimizer_stepped():
                 config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
+            train_step.update_loss(loss, sample_num=images.size(0))
 
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss*config.accumulation_steps:.4f}'
+            loss, _, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}'
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
@@ -17,7 +17,7 @@ import torchvision.transforms as transforms
 
 from simpleAICV.diffusion_model.metrics.compute_fid_is_score import ImagePathDataset
 
-from tools.diffusion_scripts import generate_diffusion_model_images, compute_diffusion_model_metric
+from tools.diffusion_scripts import generate_diffusion_model_images, compute_diffusion_model_metric, generate_and_compute_diffusion_model_metric
 from tools.utils import get_logger, set_seed
 
 
@@ -52,6 +52,10 @@ def main():
     config.save_generate_image_dir = os.path.join(config.save_image_dir,
                                                   'generate_images')
 
+    if not hasattr(config,
+                   'fid_stats_cache_dir') or not config.fid_stats_cache_dir:
+        config.fid_stats_cache_dir = os.path.join(args.work_dir, 'fid_stats')
+
     set_seed(config.seed)
 
     local_rank = int(os.environ['LOCAL_RANK'])
@@ -106,6 +110,22 @@ def main():
                                                 device_ids=[local_rank],
                                                 output_device=local_rank)
 
+    if hasattr(config,
+               'use_streaming_metric') and config.use_streaming_metric:
+        # generate images and compute fid/is in memory in one pass
+        fid_model = config.fid_model
+        fid_model = fid_model.cuda()
+
+        fid_value, is_score_mean, is_score_std, test_image_num, generate_image_num = generate_and_compute_diffusion_model_metric(
+            test_loader, model, sampler, fid_model, config)
+
+        torch.cuda.empty_cache()
+
+        log_info = f'fid: {fid_value:.3f}, is_score: {is_score_mean:.3f}/{is_score_std:.3f}, test_image_num: {test_image_num}, generate_image_num: {generate_image_num}'
+        logger.info(log_info) if local_rank == 0 else None
+
+        return
+
     test_images_path_list = []
     for per_image_name in os.listdir(config.save_test_image_dir):
         per_image_path = os.path.join(config.save_test_image_dir,
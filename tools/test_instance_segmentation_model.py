@@ -60,12 +60,16 @@ def main():
     batch_size = int(config.batch_size // config.gpus_num)
     num_workers = int(config.num_workers // config.gpus_num)
 
+    # coco evaluation gathers results from all ranks,each rank tests a shard of test dataset
+    test_sampler = torch.utils.data.distributed.DistributedSampler(
+        config.test_dataset, shuffle=False)
     test_loader = DataLoader(config.test_dataset,
                              batch_size=batch_size,
                              shuffle=False,
                              pin_memory=True,
                              num_workers=num_workers,
-                             collate_fn=config.test_collater)
+                             collate_fn=config.test_collater,
+                             sampler=test_sampler)
 
     for key, value in config.__dict__.items():
         if not key.startswith('__'):
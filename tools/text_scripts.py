@@ -1,11 +1,14 @@
 import cv2
 
 import collections
+import multiprocessing
 import numpy as np
 import re
 import time
 from tqdm import tqdm
 
+from shapely.geometry import Polygon
+
 from nltk.metrics.distance import edit_distance
 
 import torch
@@ -15,14 +18,16 @@ import torch.nn.functional as F
 from torch.cuda.amp import autocast
 
 from simpleAICV.text_detection.common import AverageMeter, PrecisionRecallMeter
+from simpleAICV.text_recognition.common import TextRecognitionMetricMeter
 from tools.scripts import all_reduce_operation_in_group_for_variables
+from tools.train_step import TrainStepEngine
 
 
 def test_text_recognition_for_all_dataset(val_loader_list, model, criterion,
                                           config):
 
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        model = config.ema_model.ema_model
+        model = config.ema_model.get_eval_model()
 
     result_dict = collections.OrderedDict()
     for index, (per_sub_dataset_name, per_sub_dataset_loader) in enumerate(
@@ -41,6 +46,110 @@ def test_text_recognition_for_all_dataset(val_loader_list, model, criterion,
 
 def test_text_recognition_for_per_sub_dataset(val_loader, model, criterion,
                                               config):
+    '''
+    single pass test,decode once per batch and update all metric counters,
+    all counters are summed over ranks by one all_reduce.
+    set config.use_per_metric_test=True to use per metric test functions(one pass per metric family).
+    '''
+    if hasattr(config, 'use_per_metric_test') and config.use_per_metric_test:
+        return test_text_recognition_per_metric_for_per_sub_dataset(
+            val_loader, model, criterion, config)
+
+    batch_time = AverageMeter()
+    data_time = AverageMeter()
+    losses = AverageMeter()
+
+    converter = config.converter
+    metric_meter = TextRecognitionMetricMeter(
+        config.all_char_table,
+        config.num_char_table,
+        config.alpha_char_table,
+        config.common_standard_chinese_char_first_table,
+        config.common_standard_chinese_char_second_table,
+        config.common_standard_chinese_char_third_table,
+        garbage_char=converter.garbage_char,
+        case_insensitve=True)
+
+    # switch to evaluate mode
+    model.eval()
+
+    with torch.no_grad():
+        end = time.time()
+        model_on_cuda = next(model.parameters()).is_cuda
+        for _, data in tqdm(enumerate(val_loader)):
+            images, targets = data['image'], data['label']
+            if model_on_cuda:
+                images = images.cuda()
+
+            # labels encoded in dataloader workers if collater has converter
+            if 'trans_label' in data:
+                trans_targets, target_lengths = data['trans_label'], data[
+                    'label_length']
+            else:
+                trans_targets, target_lengths = converter.encode(targets)
+            if model_on_cuda:
+                trans_targets, target_lengths = trans_targets.cuda(
+                ), target_lengths.cuda()
+
+            torch.cuda.synchronize()
+            data_time.update(time.time() - end)
+            end = time.time()
+
+            outputs = model(images)
+            torch.cuda.synchronize()
+            batch_time.update(time.time() - end)
+
+            input_lengths = torch.IntTensor([outputs.shape[1]] *
+                                            outputs.shape[0])
+            if model_on_cuda:
+                input_lengths = input_lengths.cuda()
+
+            loss = criterion(
+                F.log_softmax(outputs, dim=2).permute(1, 0, 2), trans_targets,
+                input_lengths, target_lengths)
+            # loss is reduced with metric counters after all batches
+            losses.update(loss.item(), images.size(0))
+
+            _, pred_indexes = outputs.max(dim=2)
+            # collapse repeats and blanks on device
+            pred_strs = converter.decode(pred_indexes, input_lengths)
+
+            metric_meter.update(pred_strs, targets)
+
+            end = time.time()
+
+    # sum loss and all metric counters over ranks with one all_reduce
+    counter_names = list(metric_meter.counters.keys())
+    counters = torch.tensor(
+        [losses.sum, losses.count] +
+        [metric_meter.counters[per_name] for per_name in counter_names],
+        dtype=torch.float64).cuda()
+    torch.distributed.all_reduce(counters,
+                                 op=torch.distributed.ReduceOp.SUM,
+                                 group=config.group)
+    counters = counters.cpu().tolist()
+    test_loss = counters[0] / max(counters[1], 1)
+    for per_name, per_value in zip(counter_names, counters[2:]):
+        metric_meter.counters[per_name] = per_value
+
+    # per image data load time(ms) and inference time(ms)
+    per_image_load_time = data_time.avg / (config.batch_size //
+                                           config.gpus_num) * 1000
+    per_image_inference_time = batch_time.avg / (config.batch_size //
+                                                 config.gpus_num) * 1000
+
+    all_dict = collections.OrderedDict()
+    all_dict['per_image_load_time'] = per_image_load_time
+    all_dict['per_image_inference_time'] = per_image_inference_time
+    all_dict['test_loss'] = test_loss
+    for key, value in metric_meter.compute(ignore_threhold=1000).items():
+        all_dict[key] = value
+
+    return all_dict
+
+
+def test_text_recognition_per_metric_for_per_sub_dataset(
+        val_loader, model, criterion, config):
     str_acc_edit_distance_dict = test_str_acc_edit_distance_for_per_sub_dataset(
         val_loader, model, criterion, config.converter, config)
     order_pr_dict = test_order_PR_for_per_sub_dataset(val_loader, model,
@@ -92,7 +201,13 @@ def test_str_acc_edit_distance_for_per_sub_dataset(val_loader, model,
             if model_on_cuda:
                 images = images.cuda()
 
-            trans_targets, target_lengths = config.converter.encode(targets)
+            # labels encoded in dataloader workers if collater has converter
+            if 'trans_label' in data:
+                trans_targets, target_lengths = data['trans_label'], data[
+                    'label_length']
+            else:
+                trans_targets, target_lengths = config.converter.encode(
+                    targets)
             if model_on_cuda:
                 trans_targets, target_lengths = trans_targets.cuda(
                 ), target_lengths.cuda()
@@ -123,8 +238,8 @@ def test_str_acc_edit_distance_for_per_sub_dataset(val_loader, model,
             losses.update(loss, images.size(0))
 
             _, pred_indexes = outputs.max(dim=2)
-            pred_strs = converter.decode(pred_indexes.cpu().numpy(),
-                                         input_lengths.cpu().numpy())
+            # collapse repeats and blanks on device
+            pred_strs = converter.decode(pred_indexes, input_lengths)
             pred_probs, _ = (F.softmax(outputs, dim=2)).max(dim=2)
             pred_probs = pred_probs.cpu().numpy()
 
@@ -264,7 +379,13 @@ def test_order_PR_for_per_sub_dataset(val_loader, model, criterion, converter,
             if model_on_cuda:
                 images = images.cuda()
 
-            trans_targets, target_lengths = config.converter.encode(targets)
+            # labels encoded in dataloader workers if collater has converter
+            if 'trans_label' in data:
+                trans_targets, target_lengths = data['trans_label'], data[
+                    'label_length']
+            else:
+                trans_targets, target_lengths = config.converter.encode(
+                    targets)
             if model_on_cuda:
                 trans_targets, target_lengths = trans_targets.cuda(
                 ), target_lengths.cuda()
@@ -278,8 +399,8 @@ def test_order_PR_for_per_sub_dataset(val_loader, model, criterion, converter,
 
             _, pred_indexes = outputs.max(dim=2)
 
-            pred_strs = converter.decode(pred_indexes.cpu().numpy(),
-                                         input_lengths.cpu().numpy())
+            # collapse repeats and blanks on device
+            pred_strs = converter.decode(pred_indexes, input_lengths)
 
             c_char_nums, p_char_nums, t_char_nums = compute_order_PR_per_batch(
                 c_char_nums,
@@ -379,7 +500,13 @@ def test_chars_PR_for_per_sub_dataset(val_loader, model, criterion, converter,
             if model_on_cuda:
                 images = images.cuda()
 
-            trans_targets, target_lengths = config.converter.encode(targets)
+            # labels encoded in dataloader workers if collater has converter
+            if 'trans_label' in data:
+                trans_targets, target_lengths = data['trans_label'], data[
+                    'label_length']
+            else:
+                trans_targets, target_lengths = config.converter.encode(
+                    targets)
             if model_on_cuda:
                 trans_targets, target_lengths = trans_targets.cuda(
                 ), target_lengths.cuda()
@@ -393,8 +520,8 @@ def test_chars_PR_for_per_sub_dataset(val_loader, model, criterion, converter,
 
             _, pred_indexes = outputs.max(dim=2)
 
-            pred_strs = converter.decode(pred_indexes.cpu().numpy(),
-                                         input_lengths.cpu().numpy())
+            # collapse repeats and blanks on device
+            pred_strs = converter.decode(pred_indexes, input_lengths)
 
             correct_char_nums, pred_char_nums, target_char_nums, not_include_target_char_nums = compute_chars_PR_per_batch(
                 correct_char_nums, pred_char_nums, target_char_nums,
@@ -534,7 +661,13 @@ def test_lcs_PR_for_per_sub_dataset(val_loader,
             if model_on_cuda:
                 images = images.cuda()
 
-            trans_targets, target_lengths = config.converter.encode(targets)
+            # labels encoded in dataloader workers if collater has converter
+            if 'trans_label' in data:
+                trans_targets, target_lengths = data['trans_label'], data[
+                    'label_length']
+            else:
+                trans_targets, target_lengths = config.converter.encode(
+                    targets)
             if model_on_cuda:
                 trans_targets, target_lengths = trans_targets.cuda(
                 ), target_lengths.cuda()
@@ -548,8 +681,8 @@ def test_lcs_PR_for_per_sub_dataset(val_loader,
 
             _, pred_indexes = outputs.max(dim=2)
 
-            pred_strs = converter.decode(pred_indexes.cpu().numpy(),
-                                         input_lengths.cpu().numpy())
+            # collapse repeats and blanks on device
+            pred_strs = converter.decode(pred_indexes, input_lengths)
 
             c_num_char_nums, p_num_char_nums, t_num_char_nums, c_alpha_char_nums, p_alpha_char_nums, t_alpha_char_nums, c_first_char_nums, p_first_char_nums, t_first_char_nums, c_second_char_nums, p_second_char_nums, t_second_char_nums, c_third_char_nums, p_third_char_nums, t_third_char_nums, c_char_nums, p_char_nums, t_char_nums = compute_lcs_PR_per_batch(
                 c_num_char_nums,
@@ -886,92 +1019,43 @@ def train_text_recognition(train_loader, model, criterion, optimizer,
     '''
     train semantic segmentation model for one epoch
     '''
-    losses = AverageMeter()
+    # padding pixel ratio of input batches and epoch throughput
+    padding_ratios = AverageMeter()
+    image_num = 0
 
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
+    start_time = time.time()
     for _, data in enumerate(train_loader):
         images, targets = data['image'], data['label']
         images = images.cuda()
 
-        trans_targets, target_lengths = config.converter.encode(targets)
+        if 'padding_ratio' in data:
+            padding_ratios.update(data['padding_ratio'], images.size(0))
+        image_num += images.size(0)
+
+        # labels encoded in dataloader workers if collater has converter
+        if 'trans_label' in data:
+            trans_targets, target_lengths = data['trans_label'], data[
+                'label_length']
+        else:
+            trans_targets, target_lengths = config.converter.encode(targets)
         trans_targets, target_lengths = trans_targets.cuda(
         ), target_lengths.cuda()
 
-        skip_batch_flag = False
-
-        if torch.any(torch.isinf(images)):
-            skip_batch_flag = True
-
-        if torch.any(torch.isnan(images)):
-            skip_batch_flag = True
-
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    # [B,W,num_classes]
-                    outputs = model(images)
-
-                    input_lengths = torch.IntTensor([outputs.shape[1]] *
-                                                    outputs.shape[0]).cuda()
-                    # [B,W,num_classes]->[W,B,num_classes]
-                    outputs = outputs.permute(1, 0, 2)
-
-                    loss_value = {}
-                    for loss_name in criterion.keys():
-                        if loss_name == "CTCLoss":
-                            temp_loss = criterion[loss_name](outputs,
-                                                             trans_targets,
-                                                             input_lengths,
-                                                             target_lengths)
-                            temp_loss = config.loss_ratio[loss_name] * temp_loss
-                            loss_value[loss_name] = temp_loss
-                        elif loss_name == 'ACELoss':
-                            temp_loss = criterion[loss_name](outputs,
-                                                             trans_targets)
-                            temp_loss = config.loss_ratio[loss_name] * temp_loss
-                            loss_value[loss_name] = temp_loss
-                        else:
-                            log_info = f'Unsupport loss: {loss_name}'
-                            logger.info(log_info) if local_rank == 0 else None
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        # [B,W,num_classes]
-                        outputs = model(images)
-
-                        input_lengths = torch.IntTensor(
-                            [outputs.shape[1]] * outputs.shape[0]).cuda()
-                        # [B,W,num_classes]->[W,B,num_classes]
-                        outputs = outputs.permute(1, 0, 2)
-
-                        loss_value = {}
-                        for loss_name in criterion.keys():
-                            if loss_name == "CTCLoss":
-                                temp_loss = criterion[loss_name](
-                                    outputs, trans_targets, input_lengths,
-                                    target_lengths)
-                                temp_loss = config.loss_ratio[
-                                    loss_name] * temp_loss
-                                loss_value[loss_name] = temp_loss
-                            elif loss_name == 'ACELoss':
-                                temp_loss = criterion[loss_name](outputs,
-                                                                 trans_targets)
-                                temp_loss = config.loss_ratio[
-                                    loss_name] * temp_loss
-                                loss_value[loss_name] = temp_loss
-                            else:
-                                log_info = f'Unsupport loss: {loss_name}'
-                                logger.info(
-                                    log_info) if local_rank == 0 else None
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        train_step.check_inputs([images])
+
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 # [B,W,num_classes]
                 outputs = model(images)
 
@@ -997,168 +1081,59 @@ def train_text_recognition(train_loader, model, criterion, optimizer,
                     else:
                         log_info = f'Unsupport loss: {loss_name}'
                         logger.info(log_info) if local_rank == 0 else None
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    # [B,W,num_classes]
-                    outputs = model(images)
-
-                    input_lengths = torch.IntTensor([outputs.shape[1]] *
-                                                    outputs.shape[0]).cuda()
-                    # [B,W,num_classes]->[W,B,num_classes]
-                    outputs = outputs.permute(1, 0, 2)
-
-                    loss_value = {}
-                    for loss_name in criterion.keys():
-                        if loss_name == "CTCLoss":
-                            temp_loss = criterion[loss_name](outputs,
-                                                             trans_targets,
-                                                             input_lengths,
-                                                             target_lengths)
-                            temp_loss = config.loss_ratio[loss_name] * temp_loss
-                            loss_value[loss_name] = temp_loss
-                        elif loss_name == 'ACELoss':
-                            temp_loss = criterion[loss_name](outputs,
-                                                             trans_targets)
-                            temp_loss = config.loss_ratio[loss_name] * temp_loss
-                            loss_value[loss_name] = temp_loss
-                        else:
-                            log_info = f'Unsupport loss: {loss_name}'
-                            logger.info(log_info) if local_rank == 0 else None
-
-        loss = 0.
-        for key, value in loss_value.items():
-            loss += value
-
-        inf_nan_flag = False
-        for key, value in loss_value.items():
-            if torch.any(torch.isinf(value)) or torch.any(torch.isnan(value)):
-                inf_nan_flag = True
-
-        if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-            inf_nan_flag = True
-
-        if loss == 0. or inf_nan_flag:
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
-
-        loss = loss / config.accumulation_steps
-        for key, value in loss_value.items():
-            loss_value[key] = value / config.accumulation_steps
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
 
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
+            loss = sum(loss_value.values())
 
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
 
-                optimizer.step()
-                optimizer.zero_grad()
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
 
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
+            if config.use_ema_model and train_step.optimizer_stepped():
                 config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            for key, value in loss_value.items():
-                [value] = all_reduce_operation_in_group_for_variables(
-                    variables=[value],
-                    operator=torch.distributed.ReduceOp.SUM,
-                    group=config.group)
-                loss_value[key] = value / float(config.gpus_num)
+            train_step.update_loss(loss,
+                                   loss_value,
+                                   sample_num=images.size(0))
 
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
-
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss*config.accumulation_steps:.4f}, '
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, loss: {loss:.4f}, '
             for key, value in loss_value.items():
-                log_info += f'{key}: {value*config.accumulation_steps:.4f}, '
+                log_info += f'{key}: {value:.4f}, '
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    epoch_time = time.time() - start_time
+    [padding_ratio_sum, padding_image_num, image_num,
+     epoch_time] = all_reduce_operation_in_group_for_variables(
+         variables=[
+             float(padding_ratios.sum),
+             float(padding_ratios.count),
+             float(image_num), epoch_time
+         ],
+         operator=torch.distributed.ReduceOp.SUM,
+         group=config.group)
+    padding_ratio = padding_ratio_sum / max(padding_image_num, 1.)
+    # images of all gpus per second,epoch_time is averaged over gpus
+    throughput = image_num / max(epoch_time / float(config.gpus_num), 1e-4)
+    log_info = f'train: epoch {epoch:0>4d}, padding_ratio: {padding_ratio:.4f}, throughput: {throughput:.2f} images/s'
+    logger.info(log_info) if local_rank == 0 else None
+
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
 
@@ -1166,7 +1141,7 @@ def train_text_recognition(train_loader, model, criterion, optimizer,
 def test_text_detection_for_all_dataset(val_loader_list, model, criterion,
                                         decoder, config):
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        model = config.ema_model.ema_model
+        model = config.ema_model.get_eval_model()
 
     result_dict = collections.OrderedDict()
     for index, (per_sub_dataset_name, per_sub_dataset_loader) in enumerate(
@@ -1193,6 +1168,12 @@ def test_text_detection_for_per_sub_dataset(test_loader, model, criterion,
     losses = AverageMeter()
     precision_recall = PrecisionRecallMeter()
 
+    # 每张图像的pred/gt匹配统计在进程池中计算
+    eval_num_workers = config.eval_num_workers if hasattr(
+        config, 'eval_num_workers') else 0
+    pool = multiprocessing.Pool(
+        eval_num_workers) if eval_num_workers > 0 else None
+
     with torch.no_grad():
         model_on_cuda = next(model.parameters()).is_cuda
         end = time.time()
@@ -1219,7 +1200,13 @@ def test_text_detection_for_per_sub_dataset(test_loader, model, criterion,
 
             origin_shapes = annots['shape']
             pred_correct_num, gt_correct_num, pred_num, gt_num = compute_text_detection_pr_per_batch(
-                batch_boxes, batch_scores, origin_shapes, sizes, config, preds)
+                batch_boxes,
+                batch_scores,
+                origin_shapes,
+                sizes,
+                config,
+                preds,
+                pool=pool)
 
             # please keep same variable on different gpus has same data type for all reduce operation
             [pred_correct_num, gt_correct_num, pred_num,
@@ -1235,6 +1222,10 @@ def test_text_detection_for_per_sub_dataset(test_loader, model, criterion,
 
             end = time.time()
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     precision_recall.compute()
     precision = precision_recall.precision * 100
     recall = precision_recall.recall * 100
@@ -1263,8 +1254,13 @@ def test_text_detection_for_per_sub_dataset(test_loader, model, criterion,
     return result_dict
 
 
-def compute_text_detection_pr_per_batch(batch_boxes, batch_scores, shapes,
-                                        sizes, config, preds):
+def compute_text_detection_pr_per_batch(batch_boxes,
+                                        batch_scores,
+                                        shapes,
+                                        sizes,
+                                        config,
+                                        preds,
+                                        pool=None):
     probability_map, threshold_map = preds[:, 0, :, :], preds[:, 1, :, :]
     probability_map, threshold_map = probability_map.cpu().detach().numpy(
     ), threshold_map.cpu().detach().numpy()
@@ -1282,129 +1278,34 @@ def compute_text_detection_pr_per_batch(batch_boxes, batch_scores, shapes,
     # match_count_threshold=2
     match_count_threshold = config.match_count_threshold
 
-    pred_correct_num, gt_correct_num, pred_num, gt_num = 0.0, 0.0, 0.0, 0.0
-    for per_image_pred_boxes, per_image_shapes, per_image_size, per_image_probability_map, per_image_threshold_map in zip(
-            batch_boxes, shapes, sizes, probability_map, threshold_map):
-        per_image_gt_boxes = [
-            per_shape['points'] for per_shape in per_image_shapes
+    # 使用多边形精确求交计算iou,否则使用光栅化mask计算iou
+    use_polygon_iou = hasattr(
+        config, 'use_polygon_iou') and config.use_polygon_iou
+
+    per_image_args = [[
+        per_image_pred_boxes,
+        per_image_shapes,
+        per_image_size,
+        precision_iou_threshold,
+        recall_iou_threshold,
+        punish_factor,
+        match_count_threshold,
+        use_polygon_iou,
+    ] for per_image_pred_boxes, per_image_shapes, per_image_size in zip(
+        batch_boxes, shapes, sizes)]
+
+    # 每张图像的匹配统计相互独立,可以分配到进程池中计算
+    if pool is not None:
+        per_image_results = pool.starmap(compute_text_detection_pr_per_image,
+                                         per_image_args)
+    else:
+        per_image_results = [
+            compute_text_detection_pr_per_image(*per_image_arg)
+            for per_image_arg in per_image_args
         ]
-        insection_pred_ious, insection_target_ious = compute_pred_gt_ious(
-            per_image_pred_boxes, per_image_gt_boxes, per_image_size)
-
-        per_image_pred_correct_num, per_image_gt_correct_num = 0.0, 0.0
-        per_image_pred_num, per_image_gt_num = len(per_image_pred_boxes), len(
-            per_image_gt_boxes)
-
-        pred_boxes_flag = np.zeros((len(per_image_pred_boxes), ),
-                                   dtype=np.float32)
-        gt_boxes_flag = np.zeros((len(per_image_gt_boxes), ), dtype=np.float32)
-        '''
-        ###########################################################################
-        统计参与指标计算的pred_box数量和gt_box数量说明:
-        1. gt_num = gt_box总量 - 被标记为ignore的gt_box数量
-        2. pred_num = pred_box总量 - 判定为预测标签为ignore的gt_box的pred_box数量,
-        判定为ignore的pred_box情况j较为复杂,只有当pred_box与标有ignore的gt_box有对应关系时,
-        才会被记作ignore
-        3. pred_box与gt_box对应关系有三种: 一对一、一对多、多对一,在这三种情况中,
-        统计与ignore标签gt_box对应的pred_box
-        ###########################################################################
-        '''
-
-        # 一对一匹配统计
-        per_image_pred_correct_num, per_image_gt_correct_num, pred_boxes_flag, gt_boxes_flag, one2one_per_image_pred_ignore_nums = one_to_one_match_count(
-            insection_pred_ious,
-            insection_target_ious,
-            per_image_pred_correct_num,
-            per_image_gt_correct_num,
-            per_image_shapes,
-            pred_boxes_flag,
-            gt_boxes_flag,
-            precision_iou_threshold,
-            recall_iou_threshold,
-        )
-
-        # 一个GT与多个预测匹配统计
-        per_image_pred_correct_num, per_image_gt_correct_num, pred_boxes_flag, gt_boxes_flag, one2many_per_image_pred_ignore_nums = one_to_many_match_count(
-            insection_pred_ious,
-            insection_target_ious,
-            per_image_pred_correct_num,
-            per_image_gt_correct_num,
-            per_image_shapes,
-            pred_boxes_flag,
-            gt_boxes_flag,
-            precision_iou_threshold,
-            recall_iou_threshold,
-            punish_factor,
-            match_count_threshold,
-        )
-
-        # 一个预测与多个GT匹配统计
-        per_image_pred_correct_num, per_image_gt_correct_num, pred_boxes_flag, gt_boxes_flag, many2one_per_image_pred_ignore_nums = many_to_one_match_count(
-            insection_pred_ious,
-            insection_target_ious,
-            per_image_pred_correct_num,
-            per_image_gt_correct_num,
-            per_image_shapes,
-            pred_boxes_flag,
-            gt_boxes_flag,
-            precision_iou_threshold,
-            recall_iou_threshold,
-            punish_factor,
-            match_count_threshold,
-        )
-
-        # 获取所有标为'ignore'的gt_boxes的索引
-        per_image_gt_ignore_boxes_indexes = []
-        for gt_idx in range(len(per_image_shapes)):
-            if 'ignore' in per_image_shapes[gt_idx].keys():
-                if per_image_shapes[gt_idx]['ignore']:
-                    per_image_gt_ignore_boxes_indexes.append(1)
-                else:
-                    per_image_gt_ignore_boxes_indexes.append(0)
-            else:
-                if per_image_shapes[gt_idx]['label'] == '###':
-                    per_image_gt_ignore_boxes_indexes.append(1)
-                else:
-                    per_image_gt_ignore_boxes_indexes.append(0)
-        per_image_gt_ignore_boxes_indexes = np.array(
-            per_image_gt_ignore_boxes_indexes, dtype=np.float32)
-
-        # 若经过以上三次匹配后仍然有标为'ignore'的gt_boxes未与pred_boxes匹配,统计在这种情况下,预测框忽略的数量
-        remaining_pred_ignore_box_nums = 0
-        # 求未匹配的标为'ignore'的gt_boxes
-        gt_ignore_remain_box_flag = np.logical_and(
-            (1 - gt_boxes_flag), per_image_gt_ignore_boxes_indexes)
-
-        # 三个条件需同时满足：
-        # 1.经过1对1、1对多、多对1后，仍有gt_box未匹配
-        # 2.经过1对1、1对多、多对1后，仍有N个gt_box未匹配，且在N个gt中有被标记为ignore的box
-        # 3.经过1对1、1对多、多对1后，仍有pred_box未匹配
-        if (gt_boxes_flag.shape[0] > gt_boxes_flag.sum()) and (
-                pred_boxes_flag.shape[0]
-                > pred_boxes_flag.sum()) and (gt_ignore_remain_box_flag.sum()
-                                              > 0):
-            for pred_idx in range(len(pred_boxes_flag)):
-                for gt_idx in range(len(gt_boxes_flag)):
-                    if gt_ignore_remain_box_flag[gt_idx]:
-                        if (1 - pred_boxes_flag[pred_idx]) and (
-                                insection_target_ious[gt_idx, pred_idx] > 0
-                                and insection_pred_ious[gt_idx, pred_idx] > 0):
-                            remaining_pred_ignore_box_nums += 1
-                            break
-
-        per_image_pred_correct_num = float(int(per_image_pred_correct_num))
-        per_image_gt_correct_num = float(int(per_image_gt_correct_num))
-        per_image_pred_num = float(int(per_image_pred_num))
-        per_image_gt_num = float(int(per_image_gt_num))
-
-        per_image_pred_num = per_image_pred_num - one2one_per_image_pred_ignore_nums - one2many_per_image_pred_ignore_nums - many2one_per_image_pred_ignore_nums - remaining_pred_ignore_box_nums
-        per_image_gt_num = per_image_gt_num - sum(
-            per_image_gt_ignore_boxes_indexes)
-
-        # 修正,避免出现precision/recall大于1的情况
-        per_image_pred_num = per_image_pred_correct_num if per_image_pred_correct_num > per_image_pred_num else per_image_pred_num
-        per_image_gt_num = per_image_gt_correct_num if per_image_gt_correct_num > per_image_gt_num else per_image_gt_num
 
+    pred_correct_num, gt_correct_num, pred_num, gt_num = 0.0, 0.0, 0.0, 0.0
+    for per_image_pred_correct_num, per_image_gt_correct_num, per_image_pred_num, per_image_gt_num in per_image_results:
         pred_correct_num += per_image_pred_correct_num
         gt_correct_num += per_image_gt_correct_num
         pred_num += per_image_pred_num
@@ -1418,6 +1319,139 @@ def compute_text_detection_pr_per_batch(batch_boxes, batch_scores, shapes,
     return pred_correct_num, gt_correct_num, pred_num, gt_num
 
 
+def compute_text_detection_pr_per_image(per_image_pred_boxes,
+                                        per_image_shapes, per_image_size,
+                                        precision_iou_threshold,
+                                        recall_iou_threshold, punish_factor,
+                                        match_count_threshold,
+                                        use_polygon_iou):
+    per_image_gt_boxes = [
+        per_shape['points'] for per_shape in per_image_shapes
+    ]
+    if use_polygon_iou:
+        insection_pred_ious, insection_target_ious = compute_pred_gt_polygon_ious(
+            per_image_pred_boxes, per_image_gt_boxes, per_image_size)
+    else:
+        insection_pred_ious, insection_target_ious = compute_pred_gt_ious(
+            per_image_pred_boxes, per_image_gt_boxes, per_image_size)
+
+    per_image_pred_correct_num, per_image_gt_correct_num = 0.0, 0.0
+    per_image_pred_num, per_image_gt_num = len(per_image_pred_boxes), len(
+        per_image_gt_boxes)
+
+    pred_boxes_flag = np.zeros((len(per_image_pred_boxes), ),
+                               dtype=np.float32)
+    gt_boxes_flag = np.zeros((len(per_image_gt_boxes), ), dtype=np.float32)
+    '''
+    ###########################################################################
+    统计参与指标计算的pred_box数量和gt_box数量说明:
+    1. gt_num = gt_box总量 - 被标记为ignore的gt_box数量
+    2. pred_num = pred_box总量 - 判定为预测标签为ignore的gt_box的pred_box数量,
+    判定为ignore的pred_box情况j较为复杂,只有当pred_box与标有ignore的gt_box有对应关系时,
+    才会被记作ignore
+    3. pred_box与gt_box对应关系有三种: 一对一、一对多、多对一,在这三种情况中,
+    统计与ignore标签gt_box对应的pred_box
+    ###########################################################################
+    '''
+
+    # 一对一匹配统计
+    per_image_pred_correct_num, per_image_gt_correct_num, pred_boxes_flag, gt_boxes_flag, one2one_per_image_pred_ignore_nums = one_to_one_match_count(
+        insection_pred_ious,
+        insection_target_ious,
+        per_image_pred_correct_num,
+        per_image_gt_correct_num,
+        per_image_shapes,
+        pred_boxes_flag,
+        gt_boxes_flag,
+        precision_iou_threshold,
+        recall_iou_threshold,
+    )
+
+    # 一个GT与多个预测匹配统计
+    per_image_pred_correct_num, per_image_gt_correct_num, pred_boxes_flag, gt_boxes_flag, one2many_per_image_pred_ignore_nums = one_to_many_match_count(
+        insection_pred_ious,
+        insection_target_ious,
+        per_image_pred_correct_num,
+        per_image_gt_correct_num,
+        per_image_shapes,
+        pred_boxes_flag,
+        gt_boxes_flag,
+        precision_iou_threshold,
+        recall_iou_threshold,
+        punish_factor,
+        match_count_threshold,
+    )
+
+    # 一个预测与多个GT匹配统计
+    per_image_pred_correct_num, per_image_gt_correct_num, pred_boxes_flag, gt_boxes_flag, many2one_per_image_pred_ignore_nums = many_to_one_match_count(
+        insection_pred_ious,
+        insection_target_ious,
+        per_image_pred_correct_num,
+        per_image_gt_correct_num,
+        per_image_shapes,
+        pred_boxes_flag,
+        gt_boxes_flag,
+        precision_iou_threshold,
+        recall_iou_threshold,
+        punish_factor,
+        match_count_threshold,
+    )
+
+    # 获取所有标为'ignore'的gt_boxes的索引
+    per_image_gt_ignore_boxes_indexes = []
+    for gt_idx in range(len(per_image_shapes)):
+        if 'ignore' in per_image_shapes[gt_idx].keys():
+            if per_image_shapes[gt_idx]['ignore']:
+                per_image_gt_ignore_boxes_indexes.append(1)
+            else:
+                per_image_gt_ignore_boxes_indexes.append(0)
+        else:
+            if per_image_shapes[gt_idx]['label'] == '###':
+                per_image_gt_ignore_boxes_indexes.append(1)
+            else:
+                per_image_gt_ignore_boxes_indexes.append(0)
+    per_image_gt_ignore_boxes_indexes = np.array(
+        per_image_gt_ignore_boxes_indexes, dtype=np.float32)
+
+    # 若经过以上三次匹配后仍然有标为'ignore'的gt_boxes未与pred_boxes匹配,统计在这种情况下,预测框忽略的数量
+    remaining_pred_ignore_box_nums = 0
+    # 求未匹配的标为'ignore'的gt_boxes
+    gt_ignore_remain_box_flag = np.logical_and(
+        (1 - gt_boxes_flag), per_image_gt_ignore_boxes_indexes)
+
+    # 三个条件需同时满足：
+    # 1.经过1对1、1对多、多对1后，仍有gt_box未匹配
+    # 2.经过1对1、1对多、多对1后，仍有N个gt_box未匹配，且在N个gt中有被标记为ignore的box
+    # 3.经过1对1、1对多、多对1后，仍有pred_box未匹配
+    if (gt_boxes_flag.shape[0] > gt_boxes_flag.sum()) and (
+            pred_boxes_flag.shape[0]
+            > pred_boxes_flag.sum()) and (gt_ignore_remain_box_flag.sum()
+                                          > 0):
+        for pred_idx in range(len(pred_boxes_flag)):
+            for gt_idx in range(len(gt_boxes_flag)):
+                if gt_ignore_remain_box_flag[gt_idx]:
+                    if (1 - pred_boxes_flag[pred_idx]) and (
+                            insection_target_ious[gt_idx, pred_idx] > 0
+                            and insection_pred_ious[gt_idx, pred_idx] > 0):
+                        remaining_pred_ignore_box_nums += 1
+                        break
+
+    per_image_pred_correct_num = float(int(per_image_pred_correct_num))
+    per_image_gt_correct_num = float(int(per_image_gt_correct_num))
+    per_image_pred_num = float(int(per_image_pred_num))
+    per_image_gt_num = float(int(per_image_gt_num))
+
+    per_image_pred_num = per_image_pred_num - one2one_per_image_pred_ignore_nums - one2many_per_image_pred_ignore_nums - many2one_per_image_pred_ignore_nums - remaining_pred_ignore_box_nums
+    per_image_gt_num = per_image_gt_num - sum(
+        per_image_gt_ignore_boxes_indexes)
+
+    # 修正,避免出现precision/recall大于1的情况
+    per_image_pred_num = per_image_pred_correct_num if per_image_pred_correct_num > per_image_pred_num else per_image_pred_num
+    per_image_gt_num = per_image_gt_correct_num if per_image_gt_correct_num > per_image_gt_num else per_image_gt_num
+
+    return per_image_pred_correct_num, per_image_gt_correct_num, per_image_pred_num, per_image_gt_num
+
+
 def one_to_one_match_count(insection_pred_ious, insection_target_ious,
                            per_image_pred_correct_num,
                            per_image_gt_correct_num, per_image_shapes,
@@ -1650,24 +1684,136 @@ def many_to_one_match_count(insection_pred_ious, insection_target_ious,
     return per_image_pred_correct_num, per_image_gt_correct_num, pred_boxes_flag, gt_boxes_flag, per_image_pred_ignore_nums
 
 
+def get_box_clipped_bbox(box, h, w):
+    # box在图像内的整数外接矩形[x_min,y_min,x_max,y_max],fillPoly只填充图像内的像素
+    box = box.astype(np.int32).reshape(-1, 2)
+    x_min, y_min = max(int(box[:, 0].min()), 0), max(int(box[:, 1].min()), 0)
+    x_max, y_max = min(int(box[:, 0].max()), w - 1), min(int(box[:, 1].max()),
+                                                         h - 1)
+
+    return box, [x_min, y_min, x_max, y_max]
+
+
+def fill_box_in_roi(box, roi):
+    # 在roi内填充box,与整图填充后裁剪roi结果相同
+    x_min, y_min, x_max, y_max = roi
+    roi_mask = np.zeros((y_max - y_min + 1, x_max - x_min + 1),
+                        dtype=np.float32)
+    cv2.fillPoly(roi_mask, [box - np.array([x_min, y_min], dtype=np.int32)],
+                 1.0)
+
+    return roi_mask
+
+
 def compute_pred_gt_ious(pred_boxes, gt_boxes, size):
+    '''
+    光栅化计算iou,结果与整图mask计算相同
+    每个box只在自己的外接矩形内填充一次并缓存mask,外接矩形不相交的pred/gt对交集为0,
+    相交的pred/gt对从两个缓存mask中裁剪出外接矩形交集roi后相乘求交集面积
+    roi内重新填充box时多边形被roi边界裁剪,光栅化结果与整图填充不同,不能在交集roi内重新填充
+    '''
+    insection_pred_ious = np.zeros((len(gt_boxes), len(pred_boxes)),
+                                   dtype=np.float32)
+    insection_target_ious = np.zeros((len(gt_boxes), len(pred_boxes)),
+                                     dtype=np.float32)
+    h, w = int(size[0]), int(size[1])
+
+    pred_boxes = [get_box_clipped_bbox(per_box, h, w) for per_box in pred_boxes]
+    gt_boxes = [get_box_clipped_bbox(per_box, h, w) for per_box in gt_boxes]
+
+    def get_box_mask(box, roi):
+        if roi[0] > roi[2] or roi[1] > roi[3]:
+            return np.zeros((0, 0), dtype=np.float32)
+        return fill_box_in_roi(box, roi)
+
+    pred_masks = [get_box_mask(*per_box) for per_box in pred_boxes]
+    gt_masks = [get_box_mask(*per_box) for per_box in gt_boxes]
+    pred_areas = [per_mask.sum() for per_mask in pred_masks]
+    gt_areas = [per_mask.sum() for per_mask in gt_masks]
+
+    def crop_mask_in_roi(mask, mask_roi, roi):
+        # mask_roi为mask在整图中的位置,roi在mask_roi内
+        x_min, y_min, x_max, y_max = roi
+        return mask[y_min - mask_roi[1]:y_max - mask_roi[1] + 1,
+                    x_min - mask_roi[0]:x_max - mask_roi[0] + 1]
+
+    for gt_idx, (_, per_gt_roi) in enumerate(gt_boxes):
+        for pred_idx, (_, per_pred_roi) in enumerate(pred_boxes):
+            insection_roi = [
+                max(per_gt_roi[0], per_pred_roi[0]),
+                max(per_gt_roi[1], per_pred_roi[1]),
+                min(per_gt_roi[2], per_pred_roi[2]),
+                min(per_gt_roi[3], per_pred_roi[3]),
+            ]
+            # 外接矩形不相交,交集为0
+            if insection_roi[0] > insection_roi[2] or insection_roi[
+                    1] > insection_roi[3]:
+                continue
+            insection_area = (
+                crop_mask_in_roi(gt_masks[gt_idx], per_gt_roi, insection_roi) *
+                crop_mask_in_roi(pred_masks[pred_idx], per_pred_roi,
+                                 insection_roi)).sum()
+            insection_pred_ious[gt_idx][pred_idx] = insection_area / (
+                pred_areas[pred_idx] + 1e-4)
+            insection_target_ious[gt_idx][pred_idx] = insection_area / (
+                gt_areas[gt_idx] + 1e-4)
+
+    return insection_pred_ious, insection_target_ious
+
+
+def compute_pred_gt_polygon_ious(pred_boxes, gt_boxes, size):
+    '''
+    多边形精确求交计算iou,box先与图像矩形求交保证不越界
+    只计算外接矩形相交的pred/gt对
+    '''
     insection_pred_ious = np.zeros((len(gt_boxes), len(pred_boxes)),
                                    dtype=np.float32)
     insection_target_ious = np.zeros((len(gt_boxes), len(pred_boxes)),
                                      dtype=np.float32)
-    h, w = size[0], size[1]
-
-    for gt_idx, per_gt_box in enumerate(gt_boxes):
-        gt_mask = np.zeros((h, w), dtype=np.float32)
-        cv2.fillPoly(gt_mask, [per_gt_box.astype(np.int32)], 1.0)
-        for pred_idx, per_pred_box in enumerate(pred_boxes):
-            pred_mask = np.zeros((h, w), dtype=np.float32)
-            cv2.fillPoly(pred_mask, [per_pred_box.astype(np.int32)], 1.0)
-            insection_mask = gt_mask * pred_mask
-            insection_pred_ious[gt_idx][pred_idx] = insection_mask.sum() / (
-                pred_mask.sum() + 1e-4)
-            insection_target_ious[gt_idx][pred_idx] = insection_mask.sum() / (
-                gt_mask.sum() + 1e-4)
+    if len(gt_boxes) == 0 or len(pred_boxes) == 0:
+        return insection_pred_ious, insection_target_ious
+
+    h, w = int(size[0]), int(size[1])
+    image_polygon = Polygon([[0, 0], [w, 0], [w, h], [0, h]])
+
+    def get_polygon(per_box):
+        polygon = Polygon(np.array(per_box, dtype=np.float64).reshape(-1, 2))
+        # 自相交多边形修正为合法多边形
+        if not polygon.is_valid:
+            polygon = polygon.buffer(0)
+
+        return polygon.intersection(image_polygon)
+
+    pred_polygons = [get_polygon(per_box) for per_box in pred_boxes]
+    gt_polygons = [get_polygon(per_box) for per_box in gt_boxes]
+    pred_areas = np.array([per_polygon.area for per_polygon in pred_polygons],
+                          dtype=np.float32)
+    gt_areas = np.array([per_polygon.area for per_polygon in gt_polygons],
+                        dtype=np.float32)
+
+    # 空多边形bounds为nan,比较结果为False,不参与计算
+    pred_bounds = np.array([
+        per_polygon.bounds if not per_polygon.is_empty else [np.nan] * 4
+        for per_polygon in pred_polygons
+    ],
+                           dtype=np.float64).reshape(-1, 4)
+    gt_bounds = np.array([
+        per_polygon.bounds if not per_polygon.is_empty else [np.nan] * 4
+        for per_polygon in gt_polygons
+    ],
+                         dtype=np.float64).reshape(-1, 4)
+    overlap_flag = (gt_bounds[:, None, 0] < pred_bounds[None, :, 2]) & (
+        pred_bounds[None, :, 0] < gt_bounds[:, None, 2]) & (
+            gt_bounds[:, None, 1] < pred_bounds[None, :, 3]) & (
+                pred_bounds[None, :, 1] < gt_bounds[:, None, 3])
+
+    for gt_idx, pred_idx in zip(*np.nonzero(overlap_flag)):
+        insection_area = gt_polygons[gt_idx].intersection(
+            pred_polygons[pred_idx]).area
+        insection_pred_ious[gt_idx][pred_idx] = insection_area / (
+            pred_areas[pred_idx] + 1e-4)
+        insection_target_ious[gt_idx][pred_idx] = insection_area / (
+            gt_areas[gt_idx] + 1e-4)
 
     return insection_pred_ious, insection_target_ious
 
@@ -1677,178 +1823,63 @@ def train_text_detection(train_loader, model, criterion, optimizer, scheduler,
     '''
     train semantic segmentation model for one epoch
     '''
-    losses = AverageMeter()
-
     # switch to train mode
     model.train()
 
     local_rank = config.local_rank
     iters = len(train_loader.dataset) // config.batch_size
-    iter_index = 1
     assert config.accumulation_steps >= 1, 'illegal accumulation_steps!'
 
+    train_step = TrainStepEngine(model, optimizer, config)
+    iter_index = train_step.start_iter_index
+
     for _, data in enumerate(train_loader):
         images, targets = data['image'], data['annots']
         images = images.cuda()
 
-        skip_batch_flag = False
+        train_step.check_inputs([images])
 
-        if torch.any(torch.isinf(images)):
-            skip_batch_flag = True
-
-        if torch.any(torch.isnan(images)):
-            skip_batch_flag = True
-
-        if config.use_amp:
-            with autocast():
-                if iter_index % config.accumulation_steps == 0:
-                    preds = model(images)
-                    loss_value = criterion(preds, targets)
-                else:
-                    # not reduce gradient while iter_index % config.accumulation_steps != 0
-                    with model.no_sync():
-                        preds = model(images)
-                        loss_value = criterion(preds, targets)
-        else:
-            if iter_index % config.accumulation_steps == 0:
+        # not reduce gradient while iter_index % config.accumulation_steps != 0
+        with train_step.sync_context(iter_index):
+            with autocast(enabled=config.use_amp):
                 preds = model(images)
                 loss_value = criterion(preds, targets)
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    preds = model(images)
-                    loss_value = criterion(preds, targets)
-
-        loss = sum(loss_value.values())
-
-        inf_nan_flag = False
-        for key, value in loss_value.items():
-            if torch.any(torch.isinf(value)) or torch.any(torch.isnan(value)):
-                inf_nan_flag = True
-
-        if torch.any(torch.isinf(loss)) or torch.any(torch.isnan(loss)):
-            inf_nan_flag = True
-
-        if loss == 0. or inf_nan_flag:
-            print(f'GPU id:{local_rank},zero loss or nan loss or inf loss!')
-            skip_batch_flag = True
 
-        loss = loss / config.accumulation_steps
-        for key, value in loss_value.items():
-            loss_value[key] = value / config.accumulation_steps
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                config.scaler.scale(loss).backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    config.scaler.scale(loss).backward()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                loss.backward()
-            else:
-                # not reduce gradient while iter_index % config.accumulation_steps != 0
-                with model.no_sync():
-                    loss.backward()
-
-        if hasattr(config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad:
-            grad_inf_nan_flag = False
-            for _, param in model.named_parameters():
-                per_weight_grad = param.grad
-                if per_weight_grad is not None:
-                    if torch.any(torch.isnan(per_weight_grad)) or torch.any(
-                            torch.isnan(per_weight_grad)):
-                        grad_inf_nan_flag = True
-            if grad_inf_nan_flag:
-                print(f'GPU id:{local_rank},nan grad or inf grad!')
-                skip_batch_flag = True
-
-        [skip_batch_flag] = all_reduce_operation_in_group_for_variables(
-            variables=[skip_batch_flag],
-            operator=torch.distributed.ReduceOp.SUM,
-            group=config.group)
-
-        if skip_batch_flag:
-            log_info = f'skip this batch!'
-            logger.info(log_info) if local_rank == 0 else None
-            optimizer.zero_grad()
-            continue
-
-        torch.distributed.barrier()
-
-        if config.use_amp:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-                    config.scaler.unscale_(optimizer)
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
-
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
-
-                config.scaler.step(optimizer)
-                config.scaler.update()
-                optimizer.zero_grad()
-        else:
-            if iter_index % config.accumulation_steps == 0:
-                if (hasattr(config, 'clip_grad_value')
-                        and config.clip_grad_value
-                        > 0) or (hasattr(config, 'clip_max_norm')
-                                 and config.clip_max_norm > 0):
-
-                    if hasattr(config, 'clip_grad_value'):
-                        torch.nn.utils.clip_grad_value_(
-                            model.parameters(), config.clip_grad_value)
+            loss = sum(loss_value.values())
 
-                    if hasattr(config, 'clip_max_norm'):
-                        torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                                       config.clip_max_norm)
+            train_step.check_loss(loss, loss_value)
+            train_step.backward(loss)
 
-                optimizer.step()
-                optimizer.zero_grad()
+        if train_step.is_optimizer_step(iter_index):
+            train_step.step()
 
-        if config.use_ema_model:
-            if iter_index % config.accumulation_steps == 0:
+            if config.use_ema_model and train_step.optimizer_stepped():
                 config.ema_model.update(model)
 
-        if iter_index % config.accumulation_steps == 0:
-            for key, value in loss_value.items():
-                [value] = all_reduce_operation_in_group_for_variables(
-                    variables=[value],
-                    operator=torch.distributed.ReduceOp.SUM,
-                    group=config.group)
-                loss_value[key] = value / float(config.gpus_num)
+            train_step.update_loss(loss,
+                                   loss_value,
+                                   sample_num=images.size(0))
 
-            [loss] = all_reduce_operation_in_group_for_variables(
-                variables=[loss],
-                operator=torch.distributed.ReduceOp.SUM,
-                group=config.group)
-            loss = loss / float(config.gpus_num)
-            losses.update(loss, images.size(0))
-
-        if iter_index % config.accumulation_steps == 0:
             scheduler.step(optimizer, iter_index / iters + (epoch - 1))
 
+            train_step.save_iter_checkpoint(epoch, iter_index)
+
         accumulation_iter_index, accumulation_iters = int(
             iter_index // config.accumulation_steps), int(
                 iters // config.accumulation_steps)
         if iter_index % int(
                 config.print_interval * config.accumulation_steps) == 0:
-            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, total_loss: {loss*config.accumulation_steps:.4f}, '
+            loss, loss_value, skip_batch_num = train_step.get_print_loss()
+            log_info = f'train: epoch {epoch:0>4d}, iter [{accumulation_iter_index:0>5d}, {accumulation_iters:0>5d}], lr: {scheduler.current_lr:.6f}, total_loss: {loss:.4f}, '
             for key, value in loss_value.items():
-                log_info += f'{key}: {value*config.accumulation_steps:.4f}, '
+                log_info += f'{key}: {value:.4f}, '
             logger.info(log_info) if local_rank == 0 else None
+            if skip_batch_num > 0:
+                log_info = f'skip {skip_batch_num} batches!'
+                logger.info(log_info) if local_rank == 0 else None
 
         iter_index += 1
 
-    avg_loss = losses.avg
-    avg_loss = avg_loss * config.accumulation_steps
+    avg_loss = train_step.get_avg_loss()
 
     return avg_loss
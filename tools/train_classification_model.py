@@ -17,6 +17,7 @@ from torch.utils.data import DataLoader
 from tools.scripts import train_classification, test_classification
 from tools.utils import (get_logger, set_seed, worker_seed_init_fn,
                          build_optimizer, Scheduler, build_training_mode)
+from tools.checkpoint import ResumableDistributedSampler, AsyncCheckpointer
 
 
 def parse_args():
@@ -71,7 +72,10 @@ def main():
                                 num_workers=num_workers,
                                 local_rank=local_rank,
                                 seed=config.seed)
-    train_sampler = torch.utils.data.distributed.DistributedSampler(
+    # IterableDataset(e.g. PackedShardsIterableDataset) splits samples for each rank by itself
+    use_iterable_train_dataset = isinstance(config.train_dataset,
+                                            torch.utils.data.IterableDataset)
+    train_sampler = None if use_iterable_train_dataset else ResumableDistributedSampler(
         config.train_dataset, shuffle=True)
     train_loader = DataLoader(config.train_dataset,
                               batch_size=batch_size,
@@ -135,11 +139,14 @@ def main():
 
     scheduler = Scheduler(config, optimizer)
     model, config.ema_model, config.scaler = build_training_mode(config, model)
+    config.checkpointer = AsyncCheckpointer(config, checkpoint_dir, model,
+                                            optimizer, scheduler, train_loader)
 
     start_epoch, train_time = 1, 0
     best_acc1, acc1, test_loss = 0, 0, 0
-    if os.path.exists(resume_model):
-        checkpoint = torch.load(resume_model, map_location=torch.device('cpu'))
+    # newest of epoch checkpoint and iter checkpoints
+    checkpoint = config.checkpointer.load_checkpoint(resume_model)
+    if checkpoint is not None:
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
@@ -156,7 +163,7 @@ def main():
         logger.info(log_info) if local_rank == 0 else None
 
         if 'ema_model_state_dict' in checkpoint.keys():
-            config.ema_model.ema_model.load_state_dict(
+            config.ema_model.load_ema_state_dict(
                 checkpoint['ema_model_state_dict'])
 
     # use torch 2.0 compile function
@@ -180,6 +187,13 @@ def main():
         # _orig_mod
         model = torch.compile(model, **config.compile_params)
 
+    # non state dict values saved in iter checkpoints
+    config.checkpointer.update_extra_state({
+        'time': train_time,
+        'best_acc1': best_acc1,
+        'test_loss': test_loss,
+    })
+
     for epoch in range(start_epoch, config.epochs + 1):
         per_epoch_start_time = time.time()
 
@@ -188,7 +202,10 @@ def main():
 
         torch.cuda.empty_cache()
 
-        train_sampler.set_epoch(epoch)
+        if use_iterable_train_dataset:
+            config.train_dataset.set_epoch(epoch)
+        else:
+            train_sampler.set_epoch(epoch)
         train_loss = train_classification(train_loader, model, train_criterion,
                                           optimizer, scheduler, epoch, logger,
                                           config)
@@ -211,15 +228,14 @@ def main():
             if acc1 > best_acc1 and acc1 <= 100:
                 best_acc1 = acc1
                 if config.use_ema_model:
-                    save_best_model = config.ema_model.ema_model.module.state_dict(
-                    )
+                    save_best_model = config.ema_model.ema_model.state_dict()
                 elif config.use_compile:
                     save_best_model = model._orig_mod.module.state_dict()
                 else:
                     save_best_model = model.module.state_dict()
 
-                torch.save(save_best_model,
-                           os.path.join(checkpoint_dir, 'best.pth'))
+                config.checkpointer.save_checkpoint(
+                    save_best_model, os.path.join(checkpoint_dir, 'best.pth'))
 
             if config.use_compile:
                 save_checkpoint_model = model._orig_mod.state_dict()
@@ -227,7 +243,7 @@ def main():
                 save_checkpoint_model = model.state_dict()
 
             if config.use_ema_model:
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     {
                         'epoch':
                         epoch,
@@ -249,7 +265,7 @@ def main():
                         scheduler.state_dict(),
                     }, os.path.join(checkpoint_dir, 'latest.pth'))
             else:
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     {
                         'epoch': epoch,
                         'time': train_time,
@@ -264,6 +280,8 @@ def main():
         log_info = f'until epoch: {epoch:0>3d}, best_acc1: {best_acc1:.3f}%'
         logger.info(log_info) if local_rank == 0 else None
 
+    config.checkpointer.close()
+
     if local_rank == 0:
         if os.path.exists(os.path.join(checkpoint_dir, 'best.pth')):
             os.rename(
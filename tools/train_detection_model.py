@@ -14,9 +14,11 @@ import time
 import torch
 from torch.utils.data import DataLoader
 
+from simpleAICV.detection.common import AspectRatioGroupedDistributedBatchSampler
 from tools.scripts import train_detection, test_detection
 from tools.utils import (get_logger, set_seed, worker_seed_init_fn,
                          build_optimizer, Scheduler, build_training_mode)
+from tools.checkpoint import ResumableDistributedSampler, AsyncCheckpointer
 
 
 def parse_args():
@@ -70,24 +72,48 @@ def main():
                                 num_workers=num_workers,
                                 local_rank=local_rank,
                                 seed=config.seed)
-    train_sampler = torch.utils.data.distributed.DistributedSampler(
-        config.train_dataset, shuffle=True)
-    train_loader = DataLoader(config.train_dataset,
-                              batch_size=batch_size,
-                              shuffle=False,
-                              pin_memory=True,
-                              drop_last=True,
-                              num_workers=num_workers,
-                              collate_fn=config.train_collater,
-                              sampler=train_sampler,
-                              worker_init_fn=init_fn)
-
+    if hasattr(config, 'use_aspect_ratio_group_sampler'
+               ) and config.use_aspect_ratio_group_sampler:
+        # every batch only contains images from one aspect ratio bucket
+        train_sampler = AspectRatioGroupedDistributedBatchSampler(
+            config.train_dataset,
+            batch_size=batch_size,
+            aspect_ratio_boundaries=config.aspect_ratio_boundaries
+            if hasattr(config, 'aspect_ratio_boundaries') else
+            [0.5, 0.75, 1.0, 1.333, 2.0],
+            shuffle=True,
+            drop_last=True,
+            seed=config.seed)
+        train_loader = DataLoader(config.train_dataset,
+                                  batch_sampler=train_sampler,
+                                  pin_memory=True,
+                                  num_workers=num_workers,
+                                  collate_fn=config.train_collater,
+                                  worker_init_fn=init_fn)
+    else:
+        train_sampler = ResumableDistributedSampler(config.train_dataset,
+                                                    shuffle=True)
+        train_loader = DataLoader(config.train_dataset,
+                                  batch_size=batch_size,
+                                  shuffle=False,
+                                  pin_memory=True,
+                                  drop_last=True,
+                                  num_workers=num_workers,
+                                  collate_fn=config.train_collater,
+                                  sampler=train_sampler,
+                                  worker_init_fn=init_fn)
+
+    # coco evaluation gathers results from all ranks,each rank tests a shard of test dataset
+    test_sampler = torch.utils.data.distributed.DistributedSampler(
+        config.test_dataset,
+        shuffle=False) if config.eval_type == 'COCO' else None
     test_loader = DataLoader(config.test_dataset,
                              batch_size=batch_size,
                              shuffle=False,
                              pin_memory=True,
                              num_workers=num_workers,
-                             collate_fn=config.test_collater)
+                             collate_fn=config.test_collater,
+                             sampler=test_sampler)
 
     for key, value in config.__dict__.items():
         if not key.startswith('__'):
@@ -132,11 +158,14 @@ def main():
 
     scheduler = Scheduler(config, optimizer)
     model, config.ema_model, config.scaler = build_training_mode(config, model)
+    config.checkpointer = AsyncCheckpointer(config, checkpoint_dir, model,
+                                            optimizer, scheduler, train_loader)
 
     start_epoch, train_time = 1, 0
     best_metric, metric, test_loss = 0, 0, 0
-    if os.path.exists(resume_model):
-        checkpoint = torch.load(resume_model, map_location=torch.device('cpu'))
+    # newest of epoch checkpoint and iter checkpoints
+    checkpoint = config.checkpointer.load_checkpoint(resume_model)
+    if checkpoint is not None:
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
@@ -153,7 +182,7 @@ def main():
         logger.info(log_info) if local_rank == 0 else None
 
         if 'ema_model_state_dict' in checkpoint.keys():
-            config.ema_model.ema_model.load_state_dict(
+            config.ema_model.load_ema_state_dict(
                 checkpoint['ema_model_state_dict'])
 
     # use torch 2.0 compile function
@@ -177,6 +206,13 @@ def main():
         # _orig_mod
         model = torch.compile(model, **config.compile_params)
 
+    # non state dict values saved in iter checkpoints
+    config.checkpointer.update_extra_state({
+        'time': train_time,
+        'best_metric': best_metric,
+        'test_loss': test_loss,
+    })
+
     for epoch in range(start_epoch, config.epochs + 1):
         per_epoch_start_time = time.time()
 
@@ -217,15 +253,14 @@ def main():
             if metric > best_metric and metric <= 100:
                 best_metric = metric
                 if config.use_ema_model:
-                    save_best_model = config.ema_model.ema_model.module.state_dict(
-                    )
+                    save_best_model = config.ema_model.ema_model.state_dict()
                 elif config.use_compile:
                     save_best_model = model._orig_mod.module.state_dict()
                 else:
                     save_best_model = model.module.state_dict()
 
-                torch.save(save_best_model,
-                           os.path.join(checkpoint_dir, 'best.pth'))
+                config.checkpointer.save_checkpoint(
+                    save_best_model, os.path.join(checkpoint_dir, 'best.pth'))
 
             if config.use_compile:
                 save_checkpoint_model = model._orig_mod.state_dict()
@@ -233,7 +268,7 @@ def main():
                 save_checkpoint_model = model.state_dict()
 
             if config.use_ema_model:
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     {
                         'epoch':
                         epoch,
@@ -255,7 +290,7 @@ def main():
                         scheduler.state_dict(),
                     }, os.path.join(checkpoint_dir, 'latest.pth'))
             else:
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     {
                         'epoch': epoch,
                         'time': train_time,
@@ -270,6 +305,8 @@ def main():
         log_info = f'until epoch: {epoch:0>3d}, best_metric: {best_metric:.3f}%'
         logger.info(log_info) if local_rank == 0 else None
 
+    config.checkpointer.close()
+
     if local_rank == 0:
         if os.path.exists(os.path.join(checkpoint_dir, 'best.pth')):
             os.rename(
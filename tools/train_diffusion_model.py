@@ -17,6 +17,7 @@ from torch.utils.data import DataLoader
 from tools.diffusion_scripts import train_diffusion_model
 from tools.utils import (get_logger, set_seed, worker_seed_init_fn,
                          build_optimizer, Scheduler, build_training_mode)
+from tools.checkpoint import ResumableDistributedSampler, AsyncCheckpointer
 
 
 def parse_args():
@@ -71,8 +72,8 @@ def main():
                                 num_workers=num_workers,
                                 local_rank=local_rank,
                                 seed=config.seed)
-    train_sampler = torch.utils.data.distributed.DistributedSampler(
-        config.train_dataset, shuffle=True)
+    train_sampler = ResumableDistributedSampler(config.train_dataset,
+                                                shuffle=True)
     train_loader = DataLoader(config.train_dataset,
                               batch_size=batch_size,
                               shuffle=False,
@@ -125,11 +126,14 @@ def main():
 
     scheduler = Scheduler(config, optimizer)
     model, config.ema_model, config.scaler = build_training_mode(config, model)
+    config.checkpointer = AsyncCheckpointer(config, checkpoint_dir, model,
+                                            optimizer, scheduler, train_loader)
 
     start_epoch, train_time = 1, 0
     best_loss, train_loss = 1e9, 0
-    if os.path.exists(resume_model):
-        checkpoint = torch.load(resume_model, map_location=torch.device('cpu'))
+    # newest of epoch checkpoint and iter checkpoints
+    checkpoint = config.checkpointer.load_checkpoint(resume_model)
+    if checkpoint is not None:
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
@@ -146,7 +150,7 @@ def main():
         logger.info(log_info) if local_rank == 0 else None
 
         if 'ema_model_state_dict' in checkpoint.keys():
-            config.ema_model.ema_model.load_state_dict(
+            config.ema_model.load_ema_state_dict(
                 checkpoint['ema_model_state_dict'])
 
     # use torch 2.0 compile function
@@ -170,6 +174,13 @@ def main():
         # _orig_mod
         model = torch.compile(model, **config.compile_params)
 
+    # non state dict values saved in iter checkpoints
+    config.checkpointer.update_extra_state({
+        'time': train_time,
+        'best_loss': best_loss,
+        'train_loss': train_loss,
+    })
+
     for epoch in range(start_epoch, config.epochs + 1):
         per_epoch_start_time = time.time()
 
@@ -194,15 +205,14 @@ def main():
             if train_loss < best_loss:
                 best_loss = train_loss
                 if config.use_ema_model:
-                    save_best_model = config.ema_model.ema_model.module.state_dict(
-                    )
+                    save_best_model = config.ema_model.ema_model.state_dict()
                 elif config.use_compile:
                     save_best_model = model._orig_mod.module.state_dict()
                 else:
                     save_best_model = model.module.state_dict()
 
-                torch.save(save_best_model,
-                           os.path.join(checkpoint_dir, 'best.pth'))
+                config.checkpointer.save_checkpoint(
+                    save_best_model, os.path.join(checkpoint_dir, 'best.pth'))
 
             if config.use_compile:
                 save_checkpoint_model = model._orig_mod.state_dict()
@@ -210,7 +220,7 @@ def main():
                 save_checkpoint_model = model.state_dict()
 
             if config.use_ema_model:
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     {
                         'epoch':
                         epoch,
@@ -232,7 +242,7 @@ def main():
                         scheduler.state_dict(),
                     }, os.path.join(checkpoint_dir, 'latest.pth'))
             else:
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     {
                         'epoch': epoch,
                         'time': train_time,
@@ -247,6 +257,8 @@ def main():
         log_info = f'until epoch: {epoch:0>3d}, best_loss: {best_loss:.4f}'
         logger.info(log_info) if local_rank == 0 else None
 
+    config.checkpointer.close()
+
     if local_rank == 0:
         if os.path.exists(os.path.join(checkpoint_dir, 'best.pth')):
             os.rename(os.path.join(checkpoint_dir, 'best.pth'),
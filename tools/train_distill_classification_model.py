@@ -17,6 +17,7 @@ from torch.utils.data import DataLoader
 from tools.scripts import train_distill_classification, test_distill_classification
 from tools.utils import (get_logger, set_seed, worker_seed_init_fn,
                          build_optimizer, Scheduler, build_training_mode)
+from tools.checkpoint import ResumableDistributedSampler, AsyncCheckpointer
 
 
 def parse_args():
@@ -71,8 +72,8 @@ def main():
                                 num_workers=num_workers,
                                 local_rank=local_rank,
                                 seed=config.seed)
-    train_sampler = torch.utils.data.distributed.DistributedSampler(
-        config.train_dataset, shuffle=True)
+    train_sampler = ResumableDistributedSampler(config.train_dataset,
+                                                shuffle=True)
     train_loader = DataLoader(config.train_dataset,
                               batch_size=batch_size,
                               shuffle=False,
@@ -139,12 +140,15 @@ def main():
 
     scheduler = Scheduler(config, optimizer)
     model, config.ema_model, config.scaler = build_training_mode(config, model)
+    config.checkpointer = AsyncCheckpointer(config, checkpoint_dir, model,
+                                            optimizer, scheduler, train_loader)
 
     start_epoch, train_time = 1, 0
     tea_best_acc1, tea_acc1, tea_test_loss = 0, 0, 0
     stu_best_acc1, stu_acc1, stu_test_loss = 0, 0, 0
-    if os.path.exists(resume_model):
-        checkpoint = torch.load(resume_model, map_location=torch.device('cpu'))
+    # newest of epoch checkpoint and iter checkpoints
+    checkpoint = config.checkpointer.load_checkpoint(resume_model)
+    if checkpoint is not None:
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
@@ -182,6 +186,15 @@ def main():
         # _orig_mod
         model = torch.compile(model, **config.compile_params)
 
+    # non state dict values saved in iter checkpoints
+    config.checkpointer.update_extra_state({
+        'time': train_time,
+        'tea_best_acc1': tea_best_acc1,
+        'tea_test_loss': tea_test_loss,
+        'stu_best_acc1': stu_best_acc1,
+        'stu_test_loss': stu_test_loss,
+    })
+
     for epoch in range(start_epoch, config.epochs + 1):
         per_epoch_start_time = time.time()
 
@@ -219,8 +232,9 @@ def main():
                 else:
                     save_best_teacher_model = model.module.teacher.state_dict()
 
-                torch.save(save_best_teacher_model,
-                           os.path.join(checkpoint_dir, 'best_teacher.pth'))
+                config.checkpointer.save_checkpoint(
+                    save_best_teacher_model,
+                    os.path.join(checkpoint_dir, 'best_teacher.pth'))
 
             if stu_acc1 > stu_best_acc1 and stu_acc1 <= 100:
                 stu_best_acc1 = stu_acc1
@@ -230,15 +244,16 @@ def main():
                 else:
                     save_best_student_model = model.module.student.state_dict()
 
-                torch.save(save_best_student_model,
-                           os.path.join(checkpoint_dir, 'best_student.pth'))
+                config.checkpointer.save_checkpoint(
+                    save_best_student_model,
+                    os.path.join(checkpoint_dir, 'best_student.pth'))
 
             if config.use_compile:
                 save_checkpoint_model = model._orig_mod.state_dict()
             else:
                 save_checkpoint_model = model.state_dict()
 
-            torch.save(
+            config.checkpointer.save_checkpoint(
                 {
                     'epoch': epoch,
                     'time': train_time,
@@ -255,6 +270,8 @@ def main():
         log_info = f'until epoch: {epoch:0>3d}, tea_best_acc1: {tea_best_acc1:.3f}%, stu_best_acc1: {stu_best_acc1:.3f}%'
         logger.info(log_info) if local_rank == 0 else None
 
+    config.checkpointer.close()
+
     if local_rank == 0:
         if os.path.exists(os.path.join(checkpoint_dir, 'best_teacher.pth')):
             os.rename(
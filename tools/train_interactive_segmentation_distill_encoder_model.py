@@ -19,6 +19,7 @@ from torch.cuda.amp import GradScaler
 from tools.interactive_segmentation_scripts import train_distill_sam_encoder
 from tools.utils import (get_logger, set_seed, worker_seed_init_fn,
                          build_optimizer, Scheduler, EmaModel)
+from tools.checkpoint import ResumableDistributedSampler, AsyncCheckpointer
 
 
 def build_training_mode(config, model):
@@ -91,8 +92,8 @@ def main():
                                 num_workers=num_workers,
                                 local_rank=local_rank,
                                 seed=config.seed)
-    train_sampler = torch.utils.data.distributed.DistributedSampler(
-        config.train_dataset, shuffle=True)
+    train_sampler = ResumableDistributedSampler(config.train_dataset,
+                                                shuffle=True)
     train_loader = DataLoader(config.train_dataset,
                               batch_size=batch_size,
                               shuffle=False,
@@ -144,11 +145,14 @@ def main():
 
     scheduler = Scheduler(config, optimizer)
     model, _, config.scaler = build_training_mode(config, model)
+    config.checkpointer = AsyncCheckpointer(config, checkpoint_dir, model,
+                                            optimizer, scheduler, train_loader)
 
     start_epoch, train_time = 1, 0
     best_loss, train_loss = 1e9, 0
-    if os.path.exists(resume_model):
-        checkpoint = torch.load(resume_model, map_location=torch.device('cpu'))
+    # newest of epoch checkpoint and iter checkpoints
+    checkpoint = config.checkpointer.load_checkpoint(resume_model)
+    if checkpoint is not None:
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
@@ -185,6 +189,13 @@ def main():
         # _orig_mod
         model = torch.compile(model, **config.compile_params)
 
+    # non state dict values saved in iter checkpoints
+    config.checkpointer.update_extra_state({
+        'time': train_time,
+        'best_loss': best_loss,
+        'train_loss': train_loss,
+    })
+
     for epoch in range(start_epoch, config.epochs + 1):
         per_epoch_start_time = time.time()
 
@@ -212,7 +223,7 @@ def main():
                     )
                 else:
                     save_student_model = model.module.student.state_dict()
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     save_student_model,
                     os.path.join(checkpoint_dir,
                                  f'student_model_epoch_{epoch}.pth'))
@@ -227,15 +238,16 @@ def main():
                 else:
                     save_best_student_model = model.module.student.state_dict()
 
-                torch.save(save_best_student_model,
-                           os.path.join(checkpoint_dir, 'best_student.pth'))
+                config.checkpointer.save_checkpoint(
+                    save_best_student_model,
+                    os.path.join(checkpoint_dir, 'best_student.pth'))
 
             if config.use_compile:
                 save_checkpoint_model = model._orig_mod.state_dict()
             else:
                 save_checkpoint_model = model.state_dict()
 
-            torch.save(
+            config.checkpointer.save_checkpoint(
                 {
                     'epoch': epoch,
                     'time': train_time,
@@ -250,6 +262,8 @@ def main():
         log_info = f'until epoch: {epoch:0>3d}, best_loss: {best_loss:.4f}'
         logger.info(log_info) if local_rank == 0 else None
 
+    config.checkpointer.close()
+
     if local_rank == 0:
         if os.path.exists(os.path.join(checkpoint_dir, 'best_student.pth')):
             os.rename(
@@ -0,0 +1,529 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import collections
+from contextlib import nullcontext
+
+import torch
+import torch.nn as nn
+
+
+def get_grouped_grads(parameters):
+    '''
+    group grads by device and dtype for foreach kernels
+    '''
+    grouped_grads = collections.OrderedDict()
+    for param in parameters:
+        if param.grad is None:
+            continue
+        key = (param.grad.device, param.grad.dtype)
+        if key not in grouped_grads.keys():
+            grouped_grads[key] = []
+        grouped_grads[key].append(param.grad)
+
+    return grouped_grads
+
+
+def compute_grouped_grads_total_norm(grouped_grads, device):
+    per_group_norms = []
+    for _, grads in grouped_grads.items():
+        per_grad_norms = torch._foreach_norm(grads, 2.)
+        per_group_norms.append(
+            torch.linalg.vector_norm(torch.stack(per_grad_norms).float(),
+                                     2.).to(device))
+    total_norm = torch.linalg.vector_norm(torch.stack(per_group_norms), 2.)
+
+    return total_norm
+
+
+def clip_grads_and_check_health_(parameters,
+                                 clip_grad_value=0,
+                                 clip_max_norm=0,
+                                 check_finite=True):
+    '''
+    fused multi tensor grad health check and grad clipping,replace per parameter isnan/isinf loop,
+    clip_grad_value_ and clip_grad_norm_ passes with a few foreach kernels per device/dtype group.
+    inf/nan grads come from global grad norm,any inf/nan grad make global norm inf/nan.
+    amp grads must be unscaled before,GradScaler.unscale_ already check inf/nan grads,use check_finite=False.
+    clip_grad_value:>0:clamp grads to [-clip_grad_value,clip_grad_value] first
+    clip_max_norm:>0:then scale grads to global norm <= clip_max_norm
+    return:
+    total_norm:global grad norm before clip_max_norm scaling,None if not computed
+    non_finite_flag:float tensor,1. if any inf/nan grad,None if check_finite=False
+    '''
+    grouped_grads = get_grouped_grads(parameters)
+    if len(grouped_grads) == 0:
+        return None, None
+
+    device = list(grouped_grads.keys())[0][0]
+
+    total_norm, non_finite_flag = None, None
+    if check_finite:
+        # norm of grads before value clip,clamp hide inf grads
+        total_norm = compute_grouped_grads_total_norm(grouped_grads, device)
+        non_finite_flag = torch.logical_not(
+            torch.isfinite(total_norm)).float()
+
+    if clip_grad_value > 0:
+        for _, grads in grouped_grads.items():
+            torch._foreach_clamp_min_(grads, -clip_grad_value)
+            torch._foreach_clamp_max_(grads, clip_grad_value)
+
+    if clip_max_norm > 0:
+        if total_norm is None or clip_grad_value > 0:
+            total_norm = compute_grouped_grads_total_norm(
+                grouped_grads, device)
+
+        clip_coef = clip_max_norm / (total_norm + 1e-6)
+        clip_coef = torch.clamp(clip_coef, max=1.0)
+        for (grad_device, _), grads in grouped_grads.items():
+            torch._foreach_mul_(grads, clip_coef.to(grad_device))
+
+    return total_norm, non_finite_flag
+
+
+class TrainStepEngine:
+    '''
+    shared train step for train loops in tools/*_scripts.py
+    all batch health checks(inf/nan inputs,zero/inf/nan loss,inf/nan grads) are kept as device tensors,
+    skip flag is all reduced as a device tensor and folded into GradScaler found inf,
+    so a bad batch skips optimizer step without per iter host sync,python bool all reduce and barrier.
+    grad inf/nan check and grad clipping use fused foreach kernels,see clip_grads_and_check_health_.
+    non amp training check inf/nan grads from global grad norm when skip_inf_nan_grad or clip_max_norm is set,
+    and only read skip flag once per optimizer step.
+    skipped step:train loops only update ema model when optimizer_stepped() is True,
+    scheduler still steps with iter_index,lr is a function of iter_index / iters,so lr schedule follows data position
+    (old train loops reused iter_index of a skipped batch).
+    model:ddp model
+    accumulation_steps:None:use config.accumulation_steps(1 if config has no accumulation_steps)
+    use_amp:None:use config.use_amp,False for train loops without amp path
+    '''
+
+    def __init__(self,
+                 model,
+                 optimizer,
+                 config,
+                 accumulation_steps=None,
+                 use_amp=None):
+        self.model = model
+        self.optimizer = optimizer
+
+        if accumulation_steps is None:
+            accumulation_steps = config.accumulation_steps if hasattr(
+                config, 'accumulation_steps') else 1
+        assert accumulation_steps >= 1, 'illegal accumulation_steps!'
+        self.accumulation_steps = accumulation_steps
+
+        if use_amp is None:
+            use_amp = hasattr(config, 'use_amp') and config.use_amp
+        self.use_amp = use_amp
+
+        self.scaler = config.scaler if self.use_amp else None
+
+        self.clip_grad_value = config.clip_grad_value if hasattr(
+            config, 'clip_grad_value') else 0
+        self.clip_max_norm = config.clip_max_norm if hasattr(
+            config, 'clip_max_norm') else 0
+        self.skip_inf_nan_grad = hasattr(
+            config, 'skip_inf_nan_grad') and config.skip_inf_nan_grad
+
+        self.group = config.group
+        self.gpus_num = config.gpus_num
+
+        # tools/checkpoint.py AsyncCheckpointer,for iter checkpoint and mid epoch resume
+        self.checkpointer = config.checkpointer if hasattr(
+            config, 'checkpointer') else None
+        # first iter_index of train loop,>1 after mid epoch resume
+        self.start_iter_index = self.checkpointer.pop_start_iter_index(
+        ) if self.checkpointer is not None else 1
+
+        self.device = next(model.parameters()).device
+        # local skip flag of current optimizer step
+        self.skip_flag = torch.zeros((),
+                                     dtype=torch.float32,
+                                     device=self.device)
+        # local inf/nan inputs flag,kept until step(clear_input_flag=True),
+        # for loops with multi optimizer steps per batch
+        self.input_skip_flag = torch.zeros((),
+                                           dtype=torch.float32,
+                                           device=self.device)
+        # all reduced skip flag of last optimizer step
+        self.reduced_skip_flag = torch.zeros((),
+                                             dtype=torch.float32,
+                                             device=self.device)
+        # host bool of last step,None until read
+        self.stepped = None
+        self.skip_batch_num = torch.zeros((),
+                                          dtype=torch.float32,
+                                          device=self.device)
+        self.printed_skip_batch_num = 0
+
+        self.loss_sum = torch.zeros((), dtype=torch.float32, device=self.device)
+        self.sample_num = torch.zeros((),
+                                      dtype=torch.float32,
+                                      device=self.device)
+        self.last_loss = None
+        self.last_loss_value = {}
+        # global grad norm of last optimizer step,None if not computed
+        self.grad_norm = None
+
+    def save_iter_checkpoint(self, epoch, iter_index):
+        '''
+        call after optimizer step,ema update and scheduler step
+        '''
+        if self.checkpointer is not None:
+            self.checkpointer.save_iter_checkpoint(
+                epoch,
+                iter_index,
+                accumulation_steps=self.accumulation_steps)
+
+    def is_optimizer_step(self, iter_index):
+        return iter_index % self.accumulation_steps == 0
+
+    def sync_context(self, iter_index):
+        # not reduce gradient while iter_index % accumulation_steps != 0
+        if self.is_optimizer_step(iter_index):
+            return nullcontext()
+
+        return self.model.no_sync()
+
+    def check_inputs(self, inputs):
+        '''
+        inputs:list of tensors,only check floating point tensors
+        '''
+        for per_input in inputs:
+            if torch.is_tensor(per_input) and torch.is_floating_point(
+                    per_input):
+                inf_nan_flag = torch.logical_not(
+                    torch.isfinite(per_input).all())
+                self.input_skip_flag += inf_nan_flag.to(self.device,
+                                                        dtype=torch.float32)
+
+    def check_loss(self, loss, loss_value=None):
+        '''
+        skip batch if loss is zero or any loss is inf/nan
+        '''
+        loss = loss.detach()
+        self.skip_flag += (loss == 0.).all().float()
+        self.skip_flag += torch.logical_not(torch.isfinite(loss).all()).float()
+
+        if loss_value is not None:
+            for _, value in loss_value.items():
+                self.skip_flag += torch.logical_not(
+                    torch.isfinite(value.detach()).all()).float()
+
+    def backward(self, loss, retain_graph=False):
+        loss = loss / self.accumulation_steps
+        if self.use_amp:
+            self.scaler.scale(loss).backward(retain_graph=retain_graph)
+        else:
+            loss.backward(retain_graph=retain_graph)
+
+    def step(self, clear_input_flag=True):
+        '''
+        all reduce skip flag,unscale and clip grads,then optimizer step
+        optimizer step is skipped on all gpus if any gpu has inf/nan inputs,zero/inf/nan loss or inf/nan grads
+        clear_input_flag:False:keep inputs flag for next step of same batch
+        '''
+        self.stepped = None
+        # all reduce on device,no host sync
+        self.reduced_skip_flag = self.skip_flag + self.input_skip_flag
+        torch.distributed.all_reduce(self.reduced_skip_flag,
+                                     op=torch.distributed.ReduceOp.SUM,
+                                     group=self.group)
+        self.skip_flag.zero_()
+        if clear_input_flag:
+            self.input_skip_flag.zero_()
+
+        if self.use_amp:
+            # unscale_ check inf/nan grads in one fused pass
+            self.scaler.unscale_(self.optimizer)
+
+            self.grad_norm, _ = clip_grads_and_check_health_(
+                self.model.parameters(),
+                clip_grad_value=self.clip_grad_value,
+                clip_max_norm=self.clip_max_norm,
+                check_finite=False)
+
+            # fold skip flag into GradScaler found inf,scaler.step skip optimizer.step when found inf
+            optimizer_state = self.scaler._per_optimizer_states[id(
+                self.optimizer)]
+            for found_inf in optimizer_state['found_inf_per_device'].values():
+                found_inf.add_(
+                    self.reduced_skip_flag.to(found_inf.device,
+                                              non_blocking=True))
+
+            scale = self.scaler._scale.clone()
+            growth_tracker = self.scaler._growth_tracker.clone()
+
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+
+            # skipped batch not change loss scale,same as skipping batch before scaler
+            skip_mask = self.reduced_skip_flag > 0
+            self.scaler._scale.copy_(
+                torch.where(skip_mask, scale, self.scaler._scale))
+            self.scaler._growth_tracker.copy_(
+                torch.where(skip_mask, growth_tracker,
+                            self.scaler._growth_tracker))
+        else:
+            # grads are all reduced by ddp,grad flag is same on all gpus
+            self.grad_norm, grad_non_finite_flag = clip_grads_and_check_health_(
+                self.model.parameters(),
+                clip_grad_value=self.clip_grad_value,
+                clip_max_norm=self.clip_max_norm,
+                check_finite=self.skip_inf_nan_grad or self.clip_max_norm > 0)
+            if grad_non_finite_flag is not None:
+                self.reduced_skip_flag += grad_non_finite_flag
+
+            # only host read of skip flag per optimizer step
+            self.stepped = self.reduced_skip_flag.item() == 0
+            if self.stepped:
+                self.optimizer.step()
+
+        self.optimizer.zero_grad()
+
+        self.skip_batch_num += (self.reduced_skip_flag > 0).float()
+
+        return self.reduced_skip_flag
+
+    def optimizer_stepped(self):
+        '''
+        whether last step() updated weights,amp training read skip flag to host here,
+        only call when needed,e.g. ema update
+        amp inf/nan grads found by GradScaler itself are not counted,same as old train loops
+        '''
+        if self.stepped is None:
+            self.stepped = self.reduced_skip_flag.item() == 0
+
+        return self.stepped
+
+    def update_loss(self, loss, loss_value=None, sample_num=1):
+        '''
+        call after step,keep loss on device,skipped batch not count in avg loss
+        '''
+        self.last_loss = loss.detach().float()
+        self.last_loss_value = {}
+        if loss_value is not None:
+            for key, value in loss_value.items():
+                self.last_loss_value[key] = value.detach().float()
+
+        skip_mask = self.reduced_skip_flag > 0
+        self.loss_sum += torch.where(skip_mask,
+                                     torch.zeros_like(self.last_loss),
+                                     self.last_loss * sample_num)
+        self.sample_num += torch.logical_not(skip_mask).float() * sample_num
+
+    def get_print_loss(self):
+        '''
+        all reduce last loss for log,only host sync at print interval
+        return loss,loss_value dict,new skip batch num since last print
+        '''
+        print_losses = torch.stack([self.last_loss] +
+                                   list(self.last_loss_value.values()))
+        torch.distributed.all_reduce(print_losses,
+                                     op=torch.distributed.ReduceOp.SUM,
+                                     group=self.group)
+        print_losses = (print_losses / float(self.gpus_num)).tolist()
+
+        loss = print_losses[0]
+        loss_value = {}
+        for key, value in zip(self.last_loss_value.keys(), print_losses[1:]):
+            loss_value[key] = value
+
+        skip_batch_num = int(self.skip_batch_num.item())
+        new_skip_batch_num = skip_batch_num - self.printed_skip_batch_num
+        self.printed_skip_batch_num = skip_batch_num
+
+        return loss, loss_value, new_skip_batch_num
+
+    def get_avg_loss(self):
+        avg_loss = torch.stack([self.loss_sum, self.sample_num])
+        torch.distributed.all_reduce(avg_loss,
+                                     op=torch.distributed.ReduceOp.SUM,
+                                     group=self.group)
+        loss_sum, sample_num = avg_loss.tolist()
+        avg_loss = loss_sum / sample_num if sample_num > 0 else 0.
+
+        return avg_loss
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    import numpy as np
+    import torch
+    seed = 0
+    # for hash
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    # for python and numpy
+    random.seed(seed)
+    np.random.seed(seed)
+    # for cpu gpu
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+
+    import copy
+    import time
+
+    from simpleAICV.classification.backbones.resnet import resnet50
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    torch.distributed.init_process_group(backend='nccl',
+                                         init_method='env://',
+                                         world_size=1,
+                                         rank=0)
+    torch.cuda.set_device(0)
+
+    class config:
+        accumulation_steps = 1
+        use_amp = False
+        clip_max_norm = 1.
+        group = torch.distributed.new_group(list(range(1)))
+        gpus_num = 1
+
+    net = resnet50(num_classes=1000).cuda()
+    criterion = nn.CrossEntropyLoss()
+
+    def old_train_step(model, optimizer, images, labels):
+        # per step host syncs of old train loops
+        skip_batch_flag = False
+        if torch.any(torch.isinf(images)) or torch.any(torch.isnan(images)):
+            skip_batch_flag = True
+        outputs = model(images)
+        loss = criterion(outputs, labels)
+        if loss == 0. or torch.any(torch.isinf(loss)) or torch.any(
+                torch.isnan(loss)):
+            skip_batch_flag = True
+        loss.backward()
+        skip_batch_flag = torch.tensor(skip_batch_flag).cuda()
+        torch.distributed.all_reduce(skip_batch_flag, group=config.group)
+        if skip_batch_flag.item():
+            optimizer.zero_grad()
+            return loss
+        torch.distributed.barrier()
+        torch.nn.utils.clip_grad_norm_(model.parameters(),
+                                       config.clip_max_norm)
+        optimizer.step()
+        optimizer.zero_grad()
+        torch.distributed.all_reduce(loss.detach(), group=config.group)
+        loss.item()
+
+        return loss
+
+    def new_train_step(train_step, model, images, labels):
+        train_step.check_inputs([images, labels])
+        with train_step.sync_context(1):
+            outputs = model(images)
+            loss = criterion(outputs, labels)
+            train_step.check_loss(loss)
+            train_step.backward(loss)
+        train_step.step()
+        train_step.update_loss(loss, sample_num=images.size(0))
+
+        return loss
+
+    images = torch.randn(32, 3, 224, 224).cuda()
+    labels = torch.randint(0, 1000, (32, )).cuda()
+
+    # same params after one step
+    old_model = torch.nn.parallel.DistributedDataParallel(copy.deepcopy(net),
+                                                          device_ids=[0])
+    new_model = torch.nn.parallel.DistributedDataParallel(copy.deepcopy(net),
+                                                          device_ids=[0])
+    old_optimizer = torch.optim.SGD(old_model.parameters(),
+                                    lr=0.1,
+                                    momentum=0.9)
+    new_optimizer = torch.optim.SGD(new_model.parameters(),
+                                    lr=0.1,
+                                    momentum=0.9)
+    train_step = TrainStepEngine(new_model, new_optimizer, config)
+
+    old_train_step(old_model, old_optimizer, images, labels)
+    new_train_step(train_step, new_model, images, labels)
+    max_diff = 0.
+    for old_param, new_param in zip(old_model.parameters(),
+                                    new_model.parameters()):
+        max_diff = max(max_diff,
+                       float((old_param - new_param).abs().max().item()))
+    print('1111', max_diff)
+
+    # nan input batch skip optimizer step
+    new_params = [param.detach().clone() for param in new_model.parameters()]
+    nan_images = images.clone()
+    nan_images[0, 0, 0, 0] = float('nan')
+    new_train_step(train_step, new_model, nan_images, labels)
+    skip_max_diff = 0.
+    for old_param, new_param in zip(new_params, new_model.parameters()):
+        skip_max_diff = max(skip_max_diff,
+                            float((old_param - new_param).abs().max().item()))
+    loss, _, skip_batch_num = train_step.get_print_loss()
+    print('2222', skip_max_diff, skip_batch_num, train_step.get_avg_loss())
+
+    # per step time
+    for name in ['old_train_step', 'new_train_step']:
+        for i in range(25):
+            if i == 5:
+                torch.cuda.synchronize()
+                start_time = time.time()
+            if name == 'old_train_step':
+                old_train_step(old_model, old_optimizer, images, labels)
+            else:
+                new_train_step(train_step, new_model, images, labels)
+        torch.cuda.synchronize()
+        per_step_time = (time.time() - start_time) / 20
+        print(f'3333, {name}, per step time: {per_step_time * 1000:.2f}ms')
+
+    # fused grad health check and clip vs per parameter loops
+    big_net = resnet50(num_classes=1000).cuda()
+    big_net(images).sum().backward()
+    old_grads = [param.grad.detach().clone() for param in big_net.parameters()]
+
+    def old_clip_grads(parameters):
+        parameters = list(parameters)
+        inf_nan_flag = False
+        for per_weight in parameters:
+            if per_weight.grad is not None:
+                if torch.any(torch.isnan(per_weight.grad)) or torch.any(
+                        torch.isinf(per_weight.grad)):
+                    inf_nan_flag = True
+        torch.nn.utils.clip_grad_value_(parameters, 0.01)
+        torch.nn.utils.clip_grad_norm_(parameters, config.clip_max_norm)
+
+        return inf_nan_flag
+
+    for name in ['old_clip_grads', 'fused_clip_grads']:
+        for i in range(25):
+            for param, grad in zip(big_net.parameters(), old_grads):
+                param.grad.copy_(grad)
+            if i == 5:
+                torch.cuda.synchronize()
+                start_time = time.time()
+            if name == 'old_clip_grads':
+                old_clip_grads(big_net.parameters())
+            else:
+                _, non_finite_flag = clip_grads_and_check_health_(
+                    big_net.parameters(),
+                    clip_grad_value=0.01,
+                    clip_max_norm=config.clip_max_norm,
+                    check_finite=True)
+        torch.cuda.synchronize()
+        per_clip_time = (time.time() - start_time) / 20
+        if name == 'old_clip_grads':
+            old_clipped_grads = [
+                param.grad.detach().clone() for param in big_net.parameters()
+            ]
+        print(f'4444, {name}, per clip time: {per_clip_time * 1000:.2f}ms')
+
+    clip_max_diff = 0.
+    for old_grad, param in zip(old_clipped_grads, big_net.parameters()):
+        clip_max_diff = max(clip_max_diff,
+                            float((old_grad - param.grad).abs().max().item()))
+    print('4444', clip_max_diff, non_finite_flag)
+
+    torch.distributed.destroy_process_group()
@@ -14,9 +14,11 @@ import time
 import torch
 from torch.utils.data import DataLoader
 
+from simpleAICV.text_recognition.common import WidthBucketDistributedBatchSampler
 from tools.text_scripts import train_text_recognition, test_text_recognition_for_all_dataset
 from tools.utils import (get_logger, set_seed, worker_seed_init_fn,
                          build_optimizer, Scheduler, build_training_mode)
+from tools.checkpoint import ResumableDistributedSampler, AsyncCheckpointer
 
 
 def parse_args():
@@ -71,17 +73,37 @@ def main():
                                 num_workers=num_workers,
                                 local_rank=local_rank,
                                 seed=config.seed)
-    train_sampler = torch.utils.data.distributed.DistributedSampler(
-        config.train_dataset, shuffle=True)
-    train_loader = DataLoader(config.train_dataset,
-                              batch_size=batch_size,
-                              shuffle=False,
-                              pin_memory=True,
-                              drop_last=True,
-                              num_workers=num_workers,
-                              collate_fn=config.train_collater,
-                              sampler=train_sampler,
-                              worker_init_fn=init_fn)
+    if hasattr(config,
+               'use_width_bucket_sampler') and config.use_width_bucket_sampler:
+        # every batch only contains text images from one resized width bucket
+        train_sampler = WidthBucketDistributedBatchSampler(
+            config.train_dataset,
+            batch_size=batch_size,
+            resize_h=config.resize_h if hasattr(config, 'resize_h') else 32,
+            width_boundaries=config.width_boundaries if hasattr(
+                config, 'width_boundaries') else
+            [64, 128, 192, 256, 320, 384, 512, 640],
+            shuffle=True,
+            drop_last=True,
+            seed=config.seed)
+        train_loader = DataLoader(config.train_dataset,
+                                  batch_sampler=train_sampler,
+                                  pin_memory=True,
+                                  num_workers=num_workers,
+                                  collate_fn=config.train_collater,
+                                  worker_init_fn=init_fn)
+    else:
+        train_sampler = ResumableDistributedSampler(config.train_dataset,
+                                                    shuffle=True)
+        train_loader = DataLoader(config.train_dataset,
+                                  batch_size=batch_size,
+                                  shuffle=False,
+                                  pin_memory=True,
+                                  drop_last=True,
+                                  num_workers=num_workers,
+                                  collate_fn=config.train_collater,
+                                  sampler=train_sampler,
+                                  worker_init_fn=init_fn)
 
     val_loader_list = []
     for per_sub_dataset in config.val_dataset_list:
@@ -150,11 +172,14 @@ def main():
 
     scheduler = Scheduler(config, optimizer)
     model, config.ema_model, config.scaler = build_training_mode(config, model)
+    config.checkpointer = AsyncCheckpointer(config, checkpoint_dir, model,
+                                            optimizer, scheduler, train_loader)
 
     start_epoch, train_time = 1, 0
     best_metric, metric, test_loss = 0, 0, 0
-    if os.path.exists(resume_model):
-        checkpoint = torch.load(resume_model, map_location=torch.device('cpu'))
+    # newest of epoch checkpoint and iter checkpoints
+    checkpoint = config.checkpointer.load_checkpoint(resume_model)
+    if checkpoint is not None:
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
@@ -171,7 +196,7 @@ def main():
         logger.info(log_info) if local_rank == 0 else None
 
         if 'ema_model_state_dict' in checkpoint.keys():
-            config.ema_model.ema_model.load_state_dict(
+            config.ema_model.load_ema_state_dict(
                 checkpoint['ema_model_state_dict'])
 
     # use torch 2.0 compile function
@@ -195,6 +220,13 @@ def main():
         # _orig_mod
         model = torch.compile(model, **config.compile_params)
 
+    # non state dict values saved in iter checkpoints
+    config.checkpointer.update_extra_state({
+        'time': train_time,
+        'best_metric': best_metric,
+        'test_loss': test_loss,
+    })
+
     for epoch in range(start_epoch, config.epochs + 1):
         per_epoch_start_time = time.time()
 
@@ -215,13 +247,14 @@ def main():
         if epoch % config.save_interval == 0:
             if local_rank == 0:
                 if config.use_ema_model:
-                    save_model = config.ema_model.ema_model.module.state_dict()
+                    save_model = config.ema_model.ema_model.state_dict()
                 elif config.use_compile:
                     save_model = model._orig_mod.module.state_dict()
                 else:
                     save_model = model.module.state_dict()
-                torch.save(save_model,
-                           os.path.join(checkpoint_dir, f'epoch_{epoch}.pth'))
+                config.checkpointer.save_checkpoint(
+                    save_model,
+                    os.path.join(checkpoint_dir, f'epoch_{epoch}.pth'))
 
         if epoch in config.eval_epoch or epoch == config.epochs:
             result_dict = test_text_recognition_for_all_dataset(
@@ -252,15 +285,14 @@ def main():
             if metric > best_metric and metric <= 100:
                 best_metric = metric
                 if config.use_ema_model:
-                    save_best_model = config.ema_model.ema_model.module.state_dict(
-                    )
+                    save_best_model = config.ema_model.ema_model.state_dict()
                 elif config.use_compile:
                     save_best_model = model._orig_mod.module.state_dict()
                 else:
                     save_best_model = model.module.state_dict()
 
-                torch.save(save_best_model,
-                           os.path.join(checkpoint_dir, 'best.pth'))
+                config.checkpointer.save_checkpoint(
+                    save_best_model, os.path.join(checkpoint_dir, 'best.pth'))
 
             if config.use_compile:
                 save_checkpoint_model = model._orig_mod.state_dict()
@@ -268,7 +300,7 @@ def main():
                 save_checkpoint_model = model.state_dict()
 
             if config.use_ema_model:
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     {
                         'epoch':
                         epoch,
@@ -290,7 +322,7 @@ def main():
                         scheduler.state_dict(),
                     }, os.path.join(checkpoint_dir, 'latest.pth'))
             else:
-                torch.save(
+                config.checkpointer.save_checkpoint(
                     {
                         'epoch': epoch,
                         'time': train_time,
@@ -305,6 +337,8 @@ def main():
         log_info = f'until epoch: {epoch:0>3d}, best_metric: {best_metric:.3f}%'
         logger.info(log_info) if local_rank == 0 else None
 
+    config.checkpointer.close()
+
     if local_rank == 0:
         if os.path.exists(os.path.join(checkpoint_dir, 'best.pth')):
             os.rename(
@@ -7,6 +7,7 @@ sys.path.append(BASE_DIR)
 warnings.filterwarnings('ignore')
 
 import argparse
+import collections
 import logging
 import logging.handlers
 import copy
@@ -145,22 +146,132 @@ class EmaModel(nn.Module):
     RMSprop with a short 2.4-3 epoch decay period and slow LR decay rate of .96-.99 requires EMA
     smoothing of weights to match results. Pay attention to the decay constant you are using
     relative to your update count per epoch.
+
+    ema model is a plain module(not ddp wrapped),flat ema/model tensor lists are cached at first update,
+    floating point tensors are updated by foreach lerp per device/dtype group,other tensors are copied.
+    decay:per optimizer step decay
+    update_interval:update ema every update_interval optimizer steps with decay**update_interval,
+    ema weights follow same decay per optimizer step
+    ema_dtype:None:keep model dtype,torch.bfloat16/torch.float16:store floating point ema weights in low precision,
+    low precision ema should use update_interval>1,otherwise small (1-decay) updates may be lost by rounding
+    ema_device:None:keep model device,'cpu':store ema weights in host memory
     """
 
-    def __init__(self, model, decay=0.9999):
+    def __init__(self,
+                 model,
+                 decay=0.9999,
+                 update_interval=1,
+                 ema_dtype=None,
+                 ema_device=None):
         super(EmaModel, self).__init__()
+        assert update_interval >= 1, 'illegal update_interval!'
         # make a copy of the model for accumulating moving average of weights
-        self.ema_model = copy.deepcopy(model)
+        self.ema_model = copy.deepcopy(self.unwrap_model(model))
         self.ema_model.eval()
+        for param in self.ema_model.parameters():
+            param.requires_grad_(False)
+        if ema_device is not None:
+            self.ema_model = self.ema_model.to(ema_device)
+        if ema_dtype is not None:
+            self.ema_model = self.ema_model.to(ema_dtype)
+
         self.decay = decay
-        self.update_fn = lambda e, m: self.decay * e + (1. - self.decay) * m
+        self.update_interval = update_interval
+        self.ema_dtype = ema_dtype
+        self.ema_device = ema_device
+        self.step_num = 0
+
+        self.cached_model_id = None
+        self.grouped_tensors = None
+        self.other_tensors = None
+
+    def unwrap_model(self, model):
+        # torch.compile model
+        if hasattr(model, '_orig_mod'):
+            model = model._orig_mod
+        if isinstance(model, nn.parallel.DistributedDataParallel):
+            model = model.module
+
+        return model
+
+    def cache_tensors(self, model):
+        ema_state_dict = self.ema_model.state_dict()
+        model_state_dict = model.state_dict()
+        assert ema_state_dict.keys() == model_state_dict.keys(
+        ), 'wrong ema model!'
+
+        self.grouped_tensors = collections.OrderedDict()
+        self.other_tensors = [[], []]
+        for key, ema_v in ema_state_dict.items():
+            model_v = model_state_dict[key]
+            assert ema_v.shape == model_v.shape, 'wrong ema model!'
+            if torch.is_floating_point(ema_v):
+                group_key = (ema_v.device, ema_v.dtype)
+                if group_key not in self.grouped_tensors.keys():
+                    self.grouped_tensors[group_key] = [[], []]
+                self.grouped_tensors[group_key][0].append(ema_v)
+                self.grouped_tensors[group_key][1].append(model_v)
+            else:
+                self.other_tensors[0].append(ema_v)
+                self.other_tensors[1].append(model_v)
+
+        self.cached_model_id = id(model)
 
     def update(self, model):
+        self.step_num += 1
+        if self.step_num % self.update_interval != 0:
+            return
+
+        model = self.unwrap_model(model)
+        if self.cached_model_id != id(model):
+            self.cache_tensors(model)
+
+        weight = 1. - self.decay**self.update_interval
         with torch.no_grad():
-            for ema_v, model_v in zip(self.ema_model.state_dict().values(),
-                                      model.state_dict().values()):
-                assert ema_v.shape == model_v.shape, 'wrong ema model!'
-                ema_v.copy_(self.update_fn(ema_v, model_v))
+            for (ema_device, ema_dtype), (ema_tensors, model_tensors
+                                          ) in self.grouped_tensors.items():
+                if model_tensors[0].device != ema_device or model_tensors[
+                        0].dtype != ema_dtype:
+                    # cpu ema must wait for device to host copy before lerp
+                    model_tensors = [
+                        per_tensor.to(ema_device,
+                                      dtype=ema_dtype,
+                                      non_blocking=ema_device.type == 'cuda')
+                        for per_tensor in model_tensors
+                    ]
+                # ema = ema + weight * (model - ema)
+                torch._foreach_lerp_(ema_tensors, model_tensors, weight)
+
+            for ema_v, model_v in zip(self.other_tensors[0],
+                                      self.other_tensors[1]):
+                ema_v.copy_(model_v)
+
+    def get_eval_model(self, device=None):
+        '''
+        return ema model for evaluation,low precision or cpu stored ema weights are
+        converted to a temporary float32 copy on device(default:first cuda device if available)
+        '''
+        if self.ema_dtype is None and self.ema_device is None:
+            return self.ema_model
+
+        if device is None:
+            device = torch.device(
+                'cuda') if torch.cuda.is_available() else torch.device('cpu')
+        eval_model = copy.deepcopy(self.ema_model).to(device=device,
+                                                      dtype=torch.float32)
+        eval_model.eval()
+
+        return eval_model
+
+    def load_ema_state_dict(self, state_dict):
+        '''
+        load ema weights,also support old checkpoints saved from ddp wrapped ema model
+        '''
+        state_dict = {
+            (key[len('module.'):] if key.startswith('module.') else key): value
+            for key, value in state_dict.items()
+        }
+        self.ema_model.load_state_dict(state_dict)
 
 
 def build_training_mode(config, model):
@@ -170,11 +281,16 @@ def build_training_mode(config, model):
 
     local_rank = config.local_rank
     if hasattr(config, 'use_ema_model') and config.use_ema_model:
-        ema_model = EmaModel(model, decay=config.ema_model_decay)
-        ema_model.ema_model = nn.parallel.DistributedDataParallel(
-            ema_model.ema_model,
-            device_ids=[local_rank],
-            output_device=local_rank)
+        # ema model only run forward in evaluation,no ddp wrapper
+        ema_model = EmaModel(
+            model,
+            decay=config.ema_model_decay,
+            update_interval=config.ema_model_update_interval if hasattr(
+                config, 'ema_model_update_interval') else 1,
+            ema_dtype=config.ema_model_dtype if hasattr(
+                config, 'ema_model_dtype') else None,
+            ema_device=config.ema_model_device if hasattr(
+                config, 'ema_model_device') else None)
     model = nn.parallel.DistributedDataParallel(model,
                                                 device_ids=[local_rank],
                                                 output_device=local_rank)